@@ -0,0 +1,73 @@
+"""
+benchmarks/bench_backplane.py
+
+Cross-node fan-out through the backplane broker (server/backplane.py),
+with events sent one by one and in batches. One node publishes a burst
+of chat messages for "all" while several others receive them through a
+broker on a Unix socket, as separate server nodes would; the numbers
+are messages per second until every node has all of them, and how many
+frames the publishing node wrote to do it.
+
+Run from the project root:
+    python -m benchmarks.bench_backplane
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from server.backplane import BrokerServer, BrokerBackplane
+from shared.config import BACKPLANE_BATCH_MS, BACKPLANE_BATCH_MAX
+
+NODES = 4  # receiving nodes
+MESSAGES = 20_000
+MODES = ["one by one", "batched"]
+
+
+def measure(batched):
+    directory = tempfile.mkdtemp()
+    server = BrokerServer(os.path.join(directory, "broker.sock"))
+    threading.Thread(target=server.serve, daemon=True).start()
+    sender = BrokerBackplane(server.path, "sender", batch_ms=BACKPLANE_BATCH_MS, batch_max=BACKPLANE_BATCH_MAX)
+    receivers = []
+    done = threading.Barrier(NODES + 1)
+    try:
+        for i in range(NODES):
+            node = BrokerBackplane(server.path, f"node{i}")
+            received = [0]
+
+            def handle(events, received=received):
+                received[0] += len(events)
+                if received[0] == MESSAGES:
+                    done.wait()
+            node.start(handle)
+            receivers.append(node)
+        sender.start(lambda events: None)
+
+        msg = {"type": "public", "sender": "alice", "timestamp": "10:00:00", "message": "x" * 80}
+        start = time.perf_counter()
+        for seq in range(MESSAGES):
+            sender.publish("all", {"kind": "message", "msg": dict(msg, seq=seq)})
+            if not batched:
+                sender.flush()  # a frame per message, as without batching
+        done.wait(120)
+        return MESSAGES / (time.perf_counter() - start), sender.batches
+    finally:
+        for node in receivers + [sender]:
+            node.close()
+        server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    print(f"{MESSAGES} messages from one node to {NODES} others, {os.cpu_count()} CPUs\n")
+    print(f"{'mode':>11} {'messages/s':>11} {'frames sent':>12}")
+    for name in MODES:
+        rate, batches = measure(name == "batched")
+        print(f"{name:>11} {rate:>11,.0f} {batches:>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+benchmarks/bench_broadcast.py
+
+Compares the old per-recipient encryption in broadcast() with the
+encrypt-once fan-out, for growing room sizes.
+
+Run from the project root:
+    python -m benchmarks.bench_broadcast
+"""
+
+import json
+import time
+
+from server import server as chat_server
+from shared.common import build_message, send_msg
+from shared.encrypt import encrypt_message
+
+ROOM_SIZES = [1, 10, 100, 1000]
+ROUNDS = 20
+
+
+class NullSocket:
+    """Accepts writes and throws them away, so only CPU cost is measured."""
+
+    codec = "json"
+    compression = None
+    cipher = None
+
+    def sendall(self, data):
+        pass
+
+    def enqueue(self, data):
+        pass
+
+
+def broadcast_per_recipient(message_dict):
+    """The previous broadcast(): one encryption per recipient."""
+    json_data_to_send = json.dumps(message_dict)
+    for conn in chat_server.clients.values():
+        send_msg(conn, encrypt_message(json_data_to_send))
+
+
+def measure(fn, message_dict):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(message_dict)
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def main():
+    message_dict = json.loads(build_message("public", "alice", "hello " * 20))
+
+    print(f"{'users':>6} {'per-recipient':>15} {'encrypt-once':>15} {'speedup':>8}")
+    for size in ROOM_SIZES:
+        chat_server.clients.clear()
+        for i in range(size):
+            chat_server.clients[f"user{i}"] = NullSocket()
+
+        old = measure(broadcast_per_recipient, message_dict)
+        new = measure(chat_server.broadcast, message_dict)
+        print(f"{size:>6} {old * 1000:>12.3f} ms {new * 1000:>12.3f} ms {old / new:>7.1f}x")
+
+    chat_server.clients.clear()
+
+
+if __name__ == "__main__":
+    main()
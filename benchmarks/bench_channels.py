@@ -0,0 +1,59 @@
+"""
+benchmarks/bench_channels.py
+
+Cost of delivering one message to a topic channel through the
+membership index, for growing channel sizes, with 10,000 users
+connected. A full broadcast to everyone is the baseline: channel
+fan-out should scale with the channel, not with the server.
+
+Run from the project root:
+    python -m benchmarks.bench_channels
+"""
+
+import time
+
+from server import server as chat_server
+
+CONNECTED = 10_000
+CHANNEL_SIZES = [10, 100, 1000, 10_000]
+ROUNDS = 50
+
+
+class NullSocket:
+    """Accepts writes and throws them away, so only CPU cost is measured."""
+
+    codec = "json"
+    compression = None
+    cipher = None
+
+    def enqueue(self, data):
+        pass
+
+
+def measure(fn):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def main():
+    chat_server.clients.clear()
+    for i in range(CONNECTED):
+        chat_server.clients[f"user{i}"] = NullSocket()
+    message = '{"type": "channel_message", "message": "hello"}'
+
+    everyone = measure(lambda: chat_server.fan_out(message))
+    print(f"broadcast to {CONNECTED:,} users: {everyone * 1000:.3f} ms")
+    print(f"{'members':>8} {'channel':>12} {'vs broadcast':>13}")
+    for size in CHANNEL_SIZES:
+        chat_server.channel_members["#bench"] = {f"user{i}" for i in range(size)}
+        cost = measure(lambda: chat_server.fan_out_channel("#bench", message))
+        print(f"{size:>8,} {cost * 1000:>9.3f} ms {cost / everyone:>12.2f}x")
+
+    chat_server.channel_members.clear()
+    chat_server.clients.clear()
+
+
+if __name__ == "__main__":
+    main()
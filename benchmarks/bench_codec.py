@@ -0,0 +1,69 @@
+"""
+benchmarks/bench_codec.py
+
+Size and encode/decode speed of the binary wire codec against JSON for
+a short chat line, a page of history and a small file message, both as
+plaintext and as the encrypted payload that goes on the wire.
+
+Run from the project root:
+    python -m benchmarks.bench_codec
+"""
+
+import base64
+import json
+import os
+import time
+
+from shared import codec
+from shared.common import build_message, parse_payload
+from shared.encrypt import encrypt_message, encrypt_bytes
+
+ROUNDS = 2000
+
+
+def sample_messages():
+    chat = json.loads(build_message("public", "alice", "anyone up for lunch?"))
+    history = {
+        "type": "history",
+        "sender": "server",
+        "messages": [dict(json.loads(build_message("private", f"user{i % 7}", f"message number {i}",
+                                                   receiver="bob")), seq=100_000 + i)
+                     for i in range(50)],
+        "has_more": True,
+    }
+    file_json = json.loads(build_message("file", "alice", "photo.png", receiver="bob",
+                                         file_data=base64.b64encode(os.urandom(16_384)).decode()))
+    file_binary = dict(file_json, file_data=base64.b64decode(file_json["file_data"]))
+    return [("chat line", chat, chat), ("history page", history, history),
+            ("16 KiB file", file_json, file_binary)]
+
+
+def measure(fn):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    print(f"{'message':>13} {'codec':>7} {'plaintext':>10} {'encrypted':>10} "
+          f"{'encode':>10} {'decode':>10}")
+    for name, as_json, as_binary in sample_messages():
+        # The JSON client gets file data as base64 text, the binary one as raw bytes
+        text = json.dumps(as_json)
+        data = codec.encode(as_binary)
+        rows = [
+            ("json", len(text.encode("utf-8")), len(encrypt_message(text)),
+             measure(lambda: json.dumps(as_json)),
+             measure(lambda: parse_payload(text.encode("utf-8")))),
+            ("binary", len(data), len(encrypt_bytes(data)),
+             measure(lambda: codec.encode(as_binary)),
+             measure(lambda: parse_payload(data))),
+        ]
+        for codec_name, plain, sealed, encode_us, decode_us in rows:
+            print(f"{name:>13} {codec_name:>7} {plain:>8,} B {sealed:>8,} B "
+                  f"{encode_us:>7.1f} us {decode_us:>7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
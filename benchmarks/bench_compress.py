@@ -0,0 +1,109 @@
+"""
+benchmarks/bench_compress.py
+
+Bandwidth and CPU cost of payload compression. For chat traffic
+(single chat lines, presence updates, a history page) it compares the
+bytes on the wire with no compression, plain deflate and deflate with
+the preset dictionary (and zstd if `zstandard` is installed), in both
+wire codecs. For file chunks it compares throughput on text, which
+compresses, and on random data, which ChunkCompressor gives up on.
+
+Run from the project root:
+    python -m benchmarks.bench_compress
+"""
+
+import json
+import os
+import time
+import zlib
+
+from shared import codec
+from shared.common import build_message, build_chunk
+from shared.compress import compress, decompress, ChunkCompressor, COMPRESSIONS
+from shared.config import FILE_CHUNK_SIZE
+from shared.encrypt import encrypt_bytes
+
+ROUNDS = 200
+CHUNKS = 40
+
+
+def chat_traffic():
+    lines = ["lunch?", "running 5 min late, start without me", "ok", "can you send the slides",
+             "haha", "the build is green again", "who is on call this weekend?", "thanks!"]
+    messages = []
+    for i in range(400):
+        msg = json.loads(build_message(["public", "private"][i % 2], f"user{i % 13}", lines[i % 8],
+                                       receiver=f"user{i % 5}" if i % 2 else None))
+        msg.update(id=os.urandom(16).hex(), seq=100_000 + i)
+        messages.append(msg)
+        if i % 10 == 0:
+            messages.append({"type": "presence_join", "sender": "server", "user": f"user{i}",
+                             "version": 5000 + i})
+    history = {"type": "history", "sender": "server", "messages": messages[:50], "has_more": True}
+    return messages, history
+
+
+def plain_deflate(plaintext):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(plaintext) + compressor.flush()
+
+
+def wire_size(plaintext):
+    return len(encrypt_bytes(plaintext)) + 4
+
+
+def report_chat():
+    messages, history = chat_traffic()
+    methods = [("none", lambda p: p), ("deflate", plain_deflate)]
+    methods += [(f"{name}+dict", lambda p, name=name: compress(p, name)) for name in COMPRESSIONS]
+    print(f"{'traffic':>14} {'codec':>7} {'method':>12} {'wire bytes':>11} {'saving':>7} "
+          f"{'compress':>10} {'decompress':>11}")
+    for traffic, payloads in (("chat lines", messages), ("history page", [history])):
+        for codec_name in ("json", "binary"):
+            plaintexts = [codec.encode(m) if codec_name == "binary" else json.dumps(m).encode()
+                          for m in payloads]
+            baseline = sum(map(wire_size, plaintexts))
+            rounds = ROUNDS // 10 if len(plaintexts) > 1 else ROUNDS
+            for name, fn in methods:
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    packed = [fn(p) for p in plaintexts]
+                packing = (time.perf_counter() - start) / rounds / len(plaintexts) * 1e6
+                unpacking = 0.0
+                if name.endswith("+dict"):
+                    wrapped = [p for p in packed if p[:1] == b"\x02"]
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        for p in wrapped:
+                            decompress(p)
+                    unpacking = (time.perf_counter() - start) / rounds / len(plaintexts) * 1e6
+                size = sum(map(wire_size, packed))
+                print(f"{traffic:>14} {codec_name:>7} {name:>12} {size:>11,} "
+                      f"{1 - size / baseline:>6.0%} {packing:>7.1f} us {unpacking:>8.1f} us")
+
+
+def report_chunks():
+    text = b"".join(b"%d,2026-10-18T12:00:00,alice,bob,delivered,ok\n" % i
+                    for i in range(FILE_CHUNK_SIZE // 40))[:FILE_CHUNK_SIZE]
+    noise = os.urandom(FILE_CHUNK_SIZE)
+    print(f"\n{'file':>14} {'method':>12} {'wire MB':>8} {'MB/s':>8}")
+    for label, filename, data in (("text (.csv)", "log.csv", text), ("random (.bin)", "blob.bin", noise),
+                                  ("video (.mp4)", "clip.mp4", noise)):
+        for method in (None,) + COMPRESSIONS:
+            chunks = ChunkCompressor(method, filename)
+            start = time.perf_counter()
+            wire = 0
+            for i in range(CHUNKS):
+                wire += wire_size(chunks.pack(build_chunk("t1", i * FILE_CHUNK_SIZE, data)))
+            elapsed = time.perf_counter() - start
+            megabytes = CHUNKS * FILE_CHUNK_SIZE / 2**20
+            print(f"{label:>14} {method or 'none':>12} {wire / 2**20:>8.1f} {megabytes / elapsed:>8.0f}")
+
+
+def main():
+    report_chat()
+    report_chunks()
+
+
+if __name__ == "__main__":
+    main()
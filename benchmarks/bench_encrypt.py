@@ -0,0 +1,86 @@
+"""
+benchmarks/bench_encrypt.py
+
+Cost of the shared Fernet key against the per-session AEAD ciphers: the
+bytes each adds to a frame and its encrypt/decrypt throughput, from a
+chat line up to a file chunk; what a login's key exchange costs; and
+what broadcasting costs now that session-keyed recipients each need a
+frame of their own.
+
+Run from the project root:
+    python -m benchmarks.bench_encrypt
+"""
+
+import os
+import time
+
+from shared.encrypt import (encrypt_bytes, decrypt_bytes, new_key_exchange, derive_session_ciphers,
+                            AEAD_CIPHERS)
+
+SIZES = (100, 1024, 64 * 1024, 256 * 1024)
+RECIPIENTS = 200
+
+
+def session_pair(name):
+    client_key, client_public = new_key_exchange()
+    server_key, server_public = new_key_exchange()
+    client, _ = derive_session_ciphers(name, client_key, server_public, is_client=True)
+    server, _ = derive_session_ciphers(name, server_key, client_public, is_client=False)
+    return client, server
+
+
+def measure(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def report_throughput():
+    ciphers = [("fernet", encrypt_bytes, decrypt_bytes)]
+    for name in AEAD_CIPHERS:
+        client, server = session_pair(name)
+        # Every frame is new to the receiver, as it would be on the wire
+        ciphers.append((name, client.encrypt, server.decrypt))
+    print(f"{'cipher':>18} {'size':>9} {'overhead':>9} {'encrypt':>12} {'decrypt':>12}")
+    for size in SIZES:
+        data = os.urandom(size)
+        rounds = max(20, 2_000_000 // size)
+        for name, encrypt, decrypt in ciphers:
+            frames = [encrypt(data) for _ in range(rounds)]
+            encrypting = measure(lambda: encrypt(data), rounds)
+            start = time.perf_counter()
+            for frame in frames:
+                decrypt(frame)
+            decrypting = (time.perf_counter() - start) / rounds
+            megabytes = size / 2**20
+            print(f"{name:>18} {size:>9,} {len(frames[0]) - size:>7} B "
+                  f"{megabytes / encrypting:>7.0f} MB/s {megabytes / decrypting:>7.0f} MB/s")
+
+
+def report_key_exchange():
+    def login():
+        client_key, client_public = new_key_exchange()
+        server_key, server_public = new_key_exchange()
+        derive_session_ciphers("aes-gcm", server_key, client_public, is_client=False)
+        derive_session_ciphers("aes-gcm", client_key, server_public, is_client=True)
+    print(f"\nkey exchange (both ends, one login): {measure(login, 500) * 1e6:.0f} us")
+
+
+def report_broadcast():
+    plaintext = os.urandom(200)
+    ciphers = [session_pair("aes-gcm")[1] for _ in range(RECIPIENTS)]
+    shared = measure(lambda: encrypt_bytes(plaintext), 200)
+    per_recipient = measure(lambda: [cipher.encrypt(plaintext) for cipher in ciphers], 50)
+    print(f"broadcast of a chat line to {RECIPIENTS} users: shared key {shared * 1e6:.0f} us "
+          f"(one frame), session keys {per_recipient * 1e6:.0f} us (a frame each)")
+
+
+def main():
+    report_throughput()
+    report_key_exchange()
+    report_broadcast()
+
+
+if __name__ == "__main__":
+    main()
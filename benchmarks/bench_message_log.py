@@ -0,0 +1,63 @@
+"""
+benchmarks/bench_message_log.py
+
+Append throughput of the durable message log with group fsync, compared
+with an fsync after every message.
+
+Run from the project root:
+    python -m benchmarks.bench_message_log
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from server.message_log import MessageLog
+from shared.common import build_message
+
+MESSAGES = 200_000
+FSYNC_EACH_MESSAGES = 2_000
+TARGET_RATE = 50_000
+
+
+def bench_group_fsync(directory, payload):
+    log = MessageLog(directory)
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        log.append(payload)
+    # Count the final fsync too, so every message is on disk
+    log.close()
+    return MESSAGES / (time.perf_counter() - start)
+
+
+def bench_fsync_each(directory, payload):
+    log = MessageLog(directory)
+    start = time.perf_counter()
+    for _ in range(FSYNC_EACH_MESSAGES):
+        log.append(payload)
+        log.sync()
+    elapsed = time.perf_counter() - start
+    log.close()
+    return FSYNC_EACH_MESSAGES / elapsed
+
+
+def main():
+    payload = build_message("public", "alice", "hello everyone, how is it going? " * 3).encode("utf-8")
+    print(f"payload: {len(payload)} bytes")
+
+    for name, bench in (("group fsync", bench_group_fsync),
+                        ("fsync each message", bench_fsync_each)):
+        directory = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            rate = bench(directory, payload)
+        finally:
+            shutil.rmtree(directory)
+        print(f"{name:>20}: {rate:>12,.0f} msg/s")
+        if bench is bench_group_fsync:
+            verdict = "OK" if rate >= TARGET_RATE else "BELOW TARGET"
+            print(f"{'':>20}  target {TARGET_RATE:,} msg/s: {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+benchmarks/bench_offload.py
+
+How long large frames hold up the asyncio engine's event loop, with the
+work done inline and with it offloaded (server/offload.py). Several
+connections decode a batch of frames at once while a heartbeat task
+measures how late the loop gets to it: the worst delay is what every
+other client would feel. Frame types: 256 KiB file chunks (shared key
+and session key) and a legacy 4 MiB single-frame upload.
+
+Run from the project root:
+    python -m benchmarks.bench_offload
+"""
+
+import asyncio
+import base64
+import json
+import os
+import time
+
+from server.offload import FrameOffload, create_offload
+from shared.common import build_chunk
+from shared.config import FILE_CHUNK_SIZE, OFFLOAD_MIN_BYTES, OFFLOAD_THREADS, OFFLOAD_PROCESSES
+from shared.encrypt import encrypt_bytes, encrypt_message, new_key_exchange, derive_session_ciphers
+
+CONNECTIONS = 4
+FRAMES = 40  # per connection
+
+
+def session_pair():
+    client_key, client_public = new_key_exchange()
+    server_key, server_public = new_key_exchange()
+    client, _ = derive_session_ciphers("aes-gcm", client_key, server_public, is_client=True)
+    server, _ = derive_session_ciphers("aes-gcm", server_key, client_public, is_client=False)
+    return client, server
+
+
+def workloads():
+    """(name, build) pairs; build() gives each connection its frames, fresh every run."""
+    chunk = build_chunk("t1", 0, os.urandom(FILE_CHUNK_SIZE))
+    upload = json.dumps({"type": "file_upload", "sender": "alice", "filename": "big.bin",
+                         "file_data": base64.b64encode(os.urandom(4 * 2**20)).decode()})
+    shared_chunk, shared_upload = encrypt_bytes(chunk), encrypt_message(upload)
+
+    def session_chunks():
+        # Session-keyed frames can only be received once
+        frames = []
+        for client, server in (session_pair() for _ in range(CONNECTIONS)):
+            frames.append([(client.encrypt(chunk), server) for _ in range(FRAMES)])
+        return frames
+
+    return [
+        ("chunk, shared key", lambda: [[(shared_chunk, None)] * FRAMES] * CONNECTIONS),
+        ("chunk, session key", session_chunks),
+        ("4 MiB legacy upload", lambda: [[(shared_upload, None)] * (FRAMES // 8)] * CONNECTIONS),
+    ]
+
+
+async def run(offload, frames_per_connection):
+    lateness = []
+    done = asyncio.Event()
+
+    async def heartbeat():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lateness.append(time.perf_counter() - start - 0.001)
+
+    async def connection(frames):
+        for frame, cipher in frames:
+            await offload.decode_frame_async(frame, cipher)
+
+    beat = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await asyncio.gather(*(connection(frames) for frames in frames_per_connection))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await beat
+    return elapsed, max(lateness)
+
+
+def main():
+    pooled = create_offload(OFFLOAD_MIN_BYTES, OFFLOAD_THREADS, OFFLOAD_PROCESSES)
+    # Start the decode processes before anything is timed
+    pooled.run("decode", json.loads, "{}")
+    pooled.report(reset=True)
+    print(f"{CONNECTIONS} connections; pools: {OFFLOAD_THREADS} threads, {OFFLOAD_PROCESSES} processes\n")
+    print(f"{'frames':>20} {'mode':>8} {'frames/s':>9} {'worst loop stall':>17} "
+          f"{'offload avg':>12} {'max':>9} {'max depth':>10}")
+    for name, build in workloads():
+        for mode, offload in (("inline", FrameOffload(OFFLOAD_MIN_BYTES)), ("offload", pooled)):
+            frames = build()
+            count = sum(map(len, frames))
+            elapsed, stall = asyncio.run(run(offload, frames))
+            stats = offload.report(reset=True)
+            busiest = max(stats.values(), key=lambda s: s["max_ms"])
+            print(f"{name:>20} {mode:>8} {count / elapsed:>9.0f} {stall * 1000:>14.1f} ms "
+                  f"{busiest['avg_ms']:>9.1f} ms {busiest['max_ms']:>6.1f} ms {busiest['max_depth']:>10}")
+    pooled.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+benchmarks/bench_presence.py
+
+Bytes queued to clients while N users log in one after another (a
+reconnect storm): full user_list broadcasts versus presence deltas.
+
+Run from the project root:
+    python -m benchmarks.bench_presence
+"""
+
+from server import server as chat_server
+from shared.common import build_message, frame_msg
+from shared.encrypt import encrypt_message
+
+ROOM_SIZES = [10, 100, 1000]
+
+
+class CountingSocket:
+    """Counts queued bytes instead of sending them."""
+
+    codec = "json"
+    compression = None
+    cipher = None
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def sendall(self, data):
+        self.counter[0] += len(data)
+
+    def enqueue(self, data):
+        self.counter[0] += len(data)
+
+
+def storm_user_lists(size, counter):
+    """The previous scheme: every login sends the full list to everyone."""
+    for i in range(size):
+        chat_server.clients[f"user{i}"] = CountingSocket(counter)
+        user_list = ",".join(chat_server.clients.keys())
+        message = build_message("system", "server", f"user_list:{user_list}")
+        chat_server.fan_out(message)
+
+
+def storm_deltas(size, counter):
+    for i in range(size):
+        conn = CountingSocket(counter)
+        chat_server.clients[f"user{i}"] = conn
+        chat_server.broadcast_presence("presence_join", f"user{i}")
+        conn.sendall(frame_msg(encrypt_message(chat_server.presence_snapshot())))
+
+
+def measure(fn, size):
+    chat_server.clients.clear()
+    counter = [0]
+    fn(size, counter)
+    chat_server.clients.clear()
+    return counter[0]
+
+
+def main():
+    print(f"{'users':>6} {'user_list':>14} {'deltas':>14} {'saving':>8}")
+    for size in ROOM_SIZES:
+        old = measure(storm_user_lists, size)
+        new = measure(storm_deltas, size)
+        print(f"{size:>6} {old / 1e6:>11.2f} MB {new / 1e6:>11.2f} MB {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
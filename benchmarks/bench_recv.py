@@ -0,0 +1,76 @@
+"""
+benchmarks/bench_recv.py
+
+Microbenchmark for the receive path: the old `data += packet` loop
+against FrameReader, for 1 KB, 1 MB and MAX_FRAME_SIZE (4 MB) frames
+over a local socket pair.
+
+Run from the project root:
+    python -m benchmarks.bench_recv
+"""
+
+import socket
+import struct
+import threading
+import time
+
+from shared.common import FrameReader, frame_msg
+from shared.config import MAX_FRAME_SIZE
+
+# (frame size, frames per run); FrameReader refuses anything larger
+CASES = [
+    (1024, 20000),
+    (1024 * 1024, 50),
+    (MAX_FRAME_SIZE, 25),
+]
+
+
+def legacy_recv_msg(sock):
+    """The previous recv_msg(): separate header read and bytes concatenation."""
+    raw_msg_len = sock.recv(4)
+    if not raw_msg_len:
+        return None
+    msg_len = struct.unpack('>I', raw_msg_len)[0]
+    data = b''
+    while len(data) < msg_len:
+        packet = sock.recv(msg_len - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+
+def run(size, count, make_receiver):
+    sender, receiver = socket.socketpair()
+    frame = frame_msg(b"x" * size)
+
+    def send_all():
+        for _ in range(count):
+            sender.sendall(frame)
+        sender.close()
+
+    # A daemon, so a receiver that gives up can't leave it blocked forever
+    thread = threading.Thread(target=send_all, daemon=True)
+    recv = make_receiver(receiver)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(count):
+        assert len(recv()) == size
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    return elapsed
+
+
+def main():
+    print(f"{'frame':>8} {'count':>6} {'legacy':>11} {'FrameReader':>12} {'MB/s':>8}")
+    for size, count in CASES:
+        legacy = run(size, count, lambda sock: lambda: legacy_recv_msg(sock))
+        buffered = run(size, count, lambda sock: FrameReader(sock).read_frame)
+        mb_per_s = size * count / buffered / (1024 * 1024)
+        label = f"{size // 1024} KB" if size < 1024 * 1024 else f"{size // (1024 * 1024)} MB"
+        print(f"{label:>8} {count:>6} {legacy * 1000:>8.1f} ms {buffered * 1000:>9.1f} ms {mb_per_s:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+benchmarks/bench_search.py
+
+Indexing rate and query latency of the full-text search index over a
+million synthetic chat messages, with word frequencies roughly following
+Zipf's law like real chat.
+
+Run from the project root:
+    python -m benchmarks.bench_search
+"""
+
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from server.search import SearchIndex
+
+MESSAGES = 1_000_000
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = 8
+QUERIES = 500
+TARGET_P99_MS = 10
+
+
+def make_messages(rng):
+    words = [f"w{rank}" for rank in range(VOCABULARY)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+    for seq in range(MESSAGES):
+        # One private conversation for every ten public messages
+        channels = ["public"] if seq % 10 else [f"private:u{seq % 100}", f"private:u{seq % 7}"]
+        yield seq, channels, " ".join(rng.choices(words, cum_weights=cum_weights, k=WORDS_PER_MESSAGE))
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[int(fraction * (len(samples) - 1))]
+
+
+def main():
+    rng = random.Random(1)
+    index = SearchIndex()
+    start = time.perf_counter()
+    for seq, channels, text in make_messages(rng):
+        index.add(seq, channels, text)
+    elapsed = time.perf_counter() - start
+    print(f"indexed {MESSAGES:,} messages: {MESSAGES / elapsed:,.0f} msg/s")
+
+    # Mix of common, mid-frequency and rare words, one to three per query
+    timings = []
+    for _ in range(QUERIES):
+        query = " ".join(f"w{int(rng.paretovariate(0.6)) % VOCABULARY}"
+                         for _ in range(rng.randint(1, 3)))
+        start = time.perf_counter()
+        index.search(["public", "private:u3"], query, 20)
+        timings.append((time.perf_counter() - start) * 1000)
+    p50, p99 = percentile(timings, 0.5), percentile(timings, 0.99)
+    print(f"query latency: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    verdict = "OK" if p99 <= TARGET_P99_MS else "ABOVE TARGET"
+    print(f"{'':>15}target p99 {TARGET_P99_MS} ms: {verdict}")
+
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as directory:
+        path = os.path.join(directory, "search.idx")
+        start = time.perf_counter()
+        index.save(path)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        SearchIndex().load(path)
+        loaded = time.perf_counter() - start
+        print(f"snapshot: {os.path.getsize(path) / 2**20:,.0f} MB, "
+              f"saved in {saved:.2f} s, loaded in {loaded:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
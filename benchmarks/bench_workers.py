@@ -0,0 +1,128 @@
+"""
+benchmarks/bench_workers.py
+
+Chat throughput of one server process against --workers N. A few
+senders post public messages as fast as the server takes them and every
+connected client reads all of them; the number reported is messages
+delivered to clients per second. Each worker frames and writes its own
+clients' copies, so this is the load that spreads over the cores - on a
+machine with fewer cores than workers, expect no gain (or a small loss
+to the extra hop through the core).
+
+Run from the project root:
+    python -m benchmarks.bench_workers
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+from server import server as chat_server
+from shared.common import build_message, send_msg, FrameReader
+from shared.encrypt import encrypt_message
+
+CLIENTS = 64
+SENDERS = 4
+MESSAGES = 200  # per sender
+WORKERS = (0, 1, 2, 4)  # 0: the single-process server
+
+
+def run_server(workers, port, root):
+    os.chdir(root)
+    chat_server.FILE_STORAGE_DIR = root
+    # Only the summary on the console
+    logging.disable(logging.CRITICAL)
+    chat_server.start_server("asyncio", workers=workers, port=port, host="127.0.0.1", grace=0,
+                             log_dir=os.path.join(root, "log"), mailbox_dir=os.path.join(root, "mailbox"),
+                             offload_threads=0, offload_processes=0)
+
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def connect(port, name):
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    send_msg(sock, encrypt_message(build_message("system", name, "login_request")))
+    return sock
+
+
+def receive(sock, count, done):
+    """Reads `count` frames; once the logins have settled only chat messages come."""
+    reader = FrameReader(sock)
+    received = 0
+    while received < count:
+        if not reader.read_frame():
+            break
+        received += 1
+    done.append(received)
+
+
+def measure(workers):
+    root = tempfile.mkdtemp()
+    port = free_port()
+    server = multiprocessing.get_context("spawn").Process(target=run_server, args=(workers, port, root))
+    server.start()
+    try:
+        socks = [connect(port, f"user{i}") for i in range(CLIENTS)]
+        # Let every login and its presence traffic settle before timing
+        time.sleep(1)
+        for sock in socks:
+            sock.setblocking(False)
+            try:
+                while sock.recv(1 << 20):
+                    pass
+            except BlockingIOError:
+                pass
+            sock.setblocking(True)
+        done = []
+        expected = SENDERS * MESSAGES
+        readers = [threading.Thread(target=receive, args=(sock, expected, done)) for sock in socks]
+        for reader in readers:
+            reader.start()
+        start = time.perf_counter()
+        for i, sender in enumerate(socks[:SENDERS]):
+            frame = encrypt_message(build_message("public", f"user{i}", "x" * 80))
+            threading.Thread(target=lambda s=sender, f=frame: [send_msg(s, f) for _ in range(MESSAGES)]).start()
+        for reader in readers:
+            reader.join(60)
+        elapsed = time.perf_counter() - start
+        for sock in socks:
+            sock.close()
+        return sum(done) / elapsed
+    finally:
+        os.kill(server.pid, signal.SIGINT)
+        server.join(10)
+        if server.is_alive():
+            server.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    print(f"{CLIENTS} clients, {SENDERS} senders x {MESSAGES} messages, asyncio engine, "
+          f"{os.cpu_count()} CPUs\n")
+    print(f"{'workers':>8} {'deliveries/s':>13}")
+    for workers in WORKERS:
+        print(f"{workers or 'none':>8} {measure(workers):>13,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,38 @@ from datetime import datetime
 import base64
 import os
 import json
+import uuid
+from collections import deque
 
 # Import the helper functions and config
 from client import gui
-from shared.encrypt import encrypt_message, decrypt_message
-from shared.common import build_message, parse_message, send_msg, recv_msg
-from shared.config import SERVER_IP, SERVER_PORT
+from client.presence import PresenceTracker
+from client.session import ResumeState, Outbox, login_request, resume_session, resend_unacked
+from shared.codec import seal
+from shared.compress import ChunkCompressor
+from shared.encrypt import encrypt_message, encrypt_frame, decrypt_frame
+from shared.common import build_message, send_msg, FrameReader, build_chunk, parse_payload, iter_file_chunks, resumable_upload_id, file_sha256, file_hmac
+from shared.config import SERVER_IP, SERVER_PORT, UPLOAD_READY_TIMEOUT
+
+# Second connection used for file transfers, once the server offers one,
+# and its session keys (None: the shared key)
+data_sock = None
+data_cipher = None
+# Background uploads share the data channel one file at a time
+upload_lock = threading.Lock()
+# upload_id → {"event", "ready"} until the server says where to resume
+pending_uploads = {}
+# Online users, kept up to date by the server's presence deltas
+presence = PresenceTracker()
+# Resume token and last seen seq, for getting back in after a drop
+session = ResumeState()
+# Chat messages sent but not yet acknowledged by the server
+outbox = Outbox()
+# The chat connection; replaced when a dropped session is resumed
+chat_sock = None
+# The main thread and the receiver thread both send on the chat
+# connection; each frame goes out whole under this lock
+send_lock = threading.Lock()
 
 # Create a directory for downloads if it doesn't exist
 CLIENT_DOWNLOADS_DIR = "client_downloads"
@@ -52,18 +78,116 @@ def apply_emoji(text):
         text = text.replace(code, emoji)
     return text
 
-def receive_messages(sock, username):
+def cipher_for(sock):
+    """The session keys of the chat connection or the data channel (None: the shared key)."""
+    return data_cipher if sock is not None and sock is data_sock else session.cipher
+
+
+def seal_for(sock, message):
+    """Encrypts a message (a dict, or JSON text) for the connection it is sent on."""
+    return seal(message, session.codec, session.compression, cipher_for(sock))
+
+
+def send_frame(sock, payload):
+    """Sends one sealed payload; on the chat connection under send_lock."""
+    if sock is not None and sock is data_sock:
+        # Only the upload thread sends here, and a slow one must not hold up chat
+        send_msg(sock, payload)
+        return
+    with send_lock:
+        send_msg(sock, payload)
+
+
+def apply_presence(sock, username, msg):
+    """Prints presence changes; asks for a new snapshot after a gap."""
+    change = presence.apply(msg)
+    if change is None:
+        return
+    if change[0] == "gap":
+        sync_msg = {"type": "presence_sync", "sender": username}
+        send_frame(sock, seal_for(sock, sync_msg))
+    elif change[0] == "snapshot":
+        print(f"\n[USERS] Active users: {', '.join(change[1])}")
+    elif change[0] == "join":
+        print(f"\n[USERS] {change[1]} is online")
+    else:
+        print(f"\n[USERS] {change[1]} went offline")
+
+
+def print_history_entry(msg, username):
+    sender = msg.get("sender")
+    timestamp = msg.get("timestamp", "")
+    message = apply_emoji(msg.get("message", ""))
+    if msg.get("type") == "file":
+        print(f"  {timestamp} {sender} shared '{message}' (/download {msg.get('file_id')})")
+    elif msg.get("type") == "channel_message":
+        print(f"  [{msg.get('channel')}] {timestamp} {sender} > {message}")
+    elif not msg.get("receiver"):
+        print(f"  (Global) {timestamp} {sender} > {message}")
+    elif sender == username:
+        print(f"  (Private to {msg['receiver']}) {timestamp}: {message}")
+    else:
+        print(f"  (Private from {sender}) {timestamp}: {message}")
+
+
+def resume_chat(username):
+    """
+    Tries to get back into the session after the chat connection drops.
+    Returns (sock, reader, early frames) on success, or None.
+    """
+    global chat_sock
+    print("\n[SYSTEM] Connection lost, reconnecting...")
+    resumed = resume_session(
+        session, username, lambda: socket.create_connection((SERVER_IP, SERVER_PORT)))
+    if resumed is None:
+        return None
+    sock, reader, reply, early = resumed
+    missed = session.accept(reply)
+    print(f"[SYSTEM] Reconnected, {len(missed)} missed message(s).")
+    for past in missed:
+        print_history_entry(past, username)
+    with send_lock:
+        # What is still unacknowledged goes out before anything new
+        chat_sock = sock
+        resend_unacked(outbox, sock, session)
+    return sock, reader, early
+
+
+def receive_messages(sock, username, is_data_channel=False, reader=None, early=()):
+    reader = reader or FrameReader(sock)
+    # The data channel keeps its keys; the chat connection's change when it is resumed
+    channel_cipher = data_cipher
+    pending = deque(early)  # messages received while logging in or resuming, handled first
+    downloads = {}  # transfer_id → download in progress
     while True:
         try:
             # Receiving function
-            data = recv_msg(sock)
-            if not data:
-                print("\n[SYSTEM] Server closed the connection.")
-                os._exit(0)  # Use os._exit to force exit from thread
+            data = None if pending else reader.read_frame()
+            if not pending and not data:
+                if is_data_channel:
+                    # Transfers fall back to the chat connection
+                    close_data_channel(sock)
+                    return
+                resumed = resume_chat(username)
+                if resumed is None:
+                    print("\n[SYSTEM] Server closed the connection.")
+                    os._exit(0)  # Use os._exit to force exit from thread
+                sock, reader, early = resumed
+                pending.extend(early)
+                continue
 
-            decrypted = decrypt_message(data)
-            
-            msg = parse_message(decrypted)
+            if pending:
+                msg = pending.popleft()
+            elif is_data_channel:
+                msg = parse_payload(decrypt_frame(data, channel_cipher))
+            else:
+                msg = session.open(data)
+
+            if msg.get("type") == "file_chunk":
+                write_download_chunk(downloads, msg)
+                continue
+            if not is_data_channel and not session.update(msg):
+                continue
 
             msg_type = msg.get("type")
             sender = msg.get("sender")
@@ -72,22 +196,66 @@ def receive_messages(sock, username):
             receiver = msg.get("receiver", None)
             timestamp = msg.get("timestamp", "")
 
-            if msg_type == "system":
-                if message.startswith("user_list:"):
-                    users = message.split(":", 1)[1].split(",")
-                    print(f"\n[USERS] Active users: {', '.join(users)}")
-                    gui.root.after(0, lambda: gui.update_users_list(users))
+            if msg_type == "data_channel":
+                open_data_channel(msg.get("token"), username)
 
-                else:
-                    print(f"\n[SYSTEM] {message}")
-                    gui.root.after(0, lambda m=message: gui.append_to_chat(m, "system"))
+            elif msg_type == "file_upload_ready":
+                upload_ready(msg)
+
+            elif msg_type in ("presence_snapshot", "presence_join", "presence_leave"):
+                apply_presence(sock, username, msg)
+
+            elif msg_type == "system":
+                print(f"\n[SYSTEM] {message}")
+                gui.root.after(0, lambda m=message: gui.append_to_chat(m, "system"))
             
             elif message == "username_rejected":
                 gui.username_rejected = True  # Trigger flag to re-show input dialog
 
+            elif msg_type == "history":
+                print("\n[HISTORY] Earlier messages:")
+                for past in msg.get("messages", []):
+                    print_history_entry(past, username)
+
+            elif msg_type == "search_results":
+                hits = msg.get("messages", [])
+                print(f"\n[SEARCH] {len(hits)} result(s) for '{msg.get('query')}':")
+                for hit in hits:
+                    print_history_entry(hit, username)
+
             elif msg_type == "public":
                 print(f"\n(Global) {timestamp} {sender} > {message}")
 
+            elif msg_type == "channel_message":
+                print(f"\n[{msg.get('channel')}] {timestamp} {sender} > {message}")
+
+            elif msg_type == "ack":
+                outbox.acked(msg)
+
+            elif msg_type == "mailbox":
+                queued, ack = session.take_mailbox(msg, username)
+                send_frame(sock, seal_for(sock, ack))
+                if queued:
+                    print("\n[MAILBOX] Sent to you while you were offline:")
+                    for past in queued:
+                        print_history_entry(past, username)
+
+            elif msg_type == "queued":
+                print(f"\n[SYSTEM] {msg.get('receiver')} is offline; they will get it when they log in.")
+
+            elif msg_type == "channel_joined":
+                members = msg.get("members", [])
+                print(f"\n[CHANNEL] Joined {msg.get('channel')} ({', '.join(members)})")
+                for past in session.note_replayed(msg.get("messages", [])):
+                    print_history_entry(past, username)
+
+            elif msg_type == "channel_left":
+                print(f"\n[CHANNEL] Left {msg.get('channel')}")
+
+            elif msg_type in ("channel_join", "channel_leave"):
+                action = "joined" if msg_type == "channel_join" else "left"
+                print(f"\n[CHANNEL] {msg.get('user')} {action} {msg.get('channel')}")
+
             elif msg_type == "private":
                 if sender == username:
                     print(f"\n(Private to {receiver}) {timestamp}: {message}")
@@ -106,7 +274,22 @@ def receive_messages(sock, username):
                     print(
                         f"\n[FILE] {sender} sent '{filename}' to the chat. To download, type: /download {file_id}")
 
-            # Handle a completed file download from the server
+            # Streamed download: open the target file, chunks follow
+            elif msg_type == "file_download_begin":
+                begin_download(downloads, msg)
+
+            elif msg_type == "file_download_end":
+                finish_download(downloads, msg)
+
+            elif msg_type == "file_download_error":
+                print(f"\n[ERROR] {msg.get('message')}")
+
+            # A refused upload or download request
+            elif msg_type == "file_error":
+                print(f"\n[ERROR] {msg.get('message')}")
+                upload_ready(msg)
+
+            # Handle a completed single-frame download (older servers)
             elif msg_type == "file_download":
                 filename = msg.get("message")
                 file_data_b64 = msg.get("file_data")
@@ -123,13 +306,93 @@ def receive_messages(sock, username):
                         print(f"\n[ERROR] Failed to save downloaded file: {e}")
 
         except (ConnectionAbortedError, ConnectionResetError):
-            print("\n[SYSTEM] Connection to the server was lost.")
-            os._exit(0)
+            if is_data_channel:
+                close_data_channel(sock)
+                return
+            resumed = resume_chat(username)
+            if resumed is None:
+                print("\n[SYSTEM] Connection to the server was lost.")
+                os._exit(0)
+            sock, reader, early = resumed
+            pending.extend(early)
         except Exception as e:
             print(f"\n[RECEIVE ERROR] {e}")
             break
 
 
+def open_data_channel(token, username):
+    """
+    Opens the second connection the server offered for file transfers,
+    so uploads and downloads never hold up chat messages.
+    """
+    global data_sock, data_cipher
+    try:
+        sock = socket.create_connection((SERVER_IP, SERVER_PORT))
+        attach_msg = {
+            "type": "data_channel_attach",
+            "sender": username,
+            "token": token,
+        }
+        # Under the shared key; the data channel's own session keys follow
+        send_msg(sock, encrypt_message(json.dumps(attach_msg)))
+    except Exception as e:
+        print(f"\n[SYSTEM] Data channel unavailable, sending files inline: {e}")
+        return
+    data_cipher = session.data_cipher
+    data_sock = sock
+    threading.Thread(target=receive_messages, args=(
+        sock, username, True), daemon=True).start()
+
+
+def close_data_channel(sock):
+    global data_sock
+    if data_sock is sock:
+        data_sock = None
+    sock.close()
+
+
+def download_part_path(file_id):
+    """Where an unfinished download is kept until it completes."""
+    return os.path.join(CLIENT_DOWNLOADS_DIR, f"{os.path.basename(file_id)}.part")
+
+
+def begin_download(downloads, msg):
+    filename = os.path.basename(msg.get("message"))
+    part_path = download_part_path(msg.get("file_id", filename))
+    offset = msg.get("offset", 0)
+    if offset:
+        # Keep the bytes we already have, up to where the server resumes
+        f = open(part_path, "ab")
+        f.truncate(offset)
+        print(f"\n[SYSTEM] Resuming '{filename}' from byte {offset}...")
+    else:
+        f = open(part_path, "wb")
+        print(f"\n[SYSTEM] Receiving '{filename}'...")
+    downloads[msg["transfer_id"]] = {
+        "file": f,
+        "part_path": part_path,
+        "filename": filename,
+        "file_size": msg.get("file_size", 0),
+    }
+
+
+def write_download_chunk(downloads, msg):
+    download = downloads.get(msg["transfer_id"])
+    if download:
+        download["file"].write(msg["data"])
+
+
+def finish_download(downloads, msg):
+    download = downloads.pop(msg["transfer_id"], None)
+    if not download:
+        return
+    download["file"].close()
+    os.replace(download["part_path"],
+               os.path.join(CLIENT_DOWNLOADS_DIR, download["filename"]))
+    print(
+        f"\n[SUCCESS] File '{download['filename']}' downloaded to '{CLIENT_DOWNLOADS_DIR}' folder.")
+
+
 def current_timestamp():
     return datetime.now().strftime("%H:%M:%S")
 
@@ -145,60 +408,122 @@ def send_file(sock, filepath, receiver, username):
         return
 
     try:
-        with open(filepath, "rb") as f:
-            file_data = f.read()
-
-        encoded_data = base64.b64encode(file_data).decode("utf-8")
         filename = os.path.basename(filepath)
         timestamp = current_timestamp()
+        # Same file → same ID, so a re-sent file continues where it stopped
+        upload_id = resumable_upload_id(filepath, username)
+        pending_uploads[upload_id] = {"event": threading.Event(), "ready": None}
 
         print(f"[SYSTEM] Uploading {filename}...")
 
-        # Step 1: Send the entire file in one message (as expected by the server)
-        upload_msg_dict = {
-            "type": "file_upload",
+        # Stream the file to the server in fixed-size binary chunks
+        begin_msg_dict = {
+            "type": "file_upload_begin",
             "sender": username,
             "timestamp": timestamp,
+            "upload_id": upload_id,
             "filename": filename,
-            "file_data": encoded_data
-        }
-        upload_msg_json = json.dumps(upload_msg_dict)
-
-        send_msg(sock, encrypt_message(upload_msg_json))
-
-        # Step 2: Send the notification message for broadcast
-        file_id = f"{timestamp.replace(':', '-')}_{filename}"
-        metadata_msg_dict = {
-            "type": "file",
-            "sender": username,
-            "timestamp": timestamp,
-            "message": filename,
-            "file_id": file_id,
             "file_size": file_size,
+            # Lets the server check the upload arrived intact
+            "sha256": file_sha256(filepath),
             "receiver": receiver or ""
         }
-        metadata_msg_json = json.dumps(metadata_msg_dict)
-        send_msg(sock, encrypt_message(metadata_msg_json))
+        send_frame(sock, seal_for(sock, begin_msg_dict))
+
+        ready = wait_upload_ready(upload_id)
+        if ready is None:
+            print(f"[ERROR] Server did not accept the upload of '{filename}'.")
+            return
+        if ready.get("type") == "file_error":
+            return  # the receiver printed why
+        if ready.get("challenge"):
+            # The server has this content already; proving we hold it saves sending it
+            pending_uploads[upload_id] = {"event": threading.Event(), "ready": None}
+            proof_msg_dict = {
+                "type": "file_upload_proof",
+                "sender": username,
+                "upload_id": upload_id,
+                "proof": file_hmac(filepath, ready["challenge"])
+            }
+            send_frame(sock, seal_for(sock, proof_msg_dict))
+            ready = wait_upload_ready(upload_id)
+            if ready is None:
+                print(f"[ERROR] Server did not answer for the upload of '{filename}'.")
+                return
+            if ready.get("type") == "file_error":
+                return
+            if ready.get("stored"):
+                print(f"[SYSTEM] Server already has '{filename}', nothing to send.")
+                return
+        offset = ready.get("offset", 0)
+        if offset:
+            print(f"[SYSTEM] Resuming '{filename}' from byte {offset}.")
+
+        chunks = ChunkCompressor(session.compression, filename)
+        for offset, data in iter_file_chunks(filepath, offset):
+            send_frame(sock, encrypt_frame(chunks.pack(build_chunk(upload_id, offset, data)), cipher_for(sock)))
+
+        end_msg_dict = {
+            "type": "file_upload_end",
+            "sender": username,
+            "upload_id": upload_id
+        }
+        send_frame(sock, seal_for(sock, end_msg_dict))
 
+        # The server announces the file once the last chunk is stored
         print(f"[SYSTEM] File '{filename}' sent successfully.")
 
     except Exception as e:
         print(f"[ERROR] File upload failed: {e}")
 
+def upload_ready(msg):
+    """Wakes the upload waiting for the server's file_upload_ready."""
+    pending = pending_uploads.get(msg.get("upload_id"))
+    if pending:
+        pending["ready"] = msg
+        pending["event"].set()
+
+
+def wait_upload_ready(upload_id, timeout=UPLOAD_READY_TIMEOUT):
+    """
+    Returns the server's file_upload_ready (with the byte offset to
+    upload from, and a challenge or whether the content is already
+    stored), or None on timeout.
+    """
+    pending = pending_uploads[upload_id]
+    try:
+        if not pending["event"].wait(timeout):
+            return None
+        return pending["ready"]
+    finally:
+        pending_uploads.pop(upload_id, None)
+
+
+def send_file_in_background(sock, filepath, receiver, username):
+    with upload_lock:
+        send_file(sock, filepath, receiver, username)
+
+
 def request_file_download(sock, file_id, username):
     try:
+        # Continue an interrupted download from the bytes already saved
+        part_path = download_part_path(file_id)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
         request_msg = {
             "type": "file_download_request",
             "sender": username,
             "file_id": file_id,
+            "transfer_id": uuid.uuid4().hex,
+            "offset": offset,
         }
-        send_msg(sock, encrypt_message(json.dumps(request_msg)))
+        send_frame(sock, seal_for(sock, request_msg))
         print(f"[SYSTEM] Requesting download for file ID: {file_id}")
     except Exception as e:
         print(f"[ERROR] Download request failed: {e}")
 
 
 def main():
+    global chat_sock
     username = input("Enter your username: ").strip()
     if not username:
         print("[ERROR] Username cannot be empty.")
@@ -211,17 +536,33 @@ def main():
         print(f"[ERROR] Could not connect: {e}")
         return
 
-    login_message = build_message(
-        "system", username, "login_request", timestamp=current_timestamp())
-    send_msg(client, encrypt_message(login_message))
+    reader = FrameReader(client)
+    early = []
+    try:
+        send_msg(client, encrypt_message(login_request(username, session.offer_key())))
+        # A server with session keys answers the key exchange first
+        data = reader.read_frame()
+        if not data:
+            raise ConnectionError("server closed the connection")
+        first = session.open(data)
+        if first.get("type") == "key_exchange":
+            session.key_agreed(first)
+        else:
+            early.append(first)
+    except Exception as e:
+        print(f"[ERROR] Could not log in: {e}")
+        return
     print(f"[SYSTEM] Connected to {SERVER_IP}:{SERVER_PORT} as '{username}'")
     print("[INFO] Type /sendfile <filepath> [username] to send a file.")
     print("[INFO] Type /download <file_id> to download a file.")
     print("[INFO] Type /w <username> <message> for a private message.")
+    print("[INFO] Type /search <words> to search earlier messages.")
+    print("[INFO] Type /join #channel, /leave #channel and /c #channel <message> for topic channels.")
     print("-" * 50)
 
+    chat_sock = client
     threading.Thread(target=receive_messages, args=(
-        client, username), daemon=True).start()
+        client, username, False, reader, early), daemon=True).start()
 
     while True:
         try:
@@ -239,7 +580,12 @@ def main():
                     continue
                 filepath = parts[1]
                 receiver = parts[2] if len(parts) > 2 else None
-                send_file(client, filepath, receiver, username)
+                if data_sock:
+                    # Upload in the background on the data channel
+                    threading.Thread(target=send_file_in_background, args=(
+                        data_sock, filepath, receiver, username), daemon=True).start()
+                else:
+                    send_file(chat_sock, filepath, receiver, username)
                 continue
 
             elif text.lower().startswith("/download "):
@@ -248,7 +594,41 @@ def main():
                     print("[ERROR] Usage: /download <file_id>")
                     continue
                 file_id = parts[1]
-                request_file_download(client, file_id, username)
+                request_file_download(chat_sock, file_id, username)
+                continue
+
+            elif text.lower().startswith("/search "):
+                search_msg = {
+                    "type": "search",
+                    "sender": username,
+                    "query": text.split(" ", 1)[1],
+                }
+                send_frame(chat_sock, session.seal(search_msg))
+                continue
+
+            elif text.startswith(("/join ", "/leave ")):
+                command, channel = text.split(" ", 1)
+                channel_msg = {
+                    "type": command[1:],
+                    "sender": username,
+                    "channel": channel.strip(),
+                }
+                send_frame(chat_sock, session.seal(channel_msg))
+                continue
+
+            elif text.startswith("/c "):
+                parts = text.split(" ", 2)
+                if len(parts) < 3:
+                    print("[ERROR] Usage: /c #channel message")
+                    continue
+                channel_msg = {
+                    "type": "channel_message",
+                    "sender": username,
+                    "channel": parts[1],
+                    "timestamp": timestamp,
+                    "message": apply_emoji(parts[2]),
+                }
+                send_frame(chat_sock, session.seal(outbox.track(channel_msg)))
                 continue
 
             elif text.startswith("/w "):
@@ -268,11 +648,15 @@ def main():
                 msg = build_message("public", username,
                                     text_with_emoji, timestamp=timestamp)
 
-            send_msg(client, encrypt_message(msg))
+            send_frame(chat_sock, session.seal(outbox.track(json.loads(msg))))
 
         except KeyboardInterrupt:
             print("\n[SYSTEM] Exiting chat...")
             break
+        except OSError as e:
+            # The receiver thread is resuming the session; keep going
+            print(f"[SEND ERROR] Connection lost ({e}); chat messages are sent again once reconnected.")
+            continue
         except Exception as e:
             print(f"[SEND ERROR] {e}")
             break
@@ -280,11 +664,11 @@ def main():
     try:
         disconnect_msg = build_message(
             "system", username, "disconnect", timestamp=current_timestamp())
-        send_msg(client, encrypt_message(disconnect_msg))
+        send_frame(chat_sock, session.seal(disconnect_msg))
     except:
         pass
 
-    client.close()
+    chat_sock.close()
     print("[SYSTEM] Connection closed.")
 
 
@@ -0,0 +1,196 @@
+"""
+client/downloads.py
+
+Tracks many file downloads and previews at once, keyed by the
+transfer ID sent with each request, so replies can never be matched to
+the wrong destination. At most `max_active` transfers run at a time;
+the rest wait in a queue.
+
+This module has no GUI code; ChatWindow turns the callbacks into
+progress widgets.
+"""
+
+import io
+import os
+import threading
+import uuid
+from collections import deque
+
+from shared.config import MAX_CONCURRENT_DOWNLOADS
+
+
+class Transfer:
+    """One download (save_path set) or image preview (save_path None)."""
+
+    def __init__(self, file_id, filename, save_path=None):
+        self.transfer_id = uuid.uuid4().hex
+        self.file_id = file_id
+        self.filename = filename
+        self.save_path = save_path
+        self.state = "queued"  # queued → active → done / failed
+        self.offset = 0        # first byte requested from the server
+        self.received = 0      # bytes held so far, including the offset
+        self.total = 0
+        self.file = None
+        self.percent = -1
+        self.channel = None    # the connection it streams on, once requested
+
+    @property
+    def part_path(self):
+        return f"{self.save_path}.part"
+
+    @property
+    def is_preview(self):
+        return self.save_path is None
+
+
+class DownloadManager:
+    """
+    `send_request(msg_dict)` sends a file_download_request to the server
+    and returns a name for the connection the file will stream on, so
+    fail_all() can fail just the transfers of a connection that closed.
+    Callbacks run on whichever thread feeds the manager:
+        on_progress(transfer), on_complete(transfer, data), on_error(transfer, reason)
+    `data` is the image bytes for previews and None for saved files.
+    """
+
+    def __init__(self, send_request, max_active=MAX_CONCURRENT_DOWNLOADS,
+                 on_progress=None, on_complete=None, on_error=None):
+        self.send_request = send_request
+        self.max_active = max_active
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.transfers = {}    # transfer_id → Transfer
+        self.waiting = deque()  # transfers not started yet
+        self._lock = threading.Lock()
+
+    def active_count(self):
+        return sum(1 for t in self.transfers.values() if t.state == "active")
+
+    def request(self, file_id, filename, save_path=None):
+        """Queues a download (or a preview without save_path)."""
+        transfer = Transfer(file_id, filename, save_path)
+        with self._lock:
+            self.transfers[transfer.transfer_id] = transfer
+            self.waiting.append(transfer)
+        self._start_waiting()
+        return transfer
+
+    def _start_waiting(self):
+        while True:
+            with self._lock:
+                if not self.waiting or self.active_count() >= self.max_active:
+                    return
+                transfer = self.waiting.popleft()
+                transfer.state = "active"
+                # Continue an interrupted download from the bytes already saved
+                if transfer.save_path and os.path.exists(transfer.part_path):
+                    transfer.offset = os.path.getsize(transfer.part_path)
+
+            request_msg = {
+                "type": "file_download_request",
+                "file_id": transfer.file_id,
+                "transfer_id": transfer.transfer_id,
+                "offset": transfer.offset,
+            }
+            try:
+                transfer.channel = self.send_request(request_msg)
+            except Exception as e:
+                self._fail(transfer, str(e))
+
+    def begin(self, msg):
+        """Handles file_download_begin: opens the destination."""
+        transfer = self.transfers.get(msg.get("transfer_id"))
+        if transfer is None or transfer.state != "active":
+            return
+        offset = msg.get("offset", 0)
+        transfer.total = msg.get("file_size", 0)
+        transfer.received = offset
+        try:
+            if transfer.is_preview:
+                transfer.file = io.BytesIO()
+            else:
+                # Written to a .part file so an interruption can be resumed
+                transfer.file = open(transfer.part_path, "ab" if offset else "wb")
+                transfer.file.truncate(offset)
+        except OSError as e:
+            self._fail(transfer, str(e))
+            return
+        self._report_progress(transfer)
+
+    def write_chunk(self, msg):
+        """Handles one binary chunk of a running transfer."""
+        transfer = self.transfers.get(msg.get("transfer_id"))
+        if transfer is None or transfer.file is None:
+            return
+        transfer.file.write(msg["data"])
+        transfer.received += len(msg["data"])
+        self._report_progress(transfer)
+
+    def finish(self, msg):
+        """Handles file_download_end: completes the transfer."""
+        transfer = self.transfers.get(msg.get("transfer_id"))
+        if transfer is None or transfer.file is None:
+            return
+        data = None
+        try:
+            if transfer.is_preview:
+                data = transfer.file.getvalue()
+            else:
+                transfer.file.close()
+                os.replace(transfer.part_path, transfer.save_path)
+        except OSError as e:
+            self._fail(transfer, str(e))
+            return
+        transfer.state = "done"
+        self._release(transfer)
+        if self.on_complete:
+            self.on_complete(transfer, data)
+        self._start_waiting()
+
+    def error(self, msg):
+        """Handles file_download_error from the server."""
+        transfer = self.transfers.get(msg.get("transfer_id"))
+        if transfer is not None:
+            self._fail(transfer, msg.get("message", "Download failed"))
+
+    def fail_all(self, reason, channel=None):
+        """
+        Marks every unfinished transfer failed, e.g. when the connection
+        drops - or, given a `channel`, only those streaming on it, and
+        the waiting ones are started on what is left.
+        """
+        for transfer in list(self.transfers.values()):
+            if channel is None or (transfer.state == "active" and transfer.channel == channel):
+                self._fail(transfer, reason, start_next=False)
+        if channel is not None:
+            self._start_waiting()
+
+    def _fail(self, transfer, reason, start_next=True):
+        transfer.state = "failed"
+        if transfer.file is not None:
+            # A .part file is kept so the download can be resumed later
+            transfer.file.close()
+        self._release(transfer)
+        if self.on_error:
+            self.on_error(transfer, reason)
+        if start_next:
+            self._start_waiting()
+
+    def _release(self, transfer):
+        with self._lock:
+            self.transfers.pop(transfer.transfer_id, None)
+            if transfer in self.waiting:
+                self.waiting.remove(transfer)
+        transfer.file = None
+
+    def _report_progress(self, transfer):
+        if not transfer.total:
+            return
+        percent = transfer.received * 100 // transfer.total
+        # Only report whole-percent steps to keep the GUI responsive
+        if percent != transfer.percent:
+            transfer.percent = percent
+            if self.on_progress:
+                self.on_progress(transfer)
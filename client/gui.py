@@ -1,19 +1,24 @@
 import sys
 import socket
 import threading
-import base64
 import os
 import datetime
 import json
+from collections import deque
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
 
 import customtkinter as ctk
 from customtkinter import CTkFont
 
-from shared.encrypt import encrypt_message, decrypt_message
-from shared.common import build_message, parse_message, send_msg, recv_msg
-from shared.config import SERVER_IP, SERVER_PORT, BUFFER_SIZE
+from shared.encrypt import encrypt_message, encrypt_frame, decrypt_frame
+from shared.common import build_message, send_msg, FrameReader, build_chunk, parse_payload, iter_file_chunks, resumable_upload_id, file_sha256, file_hmac
+from shared.config import SERVER_IP, SERVER_PORT, UPLOAD_READY_TIMEOUT, MAX_CONCURRENT_DOWNLOADS, HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX, SEARCH_LIMIT
+from client.downloads import DownloadManager
+from client.presence import PresenceTracker
+from client.session import ResumeState, Outbox, login_request, resume_session, resend_unacked
+from shared.codec import seal
+from shared.compress import ChunkCompressor
 from PIL import Image, ImageTk
 import io
 
@@ -38,9 +43,32 @@ class ChatWindow:
         # Initialize variables
         self.username = None
         self.client = None
-        self.pending_download_path = None
-        self.pending_preview_filename = None
+        self.reader = None
+        self.data_client = None  # second connection for file transfers
+        self.data_cipher = None  # and its session keys (None: the shared key)
+        self.upload_lock = threading.Lock()
+        self.pending_uploads = {}  # upload_id → {"event", "msg"}
+        # Downloads and previews keyed by transfer ID, several at a time
+        self.downloads = DownloadManager(
+            self.send_download_request,
+            max_active=MAX_CONCURRENT_DOWNLOADS,
+            on_progress=lambda t: self.root.after(
+                0, lambda: self.update_transfer_widget(t)),
+            on_complete=lambda t, data: self.root.after(
+                0, lambda: self.complete_transfer(t, data)),
+            on_error=lambda t, reason: self.root.after(
+                0, lambda: self.fail_transfer(t, reason)),
+        )
+        self.transfer_widgets = {}  # transfer_id → progress row widgets
         self.image_cache = {}  # Cache for downloaded images
+        self.presence = PresenceTracker()  # online users, kept by deltas
+        self.oldest_seq = None  # seq of the oldest message shown
+        self.history_loading = False
+        self.history_exhausted = False
+        self.jump_target = None  # seq of a search hit still being paged in
+        self.search_window = None
+        self.session = ResumeState()  # lets a dropped connection resume
+        self.outbox = Outbox()  # chat messages the server has not acked yet
 
         self.EMOJI_MAP = {
             # Faces
@@ -77,6 +105,7 @@ class ChatWindow:
 
         self.setup_ui()
         self.setup_connection()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # Start receiving messages in background thread
         threading.Thread(target=self.receive_messages, daemon=True).start()
@@ -103,6 +132,28 @@ class ChatWindow:
         self.chat_title.grid(row=0, column=0, padx=20,
                              pady=(20, 10), sticky="w")
 
+        # History search, next to the title
+        self.search_frame = ctk.CTkFrame(self.chat_frame, fg_color="transparent")
+        self.search_frame.grid(row=0, column=0, padx=20,
+                               pady=(20, 10), sticky="e")
+        self.search_input = ctk.CTkEntry(
+            self.search_frame,
+            placeholder_text="Search history...",
+            font=CTkFont(size=12),
+            width=220,
+            height=30
+        )
+        self.search_input.grid(row=0, column=0, padx=(0, 5))
+        self.search_input.bind("<Return>", lambda e: self.send_search())
+        self.search_button = ctk.CTkButton(
+            self.search_frame,
+            text="🔍",
+            width=35,
+            height=30,
+            command=self.send_search
+        )
+        self.search_button.grid(row=0, column=1)
+
         # Chat display area
         self.chat_display = ctk.CTkTextbox(
             self.chat_frame,
@@ -112,6 +163,9 @@ class ChatWindow:
         )
         self.chat_display.grid(row=1, column=0, padx=20,
                                pady=(0, 20), sticky="nsew")
+        # Older history loads when the user scrolls to the top
+        for sequence in ("<MouseWheel>", "<Button-4>"):
+            self.chat_display.bind(sequence, self.on_chat_scroll, add="+")
 
         # Message input area frame
         self.input_frame = ctk.CTkFrame(self.chat_frame, corner_radius=8)
@@ -232,17 +286,21 @@ class ChatWindow:
 
             self.username = username.strip()
             self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.reader = FrameReader(self.client)
 
             try:
                 self.client.connect((SERVER_IP, SERVER_PORT))
-                login_msg = build_message(
-                    "system", self.username, "login_request")
-                send_msg(self.client, encrypt_message(login_msg))
+                send_msg(self.client, encrypt_message(
+                    login_request(self.username, self.session.offer_key())))
 
-                # Wait for server response
-                response = self.client.recv(BUFFER_SIZE)
-                decrypted = decrypt_message(response)
-                msg = parse_message(decrypted)
+                # Wait for server response (one whole frame)
+                response = self.reader.read_frame()
+                # JSON or, once the server agreed to it, binary
+                msg = self.session.open(response)
+                if msg.get("type") == "key_exchange":
+                    # Everything after it is encrypted with the session keys
+                    self.session.key_agreed(msg)
+                    msg = self.session.open(self.reader.read_frame())
 
                 if msg.get("message") == "username_rejected":
                     messagebox.showerror(
@@ -250,6 +308,10 @@ class ChatWindow:
                     self.client.close()
                     continue  # re-show dialog
 
+                # Accepted logins start with the full list of online users
+                if msg.get("type") == "presence_snapshot":
+                    self.apply_presence(msg)
+
                 break  # login accepted
 
             except Exception as e:
@@ -276,12 +338,19 @@ class ChatWindow:
             i += 1
         return f"{size_bytes:.1f} {size_names[i]}"
 
-    def append_to_chat(self, message, msg_type="normal", image_data=None, image_filename=None, file_info=None):
-        """Append message to chat display with proper formatting and color coding"""
+    def append_to_chat(self, message, msg_type="normal", image_data=None, image_filename=None, file_info=None,
+                       at="end", timestamp=None):
+        """
+        Append message to chat display with proper formatting and color coding.
+        `at` is where it goes: the end, or a mark such as "history_top" when
+        older history is put above what is already shown.
+        """
         self.chat_display.configure(state="normal")
+        # Position of the last inserted character, for tagging ranges
+        cursor = "end-1c" if at == "end" else at
 
         # Add timestamp and formatting based on message type
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        timestamp = timestamp or datetime.datetime.now().strftime("%H:%M:%S")
 
         # Configure text tags for colors if not already done
         # Blue for public messages
@@ -294,6 +363,8 @@ class ChatWindow:
         self.chat_display.tag_config("orange", foreground="#FFA54A")
         # Gray for system messages
         self.chat_display.tag_config("gray", foreground="#AAAAAA")
+        # Purple for topic channel messages
+        self.chat_display.tag_config("purple", foreground="#B57CFF")
 
         # Configure file link styles
         self.chat_display.tag_config(
@@ -303,16 +374,19 @@ class ChatWindow:
 
         if msg_type == "system":
             formatted_msg = f"[{timestamp}] {message}\n"
-            self.chat_display.insert("end", formatted_msg, "gray")
+            self.chat_display.insert(at, formatted_msg, "gray")
         elif msg_type == "private_sent":
             formatted_msg = f"[{timestamp}] 🔒 You → {message}\n"
-            self.chat_display.insert("end", formatted_msg, "red")
+            self.chat_display.insert(at, formatted_msg, "red")
         elif msg_type == "private_received":
             formatted_msg = f"[{timestamp}] 🔒 {message}\n"
-            self.chat_display.insert("end", formatted_msg, "red")
+            self.chat_display.insert(at, formatted_msg, "red")
         elif msg_type == "public":
             formatted_msg = f"[{timestamp}] {message}\n"
-            self.chat_display.insert("end", formatted_msg, "blue")
+            self.chat_display.insert(at, formatted_msg, "blue")
+        elif msg_type == "channel":
+            formatted_msg = f"[{timestamp}] {message}\n"
+            self.chat_display.insert(at, formatted_msg, "purple")
         elif msg_type == "file":
             # Special handling for file messages with clickable filename
             if file_info:
@@ -331,12 +405,12 @@ class ChatWindow:
                 size_text = f" ({self.format_file_size(file_size)})" if file_size > 0 else ""
 
                 # Insert the prefix
-                self.chat_display.insert("end", prefix_msg, "orange")
+                self.chat_display.insert(at, prefix_msg, "orange")
 
                 # Insert clickable filename
-                start_pos = self.chat_display.index("end-1c")
-                self.chat_display.insert("end", filename, "file_link")
-                end_pos = self.chat_display.index("end-1c")
+                start_pos = self.chat_display.index(cursor)
+                self.chat_display.insert(at, filename, "file_link")
+                end_pos = self.chat_display.index(cursor)
 
                 # Create unique tag for this file link
                 link_tag = f"file_link_{file_id}"
@@ -351,14 +425,14 @@ class ChatWindow:
                                            lambda e, tag=link_tag: self.on_file_link_leave(tag))
 
                 # Add size info and newline
-                self.chat_display.insert("end", f"{size_text}\n", "orange")
+                self.chat_display.insert(at, f"{size_text}\n", "orange")
             else:
                 # Fallback for old format
                 formatted_msg = f"[{timestamp}] 📎 {message}\n"
-                self.chat_display.insert("end", formatted_msg, "orange")
+                self.chat_display.insert(at, formatted_msg, "orange")
         else:
             formatted_msg = f"{message}\n"
-            self.chat_display.insert("end", formatted_msg, "green")
+            self.chat_display.insert(at, formatted_msg, "green")
 
         # Add image if provided
         if image_data and image_filename:
@@ -378,9 +452,9 @@ class ChatWindow:
                 photo = ImageTk.PhotoImage(img)
 
                 # Insert image into text widget
-                self.chat_display.image_create("end", image=photo)
+                self.chat_display.image_create(at, image=photo)
                 self.chat_display.insert(
-                    "end", f"\n[Image: {image_filename}]\n")
+                    at, f"\n[Image: {image_filename}]\n")
 
                 # Keep reference to prevent garbage collection
                 if not hasattr(self.chat_display, 'images'):
@@ -390,7 +464,8 @@ class ChatWindow:
             except Exception as e:
                 print(f"Error displaying image: {e}")
 
-        self.chat_display.see("end")
+        if at == "end":
+            self.chat_display.see("end")
         self.chat_display.configure(state="disabled")
 
     def on_file_link_enter(self, tag):
@@ -410,27 +485,32 @@ class ChatWindow:
         )
         if save_path:
             try:
-                request_msg = {
-                    "type": "file_download_request",
-                    "sender": self.username,
-                    "file_id": file_id,
-                }
-
-                # --- ADD THIS LINE ---
-                print(
-                    f"[DIAGNOSTIC] Attempting to send download request for file_id: {file_id}")
-
-                send_msg(self.client, encrypt_message(json.dumps(request_msg)))
-
-                # --- AND ADD THIS LINE ---
-                print("[DIAGNOSTIC] Download request sent successfully!")
-
-                self.pending_download_path = save_path
+                self.request_download(file_id, filename, save_path)
                 self.append_to_chat(f"Downloading {filename}...", "system")
             except Exception as e:
                 messagebox.showerror("Download Error", str(e))
 
-    def handle_file_message(self, msg):
+    def request_download(self, file_id, filename, save_path=None):
+        """
+        Queues a download with the download manager. With a save_path the
+        chunks go straight to disk; without one they are collected for a
+        preview. Progress is shown in the download panel.
+        """
+        transfer = self.downloads.request(file_id, filename, save_path)
+        if transfer.state in ("queued", "active"):
+            self.create_transfer_widget(transfer)
+        return transfer.transfer_id
+
+    def send_download_request(self, request_msg):
+        """Sends a download request; the server streams the file on the data channel if there is one."""
+        request_msg["sender"] = self.username
+        channel = "data" if self.data_client else "chat"
+        send_msg(self.client, self.session.seal(request_msg))
+        return channel
+
+    def handle_file_message(self, msg, auto_preview=True, at="end", timestamp=None):
+        self.note_seq(msg)
+        start = self.message_start(at)
         sender = msg["sender"]
         filename = msg["message"]
         file_id = msg["file_id"]
@@ -448,7 +528,8 @@ class ChatWindow:
         }
 
         # Add clickable file message to chat
-        self.append_to_chat("", "file", file_info=file_info)
+        self.append_to_chat("", "file", file_info=file_info, at=at, timestamp=timestamp)
+        self.mark_message(msg, start)
 
         # Place download button in the scrollable download frame
         file_widget = self.create_file_widget(
@@ -456,19 +537,13 @@ class ChatWindow:
         file_widget.pack(fill="x", padx=5, pady=4)
 
         # Auto-download and preview images if they're small enough (< 2MB)
-        if self.is_image_file(filename) and file_size < 2 * 1024 * 1024:
+        if auto_preview and self.is_image_file(filename) and file_size < 2 * 1024 * 1024:
             self.auto_preview_image(filename, file_id)
 
     def auto_preview_image(self, filename, file_id):
         """Automatically download and preview small images"""
         try:
-            request_msg = {
-                "type": "file_download_request",
-                "sender": self.username,
-                "file_id": file_id,
-            }
-            self.client.send(encrypt_message(json.dumps(request_msg)))
-            self.pending_preview_filename = filename
+            self.request_download(file_id, filename)
         except Exception as e:
             print(f"Error auto-previewing image: {e}")
 
@@ -480,16 +555,28 @@ class ChatWindow:
 
         timestamp = datetime.datetime.now().strftime("%H:%M:%S")
 
-        if receiver == "":
-            msg = build_message("public", self.username,
-                                text, timestamp=timestamp)
+        if text.startswith(("/join ", "/leave ")):
+            # Topic channels: /join #name, /leave #name
+            command, channel = text.split(" ", 1)
+            msg = json.dumps({"type": command[1:], "sender": self.username,
+                              "channel": channel.strip()})
+        elif receiver.startswith("#"):
+            msg = self.outbox.track({"type": "channel_message", "sender": self.username,
+                                     "channel": receiver, "timestamp": timestamp, "message": text})
+        elif receiver == "":
+            msg = self.outbox.track(json.loads(build_message(
+                "public", self.username, text, timestamp=timestamp)))
         else:
-            msg = build_message("private", self.username,
-                                text, receiver=receiver, timestamp=timestamp)
+            msg = self.outbox.track(json.loads(build_message(
+                "private", self.username, text, receiver=receiver, timestamp=timestamp)))
             self.append_to_chat(f"{receiver}: {text}", "private_sent")
 
-        send_msg(self.client, encrypt_message(msg))  # FIXED
         self.input_box.delete(0, "end")
+        try:
+            send_msg(self.client, self.session.seal(msg))  # FIXED
+        except OSError:
+            # Reconnecting; chat messages are sent again once resumed
+            pass
         # print(f"\nCLIENT SENDING (Plain Text): {msg}")
         # encrypted_data = encrypt_message(msg)
         # print(f"CLIENT SENDING (Encrypted): {encrypted_data}\n")
@@ -605,50 +692,91 @@ class ChatWindow:
                 "File Too Large", "File size must be less than 100MB")
             return
 
-        try:
-            # Read file in binary mode
-            with open(filepath, "rb") as f:
-                file_data = f.read()
-
-            # Encode to base64
-            encoded = base64.b64encode(file_data).decode("utf-8")
-            filename = os.path.basename(filepath)
-            timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-
-            self.append_to_chat(
-                f"Uploading {filename}... ({self.format_file_size(file_size)})", "system")
-
-            # Step 1: Send actual file data to server (upload step)
-            upload_msg = {
-                "type": "file_upload",
-                "sender": self.username,
-                "timestamp": timestamp,
-                "filename": filename,
-                "file_data": encoded
-            }
-
-            upload_data = encrypt_message(json.dumps(upload_msg))
-            send_msg(self.client, upload_data)
-
-            # Step 2: Notify others with file metadata (broadcast step)
-            file_id = f"{timestamp.replace(':', '-')}_{filename}"
-            receiver = self.receiver_input.get().strip()
-
-            metadata_msg = {
-                "type": "file",
-                "sender": self.username,
-                "timestamp": timestamp,
-                "message": filename,
-                "file_id": file_id,
-                "file_size": file_size
-            }
-            if receiver:
-                metadata_msg["receiver"] = receiver
+        filename = os.path.basename(filepath)
+        receiver = self.receiver_input.get().strip()
+        self.append_to_chat(
+            f"Uploading {filename}... ({self.format_file_size(file_size)})", "system")
 
-            metadata_data = encrypt_message(json.dumps(metadata_msg))
-            send_msg(self.client, metadata_data)
+        if self.data_client:
+            # Upload on the data channel without freezing the window
+            threading.Thread(target=self.upload_file, args=(
+                self.data_client, filepath, file_size, receiver), daemon=True).start()
+        else:
+            self.upload_file(self.client, filepath, file_size, receiver)
+
+    def cipher_for(self, sock):
+        """The session keys of the chat connection or the data channel (None: the shared key)."""
+        return self.data_cipher if sock is not None and sock is self.data_client else self.session.cipher
+
+    def seal_for(self, sock, message):
+        """Encrypts a message (a dict, or JSON text) for the connection it is sent on."""
+        return seal(message, self.session.codec, self.session.compression, self.cipher_for(sock))
+
+    def request_upload(self, sock, upload_id, message):
+        """Sends an upload request and returns the server's file_upload_ready for it."""
+        ready = {"event": threading.Event(), "msg": None}
+        self.pending_uploads[upload_id] = ready
+        send_msg(sock, self.seal_for(sock, message))
+        accepted = ready["event"].wait(UPLOAD_READY_TIMEOUT)
+        self.pending_uploads.pop(upload_id, None)
+        if not accepted:
+            raise TimeoutError("Server did not accept the upload")
+        if ready["msg"].get("type") == "file_error":
+            raise ValueError(ready["msg"].get("message", "Server refused the upload"))
+        return ready["msg"]
+
+    def upload_file(self, sock, filepath, file_size, receiver):
+        """Streams a file to the server in binary chunks."""
+        filename = os.path.basename(filepath)
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        # Same file → same ID, so a re-sent file continues where it stopped
+        upload_id = resumable_upload_id(filepath, self.username)
 
-            # Display in UI for the sender
+        try:
+            with self.upload_lock:
+                begin_msg = {
+                    "type": "file_upload_begin",
+                    "sender": self.username,
+                    "timestamp": timestamp,
+                    "upload_id": upload_id,
+                    "filename": filename,
+                    "file_size": file_size,
+                    # Lets the server check the upload arrived intact
+                    "sha256": file_sha256(filepath),
+                    "receiver": receiver
+                }
+                # The server says where to continue from
+                ready = self.request_upload(sock, upload_id, begin_msg)
+                if ready.get("challenge"):
+                    # It has this content already; proving we hold it saves sending it
+                    proof_msg = {
+                        "type": "file_upload_proof",
+                        "sender": self.username,
+                        "upload_id": upload_id,
+                        "proof": file_hmac(filepath, ready["challenge"])
+                    }
+                    ready = self.request_upload(sock, upload_id, proof_msg)
+                file_id = ready.get("file_id")
+                offset = ready.get("offset", 0)
+
+                if not ready.get("stored"):
+                    if offset:
+                        self.root.after(0, lambda: self.append_to_chat(
+                            f"Resuming {filename} from {self.format_file_size(offset)}", "system"))
+
+                    chunks = ChunkCompressor(self.session.compression, filename)
+                    for offset, data in iter_file_chunks(filepath, offset):
+                        send_msg(sock, encrypt_frame(
+                            chunks.pack(build_chunk(upload_id, offset, data)), self.cipher_for(sock)))
+
+                    end_msg = {
+                        "type": "file_upload_end",
+                        "sender": self.username,
+                        "upload_id": upload_id
+                    }
+                    send_msg(sock, self.seal_for(sock, end_msg))
+
+            # The server announces the file to others; display it for the sender
             file_info = {
                 "sender": self.username,
                 "filename": filename,
@@ -656,11 +784,12 @@ class ChatWindow:
                 "file_size": file_size,
                 "receiver": receiver
             }
-            self.append_to_chat("", "file", file_info=file_info)
+            self.root.after(0, lambda: self.append_to_chat(
+                "", "file", file_info=file_info))
 
         except Exception as e:
-            messagebox.showerror(
-                "File Send Error", f"Error sending file: {str(e)}")
+            self.root.after(0, lambda: messagebox.showerror(
+                "File Send Error", f"Error sending file: {str(e)}"))
             print(f"[FILE SEND ERROR] {e}")
 
     def create_file_widget(self, sender, filename, file_id, file_size=0):
@@ -727,14 +856,7 @@ class ChatWindow:
         )
         if save_path:
             try:
-                request_msg = {
-                    "type": "file_download_request",
-                    "sender": self.username,
-                    "file_id": file_id,
-                }
-                send_msg(self.client, encrypt_message(
-                    json.dumps(request_msg)))  # FIXED
-                self.pending_download_path = save_path
+                self.request_download(file_id, filename, save_path)
                 self.append_to_chat(f"Downloading {filename}...", "system")
             except Exception as e:
                 messagebox.showerror("Download Error", str(e))
@@ -742,120 +864,491 @@ class ChatWindow:
     def preview_image(self, filename, file_id):
         """Preview an image without downloading"""
         try:
-            request_msg = {
-                "type": "file_download_request",
-                "sender": self.username,
-                "file_id": file_id,
-            }
-            self.client.send(encrypt_message(json.dumps(request_msg)))
-            self.pending_preview_filename = filename
+            self.request_download(file_id, filename)
             self.append_to_chat(f"Loading preview of {filename}...", "system")
         except Exception as e:
             messagebox.showerror("Preview Error", str(e))
 
+    def user_line(self, user):
+        if user == self.username:
+            return f"• {user} (You)\n"
+        return f"• {user}\n"
+
     def update_users_list(self, users):
-        """Update the active users list"""
+        """Replace the whole active users list (on a presence snapshot)"""
         self.active_users_list.configure(state="normal")
         self.active_users_list.delete("1.0", "end")
 
-        for i, user in enumerate(users, 1):
-            user = user.strip()
-            if user == self.username:
-                self.active_users_list.insert("end", f"{i}. {user} (You)\n")
-            else:
-                self.active_users_list.insert("end", f"{i}. {user}\n")
+        for user in users:
+            self.active_users_list.insert("end", self.user_line(user.strip()))
 
         self.active_users_list.configure(state="disabled")
 
+    def apply_presence(self, msg):
+        """
+        Applies a presence snapshot or delta. Deltas touch a single line
+        of the users list instead of rewriting it.
+        """
+        change = self.presence.apply(msg)
+        if change is None:
+            return
+        if change[0] == "gap":
+            # A delta went missing; ask for the full list again
+            sync_msg = {"type": "presence_sync", "sender": self.username}
+            send_msg(self.client, self.session.seal(sync_msg))
+            return
+        if change[0] == "snapshot":
+            self.update_users_list(change[1])
+            return
+
+        _, user, index = change
+        self.active_users_list.configure(state="normal")
+        if change[0] == "join":
+            self.active_users_list.insert(f"{index + 1}.0", self.user_line(user))
+        else:
+            self.active_users_list.delete(f"{index + 1}.0", f"{index + 2}.0")
+        self.active_users_list.configure(state="disabled")
+
     def _apply_emojis(self, text):
         """Replaces all emoji codes in a string with their emoji characters."""
         for code, emoji in self.EMOJI_MAP.items():
             text = text.replace(code, emoji)
         return text
 
-    def receive_messages(self):
+    def display_chat_message(self, msg, at="end", timestamp=None):
+        """Shows a public or private chat message"""
+        self.note_seq(msg)
+        start = self.message_start(at)
+        sender = msg.get("sender")
+        message = msg.get("message")
+        receiver = msg.get("receiver", "")
+
+        if msg.get("type") == "public":
+            # Translate the message before displaying
+            translated_message = self._apply_emojis(message)
+            self.append_to_chat(
+                f"{sender}: {translated_message}", "public", at=at, timestamp=timestamp)
+        elif msg.get("type") == "channel_message":
+            translated_message = self._apply_emojis(message)
+            self.append_to_chat(
+                f"{msg.get('channel')} {sender}: {translated_message}", "channel", at=at, timestamp=timestamp)
+        elif sender == self.username:
+            # This part handles messages you send, which don't need translation here
+            self.append_to_chat(
+                f"{receiver}: {message}", "private_sent", at=at, timestamp=timestamp)
+        else:
+            # Translate the message before displaying
+            translated_message = self._apply_emojis(message)
+            self.append_to_chat(
+                f"{sender}: {translated_message}", "private_received", at=at, timestamp=timestamp)
+        self.mark_message(msg, start)
+
+    def display_past_message(self, msg, at="end"):
+        """Shows a message from history with the time it was originally sent"""
+        if msg.get("type") in ("public", "private", "channel_message"):
+            self.display_chat_message(msg, at=at, timestamp=msg.get("timestamp"))
+        elif msg.get("type") == "file":
+            # Old images are not fetched again until the user asks
+            self.handle_file_message(
+                msg, auto_preview=False, at=at, timestamp=msg.get("timestamp"))
+
+    def note_seq(self, msg):
+        """Remembers the oldest message shown, where older pages continue"""
+        seq = msg.get("seq")
+        if seq is not None and (self.oldest_seq is None or seq < self.oldest_seq):
+            self.oldest_seq = seq
+
+    def message_start(self, at):
+        """The fixed index where a message inserted at `at` begins"""
+        return self.chat_display.index("end-1c" if at == "end" else at)
+
+    def mark_message(self, msg, start):
+        """Remembers where a message is shown, so search hits can jump to it"""
+        seq = msg.get("seq")
+        if seq is None:
+            return
+        mark = f"seq_{seq}"
+        self.chat_display.mark_set(mark, start)
+        # Moves along when older history is put in front of it
+        self.chat_display.mark_gravity(mark, "right")
+
+    def show_history(self, msg):
+        """Shows the recent messages the server replays after login"""
+        self.append_to_chat("── Earlier messages ──", "system")
+        for past in msg.get("messages", []):
+            self.display_past_message(past)
+        self.append_to_chat("── New messages ──", "system")
+
+    def show_mailbox(self, messages):
+        """Shows the private messages that were sent while the user was offline"""
+        # They can be older than the history already shown; paging goes on from there
+        oldest_seq = self.oldest_seq
+        self.append_to_chat("── Sent to you while you were offline ──", "system")
+        for past in messages:
+            self.display_past_message(past)
+        self.oldest_seq = oldest_seq
+
+    def show_channel_joined(self, msg):
+        """Shows the recent messages of a channel just joined"""
+        channel = msg.get("channel")
+        members = ", ".join(msg.get("members", []))
+        self.append_to_chat(f"Joined {channel} ({members}) - send to it with To: {channel}", "system")
+        for past in msg.get("messages", []):
+            self.display_past_message(past)
+
+    def on_chat_scroll(self, event=None):
+        # Check once the scroll has been applied
+        self.root.after_idle(self.load_older_history)
+
+    def load_older_history(self, force=False, limit=HISTORY_PAGE_SIZE):
+        """Fetches the page before the oldest shown message when scrolled to the top"""
+        if self.history_loading or self.history_exhausted:
+            return
+        if not force and self.chat_display.yview()[0] > 0:
+            return
+        request_msg = {
+            "type": "history_request",
+            "sender": self.username,
+            "channel": "all",
+            "limit": limit,
+        }
+        if self.oldest_seq is not None:
+            request_msg["before_seq"] = self.oldest_seq
+        self.history_loading = True
+        try:
+            send_msg(self.client, self.session.seal(request_msg))
+        except Exception as e:
+            self.history_loading = False
+            print(f"[HISTORY ERROR] {e}")
+
+    def show_history_page(self, msg):
+        """Puts a page of older messages above everything shown so far"""
+        self.history_loading = False
+        self.history_exhausted = not msg.get("has_more")
+        messages = msg.get("messages", [])
+        if messages:
+            # A mark with right gravity moves past each insert, keeping order
+            self.chat_display.mark_set("history_top", "1.0")
+            self.chat_display.mark_gravity("history_top", "right")
+            for past in messages:
+                self.display_past_message(past, at="history_top")
+            if self.history_exhausted:
+                self.append_to_chat("── Beginning of history ──", "system", at="1.0")
+        if self.jump_target is not None:
+            self.jump_to_message(self.jump_target)
+
+    def send_search(self):
+        """Asks the server for the messages best matching the search box"""
+        query = self.search_input.get().strip()
+        if not query:
+            return
+        search_msg = {
+            "type": "search",
+            "sender": self.username,
+            "query": query,
+            "limit": SEARCH_LIMIT,
+        }
+        try:
+            send_msg(self.client, self.session.seal(search_msg))
+        except Exception as e:
+            print(f"[SEARCH ERROR] {e}")
+
+    def show_search_results(self, msg):
+        """Lists search hits, best first; clicking one jumps to it in the chat"""
+        if self.search_window is not None and self.search_window.winfo_exists():
+            self.search_window.destroy()
+        self.search_window = ctk.CTkToplevel(self.root)
+        self.search_window.title(f"Search: {msg.get('query', '')}")
+        self.search_window.geometry("520x400")
+
+        results = ctk.CTkScrollableFrame(self.search_window, corner_radius=8)
+        results.pack(fill="both", expand=True, padx=10, pady=10)
+        hits = msg.get("messages", [])
+        if not hits:
+            ctk.CTkLabel(results, text="No messages found",
+                         font=CTkFont(size=12)).pack(pady=20)
+        for hit in hits:
+            sender = hit.get("sender", "")
+            if hit.get("receiver"):
+                sender = f"🔒 {sender} → {hit['receiver']}"
+            text = hit.get("message", "")
+            if hit.get("type") == "file":
+                text = f"📎 {text}"
+            label = f"[{hit.get('timestamp', '')}] {sender}: {self._apply_emojis(text)}"
+            ctk.CTkButton(
+                results,
+                text=label if len(label) <= 90 else label[:87] + "...",
+                anchor="w",
+                fg_color="transparent",
+                font=CTkFont(size=12),
+                command=lambda seq=hit.get("seq"): self.jump_to_message(seq)
+            ).pack(fill="x", padx=5, pady=2)
+
+    def jump_to_message(self, seq):
+        """Scrolls to a message, paging in older history until it is shown"""
+        mark = f"seq_{seq}"
+        if mark in self.chat_display.mark_names():
+            self.jump_target = None
+            self.chat_display.tag_config("search_hit", background="#5A4A1A")
+            self.chat_display.tag_remove("search_hit", "1.0", "end")
+            self.chat_display.tag_add("search_hit", mark, f"{mark} lineend")
+            self.chat_display.see(mark)
+            return
+        if seq is None or self.history_exhausted or \
+                (self.oldest_seq is not None and seq >= self.oldest_seq):
+            self.jump_target = None
+            self.append_to_chat("That message is no longer available", "system")
+            return
+        self.jump_target = seq
+        self.load_older_history(force=True, limit=HISTORY_PAGE_MAX)
+
+    def open_data_channel(self, token):
+        """
+        Opens the second connection the server offered for file
+        transfers, so uploads and downloads never hold up chat.
+        """
+        try:
+            sock = socket.create_connection((SERVER_IP, SERVER_PORT))
+            attach_msg = {
+                "type": "data_channel_attach",
+                "sender": self.username,
+                "token": token,
+            }
+            # Under the shared key; the data channel's own session keys follow
+            send_msg(sock, encrypt_message(json.dumps(attach_msg)))
+        except Exception as e:
+            print(f"[DATA CHANNEL] Unavailable, sending files inline: {e}")
+            return
+        self.data_cipher = self.session.data_cipher
+        self.data_client = sock
+        threading.Thread(target=self.receive_messages, args=(
+            FrameReader(sock), True), daemon=True).start()
+
+    def resume_chat(self):
+        """
+        Gets back into the session after the chat connection drops.
+        Returns (reader, early frames) on success, or None.
+        """
+        self.root.after(0, lambda: self.append_to_chat(
+            "🟡 Connection lost, reconnecting...", "system"))
+        resumed = resume_session(
+            self.session, self.username,
+            lambda: socket.create_connection((SERVER_IP, SERVER_PORT)))
+        if resumed is None:
+            self.root.after(0, lambda: self.append_to_chat(
+                "🔴 Disconnected from the server", "system"))
+            return None
+        self.client, self.reader, reply, early = resumed
+        missed = self.session.accept(reply)
+        self.root.after(0, lambda: self.show_resumed(missed))
+        resend_unacked(self.outbox, self.client, self.session)
+        return self.reader, early
+
+    def show_resumed(self, missed):
+        """Shows what was said while the connection was down"""
+        self.append_to_chat(
+            f"🟢 Reconnected, {len(missed)} missed message(s)", "system")
+        for past in missed:
+            self.display_past_message(past)
+
+    def on_close(self):
+        # Tell the server this is a logout, so nobody waits for a resume
+        try:
+            send_msg(self.client, self.session.seal(build_message(
+                "system", self.username, "disconnect")))
+        except Exception:
+            pass
+        self.root.destroy()
+
+    def receive_messages(self, reader=None, is_data_channel=False):
+        # The chat connection shares the buffered reader used during login
+        reader = reader or self.reader
+        # The data channel keeps its keys; the chat connection's change when it is resumed
+        channel_cipher = self.data_cipher
+        pending = deque()  # messages received while resuming, handled first
         while True:
             try:
-                # Use the new robust receiving function
-                data = recv_msg(self.client)
-                if not data:
-                    break
-                decrypted = decrypt_message(data)
-                msg = parse_message(decrypted)
+                try:
+                    data = None if pending else reader.read_frame()
+                except OSError:
+                    data = None  # a reset connection counts as closed
+                if not pending and not data:
+                    if is_data_channel:
+                        # Transfers fall back to the chat connection
+                        self.data_client = None
+                    # Kept .part files let these be resumed later. Downloads
+                    # on the chat connection carry on if only the data channel closed
+                    self.downloads.fail_all("connection lost", "data" if is_data_channel else None)
+                    if is_data_channel:
+                        break
+                    resumed = self.resume_chat()
+                    if resumed is None:
+                        break
+                    reader, early = resumed
+                    pending.extend(early)
+                    continue
+                if pending:
+                    msg = pending.popleft()
+                elif is_data_channel:
+                    msg = parse_payload(decrypt_frame(data, channel_cipher))
+                else:
+                    msg = self.session.open(data)
+
+                if msg.get("type") == "file_chunk":
+                    self.downloads.write_chunk(msg)
+                    continue
+                if not is_data_channel and not self.session.update(msg):
+                    continue
 
                 msg_type = msg.get("type")
-                sender = msg.get("sender")
                 message = msg.get("message")
-                timestamp = msg.get("timestamp")
-                receiver = msg.get("receiver", "")
-
-                if msg_type == "public":
-                    # Translate the message before displaying
-                    translated_message = self._apply_emojis(message)
-                    self.append_to_chat(
-                        f"{sender}: {translated_message}", "public")
-
-                elif msg_type == "private":
-                    if sender == self.username:
-                        # This part handles messages you send, which don't need translation here
-                        self.append_to_chat(
-                            f"{receiver}: {message}", "private_sent")
-                    else:
-                        # Translate the message before displaying
-                        translated_message = self._apply_emojis(message)
-                        self.append_to_chat(
-                            f"{sender}: {translated_message}", "private_received")
+
+                if msg_type in ("public", "private", "channel_message"):
+                    # Through after() too, so replayed history stays in order
+                    self.root.after(0, lambda m=msg: self.display_chat_message(m))
+
+                elif msg_type == "ack":
+                    self.outbox.acked(msg)
+
+                elif msg_type == "mailbox":
+                    queued, ack = self.session.take_mailbox(msg, self.username)
+                    send_msg(self.client, self.session.seal(ack))
+                    if queued:
+                        self.root.after(0, lambda q=queued: self.show_mailbox(q))
+
+                elif msg_type == "queued":
+                    text = f"{msg.get('receiver')} is offline; they will get it when they log in."
+                    self.root.after(0, lambda t=text: self.append_to_chat(t, "system"))
+
+                elif msg_type == "channel_joined":
+                    self.session.note_replayed(msg.get("messages", []))
+                    self.root.after(0, lambda m=msg: self.show_channel_joined(m))
+
+                elif msg_type == "channel_left":
+                    text = f"Left {msg.get('channel')}"
+                    self.root.after(0, lambda t=text: self.append_to_chat(t, "system"))
+
+                elif msg_type in ("channel_join", "channel_leave"):
+                    action = "joined" if msg_type == "channel_join" else "left"
+                    text = f"{msg.get('user')} {action} {msg.get('channel')}"
+                    self.root.after(0, lambda t=text: self.append_to_chat(t, "system"))
+
+                elif msg_type == "history":
+                    self.root.after(0, lambda m=msg: self.show_history(m))
+
+                elif msg_type == "history_page":
+                    self.root.after(0, lambda m=msg: self.show_history_page(m))
+
+                elif msg_type == "search_results":
+                    self.root.after(0, lambda m=msg: self.show_search_results(m))
+
+                elif msg_type == "data_channel":
+                    self.open_data_channel(msg.get("token"))
+
+                elif msg_type in ("presence_snapshot", "presence_join", "presence_leave"):
+                    # Use after() to safely update GUI from thread
+                    self.root.after(0, lambda m=msg: self.apply_presence(m))
+
+                elif msg_type == "file_upload_ready":
+                    ready = self.pending_uploads.get(msg.get("upload_id"))
+                    if ready:
+                        ready["msg"] = msg
+                        ready["event"].set()
 
                 elif msg_type == "system":
-                    if message.startswith("user_list:"):
-                        users = message.split(":", 1)[1].split(",")
-                        # Use after() to safely update GUI from thread
-                        self.root.after(
-                            0, lambda u=users: self.update_users_list(u))
-                    else:
-                        self.root.after(
-                            0, lambda m=message: self.append_to_chat(m, "system"))
+                    self.root.after(
+                        0, lambda m=message: self.append_to_chat(m, "system"))
 
                 elif msg_type == "file":
                     # Use after() to safely handle file message from thread
                     self.root.after(
                         0, lambda m=msg: self.handle_file_message(m))
 
-                elif msg_type == "file_download":
-                    filename = msg.get("message")
-                    file_data_b64 = msg.get("file_data")
-
-                    if file_data_b64:
-                        file_data = base64.b64decode(file_data_b64)
-
-                        # Check if this is for preview or download
-                        if hasattr(self, 'pending_preview_filename') and self.pending_preview_filename == filename:
-                            # This is for preview
-                            if self.is_image_file(filename):
-                                self.root.after(0, lambda: self.append_to_chat(
-                                    f"Image from server: {filename}",
-                                    "file",
-                                    image_data=file_data,
-                                    image_filename=filename
-                                ))
-                            self.pending_preview_filename = None
-
-                        elif hasattr(self, 'pending_download_path') and self.pending_download_path:
-                            # This is for download
-                            try:
-                                with open(self.pending_download_path, "wb") as f:
-                                    f.write(file_data)
-                                self.root.after(0, lambda: self.append_to_chat(
-                                    f"Downloaded: {filename}", "system"))
-                                self.pending_download_path = None
-                            except Exception as e:
-                                self.root.after(0, lambda: messagebox.showerror(
-                                    "Download Error", str(e)))
+                elif msg_type == "file_download_begin":
+                    self.downloads.begin(msg)
+
+                elif msg_type == "file_download_end":
+                    self.downloads.finish(msg)
+
+                elif msg_type == "file_download_error":
+                    self.downloads.error(msg)
+
+                elif msg_type == "file_error":
+                    # A refused upload or download request
+                    ready = self.pending_uploads.get(msg.get("upload_id"))
+                    if ready:
+                        ready["msg"] = msg
+                        ready["event"].set()
+                    else:
+                        self.downloads.error(msg)
 
             except Exception as e:
                 print(f"[RECEIVE ERROR] {e}")
                 break
 
+    def create_transfer_widget(self, transfer):
+        """Adds a progress row for a transfer to the download panel"""
+        row = ctk.CTkFrame(self.download_frame, corner_radius=8)
+        row.pack(fill="x", padx=5, pady=4)
+
+        kind = "🖼 Preview" if transfer.is_preview else "⬇ Download"
+        name_label = ctk.CTkLabel(
+            row,
+            text=f"{kind}: {transfer.filename}",
+            font=CTkFont(size=11)
+        )
+        name_label.pack(side="left", padx=10)
+
+        status_label = ctk.CTkLabel(
+            row,
+            text="Waiting..." if transfer.state == "queued" else "Starting...",
+            font=CTkFont(size=10),
+            text_color="#888888",
+            width=70
+        )
+        status_label.pack(side="right", padx=10)
+
+        progress_bar = ctk.CTkProgressBar(row, height=10)
+        progress_bar.set(0)
+        progress_bar.pack(side="right", padx=5, fill="x", expand=True)
+
+        self.transfer_widgets[transfer.transfer_id] = {
+            "frame": row,
+            "bar": progress_bar,
+            "status": status_label,
+        }
+
+    def update_transfer_widget(self, transfer):
+        widgets = self.transfer_widgets.get(transfer.transfer_id)
+        if not widgets or not transfer.total:
+            return
+        widgets["bar"].set(transfer.received / transfer.total)
+        widgets["status"].configure(
+            text=f"{transfer.percent}% of {self.format_file_size(transfer.total)}")
+
+    def remove_transfer_widget(self, transfer):
+        widgets = self.transfer_widgets.pop(transfer.transfer_id, None)
+        if widgets:
+            widgets["frame"].destroy()
+
+    def complete_transfer(self, transfer, data):
+        """Shows a finished download or the previewed image"""
+        self.remove_transfer_widget(transfer)
+        if not transfer.is_preview:
+            self.append_to_chat(f"Downloaded: {transfer.filename}", "system")
+        elif self.is_image_file(transfer.filename):
+            self.append_to_chat(
+                f"Image from server: {transfer.filename}",
+                "file",
+                image_data=data,
+                image_filename=transfer.filename
+            )
+
+    def fail_transfer(self, transfer, reason):
+        self.remove_transfer_widget(transfer)
+        self.append_to_chat(
+            f"Download of {transfer.filename} failed: {reason}", "system")
+
     def run(self):
         """Start the GUI application"""
         self.root.mainloop()
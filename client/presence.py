@@ -0,0 +1,51 @@
+"""
+client/presence.py
+
+Keeps the list of online users in step with the server's versioned
+presence messages: a full presence_snapshot on login, then one
+presence_join / presence_leave delta per change. A skipped version
+means a delta was lost, and the caller should ask for a new snapshot.
+"""
+
+
+class PresenceTracker:
+
+    def __init__(self):
+        self.version = None  # None until the first snapshot arrives
+        self.users = []      # in the order they joined
+
+    def apply(self, msg):
+        """
+        Applies one presence message. Returns what changed:
+            ("snapshot", users)  - replace the whole list
+            ("join", user, index) / ("leave", user, index)
+            ("gap",)             - versions were skipped; request a snapshot
+            None                 - nothing to do (stale or duplicate)
+        """
+        msg_type = msg.get("type")
+        version = msg.get("version", 0)
+
+        if msg_type == "presence_snapshot":
+            self.version = version
+            self.users = list(msg.get("users", []))
+            return ("snapshot", list(self.users))
+
+        if self.version is None or version <= self.version:
+            return None
+        if version != self.version + 1:
+            return ("gap",)
+        self.version = version
+
+        user = msg.get("user")
+        if msg_type == "presence_join":
+            if user in self.users:
+                return None
+            self.users.append(user)
+            return ("join", user, len(self.users) - 1)
+        if msg_type == "presence_leave":
+            if user not in self.users:
+                return None
+            index = self.users.index(user)
+            del self.users[index]
+            return ("leave", user, index)
+        return None
@@ -0,0 +1,228 @@
+"""
+client/session.py
+
+Resuming a chat session after the connection drops. The server sends a
+resume token after every login or resume; the client keeps it together
+with the highest message seq it has seen, and after a drop reconnects
+with a resume message instead of logging in again. Within the server's
+grace period nobody else sees the user leave and join, and only the
+messages the user missed are sent. Chat messages the server had not
+acknowledged when the connection dropped are then sent again.
+
+Every login and resume also offers a fresh key exchange; ResumeState
+keeps the session keys the server agrees to and encrypts with them.
+"""
+
+import base64
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from shared.common import send_msg, FrameReader, parse_payload, current_timestamp
+from shared.encrypt import (encrypt_message, decrypt_frame, AEAD_CIPHERS, new_key_exchange,
+                            derive_session_ciphers)
+from shared.codec import CODECS, seal
+from shared.compress import COMPRESSIONS
+from shared.config import RESUME_ATTEMPTS, RESUME_RETRY_DELAY
+
+
+class ResumeState:
+
+    def __init__(self):
+        self.token = None    # None until the server offers a session
+        self.codec = "json"  # wire codec the server agreed to
+        self.compression = None  # and payload compression, if any
+        self.cipher = None  # session keys of the chat connection; None: the shared key
+        self.data_cipher = None  # and of the data channel
+        self._private_key = None  # our half of the key exchange in progress
+        self.last_seq = -1   # highest seq received so far
+        self.replayed = set()  # seqs sent in the last resume reply
+        self.delivered = set()  # seqs already taken from the mailbox
+
+    def update(self, msg):
+        """
+        Tracks the token and seqs of one received message. Returns False
+        for a message that was already shown from a resume reply.
+        """
+        if msg.get("type") == "session":
+            self.token = msg.get("token")
+            self.codec = msg.get("codec", "json")
+            self.compression = msg.get("compression")
+        if msg.get("type") in ("history", "mailbox"):
+            # Login catch-up: a resume only needs what came after it
+            seqs = [m["seq"] for m in msg.get("messages", []) if m.get("seq") is not None]
+            self.last_seq = max([self.last_seq] + seqs)
+        seq = msg.get("seq")
+        if seq is None:
+            return True
+        if seq in self.replayed:
+            # Recorded just before the resume, so it came both ways
+            self.replayed.discard(seq)
+            return False
+        self.last_seq = max(self.last_seq, seq)
+        return True
+
+    def request(self, username):
+        return {
+            "type": "resume",
+            "sender": username,
+            "token": self.token,
+            "last_seq": self.last_seq,
+            "codecs": list(CODECS),
+            "compression": list(COMPRESSIONS),
+            "ciphers": list(AEAD_CIPHERS),
+            "key_exchange": self.offer_key(),
+        }
+
+    def offer_key(self):
+        """
+        Starts the key exchange for a new connection, which uses the
+        shared key until the server answers. Returns our public key.
+        """
+        self.cipher = self.data_cipher = None
+        self._private_key, public_key = new_key_exchange()
+        return base64.b64encode(public_key).decode("ascii")
+
+    def key_agreed(self, msg):
+        """Takes in the server's key_exchange answer and switches to the session keys."""
+        self.cipher, self.data_cipher = derive_session_ciphers(
+            msg.get("cipher"), self._private_key,
+            base64.b64decode(msg.get("key_exchange", "")), is_client=True)
+        self._private_key = None
+
+    def seal(self, message):
+        """Encrypts a message (a dict, or JSON text) for the chat connection."""
+        return seal(message, self.codec, self.compression, self.cipher)
+
+    def open(self, data):
+        """Decrypts and parses a frame received on the chat connection."""
+        return parse_payload(decrypt_frame(data, self.cipher))
+
+    def accept(self, reply):
+        """Takes in a resumed reply and returns its missed messages, oldest first."""
+        self.replayed = set()
+        return self.note_replayed(reply.get("messages", []))
+
+    def note_replayed(self, messages):
+        """
+        Records messages sent in a reply (resumed, channel_joined) that
+        may also arrive live, and returns them.
+        """
+        seqs = {m["seq"] for m in messages if m.get("seq") is not None}
+        self.replayed |= seqs
+        if seqs:
+            self.last_seq = max(self.last_seq, max(seqs))
+        return messages
+
+    def take_mailbox(self, msg, username):
+        """
+        Takes in a mailbox delivery. Returns the messages not shown yet
+        (a delivery repeated after a drop only brings old ones) and the
+        acknowledgement to send for all of them.
+        """
+        messages = msg.get("messages", [])
+        new = [m for m in messages if m.get("seq") not in self.delivered]
+        self.delivered.update(m.get("seq") for m in new)
+        ack = {
+            "type": "mailbox_ack",
+            "sender": username,
+            "seqs": [m.get("seq") for m in messages],
+        }
+        return new, ack
+
+
+def login_request(username, key_exchange=None):
+    """
+    The login message, offering the wire codecs and compression this
+    client speaks, and session keys if `key_exchange` (from
+    ResumeState.offer_key()) is given.
+    """
+    msg = {
+        "type": "system",
+        "sender": username,
+        "timestamp": current_timestamp(),
+        "message": "login_request",
+        "codecs": list(CODECS),
+        "compression": list(COMPRESSIONS),
+    }
+    if key_exchange:
+        msg["ciphers"] = list(AEAD_CIPHERS)
+        msg["key_exchange"] = key_exchange
+    return json.dumps(msg)
+
+
+class Outbox:
+    """
+    Chat messages sent but not acknowledged yet, by client message ID.
+    After a resume they are sent again; the server acks the ones it
+    already had without relaying them twice.
+    """
+
+    def __init__(self):
+        self.in_flight = OrderedDict()  # id → message JSON, oldest first
+        self._lock = threading.Lock()
+
+    def track(self, msg):
+        """Gives a chat message (a dict) an ID, keeps it until acked and returns its JSON."""
+        msg["id"] = uuid.uuid4().hex
+        message_json = json.dumps(msg)
+        with self._lock:
+            self.in_flight[msg["id"]] = message_json
+        return message_json
+
+    def acked(self, ack):
+        """Forgets the message an ack is for. Returns False if it was not in flight."""
+        with self._lock:
+            return self.in_flight.pop(ack.get("id"), None) is not None
+
+    def unacked(self):
+        with self._lock:
+            return list(self.in_flight.values())
+
+
+def resend_unacked(outbox, sock, state=None):
+    """Sends everything still in flight on a resumed connection, sealed for `state`."""
+    for message_json in outbox.unacked():
+        send_msg(sock, state.seal(message_json) if state else seal(message_json))
+
+
+def resume_session(state, username, connect, attempts=RESUME_ATTEMPTS, delay=RESUME_RETRY_DELAY):
+    """
+    Reconnects with `connect()` and resumes the session.
+    Returns (sock, reader, reply, early) - `early` being the messages
+    that arrived ahead of the reply, to be handled after it - or None if
+    the session is gone or the server can't be reached.
+    """
+    if state.token is None:
+        return None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(delay)
+        try:
+            sock = connect()
+        except OSError:
+            continue
+        try:
+            send_msg(sock, encrypt_message(json.dumps(state.request(username))))
+            reader = FrameReader(sock)
+            early = []
+            while True:
+                data = reader.read_frame()
+                if not data:
+                    raise ConnectionError("connection closed while resuming")
+                msg = state.open(data)
+                if msg.get("type") == "key_exchange":
+                    state.key_agreed(msg)
+                    continue
+                if msg.get("type") == "resumed":
+                    return sock, reader, msg, early
+                if msg.get("type") == "resume_failed":
+                    sock.close()
+                    state.token = None
+                    return None
+                early.append(msg)
+        except Exception:
+            sock.close()
+    return None
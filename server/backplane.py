@@ -0,0 +1,433 @@
+"""
+server/backplane.py
+
+Joins several chat servers ("nodes", e.g. behind a TCP load balancer)
+into one chat. Each node keeps its own clients, history, log and files;
+the backplane carries what has to cross between them:
+
+  publish   events for every other node ("all"), one node ("node:NAME")
+            or whichever node a user is on ("user:NAME"): chat messages,
+            channel changes, file copies. A node sends what it published
+            as one batch every BACKPLANE_BATCH_MS, or as soon as
+            BACKPLANE_BATCH_MAX events are waiting.
+  presence  which node each user is on. claim() is the cluster-wide
+            duplicate-name check at login; the other nodes hear of joins
+            and leaves as events.
+  files     which node stores each shared file, so a download of a file
+            uploaded elsewhere can fetch a copy first.
+
+A Broker holds that state and routes the batches. MemoryBackplane talks
+to one in the same process: the stand-in for tests and for a single
+node. BrokerBackplane talks to one in another process over a Unix socket
+(python -m server.backplane PATH), in the same frames as the worker bus
+(server/workers.py). Either way a node gets the events for it in order,
+a list at a time, on a thread of the backplane's own.
+
+Events the broker sends itself:
+  join{user, node}     a user logged in on another node
+  leave{user}          and left the chat
+  claimed{user, node}  a user this node kept a dropped session for
+                       logged in again on `node`
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import os
+import queue
+import socket
+import threading
+
+from shared import codec
+from shared.config import BACKPLANE_BATCH_MS, BACKPLANE_BATCH_MAX, BACKPLANE_TIMEOUT
+from server.workers import BusSocket
+
+# What nodes may ask a broker over its socket (Broker methods)
+CALLS = ("claim", "set_away", "release", "add_file", "locate")
+
+
+class Broker:
+    """
+    The cluster's shared state: nodes, who is on which, and where files
+    are. Deliveries are worked out under the lock but made after it is
+    released, so a node slow to take its events holds up no one else.
+    """
+
+    def __init__(self):
+        self.nodes = {}  # node → deliver(events)
+        self.users = {}  # username → [node, away]
+        self.files = {}  # file_id → node
+        self._lock = threading.Lock()
+
+    def attach(self, node, deliver):
+        """Adds a node. Returns {username: node} of the users already online."""
+        with self._lock:
+            if node in self.nodes:
+                raise ValueError(f"node {node} is already attached")
+            self.nodes[node] = deliver
+            return {user: entry[0] for user, entry in self.users.items()}
+
+    def detach(self, node):
+        """Drops a node with its users and files; the other nodes see its users leave."""
+        with self._lock:
+            if self.nodes.pop(node, None) is None:
+                return
+            gone = [user for user, entry in self.users.items() if entry[0] == node]
+            for user in gone:
+                del self.users[user]
+            self.files = {file_id: owner for file_id, owner in self.files.items() if owner != node}
+            deliveries = self._to_others(node, [{"kind": "leave", "user": user} for user in gone])
+        send(deliveries)
+        logging.info(f"[BACKPLANE] {node} detached, {len(gone)} users gone")
+
+    def _to_others(self, node, events):
+        """[(deliver, events)] for every node but `node`. Call with the lock held."""
+        if not events:
+            return []
+        return [(deliver, events) for other, deliver in self.nodes.items() if other != node]
+
+    def claim(self, node, user):
+        """
+        Puts `user` on `node`. False if they are online on another node;
+        a session dropped there gives way, as a fresh login does on one node.
+        """
+        deliveries = []
+        with self._lock:
+            entry = self.users.get(user)
+            if entry is not None and entry[0] != node:
+                owner, away = entry
+                if not away:
+                    return False
+                if owner in self.nodes:
+                    deliveries.append((self.nodes[owner], [{"kind": "claimed", "user": user, "node": node}]))
+            self.users[user] = [node, False]
+            if entry is None or entry[0] != node:
+                deliveries += self._to_others(node, [{"kind": "join", "user": user, "node": node}])
+        send(deliveries)
+        return True
+
+    def set_away(self, node, user, away):
+        """Marks a user of `node` as in (or out of) their resume grace period."""
+        with self._lock:
+            entry = self.users.get(user)
+            if entry is not None and entry[0] == node:
+                entry[1] = bool(away)
+
+    def release(self, node, user):
+        """A user of `node` left the chat."""
+        with self._lock:
+            entry = self.users.get(user)
+            if entry is None or entry[0] != node:
+                return
+            del self.users[user]
+            deliveries = self._to_others(node, [{"kind": "leave", "user": user}])
+        send(deliveries)
+
+    def add_file(self, node, file_id):
+        with self._lock:
+            self.files[file_id] = node
+
+    def locate(self, node, file_id):
+        """The node storing a file, or None."""
+        with self._lock:
+            return self.files.get(file_id)
+
+    def route(self, node, batch):
+        """
+        Delivers a batch of [target, event] pairs from `node`, one list
+        per receiving node, in the order they were published.
+        """
+        out = {}  # node → its events
+        with self._lock:
+            for target, event in batch:
+                if target == "all":
+                    receivers = [other for other in self.nodes if other != node]
+                elif target.startswith("user:"):
+                    entry = self.users.get(target[len("user:"):])
+                    receivers = [entry[0]] if entry is not None and entry[0] != node else []
+                else:
+                    receivers = [target[len("node:"):]]
+                for receiver in receivers:
+                    out.setdefault(receiver, []).append(event)
+            deliveries = [(self.nodes[receiver], events) for receiver, events in out.items()
+                          if receiver in self.nodes]
+        send(deliveries)
+
+
+def send(deliveries):
+    """Hands each node its events; see Broker."""
+    for deliver, events in deliveries:
+        deliver(events)
+
+
+class Backplane:
+    """A node's end of the backplane; MemoryBackplane and BrokerBackplane say how it reaches the broker."""
+
+    def __init__(self, node, batch_ms=BACKPLANE_BATCH_MS, batch_max=BACKPLANE_BATCH_MAX):
+        self.node = node
+        self.batch_delay = batch_ms / 1000
+        self.batch_max = batch_max
+        self.batches = 0  # sent so far
+        self._pending = []  # [target, event] pairs not sent yet
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()  # batches leave in order
+        self._inbox = queue.Queue()  # event lists for the handler; None: stop
+        self._closed = False
+
+    def start(self, handler, on_lost=None):
+        """
+        Joins the cluster. handler(events) gets what the other nodes send;
+        on_lost() is called if the broker goes away. Returns {username: node}
+        of the users online elsewhere.
+        """
+        threading.Thread(target=self._dispatch_loop, args=(handler,), daemon=True).start()
+        users = self._attach(on_lost)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        return users
+
+    def publish(self, target, event):
+        """Queues an event for "all" other nodes, "node:NAME" or "user:NAME"."""
+        with self._cond:
+            self._pending.append([target, event])
+            # Wake the flusher for the first event of a batch, and when it is full
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_max:
+                self._cond.notify()
+
+    def flush(self):
+        """Sends what was published so far, so it arrives before anything after it."""
+        with self._send_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if batch:
+                self.batches += 1
+                self._route(batch)
+
+    def _flush_loop(self):
+        while not self._closed:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                # Give the batch a moment to fill up
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch_max or self._closed,
+                                    self.batch_delay)
+            try:
+                self.flush()
+            except OSError as e:
+                logging.error(f"[BACKPLANE] Could not publish: {e}")
+
+    def _dispatch_loop(self, handler):
+        while True:
+            events = self._inbox.get()
+            if events is None:
+                return
+            try:
+                handler(events)
+            except Exception as e:
+                logging.exception(f"[BACKPLANE] Failed to handle events: {e}")
+
+    def _deliver(self, events):
+        self._inbox.put(events)
+
+    # The registry: what was published before goes out first
+    def claim(self, user):
+        """Whether `user` may log in here (see Broker.claim)."""
+        return self._call("claim", user)
+
+    def set_away(self, user, away):
+        self._call("set_away", user, away)
+
+    def release(self, user):
+        self._call("release", user)
+
+    def add_file(self, file_id):
+        self._call("add_file", file_id)
+
+    def locate(self, file_id):
+        """The node storing a file, or None."""
+        return self._call("locate", file_id)
+
+    def _call(self, name, *args):
+        self.flush()
+        return self._request(name, *args)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        try:
+            self.flush()
+        except OSError:
+            pass  # the broker is gone already
+        self._inbox.put(None)
+
+
+class MemoryBackplane(Backplane):
+    """
+    Nodes in one process sharing a Broker. Events still go through the
+    binary codec, so what works here works over a socket.
+    """
+
+    def __init__(self, node, broker=None, **options):
+        super().__init__(node, **options)
+        self.broker = broker if broker is not None else Broker()
+
+    def _attach(self, on_lost):
+        return self.broker.attach(self.node, lambda events: self._deliver(codec.decode(codec.encode(events))))
+
+    def _route(self, batch):
+        self.broker.route(self.node, codec.decode(codec.encode(batch)))
+
+    def _request(self, name, *args):
+        return getattr(self.broker, name)(self.node, *args)
+
+    def close(self):
+        super().close()
+        self.broker.detach(self.node)
+
+
+class BrokerBackplane(Backplane):
+    """A node talking to a BrokerServer over its Unix socket."""
+
+    def __init__(self, path, node, **options):
+        super().__init__(node, **options)
+        self.path = path
+        self.link = None
+        self._replies = {}  # request id → Future of the broker's answer
+        self._ids = itertools.count(1)
+
+    def _attach(self, on_lost):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.link = BusSocket(sock)
+        threading.Thread(target=self._read, args=(on_lost,), daemon=True).start()
+        return self._request("attach", self.node)
+
+    def _read(self, on_lost):
+        try:
+            for op in self.link.ops():
+                if op["op"] == "events":
+                    self._deliver(op["events"])
+                else:
+                    future = self._replies.pop(op["id"], None)
+                    if future is None:
+                        continue
+                    if "error" in op:
+                        future.set_exception(ValueError(op["error"]))
+                    else:
+                        future.set_result(op.get("value"))
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                logging.error(f"[BACKPLANE] Bad link to the broker: {e}")
+        if not self._closed and on_lost is not None:
+            on_lost()
+
+    def _route(self, batch):
+        self.link.send({"op": "route", "batch": batch})
+
+    def _request(self, name, *args):
+        request_id = next(self._ids)
+        future = self._replies[request_id] = concurrent.futures.Future()
+        self.link.send({"op": "call", "id": request_id, "name": name, "args": list(args)})
+        try:
+            return future.result(BACKPLANE_TIMEOUT)
+        finally:
+            self._replies.pop(request_id, None)
+
+    def close(self):
+        super().close()
+        if self.link is not None:
+            self.link.close()
+
+
+class BrokerServer:
+    """A Broker serving nodes on a Unix socket, one thread per node."""
+
+    def __init__(self, path, broker=None):
+        self.path = path
+        self.broker = broker if broker is not None else Broker()
+        if os.path.exists(path):
+            os.remove(path)  # left over from a broker that died
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        # Nodes run as the same user
+        os.chmod(path, 0o600)
+        self.listener.listen()
+
+    def serve(self):
+        """Accepts nodes until close()."""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_node, args=(BusSocket(sock),), daemon=True).start()
+
+    def _serve_node(self, link):
+        node = None
+
+        def deliver(events):
+            try:
+                link.send({"op": "events", "events": events})
+            except OSError:
+                pass  # its reader notices
+
+        try:
+            for op in link.ops():
+                if op["op"] == "route":
+                    if node is not None:
+                        self.broker.route(node, op["batch"])
+                    continue
+                reply = {"op": "reply", "id": op["id"]}
+                try:
+                    if node is None:
+                        if op["name"] != "attach":
+                            raise ValueError("attach first")
+                        reply["value"] = self.broker.attach(op["args"][0], deliver)
+                        node = op["args"][0]
+                    elif op["name"] in CALLS:
+                        reply["value"] = getattr(self.broker, op["name"])(node, *op["args"])
+                    else:
+                        raise ValueError(f"unknown call {op['name']}")
+                except (ValueError, TypeError, IndexError) as e:
+                    reply["error"] = str(e)
+                link.send(reply)
+        except (OSError, ValueError) as e:
+            logging.error(f"[BACKPLANE] Bad link to {node}: {e}")
+        finally:
+            if node is not None:
+                self.broker.detach(node)
+            link.close()
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_backplane(spec, node):
+    """The backplane for --backplane: "memory" (a single node) or "unix:PATH" (a broker)."""
+    if spec == "memory":
+        return MemoryBackplane(node)
+    if spec.startswith("unix:"):
+        return BrokerBackplane(spec[len("unix:"):], node)
+    raise ValueError(f"Unknown backplane: {spec}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chatroom backplane broker")
+    parser.add_argument("path", help="Unix socket the server nodes connect to (--backplane unix:PATH)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    server = BrokerServer(args.path)
+    logging.info(f"[BACKPLANE] Broker listening on {args.path}")
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
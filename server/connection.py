@@ -0,0 +1,294 @@
+"""
+server/connection.py
+
+Per-client outbound queues. Every connection owns a bounded queue of
+ready-to-send frames that is drained by its own writer (a thread for the
+thread engine, a task for the asyncio engine), so a slow reader only ever
+delays itself.
+"""
+
+import asyncio
+import logging
+import socket
+import threading
+from collections import deque
+
+from shared.config import OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY
+
+# What to do when a client's outbound queue is full:
+#   drop_oldest - discard the oldest queued frame to make room
+#   disconnect  - give up on the client and close its connection
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of frames with an overflow policy.
+    Not thread-safe on its own; the owning connection guards it.
+    """
+
+    def __init__(self, max_size=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_OVERFLOW_POLICY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_size = max_size
+        self.policy = policy
+        self.dropped = 0
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, frame):
+        """
+        Queues a frame. Returns False if the policy says the client
+        should be disconnected instead.
+        """
+        if len(self._items) >= self.max_size:
+            if self.policy == "disconnect":
+                return False
+            self._items.popleft()
+            self.dropped += 1
+        self._items.append(frame)
+        return True
+
+    def get(self):
+        return self._items.popleft()
+
+
+def next_stream_frame(stream):
+    """Returns the next frame of a stream, or None when it is finished."""
+    try:
+        return next(stream)
+    except StopIteration:
+        return None
+    except Exception as e:
+        logging.error(f"[ERROR] Stream failed: {e}")
+        return None
+
+
+class SocketConnection:
+    """
+    Thread engine connection: a blocking socket plus a writer thread
+    that drains the outbound queue.
+    """
+
+    def __init__(self, sock, max_queue=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_OVERFLOW_POLICY):
+        self.sock = sock
+        self.queue = OutboundQueue(max_queue, policy)
+        self.uploads = {}  # upload_id → upload in progress
+        self.streams = deque()  # lazy frame iterators, e.g. file downloads
+        self.bulk = None  # the user's data channel connection, if open
+        self.username = None  # set once the login is accepted
+        self.codec = "json"  # wire codec agreed at login (shared/codec.py)
+        self.compression = None  # payload compression agreed at login (shared/compress.py)
+        self.cipher = None  # session keys agreed at login; None: the shared key
+        self.data_cipher = None  # and those for the user's data channel
+        self.closed = False
+        self._closing = False
+        self._owner_done = False   # close() called: nobody reads any more
+        self._writer_done = False
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    # Blocking reads still go straight to the socket
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self.sock.recv_into(buffer, nbytes)
+
+    def sendall(self, frame):
+        self.enqueue(frame)
+
+    def enqueue(self, frame):
+        with self._cond:
+            if self._closing:
+                return
+            if not self.queue.put(frame):
+                logging.warning("[OVERFLOW] Outbound queue full, disconnecting client")
+                self._abort_locked()
+                return
+            self._cond.notify()
+
+    def add_stream(self, frames):
+        """
+        Queues an iterator of frames (e.g. a file download). The writer
+        pulls one frame at a time, so only one chunk is in memory.
+        """
+        with self._cond:
+            if self._closing:
+                return
+            self.streams.append(frames)
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self.queue and not self.streams and not self._closing:
+                    self._cond.wait()
+                if self.queue:
+                    frame = self.queue.get()
+                elif self.streams and not self._closing:
+                    stream = self.streams[0]
+                    frame = None
+                else:
+                    break
+            if frame is None:
+                # Produce the next stream frame outside the lock
+                frame = next_stream_frame(stream)
+                with self._cond:
+                    if self.streams and self.streams[0] is stream:
+                        if frame is None:
+                            self.streams.popleft()
+                        else:
+                            # Round-robin so parallel transfers share the link
+                            self.streams.rotate(-1)
+                if frame is None:
+                    continue
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                with self._cond:
+                    self._abort_locked()
+                break
+        # The reader may still be using the socket; the last one out closes it
+        with self._cond:
+            self._writer_done = True
+            if self._owner_done:
+                self._close_socket()
+
+    def abort(self):
+        """Drops everything queued and shuts the socket down right away."""
+        with self._cond:
+            self._abort_locked()
+
+    def _abort_locked(self):
+        """Drops everything queued and unblocks both reader and writer."""
+        self._closing = True
+        self.queue = OutboundQueue(self.queue.max_size, self.queue.policy)
+        self.streams.clear()
+        self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_socket(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Stops accepting frames; the writer flushes queued frames, drops
+        unfinished streams, then closes.
+        """
+        with self._cond:
+            self._closing = True
+            self._owner_done = True
+            self.streams.clear()
+            self._cond.notify_all()
+            if self._writer_done:
+                self._close_socket()
+
+
+class StreamConnection:
+    """
+    Asyncio engine connection: a StreamWriter plus a writer task that
+    drains the outbound queue. Only call it from the event loop thread.
+    Stream frames are built on the crypto pool of `offload` (see
+    server/offload.py) if given, so reading, compressing and encrypting
+    file chunks doesn't hold up the loop.
+    """
+
+    def __init__(self, writer, max_queue=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_OVERFLOW_POLICY,
+                 offload=None):
+        self.writer = writer
+        self.offload = offload
+        self.queue = OutboundQueue(max_queue, policy)
+        self.uploads = {}  # upload_id → upload in progress
+        self.streams = deque()  # lazy frame iterators, e.g. file downloads
+        self.bulk = None  # the user's data channel connection, if open
+        self.username = None  # set once the login is accepted
+        self.codec = "json"  # wire codec agreed at login (shared/codec.py)
+        self.compression = None  # payload compression agreed at login (shared/compress.py)
+        self.cipher = None  # session keys agreed at login; None: the shared key
+        self.data_cipher = None  # and those for the user's data channel
+        self.closed = False
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def sendall(self, frame):
+        self.enqueue(frame)
+
+    def enqueue(self, frame):
+        if self._closing:
+            return
+        if not self.queue.put(frame):
+            logging.warning("[OVERFLOW] Outbound queue full, disconnecting client")
+            self.abort()
+            return
+        self._wakeup.set()
+
+    def add_stream(self, frames):
+        """
+        Queues an iterator of frames (e.g. a file download). The writer
+        pulls one frame at a time, so only one chunk is in memory.
+        """
+        if self._closing:
+            return
+        self.streams.append(frames)
+        self._wakeup.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue or (self.streams and not self._closing):
+                    if self.queue:
+                        frame = self.queue.get()
+                    else:
+                        stream = self.streams[0]
+                        if self.offload is not None:
+                            frame = await self.offload.run_async("crypto", next_stream_frame, stream)
+                            if not self.streams or self.streams[0] is not stream:
+                                continue  # dropped while it was being built
+                        else:
+                            frame = next_stream_frame(stream)
+                        if frame is None:
+                            self.streams.popleft()
+                            continue
+                        # Round-robin so parallel transfers share the link
+                        self.streams.rotate(-1)
+                    self.writer.write(frame)
+                    # Only this task waits on a slow reader
+                    await self.writer.drain()
+                if self._closing:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+    def abort(self):
+        """Drops everything queued and closes the transport right away."""
+        self._closing = True
+        self.queue = OutboundQueue(self.queue.max_size, self.queue.policy)
+        self.streams.clear()
+        self.writer.transport.abort()
+        self._wakeup.set()
+
+    def close(self):
+        """
+        Stops accepting frames; the writer flushes queued frames, drops
+        unfinished streams, then closes.
+        """
+        self._closing = True
+        self.streams.clear()
+        self._wakeup.set()
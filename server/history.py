@@ -0,0 +1,184 @@
+"""
+server/history.py
+
+Recent chat history kept in memory: a bounded ring buffer of public
+messages plus a smaller window of private messages per user. Entries are
+stored already serialized, so replaying them on login is just a join
+and one encryption. Older pages are read from the durable message log
+through a per-channel index of sequence numbers.
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import deque
+
+from shared.config import HISTORY_SIZE, PRIVATE_HISTORY_SIZE, MAX_PAYLOAD_SIZE
+
+SNAPSHOT_MAGIC = b"CHANIDX1"
+SNAPSHOT_HEADER = struct.Struct(">QI")  # next seq, channels
+CHANNEL_HEADER = struct.Struct(">HQ")   # name length, seq count
+
+
+class MessageHistory:
+
+    def __init__(self, max_public=HISTORY_SIZE, max_private=PRIVATE_HISTORY_SIZE):
+        self.max_private = max_private
+        self.public = deque(maxlen=max_public)  # (order, json) entries
+        self.private = {}  # username → deque of (order, json) entries
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, message_json, receiver=None, sender=None, queued=False):
+        """
+        Records one relayed message. Private messages (with a receiver)
+        go into the windows of both sender and receiver - only the
+        sender's if it was `queued` in the receiver's mailbox, which
+        delivers it instead.
+        """
+        with self._lock:
+            entry = (next(self._order), message_json)
+            if not receiver:
+                self.public.append(entry)
+                return
+            for user in {sender} if queued else {sender, receiver}:
+                if user:
+                    window = self.private.get(user)
+                    if window is None:
+                        window = self.private[user] = deque(maxlen=self.max_private)
+                    window.append(entry)
+
+    def recent(self, username, limit):
+        """The last `limit` messages `username` may see, oldest first."""
+        with self._lock:
+            public = list(self.public)
+            private = list(self.private.get(username, ()))
+        merged = list(heapq.merge(public, private))
+        return [message_json for _, message_json in merged[-limit:]] if limit > 0 else []
+
+    def batch(self, username, limit):
+        """
+        One history message holding the recent entries, built by joining
+        the stored JSON instead of re-serializing every message. Older
+        entries are left out if they would not fit in one frame.
+        Returns None when there is nothing to replay.
+        """
+        entries = self.recent(username, limit)
+        size = 64  # the message around them
+        for count, entry in enumerate(reversed(entries)):
+            size += len(entry) + 2
+            if size > MAX_PAYLOAD_SIZE:
+                entries = entries[len(entries) - count:]
+                break
+        if not entries:
+            return None
+        return '{"type": "history", "sender": "server", "messages": [' + \
+            ", ".join(entries) + "]}"
+
+
+class ChannelIndex:
+    """
+    For each channel, the sorted sequence numbers of its messages, so a
+    page of older history is found with a binary search instead of a
+    scan. Sequence numbers are 8 bytes each in a compact array. It is
+    saved next to the message log on shutdown, so a restart only indexes
+    the records after it.
+    """
+
+    def __init__(self):
+        self.channels = {}  # channel → array of seqs, ascending
+        self.next_seq = 0   # every message below this is indexed
+        self._lock = threading.Lock()
+
+    def add(self, channel, seq):
+        with self._lock:
+            seqs = self.channels.get(channel)
+            if seqs is None:
+                seqs = self.channels[channel] = array("q")
+            seqs.append(seq)
+            self.next_seq = max(self.next_seq, seq + 1)
+
+    def save(self, path):
+        """Writes the index to `path` (atomically, through a temporary file)."""
+        tmp_path = path + ".tmp"
+        with self._lock, open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(SNAPSHOT_HEADER.pack(self.next_seq, len(self.channels)))
+            for channel, seqs in self.channels.items():
+                name = channel.encode("utf-8")
+                f.write(CHANNEL_HEADER.pack(len(name), len(seqs)))
+                f.write(name)
+                if sys.byteorder == "big":
+                    seqs = array("q", seqs)
+                    seqs.byteswap()
+                f.write(seqs.tobytes())  # stored little-endian
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Replaces the index with the one saved at `path`. Returns False
+        (leaving the index as it was) if there is none or it is unreadable.
+        """
+        channels = {}
+        try:
+            with open(path, "rb") as f:
+                data = memoryview(f.read())
+            if bytes(data[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+                raise ValueError("not a channel index")
+            position = len(SNAPSHOT_MAGIC)
+            next_seq, channel_count = SNAPSHOT_HEADER.unpack_from(data, position)
+            position += SNAPSHOT_HEADER.size
+            for _ in range(channel_count):
+                length, count = CHANNEL_HEADER.unpack_from(data, position)
+                position += CHANNEL_HEADER.size
+                channel = bytes(data[position:position + length]).decode("utf-8")
+                position += length
+                end = position + count * 8
+                if end > len(data):
+                    raise ValueError("truncated channel index")
+                seqs = channels[channel] = array("q")
+                seqs.frombytes(data[position:end])
+                if sys.byteorder == "big":
+                    seqs.byteswap()
+                position = end
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+            logging.warning(f"[LOG] Ignoring unreadable channel index {path}: {e}")
+            return False
+        with self._lock:
+            self.channels = channels
+            self.next_seq = next_seq
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.channels = {}
+            self.next_seq = 0
+
+    def page(self, channels, before_seq, limit, floors=None):
+        """
+        The last `limit` seqs below `before_seq` across `channels`,
+        ascending. `floors` maps a channel to its lowest seq to return.
+        O(log n) per channel plus the page size.
+        """
+        floors = floors or {}
+        found = []
+        with self._lock:
+            for channel in channels:
+                seqs = self.channels.get(channel)
+                if not seqs:
+                    continue
+                start = bisect.bisect_left(seqs, floors.get(channel, 0))
+                end = bisect.bisect_left(seqs, before_seq)
+                found.append(seqs[max(start, end - limit):end])
+        merged = list(heapq.merge(*found))
+        return merged[-limit:] if limit > 0 else []
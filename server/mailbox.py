@@ -0,0 +1,164 @@
+"""
+server/mailbox.py
+
+Store-and-forward for private messages to users who are offline. Each
+recipient has a mailbox file of JSON lines, one queued message per
+line, appended (and fsynced) as messages arrive. Everything queued is
+also kept in memory, so delivering on login does not touch the disk.
+
+A message's seq is its ID: the server delivers the whole mailbox in one
+frame and only removes the messages the client acknowledges, so a
+delivery interrupted by a dropped connection is simply sent again and
+the client skips the seqs it already has.
+
+Mailboxes are bounded per recipient (messages and bytes) and in total,
+and messages expire after `ttl` seconds, read or not.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from shared.config import MAILBOX_MAX_MESSAGES, MAILBOX_MAX_BYTES, MAILBOX_TOTAL_BYTES, MAILBOX_TTL
+
+
+def mailbox_name(recipient):
+    """File name of a recipient's mailbox; usernames may contain anything."""
+    return hashlib.sha256(recipient.encode("utf-8")).hexdigest()[:32] + ".box"
+
+
+class Mailbox:
+
+    def __init__(self, directory, max_messages=MAILBOX_MAX_MESSAGES, max_bytes=MAILBOX_MAX_BYTES,
+                 total_bytes=MAILBOX_TOTAL_BYTES, ttl=MAILBOX_TTL):
+        self.directory = directory
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.ttl = ttl
+        self.boxes = {}  # recipient → deque of (seq, expires, message JSON bytes), oldest first
+        self.sizes = {}  # recipient → bytes queued for them
+        self.size = 0    # bytes queued in all mailboxes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".box"):
+                continue
+            path = os.path.join(self.directory, name)
+            entries = deque()
+            recipient = None
+            damaged = False
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        message = entry["message"]
+                        seq, expires = int(entry["seq"]), float(entry["expires"])
+                        recipient = message["receiver"]
+                    except (ValueError, KeyError, TypeError):
+                        # A write torn by a crash; everything before it is intact
+                        logging.warning(f"[MAILBOX] Ignoring a damaged entry in {name}")
+                        damaged = True
+                        break
+                    entries.append((seq, expires, json.dumps(message).encode("utf-8")))
+            if recipient is None:
+                if damaged:
+                    os.remove(path)  # nothing readable in it
+                continue
+            if mailbox_name(recipient) != name:
+                continue
+            if damaged:
+                # Cut the damaged tail off, so new messages are not appended after it
+                self._rewrite(recipient, entries)
+                continue
+            self.boxes[recipient] = entries
+            self.sizes[recipient] = sum(len(payload) for _, _, payload in entries)
+            self.size += self.sizes[recipient]
+        if self.boxes:
+            logging.info(f"[MAILBOX] {sum(map(len, self.boxes.values()))} queued messages "
+                         f"for {len(self.boxes)} users")
+
+    def has_room(self, recipient):
+        """Whether another message may be queued for `recipient`."""
+        with self._lock:
+            return len(self.boxes.get(recipient, ())) < self.max_messages and \
+                self.sizes.get(recipient, 0) < self.max_bytes and self.size < self.total_bytes
+
+    def put(self, recipient, seq, message_json, now=None):
+        """Queues one private message (its JSON, already stamped with `seq`)."""
+        payload = message_json.encode("utf-8")
+        expires = (time.time() if now is None else now) + self.ttl
+        line = f'{{"seq": {seq}, "expires": {expires}, "message": {message_json}}}\n'
+        with self._lock:
+            with open(self._path(recipient), "ab") as f:
+                f.write(line.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            self.boxes.setdefault(recipient, deque()).append((seq, expires, payload))
+            self.sizes[recipient] = self.sizes.get(recipient, 0) + len(payload)
+            self.size += len(payload)
+
+    def pending(self, recipient, now=None):
+        """The unexpired messages queued for `recipient` as (seq, JSON bytes), oldest first."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [(seq, payload) for seq, expires, payload in self.boxes.get(recipient, ())
+                    if expires > now]
+
+    def ack(self, recipient, seqs):
+        """Removes the messages the recipient confirmed. Unknown seqs are ignored."""
+        seqs = set(seqs)
+        with self._lock:
+            entries = self.boxes.get(recipient)
+            if entries and any(seq in seqs for seq, _, _ in entries):
+                self._rewrite(recipient, deque(e for e in entries if e[0] not in seqs))
+
+    def expire(self, now=None):
+        """Drops the messages whose time is up. Returns how many."""
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            for recipient, entries in list(self.boxes.items()):
+                # Queued in time order with the same TTL, so expired ones are at the front
+                stale = 0
+                while stale < len(entries) and entries[stale][1] <= now:
+                    stale += 1
+                if stale:
+                    self._rewrite(recipient, deque(list(entries)[stale:]))
+                    removed += stale
+        if removed:
+            logging.info(f"[MAILBOX] Expired {removed} undelivered messages")
+        return removed
+
+    def _path(self, recipient):
+        return os.path.join(self.directory, mailbox_name(recipient))
+
+    def _rewrite(self, recipient, entries):
+        """Replaces a mailbox with `entries` (atomically). Call with the lock held."""
+        path = self._path(recipient)
+        self.size -= self.sizes.pop(recipient, 0)
+        self.boxes.pop(recipient, None)
+        if not entries:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for seq, expires, payload in entries:
+                f.write(f'{{"seq": {seq}, "expires": {expires}, "message": '.encode("utf-8") +
+                        payload + b"}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.boxes[recipient] = entries
+        self.sizes[recipient] = sum(len(payload) for _, _, payload in entries)
+        self.size += self.sizes[recipient]
@@ -0,0 +1,299 @@
+"""
+server/message_log.py
+
+Durable, append-only log of relayed chat messages.
+
+Records are numbered from 0 and written to segment files named after
+the number of their first record (00000000000000000000.log, ...). A new
+segment starts once the current one reaches `segment_bytes`. Each record
+is a 4-byte payload length, a 4-byte CRC32 and the payload (the message
+JSON). Every `index_interval`-th record also gets an entry in the
+segment's sparse .index file (record number relative to the segment,
+byte position), so a record can be found without reading the whole
+segment.
+
+Appends only go to the OS buffer; a flusher thread fsyncs them as a
+group every `fsync_interval_ms` or as soon as `fsync_batch` records are
+waiting. A crash can lose at most that window. On open, a torn or
+corrupt tail of the last segment is cut off.
+"""
+
+import bisect
+import itertools
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from shared.config import LOG_SEGMENT_BYTES, LOG_INDEX_INTERVAL, LOG_FSYNC_INTERVAL_MS, LOG_FSYNC_BATCH
+
+RECORD_HEADER = struct.Struct(">II")  # payload length, CRC32 of the payload
+INDEX_ENTRY = struct.Struct(">IQ")    # record number in the segment, byte position
+
+
+def segment_name(base, suffix):
+    return f"{base:020d}{suffix}"
+
+
+def scan_segment(path):
+    """
+    Reads the valid records of a segment file.
+    Returns ([(position, payload), ...], end of the last valid record).
+    """
+    records = []
+    position = 0
+    with open(path, "rb") as f:
+        data = f.read()
+    while position + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        records.append((position, payload))
+        position = start + length
+    return records, position
+
+
+class MessageLog:
+
+    def __init__(self, directory, segment_bytes=LOG_SEGMENT_BYTES,
+                 index_interval=LOG_INDEX_INTERVAL,
+                 fsync_interval_ms=LOG_FSYNC_INTERVAL_MS, fsync_batch=LOG_FSYNC_BATCH):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.fsync_batch = fsync_batch
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(
+            int(name[:-len(".log")]) for name in os.listdir(directory)
+            if name.endswith(".log"))
+        self._indexes = {}  # segment base → [(relative record, position), ...]
+        self._cond = threading.Condition()
+        self._unsynced = 0
+        self._closed = False
+        if self.segments:
+            self._recover_last_segment()
+        else:
+            self._open_segment(0)
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    @property
+    def first_seq(self):
+        return self.segments[0]
+
+    def _path(self, base, suffix=".log"):
+        return os.path.join(self.directory, segment_name(base, suffix))
+
+    def _open_segment(self, base):
+        """Starts a new, empty active segment."""
+        if base not in self.segments:
+            self.segments.append(base)
+        self._indexes[base] = []
+        self._base = base
+        self.next_seq = base
+        self._size = 0
+        self._file = open(self._path(base), "wb")
+        self._index_file = open(self._path(base, ".index"), "wb")
+
+    def _recover_last_segment(self):
+        """Reopens the newest segment, dropping any torn tail and rebuilding its index."""
+        base = self.segments[-1]
+        path = self._path(base)
+        records, end = scan_segment(path)
+        if end < os.path.getsize(path):
+            logging.warning(
+                f"[LOG] Truncating {os.path.getsize(path) - end} bytes of torn records in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(end)
+
+        index = [(number, position) for number, (position, _) in enumerate(records)
+                 if number % self.index_interval == 0]
+        with open(self._path(base, ".index"), "wb") as f:
+            for entry in index:
+                f.write(INDEX_ENTRY.pack(*entry))
+        self._indexes[base] = index
+
+        self._base = base
+        self.next_seq = base + len(records)
+        self._size = end
+        self._file = open(path, "ab")
+        self._index_file = open(self._path(base, ".index"), "ab")
+
+    def _load_index(self, base):
+        index = self._indexes.get(base)
+        if index is None:
+            with open(self._path(base, ".index"), "rb") as f:
+                data = f.read()
+            index = [INDEX_ENTRY.unpack_from(data, offset)
+                     for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+            self._indexes[base] = index
+        return index
+
+    def append(self, payload):
+        """Appends one record and returns its number. Durable after the next group fsync."""
+        with self._cond:
+            if self._closed:
+                raise ValueError("message log is closed")
+            if self._size >= self.segment_bytes:
+                self._rotate()
+            seq = self.next_seq
+            relative = seq - self._base
+            if relative % self.index_interval == 0:
+                self._index_file.write(INDEX_ENTRY.pack(relative, self._size))
+                self._indexes[self._base].append((relative, self._size))
+            self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._size += RECORD_HEADER.size + len(payload)
+            self.next_seq += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch:
+                self._cond.notify()
+        return seq
+
+    def _rotate(self):
+        """Seals the active segment (fully synced) and starts the next one."""
+        self._sync_locked()
+        self._file.close()
+        self._index_file.close()
+        self._open_segment(self.next_seq)
+        logging.info(f"[LOG] Started segment {segment_name(self._base, '.log')}")
+
+    def _sync_locked(self):
+        self._file.flush()
+        self._index_file.flush()
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._unsynced >= self.fsync_batch or self._closed,
+                    timeout=self.fsync_interval)
+                if self._closed:
+                    return
+                if not self._unsynced:
+                    continue
+                self._file.flush()
+                self._index_file.flush()
+                self._unsynced = 0
+                # fsync a duplicate outside the lock, so appends (and even
+                # a rotation closing the file) don't wait for the disk
+                fds = [os.dup(self._file.fileno()), os.dup(self._index_file.fileno())]
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+            except OSError as e:
+                logging.error(f"[LOG] fsync failed: {e}")
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def sync(self):
+        """Flushes and fsyncs everything appended so far."""
+        with self._cond:
+            if not self._closed:
+                self._sync_locked()
+
+    def _snapshot(self):
+        """Flushes buffered appends so readers see them; returns (end seq, segments)."""
+        with self._cond:
+            if not self._closed:
+                self._file.flush()
+            return self.next_seq, list(self.segments)
+
+    def _seek(self, f, base, relative):
+        """Positions `f` at the nearest indexed record at or before `relative`."""
+        index = self._load_index(base)
+        slot = bisect.bisect_right(index, (relative, float("inf"))) - 1
+        current, position = index[slot] if slot >= 0 else (0, 0)
+        f.seek(position)
+        return current
+
+    def iter_records(self, start_seq=0):
+        """Yields (seq, payload) from `start_seq` to the current end of the log."""
+        end_seq, segments = self._snapshot()
+        seq = max(start_seq, segments[0])
+        number = bisect.bisect_right(segments, seq) - 1
+        while seq < end_seq and number < len(segments):
+            base = segments[number]
+            with open(self._path(base), "rb") as f:
+                current = self._seek(f, base, seq - base)
+                while seq < end_seq:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, _ = RECORD_HEADER.unpack(header)
+                    if base + current < seq:
+                        f.seek(length, os.SEEK_CUR)
+                    else:
+                        yield seq, f.read(length)
+                        seq += 1
+                    current += 1
+            number += 1
+
+    def read(self, start_seq, limit=None):
+        """Returns up to `limit` (seq, payload) records from `start_seq` on."""
+        records = self.iter_records(start_seq)
+        if limit is not None:
+            records = itertools.islice(records, limit)
+        return list(records)
+
+    def read_seqs(self, seqs):
+        """
+        Returns the (seq, payload) records for specific record numbers,
+        given in ascending order. Each lookup seeks through the sparse
+        index, so a page costs O(log n) plus the records skipped.
+        """
+        end_seq, segments = self._snapshot()
+        results = []
+        f = None
+        base = current = None
+        try:
+            for seq in seqs:
+                if seq < segments[0] or seq >= end_seq:
+                    continue
+                seq_base = segments[bisect.bisect_right(segments, seq) - 1]
+                relative = seq - seq_base
+                if seq_base != base:
+                    if f is not None:
+                        f.close()
+                    f = open(self._path(seq_base), "rb")
+                    base, current = seq_base, None
+                # Scan forward from where we are if that is close, else seek
+                if current is None or current > relative or \
+                        relative - current > self.index_interval:
+                    current = self._seek(f, base, relative)
+                while current < relative:
+                    length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                    f.seek(length, os.SEEK_CUR)
+                    current += 1
+                length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                results.append((seq, f.read(length)))
+                current += 1
+        finally:
+            if f is not None:
+                f.close()
+        return results
+
+    def tail(self, count):
+        """The last `count` records, oldest first."""
+        return self.read(max(self.first_seq, self.next_seq - count))
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._sync_locked()
+            self._closed = True
+            self._file.close()
+            self._index_file.close()
+            self._cond.notify_all()
+        self._flusher.join()
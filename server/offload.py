@@ -0,0 +1,189 @@
+"""
+server/offload.py
+
+Moves the CPU-heavy part of handling a large frame off the connection
+that received it. Decrypting a file chunk or parsing a legacy upload
+with megabytes of base64 in it takes long enough to stall every other
+client of the asyncio engine, and parsing holds the GIL, so under the
+thread engine it slows every other thread too.
+
+A FrameOffload has two pluggable executors:
+  crypto - threads for decryption, decompression and building download
+           frames; OpenSSL and zlib release the GIL while they work
+  decode - processes for parsing big JSON and binary messages, which
+           would otherwise hold the GIL
+Frames under the size threshold, i.e. nearly all chat traffic, are
+handled inline as before: a hop to a pool costs more than they do.
+Without an executor that work stays inline too.
+
+Every job is counted per pool: jobs waiting or running (the queue
+depth) and the time from submitting a job to its result.
+"""
+
+import asyncio
+import base64
+import binascii
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from shared.common import parse_payload, CHUNK_MARKER
+from shared.compress import decompress, COMPRESSED_MARKER
+from shared.config import OFFLOAD_MIN_BYTES
+from shared.encrypt import decrypt_frame
+
+POOLS = ("crypto", "decode")
+
+
+def open_payload(data, cipher=None):
+    """Decrypts a frame and undoes its compression: the payload parse_payload() reads."""
+    payload = decrypt_frame(data, cipher)
+    if payload[:1] == bytes([COMPRESSED_MARKER]):
+        payload = decompress(payload)
+        if payload[:1] == bytes([COMPRESSED_MARKER]):
+            raise ValueError("compressed payload inside a compressed payload")
+    return payload
+
+
+def decode_payload(payload):
+    """
+    parse_payload() for the decode pool. A legacy upload's base64 is
+    decoded there too; the upload handler takes raw bytes as they are.
+    """
+    msg = parse_payload(payload)
+    if isinstance(msg, dict) and msg.get("type") == "file_upload" and isinstance(msg.get("file_data"), str):
+        try:
+            msg["file_data"] = base64.b64decode(msg["file_data"])
+        except binascii.Error:
+            pass  # left for the handler to report
+    return msg
+
+
+class PoolStats:
+    """Queue depth and latency of the jobs sent to one pool."""
+
+    def __init__(self):
+        self.depth = 0       # jobs submitted and not finished yet
+        self.max_depth = 0   # since the last report
+        self.jobs = 0        # finished since the last report
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+
+    def submitted(self):
+        with self._lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def finished(self, latency):
+        with self._lock:
+            self.depth -= 1
+            self.jobs += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def report(self, reset=False):
+        """The numbers as a dict (latencies in milliseconds), optionally starting over."""
+        with self._lock:
+            report = {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "jobs": self.jobs,
+                "avg_ms": self.total_latency / self.jobs * 1000 if self.jobs else 0.0,
+                "max_ms": self.max_latency * 1000,
+            }
+            if reset:
+                self.max_depth = self.depth
+                self.jobs = 0
+                self.total_latency = self.max_latency = 0.0
+        return report
+
+
+class FrameOffload:
+    """Decodes received frames, sending large ones' work to the executors."""
+
+    def __init__(self, threshold=OFFLOAD_MIN_BYTES, crypto=None, decode=None):
+        self.threshold = threshold
+        self.executors = {"crypto": crypto, "decode": decode}
+        self.stats = {pool: PoolStats() for pool in POOLS}
+
+    def submit(self, pool, fn, *args):
+        """Runs fn(*args) on a pool; returns its concurrent.futures.Future."""
+        stats = self.stats[pool]
+        stats.submitted()
+        start = time.perf_counter()
+        try:
+            future = self.executors[pool].submit(fn, *args)
+        except Exception:
+            stats.finished(time.perf_counter() - start)
+            raise
+        future.add_done_callback(lambda _: stats.finished(time.perf_counter() - start))
+        return future
+
+    def run(self, pool, fn, *args):
+        """fn(*args) on a pool, waiting for it; inline if the pool has no executor."""
+        if self.executors[pool] is None:
+            return fn(*args)
+        return self.submit(pool, fn, *args).result()
+
+    async def run_async(self, pool, fn, *args):
+        """run() for the event loop: awaits the job instead of blocking."""
+        if self.executors[pool] is None:
+            return fn(*args)
+        return await asyncio.wrap_future(self.submit(pool, fn, *args))
+
+    def parses_apart(self, payload):
+        """Whether parsing a payload goes to the decode pool: big messages, not file chunks."""
+        return len(payload) >= self.threshold and payload[:1] != bytes([CHUNK_MARKER])
+
+    def decode_frame(self, data, cipher=None):
+        """
+        Thread engine: decrypts and parses one frame. The calling thread
+        is the connection's own, so decryption stays on it; only the
+        parsing of big messages moves to the decode pool.
+        """
+        payload = open_payload(data, cipher)
+        if self.parses_apart(payload):
+            return self.run("decode", decode_payload, payload)
+        return parse_payload(payload)
+
+    async def decode_frame_async(self, data, cipher=None):
+        """Asyncio engine: decode_frame() with large frames decrypted on the crypto pool."""
+        if len(data) >= self.threshold:
+            payload = await self.run_async("crypto", open_payload, data, cipher)
+        else:
+            payload = open_payload(data, cipher)
+        # A small compressed frame can still hold a big message
+        if self.parses_apart(payload):
+            return await self.run_async("decode", decode_payload, payload)
+        return parse_payload(payload)
+
+    def report(self, reset=False):
+        """Per pool: {"depth", "max_depth", "jobs", "avg_ms", "max_ms"}."""
+        return {pool: self.stats[pool].report(reset) for pool in POOLS}
+
+    def log_report(self):
+        """Logs the numbers of the pools that had work since the last report."""
+        for pool, stats in self.report(reset=True).items():
+            if stats["jobs"] or stats["depth"]:
+                logging.info(
+                    f"[OFFLOAD] {pool}: {stats['jobs']} jobs, depth {stats['depth']} "
+                    f"(max {stats['max_depth']}), latency avg {stats['avg_ms']:.1f} ms, "
+                    f"max {stats['max_ms']:.1f} ms")
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_offload(threshold=OFFLOAD_MIN_BYTES, threads=0, processes=0):
+    """A FrameOffload with `threads` crypto threads and `processes` decode processes (0: inline)."""
+    crypto = ThreadPoolExecutor(threads, thread_name_prefix="offload") if threads else None
+    # The server runs many threads, and forking a threaded process can
+    # leave the child holding a lock nobody will release
+    decode = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) \
+        if processes else None
+    return FrameOffload(threshold, crypto, decode)
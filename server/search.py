@@ -0,0 +1,193 @@
+"""
+server/search.py
+
+Full-text search over relayed messages. An inverted index maps every
+token to the sorted sequence numbers of the messages containing it,
+kept per history channel ("public", "private:<user>") so a user's
+search only ever looks at the channels that user may read.
+
+Hits are ranked by the summed inverse document frequency of the query
+tokens they contain (rarer words count for more), newest first on
+ties. Only the most recent `candidates` postings of each token are
+considered, so a query costs the same on a million messages as on a
+thousand. Every message containing the same set of query tokens has
+the same score, so instead of scoring messages one by one, each such
+group is found with set intersections and differences, best group
+first, until the page is full.
+
+The index is built as messages are recorded and saved next to the
+message log on shutdown. On startup it is loaded again and only the
+log records after it are indexed.
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import math
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+
+from shared.config import SEARCH_CANDIDATES, SEARCH_TOKEN_MAX, SEARCH_TERMS_MAX
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+SNAPSHOT_MAGIC = b"CHATIDX1"
+SNAPSHOT_HEADER = struct.Struct(">QQI")  # next seq, documents, channels
+NAME_HEADER = struct.Struct(">HI")       # name length, entry count
+
+
+def tokenize(text):
+    """The distinct searchable words of `text`, lowercased; none if it is not text."""
+    if not isinstance(text, str):
+        return []
+    return list(dict.fromkeys(
+        token for token in TOKEN_PATTERN.findall(text.lower())
+        if 1 < len(token) <= SEARCH_TOKEN_MAX))
+
+
+class SearchIndex:
+
+    def __init__(self, candidates=SEARCH_CANDIDATES):
+        self.candidates = candidates
+        self.channels = {}  # channel → {token → array of seqs, ascending}
+        self.next_seq = 0   # every message below this is indexed
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def add(self, seq, channels, text):
+        """Indexes message `seq` under each of its channels. Seqs must grow."""
+        tokens = tokenize(text)
+        with self._lock:
+            for channel in channels:
+                postings = self.channels.get(channel)
+                if postings is None:
+                    postings = self.channels[channel] = {}
+                for token in tokens:
+                    seqs = postings.get(token)
+                    if seqs is None:
+                        seqs = postings[token] = array("q")
+                    seqs.append(seq)
+            self.documents += 1
+            self.next_seq = seq + 1
+
+    def search(self, channels, query, limit, floors=None):
+        """
+        The seqs of the best `limit` matches for `query` in `channels`,
+        best first. `floors` maps a channel to its lowest seq to look at.
+        """
+        floors = floors or {}
+        matches, weights = [], []
+        with self._lock:
+            for token in tokenize(query)[:SEARCH_TERMS_MAX]:
+                lists = []
+                for channel in channels:
+                    seqs = self.channels.get(channel, {}).get(token)
+                    if seqs:
+                        start = bisect.bisect_left(seqs, floors.get(channel, 0))
+                        lists.append(seqs[max(start, len(seqs) - self.candidates):])
+                found = sum(len(seqs) for seqs in lists)
+                if not found:
+                    continue
+                weights.append(math.log(1 + self.documents / found))
+                matches.append(set(itertools.chain.from_iterable(lists)))
+
+        # Group every combination of matched tokens by its total score
+        groups = {}
+        for size in range(1, len(matches) + 1):
+            for combo in itertools.combinations(range(len(matches)), size):
+                score = round(sum(weights[i] for i in combo), 9)
+                groups.setdefault(score, []).append(combo)
+
+        results = []
+        for score in sorted(groups, reverse=True):
+            found = set()
+            for combo in groups[score]:
+                # Messages with exactly these tokens and none of the others
+                exact = set.intersection(*(matches[i] for i in combo))
+                for i in range(len(matches)):
+                    if exact and i not in combo:
+                        exact = exact.difference(matches[i])
+                found |= exact
+            results.extend(heapq.nlargest(limit - len(results), found))
+            if len(results) >= limit:
+                break
+        return results
+
+    def save(self, path):
+        """Writes the index to `path` (atomically, through a temporary file)."""
+        tmp_path = path + ".tmp"
+        with self._lock, open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(SNAPSHOT_HEADER.pack(self.next_seq, self.documents, len(self.channels)))
+            for channel, postings in self.channels.items():
+                name = channel.encode("utf-8")
+                f.write(NAME_HEADER.pack(len(name), len(postings)))
+                f.write(name)
+                for token, seqs in postings.items():
+                    name = token.encode("utf-8")
+                    f.write(NAME_HEADER.pack(len(name), len(seqs)))
+                    f.write(name)
+                    if sys.byteorder == "big":
+                        seqs = array("q", seqs)
+                        seqs.byteswap()
+                    f.write(seqs.tobytes())  # stored little-endian
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Replaces the index with the one saved at `path`. Returns False
+        (leaving the index as it was) if there is none or it is unreadable.
+        """
+        channels = {}
+        try:
+            with open(path, "rb") as f:
+                data = memoryview(f.read())
+            if bytes(data[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+                raise ValueError("not a search index")
+            position = len(SNAPSHOT_MAGIC)
+            next_seq, documents, channel_count = SNAPSHOT_HEADER.unpack_from(data, position)
+            position += SNAPSHOT_HEADER.size
+            for _ in range(channel_count):
+                channel, token_count, position = self._read_name(data, position)
+                postings = channels[channel] = {}
+                for _ in range(token_count):
+                    token, count, position = self._read_name(data, position)
+                    end = position + count * 8
+                    if end > len(data):
+                        raise ValueError("truncated search index")
+                    seqs = array("q")
+                    seqs.frombytes(data[position:end])
+                    if sys.byteorder == "big":
+                        seqs.byteswap()
+                    postings[token] = seqs
+                    position = end
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+            logging.warning(f"[SEARCH] Ignoring unreadable index {path}: {e}")
+            return False
+        with self._lock:
+            self.channels = channels
+            self.next_seq = next_seq
+            self.documents = documents
+        return True
+
+    @staticmethod
+    def _read_name(data, position):
+        length, count = NAME_HEADER.unpack_from(data, position)
+        position += NAME_HEADER.size
+        name = bytes(data[position:position + length]).decode("utf-8")
+        return name, count, position + length
+
+    def clear(self):
+        with self._lock:
+            self.channels = {}
+            self.next_seq = 0
+            self.documents = 0
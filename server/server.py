@@ -1,23 +1,98 @@
-from shared.config import SERVER_IP, SERVER_PORT
-from shared.common import parse_message, build_message, current_timestamp, send_msg, recv_msg
-from shared.encrypt import encrypt_message, decrypt_message
+from shared.config import SERVER_IP, SERVER_PORT, LISTEN_BACKLOG, OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY, PARTIAL_UPLOAD_TTL, HISTORY_REPLAY, PRIVATE_HISTORY_ON_LOGIN, MAX_FRAME_SIZE, MAX_PAYLOAD_SIZE, MAX_MESSAGE_SIZE, LOG_FSYNC_INTERVAL_MS, LOG_FSYNC_BATCH, LOG_REBUILD_RECORDS, HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX, SESSION_GRACE_PERIOD, RESUME_REPLAY_MAX, SEARCH_LIMIT, SEARCH_LIMIT_MAX, DEDUP_WINDOW, OFFLOAD_MIN_BYTES, OFFLOAD_THREADS, OFFLOAD_PROCESSES, OFFLOAD_REPORT_INTERVAL, FILE_FETCH_TIMEOUT
+from shared.common import build_message, current_timestamp, frame_msg, send_msg, recv_msg_async, FrameReader, build_chunk, iter_file_chunks, file_sha256, file_hmac
+from shared.encrypt import encrypt_frame, choose_cipher, new_key_exchange, derive_session_ciphers
+from shared.codec import seal, pack, choose_codec
+from shared.compress import choose_compression, ChunkCompressor
+from server.connection import SocketConnection, StreamConnection, OVERFLOW_POLICIES
+from server.storage import FileStore
+from server.history import MessageHistory, ChannelIndex
+from server.message_log import MessageLog
+from server.search import SearchIndex
+from server.mailbox import Mailbox
+from server.offload import FrameOffload, create_offload
+from server.workers import Hub, CoreLink, RemoteConnection, start_workers, stop_workers
+from server.backplane import open_backplane
+import argparse
+import asyncio
+import hashlib
+import hmac
 import json
+import secrets
 import threading
 import socket
 import base64
 import os
+import re
 import sys
+import time
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
-# from shared.common import parse_message, build_message, current_timestamp
+# from shared.common import parse_payload, build_message, current_timestamp
 
-clients = {}  # username → client socket
+clients = {}  # username → client connection (see server/connection.py)
+data_tokens = {}  # username → token for opening its data channel
+active_uploads = {}  # upload key (see upload_key) → connection currently writing it
 lock = threading.Lock()
+last_expiry_check = 0
+presence_version = 0  # bumped on every join/leave, guarded by lock
+history = MessageHistory()  # recent messages replayed on login
+message_log = None  # durable log of relayed messages, opened by start_server
+channel_index = ChannelIndex()  # channel → seqs of its messages in the log
+search_index = SearchIndex()  # word → seqs of the messages containing it
+mailbox = None  # private messages waiting for offline users, opened by start_server
+next_seq = 0  # sequence number of the next relayed message
+seq_lock = threading.Lock()
+recent_ids = OrderedDict()  # (sender, client message id) → seq, the last DEDUP_WINDOW accepted
+channel_members = {}  # topic channel name → usernames in it
+user_channels = {}  # username → topic channels they are in
+session_tokens = {}  # username → token that resumes their session
+session_since = {}  # username → seq their session began at (its private history starts there)
+away = {}  # username → when the grace period of their dropped session ends
+session_grace = SESSION_GRACE_PERIOD
+offload = FrameOffload()  # decodes frames; start_server gives it its pools
+last_offload_report = time.monotonic()
+hub = None  # the core's end of the worker bus, with --workers
+core = None  # a worker's link to the core, with --workers
+backplane = None  # this node's link to the other nodes, with --backplane
+# Presence calls to the broker run here, one at a time in the order they
+# were queued, so neither `lock` nor the event loop waits on the broker
+broker_calls = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broker")
+remote_users = {}  # username → node they are on, for users of other nodes
+fetches = {}  # file_id → [(conn, msg)] downloads waiting for a copy from another node
+fetch_deadlines = {}  # file_id → time.monotonic() when its waiting downloads give up
+
+# Upload and transfer IDs end up in file names, so keep them simple
+TRANSFER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Client message IDs, echoed back in acks and kept in the log
+MESSAGE_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# Topic channels start with "#", so they never clash with "public"/"private:..."
+CHANNEL_NAME_PATTERN = re.compile(r"#[A-Za-z0-9_-]{1,32}")
+# What a data channel may carry: file transfers, nothing that changes chat state
+DATA_CHANNEL_MESSAGES = {"file_upload_begin", "file_upload_proof", "file_chunk", "file_upload_end",
+                         "file_download_request"}
+# What a worker handles itself: the file transfers on its clients' sockets
+WORKER_MESSAGES = {"file_upload_begin", "file_upload_proof", "file_chunk", "file_upload_end",
+                   "file_upload", "file_download_request"}
+# Messages that are logged, and their fields that must be text (or null)
+RECORDED_MESSAGES = {"public", "private", "channel_message", "file"}
+TEXT_FIELDS = ("sender", "receiver", "timestamp", "message", "channel")
+
+# Outbound queue settings for new connections, overridable from the CLI
+queue_size = OUTBOUND_QUEUE_SIZE
+overflow_policy = OUTBOUND_OVERFLOW_POLICY
 
 FILE_STORAGE_DIR = "server_storage"
 os.makedirs(FILE_STORAGE_DIR, exist_ok=True)
+stores = {}  # storage directory → FileStore
+MESSAGE_LOG_DIR = os.path.join(FILE_STORAGE_DIR, "log")
+SEARCH_INDEX_FILE = "search.idx"  # saved inside the message log directory
+CHANNEL_INDEX_FILE = "channels.idx"  # likewise
+MAILBOX_DIR = os.path.join(FILE_STORAGE_DIR, "mailbox")
 
 
 def setup_logging():
@@ -44,39 +119,556 @@ def setup_logging():
     logger.addHandler(stream_handler)
 
 
-def broadcast(message_dict, exclude=None):  # Renamed for clarity
+def send_to(conn, message):
+    """Sends one message (a dict, or JSON text) in the wire format `conn` negotiated."""
+    if isinstance(conn, RemoteConnection):
+        conn.send(message)  # its worker seals it
+        return
+    payload = seal(message, conn.codec, conn.compression, conn.cipher)
+    if len(payload) > MAX_FRAME_SIZE:
+        # The peer would refuse the frame and drop the connection
+        logging.error(f"[ERROR] Not sending a {len(payload)}-byte frame, over MAX_FRAME_SIZE")
+        return
+    send_msg(conn, payload)
+
+
+def frame_for(frames, message, conn):
+    """The frame of `message` in the wire format of `conn`, built the first time one needs it."""
+    wire = (conn.codec, conn.compression)
+    if conn.cipher is not None:
+        # Session keys differ per connection, so only the plaintext is shared
+        plaintext = frames.get(("plain",) + wire)
+        if plaintext is None:
+            plaintext = frames[("plain",) + wire] = pack(message, *wire)
+        return frame_msg(conn.cipher.encrypt(plaintext))
+    frame = frames.get(wire)
+    if frame is None:
+        frame = frames[wire] = frame_msg(seal(message, *wire))
+    return frame
+
+
+def fan_out(message, exclude=None):
     """
-    Takes a dictionary, converts it to JSON, and sends it to all users.
+    Queues one message (a dict, or JSON text) for every connected user.
+    It is encrypted and framed once per wire format in use, not once per
+    user (users with session keys share the plaintext), and each connection's own writer does the socket write, so a
+    slow client can't stall the loop.
     """
-    # Always convert to JSON inside the function for consistency
-    json_data_to_send = json.dumps(message_dict)
-
-    for user, conn in clients.items():
+    if hub is not None:
+        # Each worker fans it out to its own users
+        hub.fan_out(message, exclude)
+        return
+    frames = {}  # (codec, compression) → frame, ("plain", codec, compression) → plaintext
+    # Snapshot the connections so a concurrent login/logout can't
+    # change the dict while we iterate it
+    for user, conn in list(clients.items()):
         if user != exclude:
             try:
-                send_msg(conn, encrypt_message(json_data_to_send))
-            except:
-                print(f"[ERROR] Failed to send to {user}")
+                conn.enqueue(frame_for(frames, message, conn))
+            except Exception:
+                logging.error(f"[ERROR] Failed to send to {user}")
+
+
+def broadcast(message_dict, exclude=None):  # Renamed for clarity
+    """
+    Takes a dictionary and sends it to all users.
+    Users without session keys share the key, so for them it is
+    encrypted and framed only once per wire format.
+    """
+    fan_out(message_dict, exclude=exclude)
+
+
+def message_channels(msg):
+    """The history channels a relayed message can be paged from."""
+    if msg.get("type") == "channel_message":
+        return {msg["channel"]}
+    receiver = msg.get("receiver")
+    if receiver:
+        return {f"private:{msg.get('sender')}", f"private:{receiver}"}
+    return {"public"}
+
+
+def visible_channels(username):
+    """Every history channel `username` may read: public, their private messages and their topic channels."""
+    return ["public", f"private:{username}"] + sorted(user_channels.get(username, ()))
+
+
+def channel_floors(username):
+    """
+    The lowest seq `username` may read per channel. Logins are not
+    authenticated, so unless PRIVATE_HISTORY_ON_LOGIN is set their
+    private messages start where this session did.
+    """
+    if PRIVATE_HISTORY_ON_LOGIN:
+        return {}
+    return {f"private:{username}": session_since.get(username, next_seq)}
+
+
+def record_message(msg):
+    """
+    Stamps a relayed message with the next sequence number and keeps it
+    in the history, the durable log and the channel index.
+    Returns the JSON to send, or None if a message with the same client
+    id was already recorded (`msg` then gets that message's seq).
+    """
+    global next_seq
+    msg.pop("seq", None)
+    # Serialized before a seq is taken: one that fails must not leave a
+    # seq without a log record, or seqs and record numbers drift apart
+    body = json.dumps(msg)
+    with seq_lock:
+        msg_id = msg.get("id")
+        if msg_id is not None:
+            seq = recent_ids.get((msg.get("sender"), msg_id))
+            if seq is not None:
+                msg["seq"] = seq
+                return None
+        seq = next_seq
+        next_seq += 1
+        msg["seq"] = seq
+        message_json = body[:-1] + f', "seq": {seq}}}'
+        if msg.get("type") != "channel_message":
+            # Topic channels replay their own history on join instead
+            history.add(message_json, msg.get("receiver"), msg.get("sender"), msg.get("queued", False))
+        if message_log is not None:
+            # The log numbers records the same way, so seq == record number
+            message_log.append(message_json.encode("utf-8"))
+            channels = message_channels(msg)
+            for channel in channels:
+                channel_index.add(channel, seq)
+            search_index.add(seq, channels, msg.get("message"))
+        if msg_id is not None:
+            remember_id(msg.get("sender"), msg_id, seq)
+    return message_json
+
+
+def remember_id(sender, msg_id, seq):
+    """Adds an accepted client message id to the dedup window. Call with `seq_lock` held."""
+    recent_ids[(sender, msg_id)] = seq
+    if len(recent_ids) > DEDUP_WINDOW:
+        recent_ids.popitem(last=False)
 
 
-def broadcast_user_list():
-    user_list = ",".join(clients.keys())
-    message = build_message("system", "server", f"user_list:{user_list}")
-    for conn in clients.values():
+def storable(value):
+    """Whether `value` is plain JSON; the binary codec can also carry bytes."""
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and storable(item) for key, item in value.items())
+    if isinstance(value, list):
+        return all(storable(item) for item in value)
+    return value is None or isinstance(value, (str, int, float))
+
+
+def well_formed(msg):
+    """Whether a chat message from a client can be logged: text fields are text, nothing else is bytes."""
+    return all(isinstance(msg.get(field), (str, type(None))) for field in TEXT_FIELDS) and storable(msg)
+
+
+def refusal(msg):
+    """Why a chat message from a client cannot be relayed, or None if it can."""
+    if not well_formed(msg):
+        return "a field has the wrong type"
+    if len(json.dumps(msg)) > MAX_MESSAGE_SIZE:
+        return "it is too large"
+    return None
+
+
+def duplicate_of(conn, msg):
+    """
+    Checks the client message id of a chat message before it is routed.
+    A retransmitted message that was already accepted is only acked
+    again (with its original seq); returns True for those.
+    """
+    msg_id = msg.get("id")
+    if msg_id is None:
+        return False
+    if not isinstance(msg_id, str) or not MESSAGE_ID_PATTERN.fullmatch(msg_id):
+        msg.pop("id")
+        return False
+    with seq_lock:
+        seq = recent_ids.get((msg.get("sender"), msg_id))
+    if seq is None:
+        return False
+    msg["seq"] = seq
+    send_ack(conn, msg)
+    logging.info(f"[ACK] Dropped a retransmitted copy of {msg_id} (seq {seq})")
+    return True
+
+
+def send_ack(conn, msg):
+    """
+    Tells the sender of a chat message with a client id that it was
+    accepted (its seq) or refused (seq null; a system message says why).
+    """
+    if msg.get("id") is None:
+        return
+    ack = {
+        "type": "ack",
+        "sender": "server",
+        "id": msg["id"],
+        "seq": msg.get("seq")
+    }
+    send_to(conn, ack)
+
+
+def open_message_log(directory=MESSAGE_LOG_DIR, **options):
+    """
+    Opens the message log and rebuilds the recent history and the dedup
+    window from its tail. The channel and search indexes are loaded from
+    their last save and only catch up on newer records, so a restart
+    reads the end of the log, not all of it.
+    """
+    global message_log, next_seq
+    message_log = MessageLog(directory, **options)
+    next_seq = message_log.next_seq
+    for index, name in ((channel_index, CHANNEL_INDEX_FILE), (search_index, SEARCH_INDEX_FILE)):
+        index.load(os.path.join(directory, name))
+        if index.next_seq > next_seq:
+            # Saved past a torn log tail; those seqs now belong to new messages
+            logging.warning(f"[LOG] {name} is ahead of the log, rebuilding it")
+            index.clear()
+    channels_from = channel_index.next_seq
+    indexed_from = search_index.next_seq
+    rebuild_from = next_seq - LOG_REBUILD_RECORDS
+    dedup_from = next_seq - DEDUP_WINDOW
+    restored = 0
+    # The sparse index seeks straight to the first record needed
+    for seq, payload in message_log.iter_records(
+            min(channels_from, indexed_from, rebuild_from, dedup_from)):
+        message_json = payload.decode("utf-8")
+        msg = json.loads(message_json)
+        channels = message_channels(msg)
+        if seq >= channels_from:
+            for channel in channels:
+                channel_index.add(channel, seq)
+        if seq >= indexed_from:
+            search_index.add(seq, channels, msg.get("message"))
+        if seq >= dedup_from and msg.get("id") is not None:
+            # Retransmits can still come in after a restart
+            remember_id(msg.get("sender"), msg["id"], seq)
+        if seq >= rebuild_from and msg.get("type") != "channel_message":
+            history.add(message_json, msg.get("receiver"), msg.get("sender"), msg.get("queued", False))
+            restored += 1
+    logging.info(
+        f"[LOG] Restored {restored} messages from {directory} "
+        f"(next record {next_seq}, {next_seq - indexed_from} newly indexed for search)")
+    return message_log
+
+
+def close_message_log():
+    """Saves the channel and search indexes next to the log and closes the log."""
+    message_log.close()
+    for index, name in ((channel_index, CHANNEL_INDEX_FILE), (search_index, SEARCH_INDEX_FILE)):
         try:
-            send_msg(conn, encrypt_message(message))
-        except:
-            pass
+            index.save(os.path.join(message_log.directory, name))
+        except OSError as e:
+            logging.error(f"[LOG] Could not save {name}: {e}")
+
+
+def with_messages(header, records):
+    """
+    JSON of `header` plus a "messages" list of logged records. Stored
+    JSON is spliced in as-is rather than parsed and re-encoded.
+    """
+    return json.dumps(header)[:-1] + ', "messages": [' + \
+        ", ".join(payload.decode("utf-8") for _, payload in records) + "]}"
+
+
+def fit_records(header, records, newest=True):
+    """
+    As many of `records` as fit in one frame along with `header`: the
+    last ones if `newest`, otherwise the first ones.
+    """
+    size = len(json.dumps(header)) + 64  # the "messages" key, and room for flags set later
+    ordered = reversed(records) if newest else records
+    for count, (_, payload) in enumerate(ordered):
+        size += len(payload) + 2
+        if size > MAX_PAYLOAD_SIZE:
+            return records[len(records) - count:] if newest else records[:count]
+    return records
 
 
-def recv_full_message(conn):
+def queue_private(conn, msg):
+    """
+    Keeps a private message (or file announcement) for a user who is
+    not online in their mailbox, and tells the sender it was queued.
+    """
+    receiver = msg.get("receiver")
+    if mailbox is None or not PRIVATE_HISTORY_ON_LOGIN:
+        # Whoever logs in next under the name would get the mailbox
+        send_system(conn, f"User '{receiver}' is offline, and this server does not keep "
+                          "private messages for offline users.")
+        send_ack(conn, msg)
+        return
+    if not isinstance(receiver, str) or not mailbox.has_room(receiver):
+        send_system(conn, f"User '{receiver}' is offline and cannot take more messages.")
+        send_ack(conn, msg)
+        return
+    msg["queued"] = True
+    message_json = record_message(msg)
+    if message_json is None:
+        send_ack(conn, msg)
+        return
+    mailbox.put(receiver, msg["seq"], message_json)
+    queued = {
+        "type": "queued",
+        "sender": "server",
+        "receiver": receiver,
+        "seq": msg["seq"],
+        "expires_in": mailbox.ttl
+    }
+    send_to(conn, queued)
+    send_ack(conn, msg)
+    logging.info(f"[MAILBOX] {msg.get('sender')} -> {receiver} queued (seq {msg['seq']})")
+
+
+def deliver_mailbox(conn, username):
+    """
+    Sends everything waiting in a user's mailbox, in as few frames as
+    fit it. It stays queued until the client acknowledges it with
+    mailbox_ack.
+    """
+    entries = mailbox.pending(username) if mailbox is not None else []
+    header = {"type": "mailbox", "sender": "server"}
+    sent = 0
+    while sent < len(entries):
+        # More than one frame if they do not fit in one
+        batch = fit_records(header, entries[sent:], newest=False)
+        send_to(conn, with_messages(header, batch))
+        sent += len(batch)
+    if entries:
+        logging.info(f"[MAILBOX] Delivered {len(entries)} queued messages to {username}")
+
+
+def send_history_page(conn, msg):
+    """
+    Answers a history_request with the messages just before `before_seq`
+    in the requested channel, read from the durable log.
+    """
+    username = conn.username
+    channel = msg.get("channel") or "all"
+    channels = {
+        "public": ["public"],
+        "private": [f"private:{username}"],
+        "all": visible_channels(username),
+    }.get(channel, [])
+    if channel in user_channels.get(username, ()):
+        channels = [channel]
     try:
-        data = recv_msg(conn)
+        limit = int(msg.get("limit") or HISTORY_PAGE_SIZE)
+        before_seq = msg.get("before_seq")
+        before_seq = next_seq if before_seq is None else int(before_seq)
+    except (TypeError, ValueError):
+        send_system(conn, "Bad history request")
+        return
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+
+    # One extra tells us whether an older page exists
+    seqs = channel_index.page(channels, before_seq, limit + 1, channel_floors(username))
+    has_more = len(seqs) > limit
+    seqs = seqs[-limit:]
+    records = message_log.read_seqs(seqs) if message_log is not None else []
+
+    header = {
+        "type": "history_page",
+        "sender": "server",
+        "channel": channel,
+        "before_seq": before_seq
+    }
+    kept = fit_records(header, records)
+    if len(kept) < len(records):
+        # The older ones did not fit; they come with the next page
+        has_more = True
+        seqs = [seq for seq, _ in kept]
+    header["first_seq"] = seqs[0] if seqs else None
+    header["has_more"] = has_more
+    send_to(conn, with_messages(header, kept))
+
+
+def send_search_results(conn, msg):
+    """Answers a search with the best matching messages the user may see, best first."""
+    username = conn.username
+    query = str(msg.get("query") or "")
+    try:
+        limit = int(msg.get("limit") or SEARCH_LIMIT)
+    except (TypeError, ValueError):
+        send_system(conn, "Bad search request")
+        return
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+
+    start = time.perf_counter()
+    seqs = search_index.search(visible_channels(username), query, limit, channel_floors(username))
+    records = dict(message_log.read_seqs(sorted(seqs))) if message_log is not None else {}
+    hits = [(seq, records[seq]) for seq in seqs if seq in records]
+    header = {
+        "type": "search_results",
+        "sender": "server",
+        "query": query
+    }
+    # The weakest hits go if they do not all fit in one frame
+    hits = fit_records(header, hits, newest=False)
+    send_to(conn, with_messages(header, hits))
+    logging.info(
+        f"[SEARCH] {username}: '{query}' → {len(hits)} hits in "
+        f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def fan_out_channel(name, message, exclude=None):
+    """
+    Queues one message for the online members of a topic channel, like
+    fan_out(). Only the channel's member set is walked, so the cost
+    grows with the channel, not with everyone connected.
+    """
+    if hub is not None:
+        conns = [clients.get(user) for user in list(channel_members.get(name, ())) if user != exclude]
+        hub.send_many([conn for conn in conns if conn is not None], message)
+        return
+    frames = {}  # (codec, compression) → frame, ("plain", codec, compression) → plaintext
+    for user in list(channel_members.get(name, ())):
+        conn = clients.get(user)
+        if conn is not None and user != exclude:
+            try:
+                conn.enqueue(frame_for(frames, message, conn))
+            except Exception:
+                logging.error(f"[ERROR] Failed to send to {user}")
+
+
+def channel_event(msg_type, name, username):
+    """Tells the other members of a channel that someone joined or left it."""
+    event = {
+        "type": msg_type,
+        "sender": "server",
+        "channel": name,
+        "user": username
+    }
+    fan_out_channel(name, event, exclude=username)
+    if backplane is not None:
+        # Members on other nodes hear of it from theirs
+        backplane.publish("all", {"kind": "channel_event", "event": event})
+
+
+def join_channel(conn, msg):
+    """Adds the user to a topic channel (creating it) and sends its recent messages."""
+    username = conn.username
+    name = msg.get("channel")
+    if not isinstance(name, str) or not CHANNEL_NAME_PATTERN.fullmatch(name):
+        send_system(conn, "Channel names look like #topic (letters, digits, - and _)")
+        return
+    with lock:
+        members = channel_members.setdefault(name, set())
+        if username not in members:
+            members.add(username)
+            user_channels.setdefault(username, set()).add(name)
+            channel_event("channel_join", name, username)
+        member_list = sorted(members)
+
+    # Anything recorded from here on reaches the user live
+    with seq_lock:
+        end_seq = next_seq
+    seqs = channel_index.page([name], end_seq, HISTORY_REPLAY)
+    records = message_log.read_seqs(seqs) if message_log is not None else []
+    header = {
+        "type": "channel_joined",
+        "sender": "server",
+        "channel": name,
+        "members": member_list
+    }
+    send_to(conn, with_messages(header, fit_records(header, records)))
+    logging.info(f"[CHANNEL] {username} joined {name} ({len(member_list)} members)")
+
+
+def leave_channel(conn, msg):
+    name = msg.get("channel")
+    with lock:
+        left = remove_from_channel(conn.username, name)
+    if left:
+        reply = {"type": "channel_left", "sender": "server", "channel": name}
+        send_to(conn, reply)
+        logging.info(f"[CHANNEL] {conn.username} left {name}")
+
+
+def remove_from_channel(username, name):
+    """Takes a user out of one channel. Call with `lock` held. Returns False if they weren't in it."""
+    members = channel_members.get(name)
+    if not members or username not in members:
+        return False
+    members.discard(username)
+    user_channels.get(username, set()).discard(name)
+    if members:
+        channel_event("channel_leave", name, username)
+    else:
+        # History stays in the log; the channel comes back on the next join
+        del channel_members[name]
+    return True
+
+
+def leave_all_channels(username):
+    """Takes a user whose session ended out of every channel. Call with `lock` held."""
+    for name in list(user_channels.pop(username, ())):
+        remove_from_channel(username, name)
+
+
+def send_channel_message(conn, msg):
+    """Relays a message to the members of one topic channel."""
+    username = conn.username
+    name = msg.get("channel")
+    if username not in channel_members.get(name, ()):
+        send_system(conn, f"You are not in {name}; join it first.")
+        send_ack(conn, msg)
+        return
+    text = msg.get("message", "")
+    logging.info(f"[CHANNEL] {username} -> {name}: {text}")
+    record = {
+        "type": "channel_message",
+        "sender": username,
+        "channel": name,
+        "timestamp": msg.get("timestamp") or current_timestamp(),
+        "message": text
+    }
+    if msg.get("id") is not None:
+        record["id"] = msg["id"]
+    message_json = record_message(record)
+    if message_json is not None:
+        fan_out_channel(name, message_json)
+        publish_message("all", record)
+    send_ack(conn, record)
+
+
+def presence_snapshot():
+    """
+    The full list of online users at the current presence version.
+    Users inside their resume grace period still count as online.
+    """
+    return json.dumps({
+        "type": "presence_snapshot",
+        "sender": "server",
+        "version": presence_version,
+        "users": list(clients.keys()) + [user for user in away if user not in clients] +
+                 [user for user in remote_users if user not in clients and user not in away]
+    })
+
+
+def broadcast_presence(msg_type, username):
+    """
+    Sends one presence_join / presence_leave delta to everyone else.
+    Call with `lock` held so versions reach every queue in order.
+    """
+    global presence_version
+    presence_version += 1
+    delta = {
+        "type": msg_type,
+        "sender": "server",
+        "version": presence_version,
+        "user": username
+    }
+    fan_out(delta, exclude=username)
+
+
+def recv_full_message(reader, conn):
+    try:
+        data = reader.read_frame()
         if not data:
             return None
-        decrypted = decrypt_message(data)
-        msg = parse_message(decrypted)
-        return msg
+        return offload.decode_frame(data, conn.cipher)
     # try:
     #     data = recv_msg(conn)
     #     if not data:
@@ -93,230 +685,1606 @@ def recv_full_message(conn):
         return None
 
 
-def handle_client(conn, addr):
-    username = None
+def start_encryption(conn, msg):
+    """
+    Answers a client that offered a key exchange with its login or
+    resume, and switches `conn` to the session keys. The answer is the
+    first frame the client gets and the last one under the shared key;
+    clients that offer nothing stay on the shared key.
+    """
+    conn.cipher = conn.data_cipher = None
+    name = choose_cipher(msg.get("ciphers"))
+    if name is None or not msg.get("key_exchange"):
+        return
+    private_key, public_key = new_key_exchange()
+    try:
+        peer_key = base64.b64decode(msg["key_exchange"], validate=True)
+        ciphers = derive_session_ciphers(name, private_key, peer_key, is_client=False)
+    except (TypeError, ValueError) as e:
+        logging.warning(f"[CRYPTO] Bad key exchange from {msg.get('sender')}: {e}")
+        return
+    send_to(conn, {
+        "type": "key_exchange",
+        "sender": "server",
+        "cipher": name,
+        "key_exchange": base64.b64encode(public_key).decode("ascii")
+    })
+    conn.cipher, conn.data_cipher = ciphers
+
+
+def negotiate(conn, msg):
+    """Settles the wire format and session keys of a login or resume, before anything is sent."""
+    # Clients that predate the binary codec offer nothing and get JSON
+    conn.codec = choose_codec(msg.get("codecs"))
+    conn.compression = choose_compression(msg.get("compression"))
+    start_encryption(conn, msg)
+
+
+def add_client(username, conn):
+    """Makes `conn` the connection of `username`. Call with `lock` held."""
+    clients[username] = conn
+    if isinstance(conn, RemoteConnection):
+        # Its worker needs to know for fan-outs
+        conn.log_in(username)
+    else:
+        conn.username = username
 
+
+def log_in(conn, msg, claimed=None):
+    """
+    Answers a client's first message, a resume or a login. `claimed` is
+    the answer of claim_name(msg), asked for here if not given. Returns
+    the username, or None if it was refused.
+    """
+    if claimed is None:
+        claimed = claim_name(msg)
+    if msg.get("type") == "resume":
+        return resume_client(conn, msg, claimed)
+    return register_client(conn, msg, claimed)
+
+
+def claim_name(msg):
+    """
+    Whether the broker lets the sender of a login or resume be on this
+    node (see Broker.claim); always True without a backplane. A resume
+    only asks if its token is right. Waits for the broker, so never call
+    it with `lock` held or on the event loop.
+    """
+    if backplane is None:
+        return True
+    username = msg.get("sender")
+    if msg.get("type") == "resume" and not token_matches(username, msg.get("token", "")):
+        return False
+    return broker_calls.submit(backplane.claim, username).result()
+
+
+def sync_presence(username):
+    """
+    A broker_calls job: tells the broker how `username` stands here when
+    it runs. Each job reads the latest local state, and they run in order,
+    so the broker ends up right even if the user changed again meanwhile.
+    """
+    with lock:
+        online = username in clients
+        dropped = username in away and not online
+    if online:
+        # Claim again: a release queued before the login may have run since
+        if not backplane.claim(username):
+            logging.warning(f"[CLUSTER] {username} is online here and on another node")
+    elif dropped:
+        backplane.set_away(username, True)
+    else:
+        backplane.release(username)
+
+
+def report_presence(username):
+    """Queues a sync_presence() of `username` for the broker, if there is one. Never waits."""
+    if backplane is not None:
+        broker_calls.submit(sync_presence, username)
+
+
+def token_matches(username, token):
+    """Whether `token` resumes the session of `username`."""
+    expected = session_tokens.get(username)
+    return bool(expected) and hmac.compare_digest(expected, str(token))
+
+
+def register_client(conn, msg, claimed):
+    """
+    Registers the sender of a login message under `conn`. `claimed`
+    says whether the broker let them log in on this node.
+    Returns the username, or None if the name was rejected.
+    """
+    temp_name = msg.get("sender")
+    replaced = False
+
+    with lock:
+        # Other nodes' users count too: the broker knows who is online where
+        if temp_name in clients or not claimed:
+            rejection = build_message(
+                "system", "server", "username_rejected")
+            send_to(conn, rejection)
+            logging.warning(
+                f"[REJECTED] {temp_name} already exists")
+            return None
+
+        if temp_name in away:
+            # A fresh login ends the dropped session instead of resuming it
+            end_session(temp_name)
+            replaced = True
+        remote_users.pop(temp_name, None)
+
+        add_client(temp_name, conn)
+        session_since[temp_name] = next_seq
+        # Others get a small delta; only the new user needs the full list
+        broadcast_presence("presence_join", temp_name)
+        send_to(conn, presence_snapshot())
+
+        # Catch the user up on what was said before, in a single frame
+        # (their private messages only if a login may read them)
+        replay = history.batch(temp_name if PRIVATE_HISTORY_ON_LOGIN else None, HISTORY_REPLAY)
+        if replay:
+            send_to(conn, replay)
+        if PRIVATE_HISTORY_ON_LOGIN:
+            deliver_mailbox(conn, temp_name)
+
+        start_session(conn, temp_name)
+
+        logging.info(
+            f"[CLIENTS] Now connected: {list(clients.keys())}")
+
+    report_presence(temp_name)
+    if replaced:
+        broadcast(json.loads(build_message(
+            "system", "server", f"{temp_name} has left the chat.")), exclude=temp_name)
+    join_msg = build_message(
+        "system", "server", f"{temp_name} has joined the chat.")
+    broadcast(json.loads(join_msg), exclude=temp_name)
+    return temp_name
+
+
+def start_session(conn, username):
+    """
+    Sends a freshly logged-in or resumed user their resume token and
+    the data channel offer. Call with `lock` held.
+    """
+    session_tokens[username] = secrets.token_hex(16)
+    session = {
+        "type": "session",
+        "sender": "server",
+        "token": session_tokens[username],
+        "grace": session_grace,
+        "codec": conn.codec,
+        "compression": conn.compression
+    }
+    send_to(conn, session)
+    if hub is not None:
+        return  # workers have no data channels
+
+    # Offer a separate connection for file transfers so they never
+    # queue up in front of chat messages
+    data_tokens[username] = secrets.token_hex(16)
+    offer = {
+        "type": "data_channel",
+        "sender": "server",
+        "timestamp": current_timestamp(),
+        "token": data_tokens[username]
+    }
+    send_to(conn, offer)
+
+
+def end_session(username):
+    """Forgets a dropped session and tells everyone the user left. Call with `lock` held."""
+    away.pop(username, None)
+    session_tokens.pop(username, None)
+    session_since.pop(username, None)
+    leave_all_channels(username)
+    broadcast_presence("presence_leave", username)
+
+
+def resume_client(conn, msg, claimed):
+    """
+    Moves a user's session onto a new connection after a drop. Nobody
+    else sees a leave or join, and the user only gets the messages
+    after `last_seq` they may see. `claimed` says whether the broker let
+    them back on this node. Returns the username, or None if there is no
+    such session (the client then logs in again).
+    """
+    username = msg.get("sender")
     try:
-        msg = recv_full_message(conn)
-        if not msg:
-            conn.close()
+        last_seq = int(msg.get("last_seq", -1))
+    except (TypeError, ValueError):
+        last_seq = None
+
+    with lock:
+        if last_seq is None or not claimed or not token_matches(username, msg.get("token", "")):
+            failed = {"type": "resume_failed", "sender": "server"}
+            send_to(conn, failed)
+            logging.warning(f"[REJECTED] Cannot resume the session of {username}")
+            if claimed:
+                # The claim marked them back; tell the broker how they really stand
+                report_presence(username)
+            return None
+        old = clients.get(username)
+        if old is not None:
+            # We had not noticed the drop yet; the new connection takes over
+            if old.bulk is not None:
+                old.bulk.close()
+            old.abort()
+        away.pop(username, None)
+        add_client(username, conn)
+    report_presence(username)
+
+    # Anything recorded from here on is sent live, so replay up to here.
+    # A message may come both ways; clients drop the second copy by seq.
+    with seq_lock:
+        end_seq = next_seq
+    channels = visible_channels(username)
+    seqs = [seq for seq in channel_index.page(channels, end_seq, RESUME_REPLAY_MAX + 1, channel_floors(username))
+            if seq > last_seq]
+    truncated = len(seqs) > RESUME_REPLAY_MAX
+    seqs = seqs[-RESUME_REPLAY_MAX:]
+    records = message_log.read_seqs(seqs) if message_log is not None else []
+    header = {
+        "type": "resumed",
+        "sender": "server",
+        "last_seq": last_seq
+    }
+    kept = fit_records(header, records)
+    header["truncated"] = truncated or len(kept) < len(records)
+    records = kept
+    send_to(conn, with_messages(header, records))
+
+    with lock:
+        # Presence may have changed while the user was away
+        send_to(conn, presence_snapshot())
+        # Only there if the last delivery was never acknowledged
+        deliver_mailbox(conn, username)
+        start_session(conn, username)
+    logging.info(f"[RESUMED] {username} after seq {last_seq}, {len(records)} missed")
+    return username
+
+
+def unregister_client(username, addr, conn=None):
+    """
+    Removes a user's connection. If the user can still resume, they
+    stay in the presence list for `session_grace` seconds; otherwise
+    everyone else is told they have left.
+    """
+    with lock:
+        if conn is not None and clients.get(username) is not conn:
+            # A resumed session already runs on a newer connection
+            return
+        conn = clients.pop(username, None)
+        data_tokens.pop(username, None)
+        if conn is not None and conn.bulk is not None:
+            conn.bulk.close()
+        going_away = conn is not None and session_grace > 0 and username in session_tokens
+        if going_away:
+            away[username] = time.monotonic() + session_grace
+            logging.info(
+                f"[AWAY] {username} from {addr}, may resume for {session_grace}s")
+        else:
+            session_tokens.pop(username, None)
+            session_since.pop(username, None)
+            leave_all_channels(username)
+            if conn is not None:
+                broadcast_presence("presence_leave", username)
+            logging.info(
+                f"[CLIENTS] Now connected: {list(clients.keys())}")
+    if conn is not None:
+        # The broker hears of the drop (another node may now take the name) or the leave
+        report_presence(username)
+    if going_away:
+        return
+    leave_msg = build_message(
+        "system", "server", f"{username} has left the chat.")
+    broadcast(json.loads(leave_msg), exclude=username)
+    logging.info(f"[DISCONNECTED] {username} from {addr}")
+
+
+def expire_sessions(now=None):
+    """Ends the dropped sessions whose grace period has run out."""
+    now = time.monotonic() if now is None else now
+    with lock:
+        expired = [user for user, deadline in away.items() if deadline <= now]
+        for username in expired:
+            end_session(username)
+    for username in expired:
+        report_presence(username)
+        leave_msg = build_message(
+            "system", "server", f"{username} has left the chat.")
+        broadcast(json.loads(leave_msg), exclude=username)
+        logging.info(f"[DISCONNECTED] {username} did not resume in time")
+    return expired
+
+
+def expire_mail():
+    if mailbox is not None:
+        mailbox.expire()
+
+
+def expire_fetches(now=None):
+    """Fails the downloads that waited FILE_FETCH_TIMEOUT for a copy from another node."""
+    now = time.monotonic() if now is None else now
+    with lock:
+        late = [file_id for file_id, deadline in fetch_deadlines.items() if deadline <= now]
+    for file_id in late:
+        finish_fetch(file_id, False, f"File '{file_id}' could not be copied from another node in time")
+
+
+def report_offload(now=None):
+    """Logs the offload pools' numbers every OFFLOAD_REPORT_INTERVAL seconds."""
+    global last_offload_report
+    now = time.monotonic() if now is None else now
+    if now - last_offload_report >= OFFLOAD_REPORT_INTERVAL:
+        last_offload_report = now
+        offload.log_report()
+
+
+def reap_sessions():
+    """Thread engine: checks for expired sessions and mail once a second."""
+    while True:
+        time.sleep(1)
+        expire_sessions()
+        expire_mail()
+        expire_fetches()
+        report_offload()
+
+
+async def reap_sessions_async():
+    """Asyncio engine: the same check as a task, so sends stay on the loop."""
+    while True:
+        await asyncio.sleep(1)
+        expire_sessions()
+        expire_mail()
+        expire_fetches()
+        report_offload()
+
+
+def attach_data_channel(conn, msg):
+    """
+    Accepts a second connection as the bulk-transfer channel of a
+    logged-in user. Returns the username, or None if the token is wrong.
+    """
+    username = msg.get("sender")
+    with lock:
+        token = data_tokens.get(username)
+        chat_conn = clients.get(username)
+        if not token or chat_conn is None or \
+                not hmac.compare_digest(token, str(msg.get("token", ""))):
+            logging.warning(f"[REJECTED] Bad data channel token for {username}")
+            return None
+        chat_conn.bulk = conn
+        conn.username = username
+        conn.codec = chat_conn.codec
+        conn.compression = chat_conn.compression
+        # Keys of its own, derived in the same key exchange as the chat connection's
+        conn.cipher = chat_conn.data_cipher
+    logging.info(f"[DATA] {username} opened a data channel")
+    return username
+
+
+def detach_data_channel(username, conn):
+    with lock:
+        chat_conn = clients.get(username)
+        if chat_conn is not None and chat_conn.bulk is conn:
+            chat_conn.bulk = None
+    logging.info(f"[DATA] {username} closed its data channel")
+
+
+def announce_file(conn, msg):
+    """Tells the receiver (or everyone) that a file is ready to download."""
+    sender = msg.get("sender")
+    receiver = msg.get("receiver")
+    filename = msg.get("message")
+    file_id = msg.get("file_id")
+
+    logging.info(
+        f"[FILE] {sender} sharing file '{filename}' (ID: {file_id})")
+
+    if backplane is not None and file_store().lookup(file_id) is not None:
+        # So other nodes know where to fetch it from. Queued behind any
+        # presence calls; the announcement is batched, so it goes out later
+        broker_calls.submit(backplane.add_file, file_id)
+
+    if receiver:
+        if receiver in clients or receiver in away or receiver in remote_users:
+            logging.info(f"[FILE] {sender} -> {receiver}: {filename}")
+            message_json = record_message(msg)
+            target = clients.get(receiver)
+            if target is not None:
+                send_to(target, message_json)
+            elif receiver in remote_users and message_json is not None:
+                publish_message("user:" + receiver, msg)
+        else:
+            queue_private(conn, msg)
+    else:
+        logging.info(f"[FILE] {sender} shared publicly: {filename}")
+        message_json = record_message(msg)
+        fan_out(message_json, exclude=sender)
+        if message_json is not None:
+            publish_message("all", msg)
+
+
+def send_system(conn, text):
+    """Sends a system notice from the server to one connection."""
+    send_to(conn, build_message("system", "server", text))
+
+
+def file_store():
+    """The content-addressed store (server/storage.py) in FILE_STORAGE_DIR."""
+    with lock:
+        store = stores.get(FILE_STORAGE_DIR)
+        if store is None:
+            store = stores[FILE_STORAGE_DIR] = FileStore(FILE_STORAGE_DIR)
+    return store
+
+
+def new_file_id():
+    # Random, so equal names shared in the same second never collide
+    return secrets.token_hex(8)
+
+
+def upload_key(username, upload_id):
+    """
+    Where a user's resumable upload is kept: upload IDs are the client's,
+    so each user has their own. The name is hashed to keep it file-safe.
+    """
+    owner = hashlib.sha256(str(username).encode("utf-8")).hexdigest()[:16]
+    return f"{owner}-{upload_id}"
+
+
+def valid_size(value):
+    """Whether a size or offset a client sent is a non-negative int."""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def send_file_error(conn, text, **transfer):
+    """
+    Refuses a transfer request, tied to its upload_id or transfer_id so
+    the client can give up on it.
+    """
+    send_to(conn, {"type": "file_error", "sender": "server", "message": text, **transfer})
+
+
+def when_hashed(path, then):
+    """
+    Calls then(digest) with the SHA-256 of a file, hashed on the crypto
+    pool. The asyncio engine's loop goes on meanwhile; a connection's own
+    thread just waits.
+    """
+    if offload.executors["crypto"] is None:
+        then(file_sha256(path))
+        return
+    when_done(offload.submit("crypto", file_sha256, path), then, f"hash '{path}'")
+
+
+def when_done(future, then, what):
+    """
+    Calls then(result) once `future` is done: back on the event loop if
+    one runs in this thread (the asyncio engine), otherwise here, after
+    waiting for it. A failure is logged as being unable to `what`.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"[ERROR] Could not {what}: {e}")
+            return
+        then(result)
+        return
+
+    def done(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"[ERROR] Could not {what}: {e}")
+            return
+        loop.call_soon_threadsafe(then, result)
+    future.add_done_callback(done)
+
+
+def partial_paths(upload_id):
+    """Returns the (data, metadata) paths of a resumable upload (by its upload_key)."""
+    directory = os.path.join(FILE_STORAGE_DIR, "partial")
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, upload_id)
+    return f"{base}.part", f"{base}.json"
+
+
+def expire_partial_uploads():
+    """Deletes partial uploads nobody has touched for PARTIAL_UPLOAD_TTL."""
+    global last_expiry_check
+    now = time.time()
+    if now - last_expiry_check < 60:
+        return
+    last_expiry_check = now
+
+    directory = os.path.join(FILE_STORAGE_DIR, "partial")
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        upload_id = name[:-len(".json")]
+        if upload_id in active_uploads:
+            continue
+        part_path, meta_path = partial_paths(upload_id)
+        try:
+            touched = os.path.getmtime(
+                part_path if os.path.exists(part_path) else meta_path)
+            if now - touched > PARTIAL_UPLOAD_TTL:
+                for path in (part_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                logging.info(f"[UPLOAD] Expired partial upload {upload_id}")
+        except OSError:
+            pass
+
+
+def begin_upload(conn, msg):
+    """
+    Opens (or reopens) a resumable upload and tells the client which
+    byte offset to continue from. If the content is stored already, the
+    client is also challenged to prove it has it (see prove_upload()).
+    """
+    upload_id = msg.get("upload_id") or ""
+    sender = msg.get("sender")
+    filename = os.path.basename(msg.get("filename") or "")
+    timestamp = msg.get("timestamp") or current_timestamp()
+    file_size = msg.get("file_size", 0)
+    digest = msg.get("sha256") or ""
+
+    if not TRANSFER_ID_PATTERN.fullmatch(upload_id) or not filename:
+        send_system(conn, "Failed to upload file: missing upload_id or filename")
+        return
+    if not valid_size(file_size):
+        send_file_error(conn, f"Failed to upload '{filename}': bad file_size", upload_id=upload_id)
+        return
+    if not SHA256_PATTERN.fullmatch(digest):
+        digest = ""
+
+    expire_partial_uploads()
+    key = upload_key(conn.username, upload_id)
+    part_path, meta_path = partial_paths(key)
+
+    with lock:
+        previous = active_uploads.get(key)
+        active_uploads[key] = conn
+    if previous is not None and previous is not conn:
+        # A reconnecting client takes the upload over from its dead connection
+        suspend_upload(previous, upload_id)
+
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(part_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("sender") != sender or meta.get("filename") != filename or \
+                meta.get("file_size") != file_size or meta.get("sha256") != digest:
+            meta = None
+
+    received = os.path.getsize(part_path) if meta else 0
+    if meta is None or received > file_size:
+        meta = {
+            "sender": sender,
+            "receiver": msg.get("receiver") or "",
+            "filename": filename,
+            "file_size": file_size,
+            "timestamp": timestamp,
+            "sha256": digest,
+            "file_id": new_file_id(),
+        }
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        received = 0
+
+    conn.uploads[upload_id] = {
+        "file": open(part_path, "ab" if received else "wb"),
+        # The hash covers the whole file; a resumed one is hashed off the
+        # connection at the end instead of re-reading it here
+        "hasher": None if received else hashlib.sha256(),
+        "key": key,
+        "part_path": part_path,
+        "meta_path": meta_path,
+        "received": received,
+        **meta,
+    }
+    if received:
+        logging.info(
+            f"[UPLOAD] Resuming '{filename}' at byte {received} of {file_size}")
+    else:
+        logging.info(
+            f"[UPLOAD] Receiving '{filename}' as '{meta['file_id']}' ({file_size} bytes)")
+
+    ready_msg = {
+        "type": "file_upload_ready",
+        "sender": "server",
+        "upload_id": upload_id,
+        "file_id": meta["file_id"],
+        "offset": received
+    }
+    if digest and file_size and file_store().has(digest, file_size):
+        # Naming the hash is not enough to get the content shared; a
+        # client that has the bytes can prove it and skip sending them
+        conn.uploads[upload_id]["challenge"] = ready_msg["challenge"] = secrets.token_hex(16)
+    send_to(conn, ready_msg)
+
+
+def prove_upload(conn, msg):
+    """
+    Checks a file_upload_proof: the HMAC of the file keyed by the
+    upload's challenge. If it matches the stored content, the upload is
+    done without a transfer; otherwise the client sends the bytes.
+    Each challenge is good for one try.
+    """
+    upload_id = msg.get("upload_id")
+    upload = conn.uploads.get(upload_id)
+    challenge = upload.pop("challenge", None) if upload is not None else None
+    if challenge is None:
+        send_file_error(conn, "No upload is waiting for a proof", upload_id=upload_id)
+        return
+    path = file_store().object_path(upload["sha256"])
+
+    def check(expected):
+        if conn.uploads.get(upload_id) is not upload:
+            return  # given up or taken over meanwhile
+        if hmac.compare_digest(expected, str(msg.get("proof", ""))):
+            skip_upload(conn, upload_id)
             return
+        logging.warning(f"[UPLOAD] Wrong proof for '{upload['filename']}' from {upload['sender']}")
+        send_to(conn, {
+            "type": "file_upload_ready",
+            "sender": "server",
+            "upload_id": upload_id,
+            "file_id": upload["file_id"],
+            "offset": upload["received"],
+            "stored": False
+        })
+
+    if offload.executors["crypto"] is None:
+        check(file_hmac(path, challenge))
+    else:
+        when_done(offload.submit("crypto", file_hmac, path, challenge), check, f"check a proof for '{path}'")
+
+
+def skip_upload(conn, upload_id):
+    """Shares content the server already stores under a proven upload's file_id."""
+    upload = suspend_upload(conn, upload_id)
+    remove_partial(upload)
+    file_store().record(upload["file_id"], upload["sha256"], upload["filename"],
+                        upload["file_size"], upload["sender"], upload["timestamp"])
+    logging.info(
+        f"[UPLOAD] '{upload['filename']}' from {upload['sender']} already stored, skipping transfer")
+    send_to(conn, {
+        "type": "file_upload_ready",
+        "sender": "server",
+        "upload_id": upload_id,
+        "file_id": upload["file_id"],
+        "offset": upload["file_size"],
+        "stored": True
+    })
+    announce_upload(conn, upload)
+
+
+
+def write_upload_chunk(conn, msg):
+    """Appends one binary chunk straight to the partial file."""
+    upload = conn.uploads.get(msg["transfer_id"])
+    if upload is None:
+        return
+    data = msg["data"]
+    if msg["offset"] != upload["received"] or \
+            upload["received"] + len(data) > upload["file_size"]:
+        discard_upload(conn, msg["transfer_id"])
+        send_system(conn, f"Failed to upload file: bad chunk for '{upload['filename']}'")
+        return
+    upload["file"].write(data)
+    if upload["hasher"] is not None:
+        upload["hasher"].update(data)
+    upload["received"] += len(data)
+
+
+def finish_upload(conn, msg):
+    """Moves a fully received upload into place."""
+    upload_id = msg.get("upload_id")
+    upload = conn.uploads.get(upload_id)
+    if upload is None:
+        return
+
+    if upload["received"] != upload["file_size"]:
+        # Keep what we have; the client can resume from here
+        suspend_upload(conn, upload_id)
+        logging.error(
+            f"[ERROR] Upload of '{upload['filename']}' incomplete "
+            f"({upload['received']}/{upload['file_size']} bytes)")
+        send_system(conn, f"Failed to upload file: '{upload['filename']}' incomplete")
+        return
+
+    suspend_upload(conn, upload_id)
+    if upload["hasher"] is None:
+        when_hashed(upload["part_path"], lambda digest: store_upload(conn, upload, digest))
+    else:
+        store_upload(conn, upload, upload["hasher"].hexdigest())
+
+
+def store_upload(conn, upload, digest):
+    """Puts a complete upload whose hash is known into the store and announces it."""
+    if upload["sha256"] and upload["sha256"] != digest:
+        remove_partial(upload)
+        logging.error(
+            f"[ERROR] Upload of '{upload['filename']}' does not match its hash")
+        send_system(conn, f"Failed to upload file: '{upload['filename']}' is corrupted")
+        return
+
+    file_store().add_file(upload["file_id"], upload["part_path"], digest,
+                          upload["filename"], upload["sender"], upload["timestamp"])
+    os.remove(upload["meta_path"])
+    logging.info(
+        f"[UPLOAD] Saved file '{upload['filename']}' as '{upload['file_id']}' "
+        f"({upload['received']} bytes, sha256 {digest[:12]})")
+    announce_upload(conn, upload)
+
+
+def announce_upload(conn, upload):
+    """Tells the uploader their file is stored, and everyone it is for that it is there."""
+    send_system(conn, f"File '{upload['filename']}' uploaded successfully")
+
+    # Announce it from here, so nobody hears about a half-written file
+    route(conn, {
+        "type": "file",
+        "sender": upload["sender"],
+        "timestamp": upload["timestamp"],
+        "message": upload["filename"],
+        "file_id": upload["file_id"],
+        "file_size": upload["file_size"],
+        "receiver": upload["receiver"]
+    })
+
+
+def suspend_upload(conn, upload_id):
+    """
+    Closes an upload's file and forgets it on this connection.
+    The partial file stays on disk so the upload can be resumed.
+    """
+    upload = conn.uploads.pop(upload_id, None)
+    if upload is None:
+        return None
+    upload["file"].close()
+    with lock:
+        if active_uploads.get(upload["key"]) is conn:
+            del active_uploads[upload["key"]]
+    return upload
+
+
+def discard_upload(conn, upload_id):
+    """Stops an upload and deletes what was received."""
+    upload = suspend_upload(conn, upload_id)
+    if upload is not None:
+        remove_partial(upload)
+
+
+def remove_partial(upload):
+    for path in (upload["part_path"], upload["meta_path"]):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def suspend_uploads(conn):
+    """Keeps every unfinished upload of a closing connection resumable."""
+    for upload_id in list(conn.uploads):
+        suspend_upload(conn, upload_id)
+
+
+def iter_download_frames(filepath, file_id, filename, transfer_id, requester, offset=0, length=None,
+                         codec="json", compression=None, cipher=None):
+    """
+    Yields the frames of a streamed download: file_download_begin, one
+    encrypted binary chunk per FILE_CHUNK_SIZE, then file_download_end.
+    `offset`/`length` select a byte range, e.g. to resume a download.
+    Nothing is read from disk until the writer asks for the next frame.
+    Chunks are compressed one by one unless the file is compressed already.
+    """
+    file_size = os.path.getsize(filepath)
+    offset = min(max(offset, 0), file_size)
+    if length is None or length < 0 or offset + length > file_size:
+        length = file_size - offset
+
+    begin_msg = {
+        "type": "file_download_begin",
+        "sender": "server",
+        "timestamp": current_timestamp(),
+        "transfer_id": transfer_id,
+        "file_id": file_id,
+        "message": filename,
+        "file_size": file_size,
+        "offset": offset,
+        "length": length
+    }
+    yield frame_msg(seal(begin_msg, codec, compression, cipher))
+
+    chunks = ChunkCompressor(compression, filename)
+    for chunk_offset, data in iter_file_chunks(filepath, offset, length=length):
+        yield frame_msg(encrypt_frame(chunks.pack(build_chunk(transfer_id, chunk_offset, data)), cipher))
 
-        temp_name = msg.get("sender")
+    end_msg = {
+        "type": "file_download_end",
+        "sender": "server",
+        "transfer_id": transfer_id
+    }
+    yield frame_msg(seal(end_msg, codec, compression, cipher))
+    logging.info(
+        f"[DOWNLOAD] Sent file '{file_id}' to {requester} "
+        f"(bytes {offset}-{offset + length} of {file_size})")
 
+
+def route_transfer(conn, msg):
+    """Handles a message that came on a data channel, which only carries file transfers."""
+    if msg.get("type") not in DATA_CHANNEL_MESSAGES:
+        logging.warning(f"[DATA] Ignored {msg.get('type')} from {conn.username} on its data channel")
+        return
+    handle_message(conn, msg)
+
+
+def route(conn, msg):
+    """
+    Handles a message from a logged-in client. A worker handles file
+    transfers itself and passes everything else to the core.
+    """
+    if core is not None and msg.get("type") not in WORKER_MESSAGES:
+        core.forward(conn, msg)
+    else:
+        handle_message(conn, msg)
+
+
+def handle_message(conn, msg):
+    """
+    Routes one decoded message from a logged-in client.
+    Shared by both the thread and the asyncio engines, so it must only
+    talk to sockets through send_to()/broadcast().
+    """
+    msg_type = msg.get("type")
+    sender = msg.get("sender")
+    timestamp = msg.get("timestamp", current_timestamp())
+    text = msg.get("message", "")
+
+    logging.debug(f"[DEBUG] Received message type: {msg_type} from {sender}")
+
+    if msg_type in RECORDED_MESSAGES:
+        problem = refusal(msg)
+    else:
+        problem = None
+    if problem:
+        logging.warning(f"[REJECTED] {msg_type} message from {conn.username}: {problem}")
+        send_system(conn, f"Message refused: {problem}")
+        if not isinstance(msg.get("id"), str) or not MESSAGE_ID_PATTERN.fullmatch(msg["id"]):
+            msg.pop("id", None)
+        send_ack(conn, msg)
+        return
+    if msg_type in ("public", "private", "channel_message") and duplicate_of(conn, msg):
+        # Sent again after a reconnect, but it got through the first time
+        return
+
+    if msg_type == "public":
+        logging.info(f"[PUBLIC] {sender}: {text}")
+        # Serialized once for both the history and the fan-out
+        message_json = record_message(msg)
+        if message_json is not None:
+            fan_out(message_json)
+            publish_message("all", msg)
+        send_ack(conn, msg)
+
+    elif msg_type == "private":
+        receiver = msg.get("receiver")
+        if receiver in clients or receiver in away or receiver in remote_users:
+            logging.info(f"[PRIVATE] {sender} -> {receiver}: {text}")
+            message_json = record_message(msg)
+            # A user in their grace period gets it when they resume
+            target = clients.get(receiver)
+            if target is not None and message_json is not None:
+                send_to(target, message_json)
+            elif receiver in remote_users and message_json is not None:
+                publish_message("user:" + receiver, msg)
+            send_ack(conn, msg)
+        else:
+            queue_private(conn, msg)
+
+    elif msg_type == "mailbox_ack":
+        seqs = msg.get("seqs")
+        if mailbox is not None and isinstance(seqs, list):
+            mailbox.ack(conn.username, [seq for seq in seqs if isinstance(seq, int)])
+
+    elif msg_type == "history_request":
+        send_history_page(conn, msg)
+
+    elif msg_type == "search":
+        send_search_results(conn, msg)
+
+    elif msg_type == "join":
+        join_channel(conn, msg)
+
+    elif msg_type == "leave":
+        leave_channel(conn, msg)
+
+    elif msg_type == "channel_message":
+        send_channel_message(conn, msg)
+
+    elif msg_type == "system" and text == "disconnect":
+        # A deliberate logout: leave right away, no grace period
         with lock:
-            if temp_name in clients:
-                rejection = build_message(
-                    "system", "server", "username_rejected")
-                # This line was already correct
-                send_msg(conn, encrypt_message(rejection))
-                logging.warning(
-                    f"[REJECTED] {temp_name} already exists")
-                # logging.warning(
-                #     f"Rejected duplicate username '{temp_name}' from {addr}")
-                conn.close()
+            session_tokens.pop(conn.username, None)
+
+    elif msg_type == "presence_sync":
+        # The client missed a delta; resend everything
+        with lock:
+            send_to(conn, presence_snapshot())
+
+    elif msg_type == "file_upload_begin":
+        begin_upload(conn, msg)
+
+    elif msg_type == "file_upload_proof":
+        prove_upload(conn, msg)
+
+    elif msg_type == "file_chunk":
+        write_upload_chunk(conn, msg)
+
+    elif msg_type == "file_upload_end":
+        finish_upload(conn, msg)
+
+    elif msg_type == "file_upload":
+        # Legacy single-frame upload from older clients
+        filename = msg.get("filename")
+        file_data_b64 = msg.get("file_data")
+        timestamp = msg.get("timestamp")
+
+        if not file_data_b64:
+            logging.error(f"[ERROR] No file data received for {filename}")
+            return
+
+        try:
+            # Binary clients may send the bytes as they are
+            file_data = file_data_b64 if isinstance(file_data_b64, bytes) else base64.b64decode(file_data_b64)
+            file_id = new_file_id()
+            filepath, _ = partial_paths(file_id)
+
+            with open(filepath, "wb") as f:
+                f.write(file_data)
+            file_store().add_file(
+                file_id, filepath, hashlib.sha256(file_data).hexdigest(),
+                os.path.basename(filename), msg.get("sender"), timestamp)
+
+            logging.info(
+                f"[UPLOAD] Saved file '{filename}' as '{file_id}' ({len(file_data)} bytes)")
+
+            confirm_msg = build_message(
+                "system", "server", f"File '{filename}' uploaded successfully")
+            send_to(conn, confirm_msg)
+
+        except Exception as e:
+            logging.error(
+                f"[ERROR] Failed to save uploaded file '{filename}': {e}")
+            error_msg = build_message(
+                "system", "server", f"Failed to upload file: {e}")
+            send_to(conn, error_msg)
+
+    elif msg_type == "file":
+        announce_file(conn, msg)
+
+    elif msg_type == "file_download_request":
+        file_id = os.path.basename(msg.get("file_id") or "")
+        requester = msg.get("sender")
+        transfer_id = msg.get("transfer_id")
+        found = file_store().lookup(file_id)
+
+        logging.info(
+            f"[DOWNLOAD] {requester} requesting file '{file_id}'")
+
+        if found is None or not os.path.exists(found[0]):
+            if found is None and fetch_file(conn, msg, file_id):
+                return  # uploaded on another node; handled again once copied here
+            send_not_found(conn, file_id, transfer_id)
+            return
+        filepath, record = found
+
+        if transfer_id:
+            offset = msg.get("offset") or 0
+            length = msg.get("length")
+            if not valid_size(offset) or (length is not None and not valid_size(length)):
+                send_file_error(conn, f"Bad range for file '{file_id}'", transfer_id=transfer_id)
                 return
+            # Streamed lazily by the writer of the data channel if the
+            # client opened one, otherwise behind chat on this connection
+            target = conn.bulk or conn
+            target.add_stream(iter_download_frames(
+                filepath, file_id, record["filename"], transfer_id, requester,
+                offset=offset, length=length, codec=target.codec,
+                compression=target.compression, cipher=target.cipher))
+            return
+
+        # Legacy single-frame download for clients without transfer IDs
+        if os.path.getsize(filepath) > MAX_PAYLOAD_SIZE * 3 // 4 - 1024:
+            # Base64 in one frame would be more than the client accepts
+            logging.warning(f"[DOWNLOAD] '{file_id}' is too large for a single-frame download")
+            send_system(conn, f"File '{file_id}' is too large to download without transfer IDs")
+            return
+        try:
+            with open(filepath, "rb") as f:
+                file_data = f.read()
+
+            file_data_b64 = base64.b64encode(file_data).decode("utf-8")
+
+            download_msg = {
+                "type": "file_download",
+                "sender": "server",
+                "timestamp": current_timestamp(),
+                "message": record["filename"],
+                "file_data": file_data_b64
+            }
+
+            send_to(clients[requester], download_msg)
+            logging.info(
+                f"[DOWNLOAD] Sent file '{file_id}' to {requester} ({len(file_data)} bytes)")
+
+        except Exception as e:
+            logging.error(
+                f"[ERROR] Could not send file '{file_id}': {e}")
+            error_msg = build_message(
+                "system", "server", f"Error downloading file: {e}")
+            send_to(conn, error_msg)
+
+
+def send_not_found(conn, file_id, transfer_id, text=None):
+    text = text or f"File '{file_id}' not found"
+    logging.error(f"[ERROR] {text}")
+    if transfer_id:
+        # Tied to the transfer so the client can free its slot
+        error_msg = json.dumps({
+            "type": "file_download_error",
+            "sender": "server",
+            "transfer_id": transfer_id,
+            "message": text,
+        })
+    else:
+        error_msg = build_message("system", "server", text)
+    send_to(conn, error_msg)
+
+
+def handle_client(sock, addr):
+    """Thread engine: serves one client socket on its own thread."""
+    conn = SocketConnection(sock, queue_size, overflow_policy)
+    reader = FrameReader(sock)
+    username = None
+    is_data_channel = False
+
+    try:
+        msg = recv_full_message(reader, conn)
+        if not msg:
+            return
+
+        if msg.get("type") == "data_channel_attach":
+            is_data_channel = True
+            username = attach_data_channel(conn, msg)
+        else:
+            negotiate(conn, msg)
+            if core is not None:
+                # The core has the sessions; wait for its verdict
+                username = core.open(conn, msg, addr).result()
             else:
-                clients[temp_name] = conn
-                username = temp_name
-                # Send user list directly to the new user as well
-                user_list = ",".join(clients.keys())
-                message = build_message(
-                    "system", "server", f"user_list:{user_list}")
-                # ✅ Direct message to new client
-                send_msg(conn, encrypt_message(message))
-                broadcast_user_list()
-
-                # print(f"[CLIENTS] Now connected: {list(clients.keys())}")
-                logging.info(
-                    f"[CLIENTS] Now connected: {list(clients.keys())}")
-
-        # print(f"[CONNECTED] {username} from {addr}")
-        logging.info(f"[CONNECTED] {username} from {addr}")
-
-        join_msg = build_message(
-            "system", "server", f"{username} has joined the chat.")
-        broadcast(json.loads(join_msg), exclude=username)
+                username = log_in(conn, msg)
+        if not username:
+            return
+
+        if not is_data_channel:
+            logging.info(f"[CONNECTED] {username} from {addr}")
 
         while True:
-            msg = recv_full_message(conn)
+            msg = recv_full_message(reader, conn)
             if not msg:
                 break
+            if is_data_channel:
+                route_transfer(conn, msg)
+            else:
+                route(conn, msg)
 
-            msg_type = msg.get("type")
-            sender = msg.get("sender")
-            timestamp = msg.get("timestamp", current_timestamp())
-            text = msg.get("message", "")
-
-            print(f"[DEBUG] Received message type: {msg_type} from {sender}")
-
-            if msg_type == "public":
-                # print(f"[PUBLIC] {sender}: {text}")
-                logging.info(f"[PUBLIC] {sender}: {text}")
-                # This correctly calls the fixed broadcast function
-                broadcast(msg)
-
-            elif msg_type == "private":
-                receiver = msg.get("receiver")
-                if receiver in clients:
-                    # print(f"[PRIVATE] {sender} → {receiver}: {text}")
-                    logging.info(f"[PRIVATE] {sender} -> {receiver}: {text}")
-                    # This line was already correct
-                    send_msg(clients[receiver],
-                             encrypt_message(json.dumps(msg)))
-                else:
-                    error = build_message(
-                        "system", "server", f"User '{receiver}' not found.")
-                    # FIXED: Replaced .send() with send_msg()
-                    send_msg(conn, encrypt_message(error))
-
-            elif msg_type == "file_upload":
-                filename = msg.get("filename")
-                file_data_b64 = msg.get("file_data")
-                timestamp = msg.get("timestamp")
-
-                if not file_data_b64:
-                    print(f"[ERROR] No file data received for {filename}")
-                    continue
-
-                try:
-                    file_data = base64.b64decode(file_data_b64)
-                    file_id = f"{timestamp.replace(':', '-')}_{filename}"
-                    filepath = os.path.join(FILE_STORAGE_DIR, file_id)
-
-                    with open(filepath, "wb") as f:
-                        f.write(file_data)
-
-                    # print(
-                    #     f"[UPLOAD] Saved file '{filename}' as '{file_id}' ({len(file_data)} bytes)")
-                    logging.info(
-                        f"[UPLOAD] Saved file '{filename}' as '{file_id}' ({len(file_data)} bytes)")
-
-                    confirm_msg = build_message(
-                        "system", "server", f"File '{filename}' uploaded successfully")
-                    send_msg(conn, encrypt_message(confirm_msg))
-
-                except Exception as e:
-                    # print(
-                    #     f"[ERROR] Failed to save uploaded file '{filename}': {e}")
-                    logging.error(
-                        f"[ERROR] Failed to save uploaded file '{filename}': {e}")
-                    error_msg = build_message(
-                        "system", "server", f"Failed to upload file: {e}")
-                    send_msg(conn, encrypt_message(error_msg))
-
-            elif msg_type == "file":
-                receiver = msg.get("receiver")
-                filename = msg.get("message")
-                file_id = msg.get("file_id")
-
-                logging.info(
-                    f"[FILE] {sender} sharing file '{filename}' (ID: {file_id})")
-
-                if receiver:
-                    if receiver in clients:
-                        # print(f"[FILE] {sender} → {receiver}: {filename}")
-                        logging.info(
-                            f"[FILE] {sender} -> {receiver}: {msg.get('message')}")
-                        send_msg(clients[receiver],
-                                 encrypt_message(json.dumps(msg)))
-                    else:
-                        error = build_message(
-                            "system", "server", f"User '{receiver}' not found.")
-                        send_msg(conn, encrypt_message(error))
-                else:
-                    # print(f"[FILE] {sender} shared file publicly: {filename}")
-                    logging.info(
-                        f"[FILE] {sender} shared publicly: {msg.get('message')}")
-                    broadcast(msg, exclude=sender)
-
-            elif msg_type == "file_download_request":
-                file_id = msg.get("file_id")
-                requester = msg.get("sender")
-                filepath = os.path.join(FILE_STORAGE_DIR, file_id)
-
-                # print(f"[DOWNLOAD] {requester} requesting file '{file_id}'")
-                logging.info(
-                    f"[DOWNLOAD] {requester} requesting file '{file_id}'")
-
-                if not os.path.exists(filepath):
-                    # print(f"[ERROR] File '{file_id}' not found")
-                    logging.error(
-                        f"[ERROR] File '{file_id}' not found'")
-                    error_msg = build_message(
-                        "system", "server", f"File '{file_id}' not found")
-                    send_msg(conn, encrypt_message(error_msg))
-                    continue
-
-                try:
-                    with open(filepath, "rb") as f:
-                        file_data = f.read()
-
-                    file_data_b64 = base64.b64encode(file_data).decode("utf-8")
-                    original_filename = "_".join(file_id.split("_")[1:])
-
-                    download_msg = {
-                        "type": "file_download",
-                        "sender": "server",
-                        "timestamp": current_timestamp(),
-                        "message": original_filename,
-                        "file_data": file_data_b64
-                    }
-
-                    send_msg(clients[requester], encrypt_message(
-                        json.dumps(download_msg)))
-                    # print(
-                    #     f"[DOWNLOAD] Sent file '{file_id}' to {requester} ({len(file_data)} bytes)")
-                    logging.info(
-                        f"[DOWNLOAD] Sent file '{file_id}' to {requester} ({len(file_data)} bytes)")
-
-                except Exception as e:
-                    # print(f"[ERROR] Could not send file '{file_id}': {e}")
-                    logging.error(
-                        f"[ERROR] Could not send file '{file_id}': {e}")
-                    error_msg = build_message(
-                        "system", "server", f"Error downloading file: {e}")
-                    send_msg(conn, encrypt_message(error_msg))
+    except Exception as e:
+        logging.exception(f"[EXCEPTION] {username}: {e}")
+
+    finally:
+        suspend_uploads(conn)
+        if username and is_data_channel:
+            detach_data_channel(username, conn)
+        elif core is not None:
+            leave_worker(conn)
+        elif username:
+            unregister_client(username, addr, conn)
+        conn.close()
+
+
+async def recv_full_message_async(reader, conn):
+    try:
+        data = await recv_msg_async(reader)
+        if not data:
+            return None
+        return await offload.decode_frame_async(data, conn.cipher)
+    except Exception as e:
+        print(f"[RECV ERROR] {e}")
+        return None
+
+
+async def handle_client_async(reader, writer):
+    """Asyncio engine: serves one client as a task on the event loop."""
+    addr = writer.get_extra_info("peername")
+    conn = StreamConnection(writer, queue_size, overflow_policy, offload)
+    username = None
+    is_data_channel = False
+
+    try:
+        msg = await recv_full_message_async(reader, conn)
+        if not msg:
+            return
+
+        if msg.get("type") == "data_channel_attach":
+            is_data_channel = True
+            username = attach_data_channel(conn, msg)
+        else:
+            negotiate(conn, msg)
+            if core is not None:
+                username = await asyncio.wrap_future(core.open(conn, msg, addr))
+            else:
+                claimed = None
+                if backplane is not None:
+                    # The broker's answer takes a round trip: wait for it off the loop
+                    claimed = await asyncio.get_running_loop().run_in_executor(None, claim_name, msg)
+                username = log_in(conn, msg, claimed)
+        if not username:
+            return
+
+        if not is_data_channel:
+            logging.info(f"[CONNECTED] {username} from {addr}")
+
+        while True:
+            msg = await recv_full_message_async(reader, conn)
+            if not msg:
+                break
+            if is_data_channel:
+                route_transfer(conn, msg)
+            else:
+                route(conn, msg)
 
     except Exception as e:
-        # print(f"[EXCEPTION] {username}: {e}")
         logging.exception(f"[EXCEPTION] {username}: {e}")
 
     finally:
-        if username:
-            with lock:
-                clients.pop(username, None)
-                broadcast_user_list()
-                # print(f"[CLIENTS] Now connected: {list(clients.keys())}")
-                logging.info(
-                    f"[CLIENTS] Now connected: {list(clients.keys())}")
-            leave_msg = build_message(
-                "system", "server", f"{username} has left the chat.")
-            broadcast(json.loads(leave_msg), exclude=username)
-            # print(f"[DISCONNECTED] {username} from {addr}")
-            logging.info(f"[DISCONNECTED] {username} from {addr}")
+        suspend_uploads(conn)
+        if username and is_data_channel:
+            detach_data_channel(username, conn)
+        elif core is not None:
+            leave_worker(conn)
+        elif username:
+            unregister_client(username, addr, conn)
         conn.close()
 
 
-def start_server():
-    setup_logging()
+async def serve_async(host=SERVER_IP, port=SERVER_PORT, reuse_port=False):
+    """Runs every connection as a task on a single event loop."""
+    server = await asyncio.start_server(
+        handle_client_async, host, port, backlog=LISTEN_BACKLOG,
+        reuse_address=True, reuse_port=reuse_port)
+    logging.info(f"[STARTED] Chat server on {host}:{port} (asyncio engine)")
+    if core is not None:
+        loop = asyncio.get_running_loop()
+        # Ops touch connections, so they run on the loop
+        core.start(lambda op: loop.call_soon_threadsafe(carry_out, op), lost_core)
+    if backplane is not None:
+        loop = asyncio.get_running_loop()
+        join_cluster(lambda events: loop.call_soon_threadsafe(handle_cluster_events, events))
+    reaper = asyncio.get_running_loop().create_task(reap_sessions_async())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reaper.cancel()
+
+
+def serve_threads(host=SERVER_IP, port=SERVER_PORT, reuse_port=False):
+    """Runs one daemon thread per accepted connection."""
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((SERVER_IP, SERVER_PORT))
-    server.listen(5)
-    # print(f"[STARTED] Chat server on {SERVER_IP}:{SERVER_PORT}")
-    logging.info(f"[STARTED] Chat server on {SERVER_IP}:{SERVER_PORT}")
+    if reuse_port:
+        # Every worker listens on the port; the kernel spreads the connections
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(LISTEN_BACKLOG)
+    logging.info(f"[STARTED] Chat server on {host}:{port}")
+    if core is not None:
+        core.start(carry_out, lost_core)
+    if backplane is not None:
+        join_cluster()
+    threading.Thread(target=reap_sessions, daemon=True).start()
 
     try:
         while True:
             conn, addr = server.accept()
             threading.Thread(target=handle_client, args=(
                 conn, addr), daemon=True).start()
+    finally:
+        server.close()
+
+
+def carry_out(op):
+    """Worker: does what the core asks (the ops are listed in server/workers.py)."""
+    kind = op["op"]
+    if kind == "fan_out":
+        fan_out(op["message"], op["exclude"])
+    elif kind == "send_many":
+        frames = {}  # as in fan_out(): one frame per wire format
+        for conn_id in op["conns"]:
+            conn = core.connections.get(conn_id)
+            if conn is not None:
+                conn.enqueue(frame_for(frames, op["message"], conn))
+    elif kind == "opened":
+        core.opened(op["conn"], op["user"])
+    else:
+        conn = core.connections.get(op["conn"])
+        if conn is None:
+            return  # already gone
+        if kind == "send":
+            send_to(conn, op["message"])
+        elif kind == "login":
+            with lock:
+                clients[op["user"]] = conn
+            conn.username = op["user"]
+        elif kind == "abort":
+            with lock:
+                if clients.get(conn.username) is conn:
+                    del clients[conn.username]
+            conn.abort()
+
+
+def leave_worker(conn):
+    """Worker: forgets a client that disconnected, and tells the core."""
+    with lock:
+        if conn.username and clients.get(conn.username) is conn:
+            del clients[conn.username]
+    core.closed(conn)
+
+
+def lost_core():
+    # Without the core nobody can log in or chat; let the clients reconnect elsewhere
+    logging.warning("[BUS] Lost the core, exiting")
+    os._exit(1)
+
+
+def drop_remote(conn):
+    """Core: a worker's client disconnected (or its worker did)."""
+    if conn.username:
+        unregister_client(conn.username, conn.addr, conn)
+
+
+def run_worker(index, engine, host, port, offload_threshold, offload_threads, offload_processes):
+    """A worker process: serves its share of the port's connections for the core."""
+    global hub, core, offload
+    # The bus listener belongs to the core
+    hub.listener.close()
+    bus_path, hub = hub.path, None
+    core = CoreLink(bus_path, f"worker-{index}")
+    offload = create_offload(offload_threshold, offload_threads, offload_processes)
+    try:
+        if engine == "asyncio":
+            asyncio.run(serve_async(host, port, reuse_port=True))
+        else:
+            serve_threads(host, port, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        offload.shutdown()
+
+
+def serve_core(workers):
+    """Multi-process mode: the workers hold the connections, this process the shared state."""
+    logging.info(f"[STARTED] Core of {workers} workers, bus at {hub.path}")
+    threading.Thread(target=reap_sessions, daemon=True).start()
+    hub.serve(log_in, handle_message, drop_remote)
+
+
+def publish_message(target, msg):
+    """Passes a recorded chat message on to the other nodes (targets as in server/backplane.py)."""
+    if backplane is not None:
+        backplane.publish(target, {"kind": "message", "msg": msg})
+
+
+def join_cluster(dispatch=None):
+    """
+    Attaches this node to the backplane. dispatch(events) runs
+    handle_cluster_events where the engine wants it (the asyncio engine:
+    on its loop).
+    """
+    users = backplane.start(dispatch or handle_cluster_events, lost_backplane)
+    with lock:
+        remote_users.update(users)
+    logging.info(f"[CLUSTER] {backplane.node} joined, {len(users)} users on other nodes")
+
+
+def lost_backplane():
+    # Without the broker no login can be checked against the other nodes
+    logging.warning("[CLUSTER] Lost the backplane, exiting")
+    os._exit(1)
+
+
+def handle_cluster_events(events):
+    """Handles what the other nodes sent (the events are listed in server/backplane.py)."""
+    for event in events:
+        kind = event.get("kind")
+        if kind == "message":
+            deliver_remote(event["msg"])
+        elif kind == "channel_event":
+            event = event["event"]
+            fan_out_channel(event["channel"], event, exclude=event["user"])
+        elif kind in ("join", "leave", "claimed"):
+            remote_presence(event)
+        elif kind == "fetch":
+            # Reading the file must not hold up the events behind it
+            threading.Thread(target=send_file_copy, args=(event["file_id"], event["node"]),
+                             daemon=True).start()
+        elif kind == "file_part":
+            receive_file_part(event)
+
+
+def deliver_remote(msg):
+    """
+    Delivers a chat message from another node to the users here. It is
+    recorded here too, under this node's next seq, so history, resume
+    and search work as for local messages.
+    """
+    msg.pop("seq", None)
+    message_json = record_message(msg)
+    if message_json is None:
+        return
+    if msg.get("type") == "channel_message":
+        fan_out_channel(msg["channel"], message_json)
+    elif msg.get("receiver"):
+        target = clients.get(msg["receiver"])
+        if target is not None:
+            send_to(target, message_json)
+    else:
+        fan_out(message_json)
+
+
+def remote_presence(event):
+    """A user joined or left on another node, or took over a session dropped here."""
+    username = event["user"]
+    kind = event["kind"]
+    with lock:
+        if kind == "claimed":
+            if username in clients:
+                return
+            # They logged in again elsewhere: their session here ends without a leave
+            away.pop(username, None)
+            session_tokens.pop(username, None)
+            session_since.pop(username, None)
+            leave_all_channels(username)
+            remote_users[username] = event["node"]
+            logging.info(f"[CLUSTER] {username} moved to {event['node']}")
+            return
+        here = username in clients or username in away
+        if kind == "join":
+            known = here or username in remote_users
+            remote_users[username] = event["node"]
+            if known:
+                return
+            broadcast_presence("presence_join", username)
+        else:
+            if remote_users.pop(username, None) is None or here:
+                return
+            broadcast_presence("presence_leave", username)
+    verb = "joined" if kind == "join" else "left"
+    broadcast(json.loads(build_message(
+        "system", "server", f"{username} has {verb} the chat.")), exclude=username)
+
+
+def fetch_file(conn, msg, file_id):
+    """
+    Parks a download request for a file this node does not have, and
+    asks the broker which node stores it (see ask_for_copy()). The
+    request is answered once the copy is here, or with an error if no
+    node has it or it takes longer than FILE_FETCH_TIMEOUT. False
+    without a backplane.
+    """
+    if backplane is None or not file_id:
+        return False
+    with lock:
+        waiting = fetches.setdefault(file_id, [])
+        waiting.append((conn, msg))
+        if len(waiting) > 1:
+            return True  # already on its way
+        fetch_deadlines[file_id] = time.monotonic() + FILE_FETCH_TIMEOUT
+    when_done(broker_calls.submit(backplane.locate, file_id),
+              lambda owner: ask_for_copy(file_id, owner), f"locate file '{file_id}'")
+    return True
+
+
+def ask_for_copy(file_id, owner):
+    """Asks `owner`, the node storing a file, to send this node a copy."""
+    if owner is None or owner == backplane.node:
+        finish_fetch(file_id, False)
+        return
+    logging.info(f"[CLUSTER] Fetching file '{file_id}' from {owner}")
+    backplane.publish("node:" + owner, {"kind": "fetch", "file_id": file_id, "node": backplane.node})
+
+
+def send_file_copy(file_id, node):
+    """Sends a stored file to the node that asked, a chunk per event; the last one carries its record."""
+    target = "node:" + node
+    found = file_store().lookup(file_id)
+    if found is None or not os.path.exists(found[0]):
+        backplane.publish(target, {"kind": "file_part", "file_id": file_id, "missing": True})
+        return
+    filepath, record = found
+    size = 0
+    for offset, data in iter_file_chunks(filepath):
+        backplane.publish(target, {"kind": "file_part", "file_id": file_id, "offset": offset, "data": data})
+        # A batch per chunk, so the file is never in memory whole
+        backplane.flush()
+        size = offset + len(data)
+    backplane.publish(target, {"kind": "file_part", "file_id": file_id, "offset": size, "data": b"",
+                               "record": record})
+    logging.info(f"[CLUSTER] Sent a copy of file '{file_id}' to {node} ({size} bytes)")
+
+
+def receive_file_part(event):
+    """Writes one piece of a fetched file; the last one puts it into the store."""
+    file_id = os.path.basename(event["file_id"])
+    if event.get("missing"):
+        finish_fetch(file_id, False)
+        return
+    part_path, _ = partial_paths(f"copy-{file_id}")
+    with open(part_path, "ab" if event["offset"] else "wb") as f:
+        f.write(event["data"])
+    record = event.get("record")
+    if record is not None:
+        # Hashed off the event loop; the rest carries on in store_copy()
+        when_hashed(part_path, lambda digest: store_copy(file_id, part_path, record, digest))
+
+
+def store_copy(file_id, part_path, record, digest):
+    """Puts a fetched file into the store if it arrived intact."""
+    # Files from before the store have no hash to check
+    if record.get("sha256", digest) != digest or os.path.getsize(part_path) != record["size"]:
+        logging.error(f"[ERROR] Copy of file '{file_id}' is corrupted")
+        os.remove(part_path)
+        finish_fetch(file_id, False)
+        return
+    file_store().add_file(file_id, part_path, digest, record["filename"],
+                          record.get("uploader"), record.get("timestamp"))
+    logging.info(f"[CLUSTER] Stored a copy of file '{file_id}' ({record['size']} bytes)")
+    finish_fetch(file_id, True)
+
+
+def finish_fetch(file_id, copied, error=None):
+    """
+    Carries on with the downloads that waited for a file's copy, or
+    fails them with `error` (by default, that the file is not found).
+    """
+    with lock:
+        waiting = fetches.pop(file_id, [])
+        fetch_deadlines.pop(file_id, None)
+    for conn, msg in waiting:
+        if copied:
+            handle_message(conn, msg)
+        else:
+            send_not_found(conn, file_id, msg.get("transfer_id"), error)
+
+
+def start_server(engine="threads", max_queue=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_OVERFLOW_POLICY,
+                 log_dir=MESSAGE_LOG_DIR, fsync_ms=LOG_FSYNC_INTERVAL_MS, fsync_batch=LOG_FSYNC_BATCH,
+                 grace=SESSION_GRACE_PERIOD, mailbox_dir=MAILBOX_DIR, offload_threshold=OFFLOAD_MIN_BYTES,
+                 offload_threads=OFFLOAD_THREADS, offload_processes=OFFLOAD_PROCESSES, workers=0,
+                 host=SERVER_IP, port=SERVER_PORT, backplane_spec=None, node=None):
+    global queue_size, overflow_policy, session_grace, mailbox, offload, hub, backplane
+    queue_size, overflow_policy = max_queue, policy
+    session_grace = grace
+    setup_logging()
+    processes = []
+    if backplane_spec:
+        if workers:
+            raise SystemExit("--backplane does not combine with --workers; run one process per node")
+        backplane = open_backplane(backplane_spec, node or f"{socket.gethostname()}:{port}")
+    if workers:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise SystemExit("--workers needs SO_REUSEPORT, which this platform does not have")
+        hub = Hub()
+        # Fork before this process starts threads (the message log has one);
+        # each worker makes its own offload pools
+        processes = start_workers(workers, run_worker, engine, host, port,
+                                  offload_threshold, offload_threads, offload_processes)
+    else:
+        offload = create_offload(offload_threshold, offload_threads, offload_processes)
+    mailbox = Mailbox(mailbox_dir)
+    open_message_log(log_dir, fsync_interval_ms=fsync_ms, fsync_batch=fsync_batch)
+    try:
+        if workers:
+            serve_core(workers)
+        elif engine == "asyncio":
+            asyncio.run(serve_async(host, port))
+        else:
+            serve_threads(host, port)
     except KeyboardInterrupt:
         logging.info("[SHUTDOWN] Server shutting down...")
     finally:
-        server.close()
+        if hub is not None:
+            hub.close()  # workers exit when the bus goes
+        stop_workers(processes)
+        if backplane is not None:
+            broker_calls.shutdown()  # the last presence changes go out first
+            backplane.close()
+        offload.shutdown()
+        close_message_log()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chatroom server")
+    parser.add_argument(
+        "--engine", choices=["threads", "asyncio"], default="threads",
+        help="threads: one thread per client; asyncio: one event loop for all clients")
+    parser.add_argument(
+        "--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE,
+        help="maximum frames waiting to be sent to one client")
+    parser.add_argument(
+        "--overflow-policy", choices=OVERFLOW_POLICIES, default=OUTBOUND_OVERFLOW_POLICY,
+        help="what to do when a client's outbound queue is full")
+    parser.add_argument(
+        "--log-dir", default=MESSAGE_LOG_DIR,
+        help="directory of the durable message log")
+    parser.add_argument(
+        "--fsync-ms", type=int, default=LOG_FSYNC_INTERVAL_MS,
+        help="fsync the message log at least this often (milliseconds)")
+    parser.add_argument(
+        "--fsync-batch", type=int, default=LOG_FSYNC_BATCH,
+        help="fsync the message log as soon as this many messages are waiting")
+    parser.add_argument(
+        "--session-grace", type=float, default=SESSION_GRACE_PERIOD,
+        help="seconds a dropped user may resume before others see them leave (0: leave right away)")
+    parser.add_argument(
+        "--mailbox-dir", default=MAILBOX_DIR,
+        help="directory of the mailboxes holding private messages for offline users")
+    parser.add_argument(
+        "--offload-threshold", type=int, default=OFFLOAD_MIN_BYTES,
+        help="frames at least this big (bytes) are decrypted and parsed off the connection")
+    parser.add_argument(
+        "--offload-threads", type=int, default=OFFLOAD_THREADS,
+        help="threads decrypting large frames (0: decrypt inline)")
+    parser.add_argument(
+        "--offload-processes", type=int, default=OFFLOAD_PROCESSES,
+        help="processes parsing large messages (0: parse inline)")
+    parser.add_argument(
+        "--workers", type=int, default=0,
+        help="serve clients from this many processes sharing the port (0: one process)")
+    parser.add_argument(
+        "--host", default=SERVER_IP,
+        help="address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=SERVER_PORT,
+        help="port to listen on (nodes of one cluster on one machine need one each)")
+    parser.add_argument(
+        "--backplane",
+        help="join other server nodes through a broker: unix:PATH (see server/backplane.py), "
+             "or memory for a node on its own")
+    parser.add_argument(
+        "--node",
+        help="this node's name on the backplane (default: host:port)")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    start_server(engine=args.engine, max_queue=args.queue_size,
+                 policy=args.overflow_policy, log_dir=args.log_dir,
+                 fsync_ms=args.fsync_ms, fsync_batch=args.fsync_batch,
+                 grace=args.session_grace, mailbox_dir=args.mailbox_dir,
+                 offload_threshold=args.offload_threshold, offload_threads=args.offload_threads,
+                 offload_processes=args.offload_processes, workers=args.workers,
+                 host=args.host, port=args.port, backplane_spec=args.backplane, node=args.node)
@@ -0,0 +1,127 @@
+"""
+server/storage.py
+
+Content-addressed file storage. Every file is stored once under its
+SHA-256 hash in sharded subdirectories (objects/ab/abcd...), and an
+append-only index maps each shared file_id to its hash, name, size,
+uploader and time. Sharing the same content again only adds an index
+entry.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+# Files older servers saved in the store root as "<timestamp>_<filename>",
+# the timestamp with "-" for ":" (e.g. "12-00-00_photo.png")
+LEGACY_FILE_ID = re.compile(r"[0-9][0-9 -]*_[^/\\]+")
+# The store's own entries in its root, never handed out as legacy files
+INTERNAL_NAMES = {"index.jsonl", "objects", "partial"}
+
+
+class FileStore:
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.index = {}  # file_id → {"sha256", "filename", "size", "uploader", "timestamp"}
+        self._index_read = 0  # bytes of the index file loaded so far
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Loads the index lines added since the last call, by this process or another."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_read)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # still being written; read it next time
+                self._index_read += len(line)
+                try:
+                    record = json.loads(line)
+                    self.index[record["file_id"]] = record
+                except (ValueError, KeyError):
+                    # A torn last line from a crash; the rest is still good
+                    logging.warning(f"[STORAGE] Skipping bad index line in {self.index_path}")
+
+    def object_path(self, digest):
+        """Two hex characters of sharding keep directories small."""
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def has(self, digest, size=None):
+        """Whether content with this hash (and size, if given) is stored."""
+        try:
+            stored_size = os.path.getsize(self.object_path(digest))
+        except OSError:
+            return False
+        return size is None or stored_size == size
+
+    def add_file(self, file_id, path, digest, filename, uploader, timestamp):
+        """
+        Moves a finished file into the store under its hash and records
+        file_id. If the content is already stored the file is dropped.
+        """
+        size = os.path.getsize(path)
+        target = self.object_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.has(digest, size):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+        return self.record(file_id, digest, filename, size, uploader, timestamp)
+
+    def record(self, file_id, digest, filename, size, uploader, timestamp):
+        """Adds an index entry for content that is already stored."""
+        record = {
+            "file_id": file_id,
+            "sha256": digest,
+            "filename": filename,
+            "size": size,
+            "uploader": uploader,
+            "timestamp": timestamp,
+        }
+        with self._lock:
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.index[file_id] = record
+        return record
+
+    @staticmethod
+    def is_legacy_id(file_id):
+        """Whether a file_id names an old-style upload, not the store's own files."""
+        return bool(file_id) and file_id == os.path.basename(file_id) and \
+            not file_id.startswith(".") and file_id not in INTERNAL_NAMES and \
+            LEGACY_FILE_ID.fullmatch(file_id) is not None
+
+    def lookup(self, file_id):
+        """
+        Returns (path, record) for a file_id, or None. Files saved under
+        their file_id before the store existed are still found.
+        """
+        record = self.index.get(file_id)
+        if record is None:
+            # Another server process (--workers) may have stored it
+            with self._lock:
+                self._load_index()
+            record = self.index.get(file_id)
+        if record is not None:
+            return self.object_path(record["sha256"]), record
+
+        if not self.is_legacy_id(file_id):
+            return None
+        legacy_path = os.path.join(self.root, file_id)
+        if os.path.isfile(legacy_path):
+            return legacy_path, {
+                "file_id": file_id,
+                "filename": "_".join(file_id.split("_")[1:]),
+                "size": os.path.getsize(legacy_path),
+            }
+        return None
@@ -0,0 +1,314 @@
+"""
+server/workers.py
+
+Multi-process mode (--workers N). N worker processes each listen on the
+server port with SO_REUSEPORT, so the kernel spreads new connections
+over them, and each does the work that grows with its connections:
+reading and decrypting frames, the key exchange, framing and
+encrypting what is sent, socket writes and file transfers. The parent
+process is the core. It keeps what every user shares - presence,
+sessions, channels, history, the message log, mailboxes - and runs the
+same routing code as the single-process server, on RemoteConnections
+standing in for the workers' clients.
+
+Core and workers talk over a Unix socket in a private directory, one
+connection per worker, in frames of the binary codec (shared/codec.py):
+
+  worker → core   hello{worker}                  once, first
+                  open{conn, addr, codec, compression, msg}
+                                                 a client's login or resume
+                  message{conn, msg}             anything else it sends
+                  close{conn}                    it disconnected
+  core → worker   opened{conn, user}             the verdict on an open
+                                                 (user None: refused)
+                  login{conn, user}              conn now is that user
+                  send{conn, message}            a message for one client
+                  send_many{conns, message}      one message, several clients
+                  fan_out{message, exclude}      one message for everyone
+                  abort{conn}                    drop a client (its session
+                                                 resumed elsewhere)
+
+A broadcast crosses to each worker once, and each worker frames it once
+per wire format for all of its own clients, as fan_out() always did.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from shared import codec
+from shared.common import frame_msg, FrameReader
+
+
+class BusSocket:
+    """One end of a bus connection: ops out, locked so whole frames go out together."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, op):
+        frame = frame_msg(codec.encode(op))
+        with self._lock:
+            self.sock.sendall(frame)
+
+    def ops(self):
+        """The ops coming in, until the other end is gone."""
+        reader = FrameReader(self.sock)
+        while True:
+            frame = reader.read_frame()
+            if not frame:
+                return
+            yield codec.decode(frame)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RemoteConnection:
+    """
+    The core's stand-in for a client connection held by a worker. It has
+    the attributes the routing code reads; sending means asking the worker.
+    """
+
+    def __init__(self, link, conn_id, addr, codec_name="json", compression=None):
+        self.link = link
+        self.conn_id = conn_id
+        self.addr = addr
+        self.codec = codec_name
+        self.compression = compression
+        self.cipher = None  # the worker holds the session keys
+        self.data_cipher = None
+        self.bulk = None  # no data channel in multi-process mode
+        self.uploads = {}  # file transfers stay on the worker
+        self.username = None
+        self.closed = False
+
+    def send(self, message):
+        self.link.send({"op": "send", "conn": self.conn_id, "message": message})
+
+    def log_in(self, username):
+        self.username = username
+        self.link.send({"op": "login", "conn": self.conn_id, "user": username})
+
+    def abort(self):
+        self.closed = True
+        self.link.send({"op": "abort", "conn": self.conn_id})
+
+
+class WorkerLink(BusSocket):
+    """The core's end of one worker's bus connection."""
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.name = None  # from its hello
+        self.connections = {}  # conn id → RemoteConnection
+
+    def send(self, op):
+        try:
+            super().send(op)
+        except OSError:
+            pass  # the link's reader notices the worker is gone
+
+
+class Hub:
+    """
+    The core's side of the bus: a Unix socket the workers connect to,
+    read by one thread per worker. Ops from one worker are handled in
+    the order it sent them.
+    """
+
+    def __init__(self):
+        # Only this user may open it (mkdtemp makes it 0700)
+        self.directory = tempfile.mkdtemp(prefix="chat-bus-")
+        self.path = os.path.join(self.directory, "bus.sock")
+        self.links = []
+        self.closed = False
+        self._lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+
+    def serve(self, on_open, on_message, on_close):
+        """
+        Accepts workers until close(). on_open(conn, msg) logs a client
+        in and returns its username (None: refused); on_message(conn, msg)
+        handles the rest of what it sends; on_close(conn) drops it.
+        """
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            link = WorkerLink(sock)
+            with self._lock:
+                self.links.append(link)
+            threading.Thread(target=self._serve_link, args=(link, on_open, on_message, on_close),
+                             daemon=True).start()
+
+    def _serve_link(self, link, on_open, on_message, on_close):
+        try:
+            for op in link.ops():
+                self._dispatch(link, op, on_open, on_message, on_close)
+        except (OSError, ValueError) as e:
+            if not self.closed:
+                logging.error(f"[BUS] Bad link to {link.name}: {e}")
+        finally:
+            with self._lock:
+                self.links.remove(link)
+            link.close()
+            if self.closed:
+                return  # shutting down, clients and all
+            logging.warning(f"[BUS] Lost {link.name}, dropping its {len(link.connections)} clients")
+            for conn in list(link.connections.values()):
+                on_close(conn)
+            link.connections.clear()
+
+    def _dispatch(self, link, op, on_open, on_message, on_close):
+        kind = op.get("op")
+        if kind == "hello":
+            link.name = op.get("worker")
+            logging.info(f"[BUS] {link.name} connected")
+        elif kind == "open":
+            conn = RemoteConnection(link, op["conn"], op.get("addr"), op.get("codec"), op.get("compression"))
+            link.connections[conn.conn_id] = conn
+            try:
+                username = on_open(conn, op["msg"])
+            except Exception as e:
+                logging.exception(f"[BUS] Login from {link.name} failed: {e}")
+                username = None
+            if username is None:
+                link.connections.pop(conn.conn_id, None)
+            link.send({"op": "opened", "conn": conn.conn_id, "user": username})
+        elif kind == "message":
+            conn = link.connections.get(op["conn"])
+            if conn is None or conn.username is None:
+                return
+            try:
+                on_message(conn, op["msg"])
+            except Exception as e:
+                # As in one process: a message that breaks the server ends its connection
+                logging.exception(f"[EXCEPTION] {conn.username}: {e}")
+                conn.abort()
+        elif kind == "close":
+            conn = link.connections.pop(op["conn"], None)
+            if conn is not None:
+                on_close(conn)
+
+    def fan_out(self, message, exclude=None):
+        """Sends a message for everyone to every worker, once each."""
+        op = {"op": "fan_out", "message": message, "exclude": exclude}
+        with self._lock:
+            links = list(self.links)
+        for link in links:
+            link.send(op)
+
+    def send_many(self, conns, message):
+        """Sends one message to several RemoteConnections, one op per worker."""
+        by_link = {}
+        for conn in conns:
+            by_link.setdefault(conn.link, []).append(conn.conn_id)
+        for link, conn_ids in by_link.items():
+            link.send({"op": "send_many", "conns": conn_ids, "message": message})
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        with self._lock:
+            links = list(self.links)
+        for link in links:
+            link.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class CoreLink(BusSocket):
+    """A worker's end of the bus."""
+
+    def __init__(self, path, name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        super().__init__(sock)
+        self.connections = {}  # conn id → this worker's client connection
+        self._ids = {}  # client connection → its conn id
+        self._opening = {}  # conn id → Future of the core's verdict
+        self._next_id = itertools.count(1)
+        self.send({"op": "hello", "worker": name})
+
+    def start(self, dispatch, on_lost):
+        """Reads the core's ops on a thread of their own, passing each to dispatch(op)."""
+        def read():
+            try:
+                for op in self.ops():
+                    try:
+                        dispatch(op)
+                    except Exception as e:
+                        logging.exception(f"[BUS] Failed to carry out {op.get('op')}: {e}")
+            except (OSError, ValueError) as e:
+                logging.error(f"[BUS] Bad link to the core: {e}")
+            on_lost()
+        threading.Thread(target=read, daemon=True).start()
+
+    def open(self, conn, msg, addr):
+        """
+        Hands a client's first message to the core. Returns a
+        concurrent.futures.Future of its username (None: refused),
+        set when the opened op is dispatched.
+        """
+        conn_id = next(self._next_id)
+        future = concurrent.futures.Future()
+        self.connections[conn_id] = conn
+        self._ids[conn] = conn_id
+        self._opening[conn_id] = future
+        self.send({"op": "open", "conn": conn_id, "addr": str(addr), "codec": conn.codec,
+                   "compression": conn.compression, "msg": msg})
+        return future
+
+    def opened(self, conn_id, username):
+        future = self._opening.pop(conn_id, None)
+        if future is not None:
+            future.set_result(username)
+
+    def forward(self, conn, msg):
+        """Passes a message from a logged-in client to the core."""
+        self.send({"op": "message", "conn": self._ids[conn], "msg": msg})
+
+    def closed(self, conn):
+        """Tells the core a client is gone."""
+        conn_id = self._ids.pop(conn, None)
+        if conn_id is None:
+            return
+        self.connections.pop(conn_id, None)
+        self._opening.pop(conn_id, None)
+        self.send({"op": "close", "conn": conn_id})
+
+
+def start_workers(count, target, *args):
+    """
+    Forks `count` processes running target(index, *args). They are
+    forked, not spawned, so they start with the parent's settings; do
+    it before the parent starts any threads.
+    """
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=target, args=(index,) + args, name=f"worker-{index}")
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def stop_workers(processes, timeout=5):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout)
@@ -0,0 +1,240 @@
+"""
+shared/codec.py
+
+Compact binary encoding of protocol messages, an alternative to JSON
+that client and server agree on at login (see protocol.md, "Wire
+Codecs"). Payloads say what they are by their first byte - JSON starts
+with "{", file chunks with CHUNK_MARKER, binary messages with
+BINARY_MARKER and compressed payloads with COMPRESSED_MARKER - so either
+side can always read both.
+
+After the marker comes one value: a one-byte tag, then
+
+    NONE, FALSE, TRUE   nothing
+    INT                 zigzag varint
+    FLOAT               8-byte IEEE 754, big-endian
+    STR, BYTES          varint length + UTF-8 text / raw bytes
+    LIST                varint count + values
+    DICT                varint count + (key, value) pairs
+    SYMBOL              varint index into SYMBOLS
+
+A dict key is a varint index into KEYS, or 0 followed by a varint
+length and the UTF-8 name for keys not in the table. Message types and
+other frequent strings are SYMBOLs. A chat line thus costs a few bytes
+of framing instead of its field names and quotes, and bytes values are
+carried raw instead of base64.
+
+KEYS and SYMBOLS are part of the wire format: only ever append to them.
+"""
+
+import json
+import struct
+
+from shared.compress import compress
+from shared.encrypt import encrypt_frame
+
+BINARY_MARKER = 0x01
+
+CODECS = ("binary", "json")  # the ones this side speaks, preferred first
+
+NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT, SYMBOL = range(10)
+
+KEYS = (
+    None,  # 0: the name follows inline
+    "type", "sender", "receiver", "timestamp", "message", "seq", "id",
+    "messages", "channel", "file_id", "file_size", "file_data", "token",
+    "version", "users", "user", "members", "query", "limit", "before_seq",
+    "first_seq", "has_more", "last_seq", "truncated", "grace", "codec",
+    "codecs", "seqs", "queued", "expires_in", "transfer_id", "upload_id",
+    "offset", "length", "sha256", "received", "stored", "challenge", "proof",
+)
+SYMBOLS = (
+    "public", "private", "file", "system", "channel_message", "server",
+    "history", "history_page", "history_request", "search", "search_results",
+    "presence_snapshot", "presence_join", "presence_leave", "presence_sync",
+    "session", "resume", "resumed", "resume_failed", "data_channel",
+    "data_channel_attach", "ack", "queued", "mailbox", "mailbox_ack", "join",
+    "leave", "channel_joined", "channel_left", "channel_join", "channel_leave",
+    "login_request", "disconnect", "username_rejected", "file_upload",
+    "file_upload_begin", "file_upload_end", "file_upload_ready",
+    "file_download", "file_download_request", "file_download_begin",
+    "file_download_end", "file_download_error", "all", "binary", "json",
+    "file_upload_proof",
+)
+# Indexes are written as a single byte
+assert len(KEYS) < 128 and len(SYMBOLS) < 128
+KEY_INDEX = {key: index for index, key in enumerate(KEYS) if key}
+SYMBOL_INDEX = {symbol: index for index, symbol in enumerate(SYMBOLS)}
+
+_DOUBLE = struct.Struct(">d")
+
+
+def choose_codec(offered):
+    """The codec to use with a peer that offered `offered` (JSON if none is shared)."""
+    if isinstance(offered, list):
+        for codec in CODECS:
+            if codec in offered:
+                return codec
+    return "json"
+
+
+def _varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _encode_value(out, value):
+    # Ordered by how often each type shows up in chat traffic
+    kind = type(value)
+    if kind is str:
+        symbol = SYMBOL_INDEX.get(value)
+        if symbol is not None:
+            out.append(SYMBOL)
+            out.append(symbol)  # fewer than 128 symbols: one byte
+            return
+        data = value.encode("utf-8")
+        out.append(STR)
+        _varint(out, len(data))
+        out += data
+    elif kind is int:
+        if not -2**63 <= value < 2**63:
+            raise ValueError(f"integer out of range: {value}")
+        out.append(INT)
+        _varint(out, (value << 1) ^ (value >> 63))
+    elif kind is dict:
+        out.append(DICT)
+        _varint(out, len(value))
+        for key, item in value.items():
+            index = KEY_INDEX.get(key)
+            if index is not None:
+                out.append(index)  # fewer than 128 keys: one byte
+            else:
+                if type(key) is not str:
+                    raise TypeError(f"keys must be str, not {type(key).__name__}")
+                name = key.encode("utf-8")
+                out.append(0)
+                _varint(out, len(name))
+                out += name
+            _encode_value(out, item)
+    elif kind is list or kind is tuple:
+        out.append(LIST)
+        _varint(out, len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif kind is float:
+        out.append(FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(BYTES)
+        _varint(out, len(value))
+        out += value
+    else:
+        raise TypeError(f"cannot encode {type(value).__name__}")
+
+
+def encode(msg):
+    """Binary payload of a message (a dict, or anything else the tags cover)."""
+    out = bytearray((BINARY_MARKER,))
+    _encode_value(out, msg)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    n, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def _decode_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == SYMBOL:
+        index, pos = _read_varint(data, pos)
+        return SYMBOLS[index], pos
+    if tag == STR or tag == BYTES:
+        length, pos = _read_varint(data, pos)
+        end = pos + length
+        if end > len(data):
+            raise ValueError("truncated field")
+        raw = data[pos:end]
+        return (str(raw, "utf-8") if tag == STR else bytes(raw)), end
+    if tag == INT:
+        n, pos = _read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    if tag == DICT:
+        count, pos = _read_varint(data, pos)
+        result = {}
+        for _ in range(count):
+            index, pos = _read_varint(data, pos)
+            if index:
+                key = KEYS[index]
+            else:
+                length, pos = _read_varint(data, pos)
+                key = str(data[pos:pos + length], "utf-8")
+                pos += length
+            result[key], pos = _decode_value(data, pos)
+        return result, pos
+    if tag == LIST:
+        count, pos = _read_varint(data, pos)
+        result = []
+        for _ in range(count):
+            item, pos = _decode_value(data, pos)
+            result.append(item)
+        return result, pos
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    raise ValueError(f"unknown tag {tag}")
+
+
+def decode(data):
+    """The message in a binary payload (which starts with BINARY_MARKER)."""
+    if not data or data[0] != BINARY_MARKER:
+        raise ValueError("not a binary message")
+    try:
+        value, end = _decode_value(data, 1)
+    except IndexError:
+        raise ValueError("truncated or malformed message") from None
+    if end != len(data):
+        raise ValueError("trailing bytes after message")
+    return value
+
+
+def pack(message, codec="json", compression=None):
+    """
+    Plaintext payload of a message - a dict, or JSON text as stored in
+    history and the log - in the given codec, compressed if that pays.
+    """
+    if codec == "binary":
+        plaintext = encode(json.loads(message) if isinstance(message, str) else message)
+    else:
+        plaintext = (message if isinstance(message, str) else json.dumps(message)).encode("utf-8")
+    return compress(plaintext, compression)
+
+
+def seal(message, codec="json", compression=None, cipher=None):
+    """Encrypted payload of a message; see pack() and encrypt_frame()."""
+    return encrypt_frame(pack(message, codec, compression), cipher)
@@ -1,7 +1,21 @@
+import asyncio
+import hashlib
+import hmac
 import json
+import os
 from datetime import datetime
 import struct
 
+from shared.config import BUFFER_SIZE, FILE_CHUNK_SIZE, MAX_FRAME_SIZE
+from shared import codec
+from shared.codec import BINARY_MARKER
+from shared import compress
+from shared.compress import COMPRESSED_MARKER
+
+# First plaintext byte of a binary file chunk. JSON messages start with '{'.
+CHUNK_MARKER = 0x00
+_CHUNK_HEADER = struct.Struct('>BBQ')  # marker, id length, offset
+
 
 def current_timestamp():
     return datetime.now().strftime("%H:%M:%S")
@@ -26,36 +40,234 @@ def build_message(msg_type, sender, message, receiver=None, file_data=None, time
 def parse_message(message):
     return json.loads(message)
 
+
+def build_chunk(transfer_id, offset, data):
+    """
+    Builds the plaintext of a binary file chunk: a small header with the
+    transfer ID and byte offset, followed by the raw data (no base64).
+    """
+    transfer_id = transfer_id.encode("utf-8")
+    return _CHUNK_HEADER.pack(CHUNK_MARKER, len(transfer_id), offset) + transfer_id + data
+
+
+def parse_payload(plaintext):
+    """
+    Parses a decrypted payload into a message dict. Binary chunks become
+    {"type": "file_chunk", "transfer_id", "offset", "data"}.
+    """
+    if plaintext[:1] == bytes([COMPRESSED_MARKER]):
+        plaintext = compress.decompress(plaintext)
+    if plaintext[:1] == bytes([CHUNK_MARKER]):
+        _, id_len, offset = _CHUNK_HEADER.unpack_from(plaintext)
+        start = _CHUNK_HEADER.size
+        return {
+            "type": "file_chunk",
+            "transfer_id": plaintext[start:start + id_len].decode("utf-8"),
+            "offset": offset,
+            "data": plaintext[start + id_len:],
+        }
+    if plaintext[:1] == bytes([BINARY_MARKER]):
+        return codec.decode(plaintext)
+    return json.loads(plaintext)
+
+
+def resumable_upload_id(filepath, username):
+    """
+    Derives an upload ID from the file's identity, so sending the same
+    unchanged file again resumes the interrupted upload.
+    """
+    stat = os.stat(filepath)
+    key = f"{username}|{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def iter_file_chunks(filepath, offset=0, chunk_size=FILE_CHUNK_SIZE, length=None):
+    """
+    Yields (offset, data) pieces of a file, reading one chunk at a time
+    so memory use stays bounded by chunk_size. With `length`, stops after
+    that many bytes (for ranged transfers).
+    """
+    remaining = length
+    with open(filepath, "rb") as f:
+        f.seek(offset)
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            data = f.read(size)
+            if not data:
+                break
+            yield offset, data
+            offset += len(data)
+            if remaining is not None:
+                remaining -= len(data)
+
+
+def file_sha256(filepath):
+    """Hex SHA-256 of a file's content, read one chunk at a time."""
+    hasher = hashlib.sha256()
+    for _, data in iter_file_chunks(filepath):
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def file_hmac(filepath, key):
+    """
+    Hex HMAC-SHA256 of a file's content under `key` (hex), read one
+    chunk at a time. Proves a peer holds a file: see protocol.md,
+    "Deduplication".
+    """
+    mac = hmac.new(bytes.fromhex(key), digestmod=hashlib.sha256)
+    for _, data in iter_file_chunks(filepath):
+        mac.update(data)
+    return mac.hexdigest()
+
 # New helper function to send a message with a header
 
 
+def frame_msg(message):
+    """
+    Returns the message with its 4-byte length header prepended.
+    The result is immutable, so one frame can be written to many sockets.
+    """
+    # Pack the length of the message into a 4-byte integer
+    return struct.pack('>I', len(message)) + message
+
+
 def send_msg(sock, message):
     """
     Encodes a message and prepends a 4-byte header with the message length.
     """
-    # Pack the length of the message into a 4-byte integer
-    msg_len = struct.pack('>I', len(message))
     # Send the header followed by the message
-    sock.sendall(msg_len + message)
+    sock.sendall(frame_msg(message))
 
 # New helper function to receive a message with a header
 
 
+def frame_length(header, offset=0):
+    """
+    The payload length in a 4-byte frame header. Raises ValueError if it
+    is over MAX_FRAME_SIZE, before anything is allocated for it.
+    """
+    msg_len = struct.unpack_from('>I', header, offset)[0]
+    if msg_len > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {msg_len} bytes is over the {MAX_FRAME_SIZE} byte limit")
+    return msg_len
+
+
+def _recv_exactly(sock, n):
+    """
+    Reads exactly n bytes into a preallocated bytearray.
+    Returns None if the connection closes first.
+    """
+    data = bytearray(n)
+    view = memoryview(data)
+    pos = 0
+    while pos < n:
+        received = sock.recv_into(view[pos:])
+        if not received:
+            return None
+        pos += received
+    return data
+
+
 def recv_msg(sock):
     """
     Receives a message by first reading the 4-byte length header.
+    For reading many frames from one socket, prefer FrameReader.
     """
     # Read the 4-byte header to get the message length
-    raw_msg_len = sock.recv(4)
+    raw_msg_len = _recv_exactly(sock, 4)
     if not raw_msg_len:
         return None
-    msg_len = struct.unpack('>I', raw_msg_len)[0]
+    msg_len = frame_length(raw_msg_len)
 
-    # Read the full message data based on the length
-    data = b''
-    while len(data) < msg_len:
-        packet = sock.recv(msg_len - len(data))
-        if not packet:
-            return None
-        data += packet
-    return data
+    # Read the full message straight into its final buffer
+    data = _recv_exactly(sock, msg_len)
+    if data is None:
+        return None
+    return bytes(data)
+
+
+class FrameReader:
+    """
+    Buffered reader for length-prefixed frames on a blocking socket.
+
+    Small frames are cut out of a shared receive buffer, so one kernel
+    read can yield several frames. A frame bigger than what is already
+    buffered gets a bytearray of exactly its size that is filled in place
+    with recv_into, so large payloads are never copied piece by piece.
+    """
+
+    def __init__(self, sock, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unread byte
+        self._end = 0    # end of received data
+
+    def _fill(self):
+        """Reads more data from the socket. Returns False on EOF."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            # Move the partial frame to the front to make room
+            remaining = self._end - self._start
+            self._buf[:remaining] = self._view[self._start:self._end]
+            self._start, self._end = 0, remaining
+        received = self.sock.recv_into(self._view[self._end:])
+        if not received:
+            return False
+        self._end += received
+        return True
+
+    def read_frame(self):
+        """
+        Returns the next frame payload (bytes or bytearray), or None
+        once the connection is closed. Raises ValueError for a frame
+        over MAX_FRAME_SIZE.
+        """
+        while self._end - self._start < 4:
+            if not self._fill():
+                return None
+        msg_len = frame_length(self._buf, self._start)
+        self._start += 4
+
+        available = self._end - self._start
+        if msg_len <= available:
+            frame = bytes(self._view[self._start:self._start + msg_len])
+            self._start += msg_len
+            return frame
+
+        if msg_len <= len(self._buf) - self._start:
+            # Still fits in the buffer; keep reading into it
+            while self._end - self._start < msg_len:
+                if not self._fill():
+                    return None
+            frame = bytes(self._view[self._start:self._start + msg_len])
+            self._start += msg_len
+            return frame
+
+        # Large frame: take what is buffered, then fill the rest in place
+        frame = bytearray(msg_len)
+        frame_view = memoryview(frame)
+        frame_view[:available] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        pos = available
+        while pos < msg_len:
+            received = self.sock.recv_into(frame_view[pos:])
+            if not received:
+                return None
+            pos += received
+        return frame
+
+
+async def recv_msg_async(reader):
+    """
+    asyncio counterpart of recv_msg() for a StreamReader.
+    Returns None when the peer closes the connection.
+    """
+    try:
+        raw_msg_len = await reader.readexactly(4)
+        msg_len = frame_length(raw_msg_len)
+        return await reader.readexactly(msg_len)
+    except asyncio.IncompleteReadError:
+        return None
@@ -0,0 +1,158 @@
+"""
+shared/compress.py
+
+Optional compression of payloads before they are encrypted, agreed on
+at login like the wire codec (see protocol.md, "Compression"). A
+compressed payload is COMPRESSED_MARKER, a method byte and the
+compressed bytes of an ordinary payload (JSON, binary message or file
+chunk), so every frame says for itself whether it is compressed and
+small frames that would not shrink are simply sent as they are.
+
+Chat messages are short and look alike, which leaves a compressor
+working on a single message little to go on; both methods are primed
+with DICTIONARY, a preset dictionary of the text such messages are
+made of. File chunks are compressed one at a time as they are streamed,
+each on its own so resumed and ranged transfers keep working, and not
+at all for files that are compressed already.
+
+zlib (raw deflate) is always available. zstd needs the optional
+`zstandard` package and is only offered when it is installed.
+DICTIONARY is part of the wire format: changing it needs a new method.
+"""
+
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from shared.config import COMPRESSION_MIN_BYTES, COMPRESSION_LEVEL, COMPRESSION_MAX_BYTES
+
+# First plaintext byte of a compressed payload (after CHUNK_MARKER 0x00
+# and BINARY_MARKER 0x01)
+COMPRESSED_MARKER = 0x02
+
+METHODS = {"zlib": 1, "zstd": 2}
+METHOD_NAMES = {number: name for name, number in METHODS.items()}
+
+# The ones this side speaks, preferred first
+COMPRESSIONS = ("zstd", "zlib") if zstandard else ("zlib",)
+
+# Files in these formats are compressed already; their chunks are sent as they are
+PRECOMPRESSED_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic",
+    ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png",
+    ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+# Stop compressing a file transfer whose chunks shrink by less than this
+CHUNK_MIN_SAVING = 0.05
+
+# Deflate looks for matches nearest the end of the dictionary first, so
+# the most common pieces come last
+DICTIONARY = (
+    b'presence_snapshot", "users": ["version": file_download_begin'
+    b'file_download_end", "transfer_id": "file_upload_ready", "upload_id": "'
+    b'"offset": "file_size": "sha256": "file_id": "filename": '
+    b'"type": "history", "sender": "server", "messages": [], "has_more": false'
+    b'"type": "search_results", "query": "'
+    b'"type": "channel_joined", "channel": "#"type": "channel_message", "channel": "#'
+    b'"type": "mailbox", "queued": true, "expires_in": '
+    b'"type": "session", "token": "", "grace": 30, "codec": "binary", "compression": "zlib"'
+    b'"type": "system", "sender": "server", "message": " has left the chat."}'
+    b'"type": "system", "sender": "server", "message": " has joined the chat."}'
+    b'"type": "presence_leave", "user": "", "version": '
+    b'"type": "presence_join", "user": "", "version": '
+    b'"type": "ack", "sender": "server", "id": "", "seq": '
+    b'"type": "file", "sender": "", "receiver": "'
+    b'"type": "private", "sender": "", "receiver": "'
+    b'{"type": "public", "sender": "", "timestamp": "12:00:00", "message": "", "id": "", "seq": 1'
+)
+
+_zlib_template = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, 8,
+                                  zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+if zstandard:
+    _zstd_dictionary = zstandard.ZstdCompressionDict(
+        DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+def choose_compression(offered):
+    """The method to use with a peer that offered `offered`, or None."""
+    if isinstance(offered, list):
+        for method in COMPRESSIONS:
+            if method in offered:
+                return method
+    return None
+
+
+def is_precompressed(filename):
+    """Whether a file's name says its contents are compressed already."""
+    return os.path.splitext(filename or "")[1].lower() in PRECOMPRESSED_EXTENSIONS
+
+
+def compress(plaintext, method):
+    """
+    The payload to encrypt for `plaintext`: compressed with `method`, or
+    `plaintext` itself if there is no method or it would not get smaller.
+    """
+    if method is None or len(plaintext) < COMPRESSION_MIN_BYTES:
+        return plaintext
+    if method == "zlib":
+        # Copying the primed compressor is cheaper than loading the dictionary again
+        compressor = _zlib_template.copy()
+        packed = compressor.compress(plaintext) + compressor.flush()
+    elif method == "zstd" and zstandard:
+        packed = zstandard.ZstdCompressor(dict_data=_zstd_dictionary).compress(plaintext)
+    else:
+        raise ValueError(f"unknown compression: {method}")
+    if len(packed) + 2 >= len(plaintext):
+        return plaintext
+    return bytes((COMPRESSED_MARKER, METHODS[method])) + packed
+
+
+def decompress(payload):
+    """The payload inside a compressed one (which starts with COMPRESSED_MARKER)."""
+    if len(payload) < 2 or payload[0] != COMPRESSED_MARKER:
+        raise ValueError("not a compressed payload")
+    method = METHOD_NAMES.get(payload[1])
+    data = memoryview(payload)[2:]
+    if method == "zlib":
+        decompressor = zlib.decompressobj(-15, DICTIONARY)
+        try:
+            plaintext = decompressor.decompress(data, COMPRESSION_MAX_BYTES)
+        except zlib.error as e:
+            raise ValueError(f"bad compressed payload: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise ValueError("decompressed payload too large")
+        if not decompressor.eof:
+            raise ValueError("truncated compressed payload")
+        return plaintext
+    if method == "zstd" and zstandard:
+        if zstandard.frame_content_size(data) > COMPRESSION_MAX_BYTES:
+            raise ValueError("decompressed payload too large")
+        try:
+            return zstandard.ZstdDecompressor(dict_data=_zstd_dictionary).decompress(
+                data, max_output_size=COMPRESSION_MAX_BYTES)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"bad compressed payload: {e}") from None
+    raise ValueError(f"unknown compression method {payload[1]}")
+
+
+class ChunkCompressor:
+    """
+    Compresses the chunks of one file transfer, unless the file is
+    compressed already or its chunks turn out not to shrink.
+    """
+
+    def __init__(self, method, filename):
+        self.method = None if is_precompressed(filename) else method
+
+    def pack(self, plaintext):
+        if self.method is None:
+            return plaintext
+        packed = compress(plaintext, self.method)
+        if len(packed) > len(plaintext) * (1 - CHUNK_MIN_SAVING):
+            self.method = None  # not worth the CPU for the rest of the file
+        return packed
@@ -1,3 +1,130 @@
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 8888
 BUFFER_SIZE = 65536
+
+# Pending connections the listening socket will queue before refusing
+LISTEN_BACKLOG = 1024
+
+# Per-client outbound queue: max frames waiting, and what to do when full
+# ("drop_oldest" or "disconnect")
+OUTBOUND_QUEUE_SIZE = 1024
+OUTBOUND_OVERFLOW_POLICY = "drop_oldest"
+
+# Size of the binary chunks files are streamed in
+FILE_CHUNK_SIZE = 256 * 1024
+
+# Largest frame a peer may announce (bytes): a file chunk with its headers
+# fits many times over, and so do history replays. Anything bigger is
+# refused before a buffer is allocated for it. Legacy single-frame uploads
+# are limited to about 3 MB by this.
+MAX_FRAME_SIZE = 16 * FILE_CHUNK_SIZE
+
+# Most plaintext (bytes of JSON) the server puts in one frame: what is
+# left of MAX_FRAME_SIZE once encryption has added its part (the shared
+# key's base64 makes a payload a third bigger). Replays, history pages
+# and search results are cut to fit, and mailboxes are split into frames
+MAX_PAYLOAD_SIZE = MAX_FRAME_SIZE * 3 // 4 - 4096
+
+# Largest message (bytes of JSON) the server relays and logs, so any one
+# fits in a replay with room to spare for the frame's other fields
+MAX_MESSAGE_SIZE = MAX_PAYLOAD_SIZE // 4
+
+# Unfinished uploads are kept this long (seconds) so they can be resumed
+PARTIAL_UPLOAD_TTL = 24 * 60 * 60
+
+# How long a client waits for the server to accept an upload (seconds)
+UPLOAD_READY_TIMEOUT = 30
+
+# Downloads and previews the GUI runs at once; the rest wait their turn
+MAX_CONCURRENT_DOWNLOADS = 3
+
+# Recent messages kept in memory: public ones, and private ones per user
+HISTORY_SIZE = 500
+PRIVATE_HISTORY_SIZE = 100
+
+# How many recent messages a user is sent right after logging in
+HISTORY_REPLAY = 50
+
+# Logins are not authenticated: anyone can log in under any free name.
+# Only if this is True does a login get the private messages sent to and
+# from that name before it (login replay, history pages, search and the
+# offline mailbox); otherwise a session only ever sees its own. Off by
+# default, which also means private messages to offline users are refused
+# (the sender is told so) instead of being kept in a mailbox
+PRIVATE_HISTORY_ON_LOGIN = False
+
+# Durable message log: segment size, one sparse index entry per N records,
+# and group fsync every N milliseconds or N messages, whichever comes first
+LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+LOG_INDEX_INTERVAL = 64
+LOG_FSYNC_INTERVAL_MS = 50
+LOG_FSYNC_BATCH = 1000
+
+# Records read back from the end of the log to rebuild history on startup
+LOG_REBUILD_RECORDS = 20000
+
+# Messages per page of older history a client fetches, and the most it may ask for
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
+# Seconds a dropped user has to resume their session before others see them leave
+SESSION_GRACE_PERIOD = 30
+
+# Most missed messages sent when a session is resumed
+RESUME_REPLAY_MAX = 500
+
+# How often a client tries to resume after the connection drops, and the pause (seconds)
+RESUME_ATTEMPTS = 5
+RESUME_RETRY_DELAY = 1.0
+
+# Search results a client gets by default, and the most it may ask for
+SEARCH_LIMIT = 20
+SEARCH_LIMIT_MAX = 100
+
+# Most recent messages per search word that are ranked, the longest word
+# indexed, and the most words of a query that are used
+SEARCH_CANDIDATES = 5000
+SEARCH_TOKEN_MAX = 40
+SEARCH_TERMS_MAX = 8
+
+# Private messages to offline users wait in a mailbox on disk: the most
+# queued per user (messages and bytes), the most for all mailboxes
+# together, and how long (seconds) they are kept
+MAILBOX_MAX_MESSAGES = 200
+MAILBOX_MAX_BYTES = 1024 * 1024
+MAILBOX_TOTAL_BYTES = 64 * 1024 * 1024
+MAILBOX_TTL = 7 * 24 * 60 * 60
+
+# Most recent client message IDs the server remembers, so a message sent
+# again after a reconnect is acknowledged but not relayed twice
+DEDUP_WINDOW = 10000
+
+# Payload compression: smallest payload worth compressing (bytes), zlib
+# level, and the most a compressed payload may expand to
+COMPRESSION_MIN_BYTES = 48
+COMPRESSION_LEVEL = 6
+COMPRESSION_MAX_BYTES = 16 * 1024 * 1024
+
+# Session-encrypted frames may arrive this far out of order (by counter)
+# before they are refused as too old
+AEAD_REPLAY_WINDOW = 4096
+
+# The server decrypts and parses frames at least this big (bytes) off the
+# connection: on threads (decryption) and processes (parsing big messages).
+# 0 threads or processes keeps that work inline.
+OFFLOAD_MIN_BYTES = 64 * 1024
+OFFLOAD_THREADS = 4
+OFFLOAD_PROCESSES = 2
+
+# How often (seconds) the server logs the offload pools' queue depth and latency
+OFFLOAD_REPORT_INTERVAL = 60
+
+# Events one server node publishes for others go out in batches: after at
+# most this many milliseconds, or as soon as this many are waiting
+BACKPLANE_BATCH_MS = 5
+BACKPLANE_BATCH_MAX = 256
+# Seconds a node waits for the backplane broker to answer (e.g. a login's name check)
+BACKPLANE_TIMEOUT = 10
+# Seconds a download waits for its file to be copied from another node
+# before the client is told it failed
+FILE_FETCH_TIMEOUT = 60
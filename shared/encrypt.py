@@ -21,9 +21,24 @@ shared/encrypt.py
 
 Provides symmetric-key encryption/decryption for chat messages
 using cryptography.fernet (AES-CBC with HMAC).
+
+Clients that support it agree on per-session keys at login instead (an
+ephemeral X25519 exchange, see protocol.md, "Session Encryption") and
+then encrypt raw bytes with AES-GCM or ChaCha20-Poly1305 through a
+SessionCipher. The shared Fernet key only protects the login itself.
 """
 
+import struct
+import threading
+
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from shared.config import AEAD_REPLAY_WINDOW
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Replace this with your own Fernet key. To generate a new one, run:
@@ -57,9 +72,157 @@ def decrypt_message(token: bytes) -> str:
     """
     if not isinstance(token, (bytes, bytearray)):
         raise TypeError("decrypt_message expects bytes")
+    if isinstance(token, bytearray):
+        # Fernet only accepts bytes; large frames arrive as bytearray
+        token = bytes(token)
     return _cipher.decrypt(token).decode("utf-8")
 
 
+def encrypt_bytes(data: bytes) -> bytes:
+    """
+    Encrypts raw bytes (e.g. a file chunk) into a Fernet token.
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        raise TypeError("encrypt_bytes expects bytes")
+    return _cipher.encrypt(bytes(data))
+
+
+def decrypt_bytes(token: bytes) -> bytes:
+    """
+    Decrypts a Fernet token back into raw bytes.
+    """
+    if not isinstance(token, (bytes, bytearray)):
+        raise TypeError("decrypt_bytes expects bytes")
+    return _cipher.decrypt(bytes(token))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Session encryption
+# ─────────────────────────────────────────────────────────────────────────────
+
+# The ones this side speaks, preferred first: AES-GCM runs on the CPU's
+# AES instructions where there are any
+AEAD_CIPHERS = ("aes-gcm", "chacha20-poly1305")
+_AEAD_IDS = {"aes-gcm": 1, "chacha20-poly1305": 2}
+_AEAD_CLASSES = {"aes-gcm": AESGCM, "chacha20-poly1305": ChaCha20Poly1305}
+
+# Cipher ID and message counter in front of every session-encrypted frame.
+# A Fernet token starts with "g" (0x67), which no cipher ID uses.
+_AEAD_HEADER = struct.Struct(">BQ")
+_AEAD_TAG_SIZE = 16
+
+
+def choose_cipher(offered):
+    """The session cipher to use with a peer that offered `offered`, or None."""
+    if isinstance(offered, list):
+        for name in AEAD_CIPHERS:
+            if name in offered:
+                return name
+    return None
+
+
+def new_key_exchange():
+    """A fresh X25519 key pair for one login: (private key, raw 32-byte public key)."""
+    private_key = X25519PrivateKey.generate()
+    public_key = private_key.public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    return private_key, public_key
+
+
+def derive_session_ciphers(name, private_key, peer_public_key, is_client):
+    """
+    Completes a key exchange. Returns the SessionCiphers for the chat
+    connection and for the data channel; each direction of each gets
+    its own key, so no key ever encrypts under the other side's counter.
+    Raises ValueError for an unknown cipher or a bad public key.
+    """
+    if name not in _AEAD_CLASSES:
+        raise ValueError(f"unknown cipher: {name}")
+    shared_secret = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public_key))
+    keys = HKDF(algorithm=hashes.SHA256(), length=128, salt=None,
+                info=b"chatroom session keys v1").derive(shared_secret)
+    to_server, to_client = (keys[0:32], keys[64:96]), (keys[32:64], keys[96:128])
+    send, receive = (to_server, to_client) if is_client else (to_client, to_server)
+    return (SessionCipher(name, send[0], receive[0]),
+            SessionCipher(name, send[1], receive[1]))
+
+
+class SessionCipher:
+    """
+    One connection's AEAD keys. Every frame carries the counter its
+    nonce is made from: the counter only goes up, so a nonce is never
+    used twice with a key. Frames may be encrypted by several threads
+    and reach the wire slightly out of order, so the receiving side
+    accepts any counter it has not seen in the last AEAD_REPLAY_WINDOW,
+    and rejects replays and anything older.
+    """
+
+    def __init__(self, name, send_key, receive_key, window=AEAD_REPLAY_WINDOW):
+        self.name = name
+        self.cipher_id = _AEAD_IDS[name]
+        self._send = _AEAD_CLASSES[name](send_key)
+        self._receive = _AEAD_CLASSES[name](receive_key)
+        self._window = window
+        self._next = 0
+        self._highest = -1  # highest counter received so far
+        self._seen = 0      # bit i set: counter _highest - i was received
+        self._lock = threading.Lock()
+
+    def encrypt(self, data):
+        with self._lock:
+            counter = self._next
+            self._next += 1
+        header = _AEAD_HEADER.pack(self.cipher_id, counter)
+        # The header is authenticated too, so the counter can't be changed
+        return header + self._send.encrypt(b"\0\0\0\0" + header[1:], bytes(data), header)
+
+    def decrypt(self, token):
+        if len(token) < _AEAD_HEADER.size + _AEAD_TAG_SIZE:
+            raise ValueError("frame too short")
+        cipher_id, counter = _AEAD_HEADER.unpack_from(token)
+        if cipher_id != self.cipher_id:
+            raise ValueError("frame is not encrypted with the session key")
+        with self._lock:
+            if self._replayed(counter):
+                raise ValueError(f"replayed or too old frame {counter}")
+        header = bytes(token[:_AEAD_HEADER.size])
+        try:
+            data = self._receive.decrypt(b"\0\0\0\0" + header[1:],
+                                         bytes(token[_AEAD_HEADER.size:]), header)
+        except InvalidTag:
+            raise ValueError("frame failed authentication") from None
+        with self._lock:
+            # Checked again: another thread may have taken it meanwhile
+            if self._replayed(counter):
+                raise ValueError(f"replayed or too old frame {counter}")
+            if counter > self._highest:
+                shift = counter - self._highest
+                self._seen = ((self._seen << shift) | 1) & ((1 << self._window) - 1)
+                self._highest = counter
+            else:
+                self._seen |= 1 << (self._highest - counter)
+        return data
+
+    def _replayed(self, counter):
+        if counter > self._highest:
+            return False
+        age = self._highest - counter
+        return age >= self._window or bool(self._seen >> age & 1)
+
+
+def encrypt_frame(data, cipher=None):
+    """Encrypts a payload with the connection's session cipher, or Fernet if it has none."""
+    return cipher.encrypt(data) if cipher is not None else encrypt_bytes(data)
+
+
+def decrypt_frame(token, cipher=None):
+    """
+    Decrypts a received frame. Once a connection has a session cipher,
+    frames under the shared Fernet key are refused (ValueError).
+    """
+    return cipher.decrypt(token) if cipher is not None else decrypt_bytes(token)
+
+
 # Optional helper (uncomment to use):
 # def generate_new_key() -> bytes:
 #     """
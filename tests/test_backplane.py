@@ -0,0 +1,425 @@
+import unittest
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from server import server as chat_server
+from server.backplane import Broker, MemoryBackplane, BrokerBackplane, BrokerServer
+from shared.common import build_message, build_chunk, parse_message, parse_payload, send_msg, recv_msg
+from shared.encrypt import encrypt_message, encrypt_bytes, decrypt_message, decrypt_bytes
+
+
+def start(backplane):
+    """Starts a backplane whose events land in a queue, one event at a time."""
+    events = queue.Queue()
+    users = backplane.start(lambda batch: [events.put(event) for event in batch])
+    return events, users
+
+
+class TestBroker(unittest.TestCase):
+    """Three nodes in one process, through a shared Broker."""
+
+    def setUp(self):
+        self.broker = Broker()
+        self.a = MemoryBackplane("a", self.broker, batch_ms=1)
+        self.b = MemoryBackplane("b", self.broker, batch_ms=1)
+        self.c = MemoryBackplane("c", self.broker, batch_ms=1)
+        self.a_events, _ = start(self.a)
+        self.b_events, _ = start(self.b)
+        self.c_events, _ = start(self.c)
+
+    def tearDown(self):
+        for backplane in (self.a, self.b, self.c):
+            backplane.close()
+
+    def test_publish_targets(self):
+        self.assertTrue(self.b.claim("bob"))
+        self.assertEqual(self.a_events.get(timeout=5), {"kind": "join", "user": "bob", "node": "b"})
+        self.assertEqual(self.c_events.get(timeout=5), {"kind": "join", "user": "bob", "node": "b"})
+
+        self.a.publish("all", {"kind": "message", "msg": {"message": "hi", "data": b"\x00\xff"}})
+        self.a.publish("user:bob", {"kind": "message", "msg": {"message": "psst"}})
+        self.a.publish("node:c", {"kind": "fetch", "file_id": "f1", "node": "a"})
+        self.assertEqual(self.b_events.get(timeout=5)["msg"], {"message": "hi", "data": b"\x00\xff"})
+        self.assertEqual(self.b_events.get(timeout=5)["msg"]["message"], "psst")
+        self.assertEqual(self.c_events.get(timeout=5)["msg"]["message"], "hi")
+        self.assertEqual(self.c_events.get(timeout=5)["kind"], "fetch")
+        # Nothing comes back to the sender
+        self.a.flush()
+        self.assertTrue(self.a_events.empty())
+
+    def test_events_go_out_in_batches(self):
+        self.a.batch_delay = 0.2
+        for i in range(50):
+            self.a.publish("all", {"kind": "message", "msg": {"message": str(i)}})
+        self.a.flush()
+        self.assertEqual(self.a.batches, 1)
+        self.assertEqual([self.b_events.get(timeout=5)["msg"]["message"] for _ in range(50)],
+                         [str(i) for i in range(50)])
+
+    def test_full_batch_goes_out_early(self):
+        self.a.batch_delay = 60
+        self.a.batch_max = 10
+        for i in range(10):
+            self.a.publish("all", {"kind": "message", "msg": {"message": str(i)}})
+        self.assertEqual(self.b_events.get(timeout=5)["msg"]["message"], "0")
+
+    def test_names_are_claimed_cluster_wide(self):
+        self.assertTrue(self.a.claim("alice"))
+        self.assertFalse(self.b.claim("alice"))
+        self.assertTrue(self.a.claim("alice"))  # the same node may claim again
+
+        # A dropped session gives way to a login elsewhere
+        self.a.set_away("alice", True)
+        self.assertTrue(self.b.claim("alice"))
+        self.assertEqual(self.a_events.get(timeout=5), {"kind": "claimed", "user": "alice", "node": "b"})
+        self.assertEqual(self.c_events.get(timeout=5)["node"], "a")
+        self.assertEqual(self.c_events.get(timeout=5), {"kind": "join", "user": "alice", "node": "b"})
+
+        # Only the node the user is on can let them go
+        self.a.release("alice")
+        self.assertEqual(self.broker.users["alice"], ["b", False])
+        self.b.release("alice")
+        self.assertEqual(self.c_events.get(timeout=5), {"kind": "leave", "user": "alice"})
+        self.assertNotIn("alice", self.broker.users)
+
+    def test_file_locations(self):
+        self.a.add_file("f1")
+        self.assertEqual(self.b.locate("f1"), "a")
+        self.assertIsNone(self.b.locate("f2"))
+
+    def test_deliveries_made_outside_the_lock(self):
+        held = []
+        self.broker.attach("d", lambda events: held.append(self.broker._lock.locked()))
+        self.a.claim("dora")
+        self.a.publish("all", {"kind": "message", "msg": {"message": "hi"}})
+        self.a.flush()
+        self.a.release("dora")
+        self.assertEqual(held, [False, False, False])
+
+    def test_detached_node_takes_its_users_and_files(self):
+        self.a.claim("alice")
+        self.a.add_file("f1")
+        self.assertEqual(self.b_events.get(timeout=5)["kind"], "join")
+        self.a.close()
+        self.assertEqual(self.b_events.get(timeout=5), {"kind": "leave", "user": "alice"})
+        self.assertIsNone(self.b.locate("f1"))
+        self.assertTrue(self.b.claim("alice"))
+
+
+class TestBrokerServer(unittest.TestCase):
+    """The same over the broker's Unix socket."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.server = BrokerServer(os.path.join(directory, "broker.sock"))
+        threading.Thread(target=self.server.serve, daemon=True).start()
+        self.a = BrokerBackplane(self.server.path, "a", batch_ms=1)
+        self.b = BrokerBackplane(self.server.path, "b", batch_ms=1)
+        self.a_events, _ = start(self.a)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self.server.close()
+
+    def test_nodes_through_the_broker(self):
+        self.assertTrue(self.a.claim("alice"))
+        self.b_events, users = start(self.b)
+        self.assertEqual(users, {"alice": "a"})
+        self.assertFalse(self.b.claim("alice"))
+
+        self.b.publish("user:alice", {"kind": "message", "msg": {"message": "psst", "data": b"\x01"}})
+        self.assertEqual(self.a_events.get(timeout=5)["msg"], {"message": "psst", "data": b"\x01"})
+        self.b.add_file("f1")
+        self.assertEqual(self.a.locate("f1"), "b")
+
+        self.a.close()
+        self.assertEqual(self.b_events.get(timeout=5), {"kind": "leave", "user": "alice"})
+
+    def test_node_names_are_unique(self):
+        start(self.b)
+        with self.assertRaises(ValueError):
+            start(BrokerBackplane(self.server.path, "a"))
+
+
+class LockCheckingBackplane:
+    """Answers the server's presence calls, noting whether its lock was free during each."""
+
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, name, user):
+        free = chat_server.lock.acquire(timeout=1)
+        if free:
+            chat_server.lock.release()
+        self.calls.append((name, user, free))
+
+    def claim(self, user):
+        self._record("claim", user)
+        return True
+
+    def set_away(self, user, away):
+        self._record("set_away", user)
+
+    def release(self, user):
+        self._record("release", user)
+
+
+class StubConnection:
+    codec = "json"
+    compression = None
+    cipher = None
+    bulk = None
+    username = None
+
+    def sendall(self, frame):
+        pass
+
+    def enqueue(self, frame):
+        pass
+
+
+class TestPresenceCalls(unittest.TestCase):
+    """The server asks the broker without holding its lock, in the order things happen."""
+
+    def wait_for_broker(self):
+        chat_server.broker_calls.submit(lambda: None).result()
+
+    def test_login_and_leave(self):
+        backplane = LockCheckingBackplane()
+        with patch.object(chat_server, "backplane", backplane), \
+                patch.object(chat_server, "session_grace", 0), \
+                patch.dict(chat_server.clients), patch.dict(chat_server.session_tokens), \
+                patch.dict(chat_server.data_tokens), patch.dict(chat_server.session_since):
+            conn = StubConnection()
+            self.assertEqual(chat_server.log_in(conn, {"type": "login_request", "sender": "zoe"}), "zoe")
+            self.wait_for_broker()
+            self.assertEqual(backplane.calls, [("claim", "zoe", True)] * 2)
+            chat_server.unregister_client("zoe", None, conn)
+            self.wait_for_broker()
+        self.assertEqual(backplane.calls[2:], [("release", "zoe", True)])
+
+    def test_drop_then_resume(self):
+        backplane = LockCheckingBackplane()
+        with patch.object(chat_server, "backplane", backplane), \
+                patch.object(chat_server, "session_grace", 30), \
+                patch.dict(chat_server.clients), patch.dict(chat_server.session_tokens), \
+                patch.dict(chat_server.data_tokens), patch.dict(chat_server.session_since), \
+                patch.dict(chat_server.away):
+            conn = StubConnection()
+            chat_server.log_in(conn, {"type": "login_request", "sender": "zoe"})
+            chat_server.unregister_client("zoe", None, conn)
+            self.wait_for_broker()
+            self.assertEqual(backplane.calls[-1], ("set_away", "zoe", True))
+
+            resume = {"type": "resume", "sender": "zoe", "last_seq": 0,
+                      "token": chat_server.session_tokens["zoe"]}
+            self.assertEqual(chat_server.log_in(StubConnection(), resume), "zoe")
+            self.wait_for_broker()
+        self.assertEqual(backplane.calls[-2:], [("claim", "zoe", True)] * 2)
+
+
+class LocatingBackplane:
+    """Says every file is on node "b", noting the thread each call ran on."""
+    node = "a"
+
+    def __init__(self):
+        self.threads = []
+        self.published = []
+
+    def locate(self, file_id):
+        self.threads.append(threading.current_thread().name)
+        return "b"
+
+    def publish(self, target, event):
+        self.published.append((target, event))
+
+
+class RecordingConnection(StubConnection):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, frame):
+        self.sent.append(parse_payload(decrypt_bytes(frame[4:])))
+
+
+class TestFileFetch(unittest.TestCase):
+    """Downloads of files stored on another node."""
+
+    def test_locate_runs_off_the_loop(self):
+        backplane = LocatingBackplane()
+        request = {"type": "file_download_request", "file_id": "f1", "transfer_id": "t1"}
+
+        async def download():
+            chat_server.fetch_file(RecordingConnection(), request, "f1")
+            while not backplane.published:
+                await asyncio.sleep(0.01)
+
+        with patch.object(chat_server, "backplane", backplane), \
+                patch.dict(chat_server.fetches, clear=True), \
+                patch.dict(chat_server.fetch_deadlines, clear=True):
+            asyncio.run(asyncio.wait_for(download(), 5))
+        self.assertTrue(backplane.threads[0].startswith("broker"))
+        self.assertEqual(backplane.published, [("node:b", {"kind": "fetch", "file_id": "f1", "node": "a"})])
+
+    def test_waiting_downloads_expire(self):
+        conn = RecordingConnection()
+        request = {"type": "file_download_request", "file_id": "f1", "transfer_id": "t1"}
+        with patch.object(chat_server, "backplane", LocatingBackplane()), \
+                patch.dict(chat_server.fetches, clear=True), \
+                patch.dict(chat_server.fetch_deadlines, clear=True):
+            self.assertTrue(chat_server.fetch_file(conn, request, "f1"))
+            chat_server.expire_fetches()
+            self.assertEqual(conn.sent, [])  # not yet
+            chat_server.expire_fetches(time.monotonic() + chat_server.FILE_FETCH_TIMEOUT)
+            self.assertEqual(chat_server.fetches, {})
+        self.assertEqual([(m["type"], m["transfer_id"]) for m in conn.sent], [("file_download_error", "t1")])
+
+
+def run_broker(path):
+    """Target of the broker process in TestClusterProcesses."""
+    server = BrokerServer(path)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def run_node(engine, name, port, root, broker_path):
+    """Target of a server node process in TestClusterProcesses."""
+    os.chdir(root)  # for server.log
+    chat_server.FILE_STORAGE_DIR = root
+    chat_server.start_server(engine, port=port, host="127.0.0.1", grace=0,
+                             log_dir=os.path.join(root, "log"), mailbox_dir=os.path.join(root, "mailbox"),
+                             offload_threads=0, offload_processes=0,
+                             backplane_spec="unix:" + broker_path, node=name)
+
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def login(port, username):
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    send_msg(sock, encrypt_message(build_message("system", username, "login_request")))
+    return sock
+
+
+def recv_until(sock, predicate):
+    while True:
+        msg = parse_message(decrypt_message(recv_msg(sock)))
+        if predicate(msg):
+            return msg
+
+
+class TestClusterProcesses(unittest.TestCase):
+    """A broker and two server nodes, each a process of its own."""
+    engine = "threads"
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        context = multiprocessing.get_context("spawn")
+        broker_path = os.path.join(self.root, "broker.sock")
+        self.processes = [context.Process(target=run_broker, args=(broker_path,))]
+        self.processes[0].start()
+        while not os.path.exists(broker_path):
+            time.sleep(0.05)
+        self.ports = {}
+        for name in ("a", "b"):
+            self.ports[name] = free_port()
+            node_root = os.path.join(self.root, name)
+            os.makedirs(node_root)
+            self.processes.append(context.Process(
+                target=run_node, args=(self.engine, name, self.ports[name], node_root, broker_path)))
+            self.processes[-1].start()
+
+    def tearDown(self):
+        for process in reversed(self.processes):
+            os.kill(process.pid, signal.SIGINT)
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+    def test_chat_across_nodes(self):
+        alice = login(self.ports["a"], "alice")
+        recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        bob = login(self.ports["b"], "bob")
+        self.assertIn("alice", recv_until(bob, lambda m: m["type"] == "presence_snapshot")["users"])
+        self.assertEqual(recv_until(alice, lambda m: m["type"] == "presence_join")["user"], "bob")
+
+        # The name is taken on the other node
+        again = login(self.ports["b"], "alice")
+        self.assertEqual(recv_until(again, lambda m: m["type"] == "system")["message"], "username_rejected")
+        again.close()
+
+        send_msg(alice, encrypt_message(build_message("public", "alice", "hello from a")))
+        self.assertEqual(recv_until(bob, lambda m: m["type"] == "public")["message"], "hello from a")
+        send_msg(bob, encrypt_message(build_message("private", "bob", "psst", receiver="alice")))
+        self.assertEqual(recv_until(alice, lambda m: m["type"] == "private")["message"], "psst")
+
+        bob.close()
+        self.assertEqual(recv_until(alice, lambda m: m["type"] == "presence_leave")["user"], "bob")
+        alice.close()
+
+    def test_file_uploaded_on_another_node(self):
+        content = os.urandom(300_000)
+        alice = login(self.ports["a"], "alice")
+        recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        bob = login(self.ports["b"], "bob")
+        recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+        recv_until(alice, lambda m: m["type"] == "presence_join")
+
+        send_msg(alice, encrypt_message(json.dumps({
+            "type": "file_upload_begin", "sender": "alice",
+            "timestamp": "10:00:00", "upload_id": "u1",
+            "filename": "notes.bin", "file_size": len(content)})))
+        recv_until(alice, lambda m: m["type"] == "file_upload_ready")
+        for offset in range(0, len(content), 65536):
+            send_msg(alice, encrypt_bytes(build_chunk("u1", offset, content[offset:offset + 65536])))
+        send_msg(alice, encrypt_message(json.dumps({
+            "type": "file_upload_end", "sender": "alice", "upload_id": "u1"})))
+
+        announced = recv_until(bob, lambda m: m["type"] == "file")
+        self.assertEqual(announced["message"], "notes.bin")
+        send_msg(bob, encrypt_message(json.dumps({
+            "type": "file_download_request", "sender": "bob", "file_id": announced["file_id"]})))
+        download = recv_until(bob, lambda m: m["type"] == "file_download")
+        self.assertEqual(base64.b64decode(download["file_data"]), content)
+        alice.close()
+        bob.close()
+
+
+class TestAsyncClusterProcesses(TestClusterProcesses):
+    engine = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,13 @@
 import unittest
 import base64
+import hashlib
 import os
 import json
+import threading
 from unittest.mock import MagicMock, patch
 from client import client
+from shared.common import parse_payload
+from shared.encrypt import decrypt_bytes, decrypt_message
 
 
 class DummySocket:
@@ -35,12 +39,21 @@ class TestClientModule(unittest.TestCase):
         client.request_file_download(mock_sock, "file123", "tam")
         args, _ = mock_send_msg.call_args
         encrypted_json = args[1]
-        decrypted_json = client.decrypt_message(encrypted_json)
+        decrypted_json = decrypt_message(encrypted_json)
         msg = json.loads(decrypted_json)
         self.assertEqual(msg["type"], "file_download_request")
         self.assertEqual(msg["file_id"], "file123")
         self.assertEqual(msg["sender"], "tam")
 
+    def test_chat_frames_sent_under_the_lock(self):
+        held = []
+        with patch("client.client.send_msg", side_effect=lambda sock, payload: held.append(
+                client.send_lock.locked())):
+            # The receiver thread's mailbox ack and the main thread's download request
+            client.send_frame(DummySocket(), client.seal_for(None, {"type": "mailbox_ack", "seqs": [1]}))
+            client.request_file_download(DummySocket(), "file123", "tam")
+        self.assertEqual(held, [True, True])
+
     @patch("client.client.send_msg")
     def test_send_file_rejects_large_file(self, mock_send_msg):
         # Simulate a 200MB file
@@ -55,19 +68,97 @@ class TestClientModule(unittest.TestCase):
 
         with patch("os.path.exists", return_value=True), \
              patch("os.path.getsize", return_value=len(test_content)), \
+             patch("client.client.resumable_upload_id", return_value="up1"), \
+             patch("client.client.wait_upload_ready", return_value={"offset": 0}), \
              patch("builtins.open", new_callable=unittest.mock.mock_open, read_data=test_content):
 
             client.send_file(DummySocket(), fake_path, "quynh", "tam")
 
-            # Expect 2 messages: file_upload and file notification
-            self.assertEqual(mock_send_msg.call_count, 2)
+            # Expect begin, one chunk and end; the server announces the file
+            self.assertEqual(mock_send_msg.call_count, 3)
 
             encrypted_msg = mock_send_msg.call_args_list[0][0][1]
-            decrypted_msg = client.decrypt_message(encrypted_msg)
+            decrypted_msg = decrypt_message(encrypted_msg)
             msg = json.loads(decrypted_msg)
-            self.assertEqual(msg["type"], "file_upload")
+            self.assertEqual(msg["type"], "file_upload_begin")
             self.assertEqual(msg["sender"], "tam")
             self.assertEqual(msg["filename"], "fake.txt")
+            self.assertEqual(msg["file_size"], len(test_content))
+            self.assertEqual(msg["receiver"], "quynh")
+            self.assertEqual(msg["sha256"], hashlib.sha256(test_content).hexdigest())
+
+            chunk = parse_payload(decrypt_bytes(
+                mock_send_msg.call_args_list[1][0][1]))
+            self.assertEqual(chunk["type"], "file_chunk")
+            self.assertEqual(chunk["transfer_id"], msg["upload_id"])
+            self.assertEqual(chunk["offset"], 0)
+            self.assertEqual(chunk["data"], test_content)
+
+            end = json.loads(decrypt_message(
+                mock_send_msg.call_args_list[2][0][1]))
+            self.assertEqual(end["type"], "file_upload_end")
+            self.assertEqual(end["upload_id"], msg["upload_id"])
+
+    @patch("client.client.send_msg")
+    def test_send_file_resumes_from_server_offset(self, mock_send_msg):
+        test_content = b"0123456789"
+        with patch("os.path.exists", return_value=True), \
+             patch("os.path.getsize", return_value=len(test_content)), \
+             patch("client.client.resumable_upload_id", return_value="up2"), \
+             patch("client.client.wait_upload_ready", return_value={"offset": 6}), \
+             patch("builtins.open", new_callable=unittest.mock.mock_open, read_data=test_content):
+
+            client.send_file(DummySocket(), "fake.txt", None, "tam")
+
+        chunk = parse_payload(decrypt_bytes(
+            mock_send_msg.call_args_list[1][0][1]))
+        self.assertEqual(chunk["offset"], 6)
+
+    @patch("client.client.send_msg")
+    def test_send_file_gives_up_without_ready(self, mock_send_msg):
+        with patch("os.path.exists", return_value=True), \
+             patch("os.path.getsize", return_value=10), \
+             patch("client.client.resumable_upload_id", return_value="up3"), \
+             patch("client.client.file_sha256", return_value="0" * 64), \
+             patch("client.client.wait_upload_ready", return_value=None):
+            client.send_file(DummySocket(), "fake.txt", None, "tam")
+        # Only the begin message went out
+        self.assertEqual(mock_send_msg.call_count, 1)
+
+    @patch("client.client.send_msg")
+    def test_send_file_stops_on_file_error(self, mock_send_msg):
+        with patch("os.path.exists", return_value=True), \
+             patch("os.path.getsize", return_value=10), \
+             patch("client.client.resumable_upload_id", return_value="up5"), \
+             patch("client.client.wait_upload_ready",
+                   return_value={"type": "file_error", "upload_id": "up5"}), \
+             patch("builtins.open", new_callable=unittest.mock.mock_open, read_data=b"0123456789"):
+            client.send_file(DummySocket(), "fake.txt", None, "tam")
+        # No chunks and no end: the server refused the upload
+        self.assertEqual(mock_send_msg.call_count, 1)
+
+    @patch("client.client.send_msg")
+    def test_send_file_proves_content_server_has(self, mock_send_msg):
+        with patch("os.path.exists", return_value=True), \
+             patch("os.path.getsize", return_value=10), \
+             patch("client.client.resumable_upload_id", return_value="up6"), \
+             patch("client.client.file_sha256", return_value="0" * 64), \
+             patch("client.client.file_hmac", return_value="ab" * 32) as mock_hmac, \
+             patch("client.client.wait_upload_ready",
+                   side_effect=[{"offset": 0, "challenge": "cd" * 16}, {"offset": 10, "stored": True}]):
+            client.send_file(DummySocket(), "fake.txt", None, "tam")
+        mock_hmac.assert_called_once_with("fake.txt", "cd" * 16)
+        # The begin and the proof; no chunks and no end
+        self.assertEqual(mock_send_msg.call_count, 2)
+        proof = parse_payload(decrypt_bytes(mock_send_msg.call_args_list[1][0][1]))
+        self.assertEqual((proof["type"], proof["proof"]), ("file_upload_proof", "ab" * 32))
+
+    def test_upload_ready_wakes_waiter(self):
+        client.pending_uploads["up4"] = {
+            "event": threading.Event(), "ready": None}
+        client.upload_ready({"upload_id": "up4", "offset": 1234})
+        self.assertEqual(client.wait_upload_ready("up4", timeout=1)["offset"], 1234)
+        self.assertNotIn("up4", client.pending_uploads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import unittest
+import json
+
+from shared import codec
+from shared.codec import encode, decode, choose_codec, seal, BINARY_MARKER
+from shared.common import build_message, parse_payload
+from shared.encrypt import decrypt_bytes
+
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        msg = {
+            "type": "history",
+            "sender": "server",
+            "messages": [json.loads(build_message("private", "alice", "héllo 👋", receiver="bob"))],
+            "seq": 2**40,
+            "last_seq": -1,
+            "truncated": False,
+            "more": True,
+            "first_seq": None,
+            "ratio": 0.25,
+            "custom key": {"nested": [1, "two", b"\x00\xff"]},
+        }
+        self.assertEqual(decode(encode(msg)), msg)
+
+    def test_bytes_carried_raw(self):
+        blob = bytes(range(256)) * 4
+        encoded = encode({"type": "file", "file_data": blob})
+        self.assertLess(len(encoded), len(blob) + 16)
+        self.assertEqual(decode(encoded)["file_data"], blob)
+
+    def test_smaller_than_json(self):
+        message_json = build_message("public", "alice", "lunch?", timestamp="12:00:01")
+        encoded = encode(json.loads(message_json))
+        self.assertEqual(encoded[0], BINARY_MARKER)
+        self.assertLess(len(encoded), len(message_json) // 2)
+
+    def test_malformed_input_rejected(self):
+        encoded = encode({"type": "public", "message": "hello"})
+        for bad in (encoded[:-2], encoded + b"\x00", b"\x01\x7f", b"{}", b""):
+            with self.assertRaises(ValueError):
+                decode(bad)
+
+    def test_unsupported_values_rejected(self):
+        with self.assertRaises(TypeError):
+            encode({"type": object()})
+        with self.assertRaises(ValueError):
+            encode({"seq": 2**64})
+
+    def test_tables_stay_small(self):
+        # Indexes are written as single bytes
+        self.assertLess(len(codec.KEYS), 128)
+        self.assertLess(len(codec.SYMBOLS), 128)
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def test_choose_codec(self):
+        self.assertEqual(choose_codec(["json", "binary"]), "binary")
+        self.assertEqual(choose_codec(["json"]), "json")
+        self.assertEqual(choose_codec(None), "json")
+        self.assertEqual(choose_codec("binary"), "json")
+
+    def test_parse_payload_reads_both(self):
+        msg = {"type": "public", "sender": "alice", "message": "hi"}
+        for name in ("json", "binary"):
+            self.assertEqual(parse_payload(decrypt_bytes(seal(msg, name))), msg)
+            self.assertEqual(parse_payload(decrypt_bytes(seal(json.dumps(msg), name))), msg)
+
+
+if __name__ == "__main__":
+    unittest.main()
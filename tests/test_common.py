@@ -1,8 +1,11 @@
 import unittest
 import json
+import os
 import struct
+import tempfile
 from io import BytesIO
-from shared.common import build_message, parse_message, send_msg, recv_msg, current_timestamp
+from shared.config import MAX_FRAME_SIZE
+from shared.common import build_message, parse_message, frame_msg, send_msg, recv_msg, current_timestamp, FrameReader, build_chunk, parse_payload, iter_file_chunks
 
 
 class MockSocket:
@@ -16,6 +19,28 @@ class MockSocket:
     def recv(self, n):
         return self.buffer.read(n)
 
+    def recv_into(self, view):
+        return self.buffer.readinto(view)
+
+
+class ChunkedSocket:
+    """Hands out pre-recorded chunks, one per recv_into call."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+
+    def recv_into(self, view):
+        self.reads += 1
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        n = min(len(chunk), len(view))
+        view[:n] = chunk[:n]
+        if n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
 class TestCommonModule(unittest.TestCase):
 
     def test_current_timestamp_format(self):
@@ -53,6 +78,27 @@ class TestCommonModule(unittest.TestCase):
         with self.assertRaises(json.JSONDecodeError):
             parse_message("{invalid json}")
 
+    def test_chunk_round_trip(self):
+        payload = build_chunk("abc123", 1024, b"\x00\xffraw bytes")
+        msg = parse_payload(payload)
+        self.assertEqual(msg["type"], "file_chunk")
+        self.assertEqual(msg["transfer_id"], "abc123")
+        self.assertEqual(msg["offset"], 1024)
+        self.assertEqual(msg["data"], b"\x00\xffraw bytes")
+
+    def test_parse_payload_json(self):
+        payload = build_message("public", "tam", "hi").encode("utf-8")
+        self.assertEqual(parse_payload(payload)["message"], "hi")
+
+    def test_iter_file_chunks(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"0123456789")
+        try:
+            chunks = list(iter_file_chunks(f.name, offset=2, chunk_size=3))
+        finally:
+            os.remove(f.name)
+        self.assertEqual(chunks, [(2, b"234"), (5, b"567"), (8, b"89")])
+
     def test_send_and_receive_msg(self):
         sock = MockSocket()
         message = b"Hello, this is a test."
@@ -63,10 +109,62 @@ class TestCommonModule(unittest.TestCase):
         received = recv_msg(sock)
         self.assertEqual(received, message)
 
+    def test_frame_msg_prepends_length(self):
+        frame = frame_msg(b"abc")
+        self.assertEqual(frame, struct.pack('>I', 3) + b"abc")
+
     def test_recv_msg_returns_none_on_empty(self):
         empty_sock = MockSocket()
         self.assertIsNone(recv_msg(empty_sock))
 
+class TestFrameReader(unittest.TestCase):
+
+    def test_several_frames_from_one_read(self):
+        data = frame_msg(b"one") + frame_msg(b"two") + frame_msg(b"three")
+        sock = ChunkedSocket([data])
+        reader = FrameReader(sock)
+        self.assertEqual(reader.read_frame(), b"one")
+        self.assertEqual(reader.read_frame(), b"two")
+        self.assertEqual(reader.read_frame(), b"three")
+        self.assertEqual(sock.reads, 1)
+        self.assertIsNone(reader.read_frame())
+
+    def test_frame_split_across_reads(self):
+        data = frame_msg(b"hello world")
+        sock = ChunkedSocket([data[:2], data[2:7], data[7:]])
+        self.assertEqual(FrameReader(sock).read_frame(), b"hello world")
+
+    def test_frame_wrapping_buffer_end(self):
+        data = frame_msg(b"a" * 10) + frame_msg(b"b" * 10)
+        sock = ChunkedSocket([data[:20], data[20:]])
+        reader = FrameReader(sock, buffer_size=20)
+        self.assertEqual(reader.read_frame(), b"a" * 10)
+        self.assertEqual(reader.read_frame(), b"b" * 10)
+
+    def test_large_frame_bigger_than_buffer(self):
+        payload = bytes(range(256)) * 1000
+        data = frame_msg(payload) + frame_msg(b"next")
+        sock = ChunkedSocket([data[i:i + 4096] for i in range(0, len(data), 4096)])
+        reader = FrameReader(sock, buffer_size=1024)
+        self.assertEqual(reader.read_frame(), payload)
+        self.assertEqual(reader.read_frame(), b"next")
+
+    def test_eof_mid_frame_returns_none(self):
+        data = frame_msg(b"x" * 5000)
+        sock = ChunkedSocket([data[:100]])
+        self.assertIsNone(FrameReader(sock, buffer_size=64).read_frame())
+
+    def test_oversized_frame_refused_before_reading(self):
+        # Only the header arrives; the reader must not wait for (or allocate) the rest
+        sock = ChunkedSocket([struct.pack('>I', MAX_FRAME_SIZE + 1)])
+        with self.assertRaises(ValueError):
+            FrameReader(sock).read_frame()
+        sock = MockSocket()
+        sock.sendall(struct.pack('>I', 0xFFFFFFFF))
+        with self.assertRaises(ValueError):
+            recv_msg(sock)
+
+
 if __name__ == '__main__':
     print("Testing: common.py")
     unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch
+import os
+
+from shared import compress
+from shared.compress import (compress as pack, decompress, choose_compression, is_precompressed,
+                             ChunkCompressor, COMPRESSED_MARKER)
+from shared.codec import seal
+from shared.common import build_message, build_chunk, parse_payload
+from shared.encrypt import decrypt_bytes
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_chat_message_round_trip(self):
+        plaintext = build_message("public", "alice", "anyone up for lunch?").encode("utf-8")
+        packed = pack(plaintext, "zlib")
+        self.assertEqual(packed[0], COMPRESSED_MARKER)
+        # The preset dictionary does most of the work on a message this short
+        self.assertLess(len(packed), len(plaintext) * 0.6)
+        self.assertEqual(decompress(packed), plaintext)
+
+    def test_sent_as_is_when_it_does_not_pay(self):
+        self.assertEqual(pack(b'{"type": "ack"}', "zlib"), b'{"type": "ack"}')
+        noise = os.urandom(1000)
+        self.assertEqual(pack(noise, "zlib"), noise)
+        self.assertEqual(pack(b"x" * 1000, None), b"x" * 1000)
+
+    def test_bad_payloads_rejected(self):
+        packed = pack(b"hello " * 100, "zlib")
+        for bad in (packed[:-3], b"\x02\x09" + packed[2:], b"\x02\x01garbage", b"\x02"):
+            with self.assertRaises(ValueError):
+                decompress(bad)
+
+    def test_expansion_limited(self):
+        packed = pack(b"\x00" * 100_000, "zlib")
+        with patch.object(compress, "COMPRESSION_MAX_BYTES", 50_000):
+            with self.assertRaises(ValueError):
+                decompress(packed)
+
+    @unittest.skipUnless(compress.zstandard, "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        plaintext = build_message("private", "alice", "see you at noon", receiver="bob").encode()
+        packed = pack(plaintext, "zstd")
+        self.assertEqual(packed[:2], bytes((COMPRESSED_MARKER, compress.METHODS["zstd"])))
+        self.assertEqual(decompress(packed), plaintext)
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def test_choose_compression(self):
+        self.assertEqual(choose_compression(["zlib"]), "zlib")
+        self.assertEqual(choose_compression(["lz4"]), None)
+        self.assertEqual(choose_compression(None), None)
+
+    def test_parse_payload_reads_compressed_frames(self):
+        msg = {"type": "public", "sender": "alice", "message": "hello " * 20}
+        for codec in ("json", "binary"):
+            payload = decrypt_bytes(seal(msg, codec, "zlib"))
+            self.assertEqual(payload[0], COMPRESSED_MARKER)
+            self.assertEqual(parse_payload(payload), msg)
+
+
+class TestChunkCompressor(unittest.TestCase):
+
+    def test_compressed_chunks_decode_on_their_own(self):
+        chunks = ChunkCompressor("zlib", "notes.txt")
+        for offset in (0, 4096, 8192):
+            packed = chunks.pack(build_chunk("t1", offset, b"meeting notes\n" * 300))
+            self.assertEqual(packed[0], COMPRESSED_MARKER)
+            msg = parse_payload(packed)
+            self.assertEqual((msg["offset"], msg["data"]), (offset, b"meeting notes\n" * 300))
+
+    def test_skips_compressed_files(self):
+        self.assertTrue(is_precompressed("Holiday.MP4"))
+        self.assertFalse(is_precompressed("notes.txt"))
+        chunk = build_chunk("t1", 0, b"a" * 4096)
+        self.assertEqual(ChunkCompressor("zlib", "photos.zip").pack(chunk), chunk)
+
+    def test_gives_up_on_incompressible_data(self):
+        chunks = ChunkCompressor("zlib", "backup.bin")
+        chunks.pack(build_chunk("t1", 0, os.urandom(4096)))
+        self.assertIsNone(chunks.method)
+        chunk = build_chunk("t1", 4096, b"a" * 4096)
+        self.assertEqual(chunks.pack(chunk), chunk)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import socket
+import time
+
+from server.connection import OutboundQueue, SocketConnection
+from shared.common import frame_msg, recv_msg
+
+
+class TestOutboundQueue(unittest.TestCase):
+
+    def drain(self, queue):
+        items = []
+        while queue:
+            items.append(queue.get())
+        return items
+
+    def test_fifo_order(self):
+        queue = OutboundQueue(max_size=5, policy="drop_oldest")
+        for frame in (b"a", b"b", b"c"):
+            self.assertTrue(queue.put(frame))
+        self.assertEqual(self.drain(queue), [b"a", b"b", b"c"])
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(max_size=2, policy="drop_oldest")
+        for frame in (b"a", b"b", b"c"):
+            queue.put(frame)
+        self.assertEqual(self.drain(queue), [b"b", b"c"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_disconnect(self):
+        queue = OutboundQueue(max_size=1, policy="disconnect")
+        self.assertTrue(queue.put(b"a"))
+        self.assertFalse(queue.put(b"b"))
+
+    def test_unknown_policy_raises(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(policy="block")
+
+
+class TestSocketConnection(unittest.TestCase):
+
+    def test_frames_are_written_in_order(self):
+        server_side, client_side = socket.socketpair()
+        conn = SocketConnection(server_side)
+        conn.sendall(frame_msg(b"one"))
+        conn.enqueue(frame_msg(b"two"))
+        self.assertEqual(recv_msg(client_side), b"one")
+        self.assertEqual(recv_msg(client_side), b"two")
+        conn.close()
+        self.assertIsNone(recv_msg(client_side))
+        client_side.close()
+
+    def test_stream_frames_are_pulled_lazily(self):
+        server_side, client_side = socket.socketpair()
+        conn = SocketConnection(server_side)
+        pulled = []
+
+        def frames():
+            for i in range(3):
+                pulled.append(i)
+                yield frame_msg(b"chunk%d" % i)
+
+        conn.add_stream(frames())
+        conn.enqueue(frame_msg(b"chat"))
+        received = [recv_msg(client_side) for _ in range(4)]
+        self.assertEqual(sorted(received),
+                         [b"chat", b"chunk0", b"chunk1", b"chunk2"])
+        self.assertEqual(
+            [f for f in received if f != b"chat"], [b"chunk0", b"chunk1", b"chunk2"])
+        self.assertEqual(pulled, [0, 1, 2])
+        conn.close()
+        client_side.close()
+
+    def test_slow_reader_does_not_block_sender(self):
+        server_side, client_side = socket.socketpair()
+        conn = SocketConnection(server_side, max_queue=4, policy="drop_oldest")
+        frame = frame_msg(b"x" * 65536)
+        start = time.perf_counter()
+        # Far more than the socket buffer can hold, and nobody reads
+        for _ in range(200):
+            conn.enqueue(frame)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertGreater(conn.queue.dropped, 0)
+        conn.close()
+        client_side.close()
+
+    def test_disconnect_policy_closes_socket(self):
+        server_side, client_side = socket.socketpair()
+        conn = SocketConnection(server_side, max_queue=1, policy="disconnect")
+        frame = frame_msg(b"x" * 65536)
+        for _ in range(200):
+            conn.enqueue(frame)
+        # The reader side of the connection sees the shutdown
+        self.assertEqual(conn.recv(4), b"")
+        client_side.close()
+
+
+if __name__ == '__main__':
+    print("Testing: connection.py")
+    unittest.main()
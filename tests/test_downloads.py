@@ -0,0 +1,121 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from client.downloads import DownloadManager
+
+
+class TestDownloadManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sent = []
+        self.completed = []
+        self.failed = []
+        self.progress = []
+        self.manager = DownloadManager(
+            self.sent.append,
+            max_active=2,
+            on_progress=lambda t: self.progress.append(t.percent),
+            on_complete=lambda t, data: self.completed.append((t, data)),
+            on_error=lambda t, reason: self.failed.append((t, reason)),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def deliver(self, transfer, data, offset=0):
+        tid = transfer.transfer_id
+        self.manager.begin({"transfer_id": tid, "offset": offset,
+                            "file_size": offset + len(data)})
+        self.manager.write_chunk({"transfer_id": tid, "data": data})
+        self.manager.finish({"transfer_id": tid})
+
+    def test_concurrency_limit_queues_extra_requests(self):
+        transfers = [self.manager.request(f"id{i}", f"f{i}", self.path(f"f{i}"))
+                     for i in range(3)]
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(transfers[2].state, "queued")
+
+        # Finishing one transfer starts the waiting one
+        self.deliver(transfers[0], b"abc")
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.sent[2]["transfer_id"], transfers[2].transfer_id)
+
+    def test_interleaved_transfers_go_to_their_own_files(self):
+        first = self.manager.request("id1", "a.txt", self.path("a.txt"))
+        preview = self.manager.request("id2", "b.png")
+        for t in (first, preview):
+            self.manager.begin({"transfer_id": t.transfer_id, "file_size": 4})
+        self.manager.write_chunk({"transfer_id": preview.transfer_id, "data": b"PN"})
+        self.manager.write_chunk({"transfer_id": first.transfer_id, "data": b"AAAA"})
+        self.manager.write_chunk({"transfer_id": preview.transfer_id, "data": b"G!"})
+        self.manager.finish({"transfer_id": preview.transfer_id})
+        self.manager.finish({"transfer_id": first.transfer_id})
+
+        with open(self.path("a.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"AAAA")
+        results = {t.filename: data for t, data in self.completed}
+        self.assertEqual(results, {"b.png": b"PNG!", "a.txt": None})
+        self.assertEqual(self.manager.transfers, {})
+
+    def test_resumes_from_part_file(self):
+        with open(self.path("big.bin") + ".part", "wb") as f:
+            f.write(b"12345")
+        transfer = self.manager.request("id", "big.bin", self.path("big.bin"))
+        self.assertEqual(self.sent[0]["offset"], 5)
+
+        self.deliver(transfer, b"67890", offset=5)
+        with open(self.path("big.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"1234567890")
+
+    def test_progress_reported_in_whole_percents(self):
+        transfer = self.manager.request("id", "f", self.path("f"))
+        self.manager.begin({"transfer_id": transfer.transfer_id, "file_size": 1000})
+        for _ in range(10):
+            self.manager.write_chunk({"transfer_id": transfer.transfer_id, "data": b"x"})
+        self.manager.write_chunk({"transfer_id": transfer.transfer_id, "data": b"x" * 990})
+        self.assertEqual(self.progress, [0, 1, 100])
+
+    def test_error_frees_slot(self):
+        transfers = [self.manager.request(f"id{i}", f"f{i}", self.path(f"f{i}"))
+                     for i in range(3)]
+        self.manager.error({"transfer_id": transfers[0].transfer_id,
+                            "message": "File 'id0' not found"})
+        self.assertEqual(self.failed[0][1], "File 'id0' not found")
+        self.assertEqual(transfers[2].state, "active")
+
+    def test_send_failure_reports_error(self):
+        def broken(msg):
+            raise OSError("not connected")
+        manager = DownloadManager(
+            broken, on_error=lambda t, reason: self.failed.append(reason))
+        manager.request("id", "f", self.path("f"))
+        self.assertEqual(self.failed, ["not connected"])
+        self.assertEqual(manager.transfers, {})
+
+    def test_data_channel_loss_fails_only_its_transfers(self):
+        channels = iter(["chat", "data", "chat"])
+        self.manager.send_request = lambda msg: (self.sent.append(msg), next(channels))[1]
+        on_chat, on_data, queued = [self.manager.request(f"id{i}", f"f{i}", self.path(f"f{i}"))
+                                    for i in range(3)]
+        self.manager.fail_all("connection lost", "data")
+        self.assertEqual([t for t, _ in self.failed], [on_data])
+        self.assertEqual((on_chat.state, queued.state), ("active", "active"))
+        self.assertEqual(queued.channel, "chat")
+
+    def test_fail_all_keeps_part_files(self):
+        transfer = self.manager.request("id", "f", self.path("f"))
+        self.manager.begin({"transfer_id": transfer.transfer_id, "file_size": 10})
+        self.manager.write_chunk({"transfer_id": transfer.transfer_id, "data": b"half"})
+        self.manager.fail_all("connection lost")
+        self.assertEqual(os.path.getsize(self.path("f") + ".part"), 4)
+        self.assertEqual(self.manager.transfers, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from shared.encrypt import encrypt_message, decrypt_message
+from shared.encrypt import (encrypt_message, decrypt_message, encrypt_bytes, encrypt_frame, decrypt_frame,
+                            choose_cipher, new_key_exchange, derive_session_ciphers, AEAD_CIPHERS)
 
 class TestEncryptionModule(unittest.TestCase):
 
@@ -45,6 +46,73 @@ class TestEncryptionModule(unittest.TestCase):
         with self.assertRaises(Exception):
             decrypt_message(b"invalid_token_data")
 
+
+def session_pair(name):
+    """The (chat, data) ciphers of both ends of one key exchange."""
+    client_key, client_public = new_key_exchange()
+    server_key, server_public = new_key_exchange()
+    return (derive_session_ciphers(name, client_key, server_public, is_client=True),
+            derive_session_ciphers(name, server_key, client_public, is_client=False))
+
+
+class TestSessionCipher(unittest.TestCase):
+
+    def test_both_ends_agree(self):
+        for name in AEAD_CIPHERS:
+            (client, client_data), (server, server_data) = session_pair(name)
+            frame = client.encrypt(b'{"type": "public"}')
+            self.assertEqual(frame[0], {"aes-gcm": 1, "chacha20-poly1305": 2}[name])
+            self.assertEqual(server.decrypt(frame), b'{"type": "public"}')
+            self.assertEqual(client.decrypt(server.encrypt(b"\x00chunk")), b"\x00chunk")
+            self.assertEqual(server_data.decrypt(client_data.encrypt(b"data")), b"data")
+            # The data channel's keys are not the chat connection's
+            with self.assertRaises(ValueError):
+                server_data.decrypt(client.encrypt(b"data"))
+
+    def test_tampered_frame_rejected(self):
+        (client, _), (server, _) = session_pair("aes-gcm")
+        frame = bytearray(client.encrypt(b"hello"))
+        frame[-1] ^= 1
+        with self.assertRaises(ValueError):
+            server.decrypt(bytes(frame))
+        frame = bytearray(client.encrypt(b"hello"))
+        frame[8] ^= 1  # the counter
+        with self.assertRaises(ValueError):
+            server.decrypt(bytes(frame))
+
+    def test_replays_rejected(self):
+        (client, _), (server, _) = session_pair("aes-gcm")
+        first, second, third = (client.encrypt(b"%d" % i) for i in range(3))
+        # Slightly out of order is fine, each frame only once
+        self.assertEqual(server.decrypt(third), b"2")
+        self.assertEqual(server.decrypt(first), b"0")
+        with self.assertRaises(ValueError):
+            server.decrypt(first)
+        self.assertEqual(server.decrypt(second), b"1")
+
+    def test_frames_older_than_window_rejected(self):
+        (client, _), (server, _) = session_pair("aes-gcm")
+        server._window = 8
+        late = client.encrypt(b"late")
+        for _ in range(8):
+            server.decrypt(client.encrypt(b"on time"))
+        with self.assertRaises(ValueError):
+            server.decrypt(late)
+
+    def test_shared_key_refused_after_agreement(self):
+        (client, _), _ = session_pair("chacha20-poly1305")
+        with self.assertRaises(ValueError):
+            decrypt_frame(encrypt_bytes(b"forged"), client)
+        # Without a session cipher frames are Fernet tokens as before
+        self.assertEqual(decrypt_frame(encrypt_frame(b"hello")), b"hello")
+
+    def test_choose_cipher(self):
+        self.assertEqual(choose_cipher(["chacha20-poly1305", "aes-gcm"]), "aes-gcm")
+        self.assertEqual(choose_cipher(["chacha20-poly1305"]), "chacha20-poly1305")
+        self.assertIsNone(choose_cipher(["rot13"]))
+        self.assertIsNone(choose_cipher(None))
+
+
 if __name__ == '__main__':
     print("Test running: encryption/decryption")
     unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import json
+from unittest.mock import patch
+
+from server.history import MessageHistory, ChannelIndex
+
+
+def entry(text, sender="alice", receiver=None):
+    msg = {"type": "private" if receiver else "public",
+           "sender": sender, "message": text}
+    if receiver:
+        msg["receiver"] = receiver
+    return json.dumps(msg)
+
+
+class TestMessageHistory(unittest.TestCase):
+
+    def test_public_ring_buffer_is_bounded(self):
+        history = MessageHistory(max_public=3)
+        for i in range(5):
+            history.add(entry(f"m{i}"))
+        texts = [json.loads(m)["message"] for m in history.recent("bob", 10)]
+        self.assertEqual(texts, ["m2", "m3", "m4"])
+
+    def test_private_messages_only_for_participants(self):
+        history = MessageHistory()
+        history.add(entry("hello"))
+        history.add(entry("psst", "alice", "bob"), "bob", "alice")
+        history.add(entry("bye"))
+
+        def texts(user):
+            return [json.loads(m)["message"] for m in history.recent(user, 10)]
+        self.assertEqual(texts("bob"), ["hello", "psst", "bye"])
+        self.assertEqual(texts("alice"), ["hello", "psst", "bye"])
+        self.assertEqual(texts("carol"), ["hello", "bye"])
+
+    def test_private_window_is_per_user(self):
+        history = MessageHistory(max_private=2)
+        for i in range(3):
+            history.add(entry(f"p{i}", "alice", "bob"), "bob", "alice")
+        history.add(entry("other", "carol", "bob"), "bob", "carol")
+        self.assertEqual(len(history.recent("alice", 10)), 2)
+        self.assertEqual([json.loads(m)["message"] for m in history.recent("bob", 10)],
+                         ["p2", "other"])
+
+    def test_batch_is_one_message(self):
+        history = MessageHistory()
+        self.assertIsNone(history.batch("bob", 5))
+        for i in range(4):
+            history.add(entry(f"m{i}"))
+        batch = json.loads(history.batch("bob", 2))
+        self.assertEqual(batch["type"], "history")
+        self.assertEqual([m["message"] for m in batch["messages"]], ["m2", "m3"])
+
+    def test_batch_fits_in_a_frame(self):
+        history = MessageHistory()
+        for i in range(10):
+            history.add(entry(f"m{i}" + "x" * 100))
+        with patch("server.history.MAX_PAYLOAD_SIZE", 500):
+            batch = history.batch("bob", 10)
+        self.assertLessEqual(len(batch), 500)
+        texts = [m["message"][:2] for m in json.loads(batch)["messages"]]
+        self.assertEqual(texts, ["m8", "m9"])  # the newest that fit
+
+
+class TestChannelIndex(unittest.TestCase):
+
+    def test_page_before_seq(self):
+        index = ChannelIndex()
+        for seq in range(0, 20, 2):
+            index.add("public", seq)
+        self.assertEqual(index.page(["public"], 11, 3), [6, 8, 10])
+        self.assertEqual(index.page(["public"], 3, 5), [0, 2])
+        self.assertEqual(index.page(["missing"], 10, 5), [])
+
+    def test_page_merges_channels(self):
+        index = ChannelIndex()
+        for seq in (1, 4, 6):
+            index.add("public", seq)
+        for seq in (2, 5):
+            index.add("private:bob", seq)
+        self.assertEqual(index.page(["public", "private:bob"], 6, 3), [2, 4, 5])
+        # Nothing below a channel's floor
+        self.assertEqual(index.page(["public", "private:bob"], 6, 3, {"private:bob": 3}), [1, 4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
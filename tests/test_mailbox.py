@@ -0,0 +1,81 @@
+import unittest
+import json
+import os
+import tempfile
+
+from server.mailbox import Mailbox, mailbox_name
+
+
+def private(seq, receiver="bob", text="hi"):
+    return json.dumps({"type": "private", "sender": "alice", "receiver": receiver,
+                       "message": text, "seq": seq})
+
+
+class TestMailbox(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = self.tmp.name
+
+    def test_pending_until_acknowledged(self):
+        box = Mailbox(self.directory)
+        box.put("bob", 3, private(3))
+        box.put("bob", 7, private(7))
+        self.assertEqual([seq for seq, _ in box.pending("bob")], [3, 7])
+        self.assertEqual(box.pending("carol"), [])
+
+        box.ack("bob", [3, 99])
+        self.assertEqual([seq for seq, _ in box.pending("bob")], [7])
+        box.ack("bob", [7])
+        self.assertEqual(box.pending("bob"), [])
+        self.assertEqual(box.size, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_survives_restart(self):
+        box = Mailbox(self.directory)
+        box.put("bob", 3, private(3, text="still here"))
+        box.put("bob", 4, private(4))
+        box.ack("bob", [4])
+
+        reopened = Mailbox(self.directory)
+        [(seq, payload)] = reopened.pending("bob")
+        self.assertEqual(seq, 3)
+        self.assertEqual(json.loads(payload)["message"], "still here")
+        self.assertEqual(reopened.size, box.size)
+
+    def test_damaged_tail_cut_off(self):
+        box = Mailbox(self.directory)
+        box.put("bob", 3, private(3))
+        with open(os.path.join(self.directory, mailbox_name("bob")), "ab") as f:
+            f.write(b'{"seq": 4, "expi')
+
+        reopened = Mailbox(self.directory)
+        reopened.put("bob", 5, private(5))
+        self.assertEqual([seq for seq, _ in Mailbox(self.directory).pending("bob")], [3, 5])
+
+    def test_bounded_per_user_and_in_total(self):
+        box = Mailbox(self.directory, max_messages=2, total_bytes=10_000)
+        box.put("bob", 0, private(0))
+        self.assertTrue(box.has_room("bob"))
+        box.put("bob", 1, private(1))
+        self.assertFalse(box.has_room("bob"))
+        self.assertTrue(box.has_room("carol"))
+
+        box.put("carol", 2, private(2, receiver="carol", text="x" * 10_000))
+        self.assertFalse(box.has_room("dave"))
+
+    def test_messages_expire(self):
+        box = Mailbox(self.directory, ttl=60)
+        box.put("bob", 0, private(0), now=1000)
+        box.put("bob", 1, private(1), now=1030)
+        self.assertEqual([seq for seq, _ in box.pending("bob", now=1070)], [1])
+
+        self.assertEqual(box.expire(now=1070), 1)
+        self.assertEqual([seq for seq, _ in Mailbox(self.directory).pending("bob", now=1070)], [1])
+        self.assertEqual(box.expire(now=2000), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from unittest.mock import patch
+
+from server import server as chat_server
+from server.history import MessageHistory, ChannelIndex
+from server.search import SearchIndex
+from server.message_log import MessageLog
+from shared.common import parse_payload
+from shared.encrypt import decrypt_bytes
+
+
+class RecordingConnection:
+    codec = "json"
+    compression = None
+    cipher = None
+
+    def __init__(self, username):
+        self.username = username
+        self.sent = []
+
+    def sendall(self, frame):
+        self.sent.append(frame)
+
+    def enqueue(self, frame):
+        self.sent.append(frame)
+
+
+class TestMessageLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_log(self, **options):
+        log = MessageLog(self.directory, **options)
+        self.addCleanup(log.close)
+        return log
+
+    def test_append_and_read(self):
+        log = self.open_log()
+        seqs = [log.append(f"msg{i}".encode()) for i in range(5)]
+        self.assertEqual(seqs, [0, 1, 2, 3, 4])
+        self.assertEqual(log.read(2, limit=2), [(2, b"msg2"), (3, b"msg3")])
+        self.assertEqual(log.tail(2), [(3, b"msg3"), (4, b"msg4")])
+
+    def test_segments_rotate_and_read_across_them(self):
+        log = self.open_log(segment_bytes=100, index_interval=4)
+        for i in range(50):
+            log.append(f"message {i:03d}".encode())
+        self.assertGreater(len(log.segments), 5)
+        records = log.read(7, limit=30)
+        self.assertEqual([seq for seq, _ in records], list(range(7, 37)))
+        self.assertEqual(records[-1][1], b"message 036")
+
+    def test_read_specific_records(self):
+        log = self.open_log(segment_bytes=200, index_interval=4)
+        for i in range(60):
+            log.append(f"m{i}".encode())
+        wanted = [0, 3, 4, 17, 18, 40, 59, 60]
+        self.assertEqual(log.read_seqs(wanted),
+                         [(seq, f"m{seq}".encode()) for seq in wanted[:-1]])
+
+    def test_reopen_continues_numbering(self):
+        log = MessageLog(self.directory, segment_bytes=100)
+        for i in range(20):
+            log.append(f"m{i}".encode())
+        log.close()
+
+        log = self.open_log(segment_bytes=100)
+        self.assertEqual(log.append(b"after"), 20)
+        self.assertEqual(log.read(18), [(18, b"m18"), (19, b"m19"), (20, b"after")])
+
+    def test_torn_tail_is_truncated(self):
+        log = MessageLog(self.directory)
+        log.append(b"complete")
+        log.close()
+        path = os.path.join(self.directory, f"{0:020d}.log")
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x00\x20\x12\x34")  # header cut off mid-write
+
+        log = self.open_log()
+        self.assertEqual(log.read(0), [(0, b"complete")])
+        self.assertEqual(log.append(b"next"), 1)
+        self.assertEqual(log.read(0), [(0, b"complete"), (1, b"next")])
+
+    def test_group_fsync_after_batch(self):
+        log = self.open_log(fsync_interval_ms=60000, fsync_batch=10)
+        with patch("server.message_log.os.fsync") as mock_fsync:
+            for i in range(9):
+                log.append(b"x")
+            self.assertEqual(mock_fsync.call_count, 0)
+            log.append(b"x")
+            for _ in range(100):
+                if mock_fsync.call_count:
+                    break
+                time.sleep(0.01)
+            self.assertGreater(mock_fsync.call_count, 0)
+
+    def test_history_rebuilt_on_startup(self):
+        log = MessageLog(self.directory)
+        log.append(b'{"type": "public", "sender": "alice", "message": "hi"}')
+        log.append(b'{"type": "private", "sender": "alice", "receiver": "bob", "message": "psst", "id": "m1"}')
+        log.close()
+
+        with patch.object(chat_server, "history", MessageHistory()), \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "recent_ids", OrderedDict()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            log = chat_server.open_message_log(self.directory)
+            self.addCleanup(log.close)
+            self.assertEqual(len(chat_server.history.recent("bob", 10)), 2)
+            self.assertEqual(len(chat_server.history.recent("carol", 10)), 1)
+            # Numbering continues after the restored records
+            self.assertEqual(chat_server.next_seq, 2)
+            self.assertEqual(chat_server.channel_index.page(["private:bob"], 10, 5), [1])
+            # A retransmit after the restart is still recognized
+            self.assertEqual(chat_server.recent_ids, {("alice", "m1"): 1})
+
+    def test_restart_over_non_text_message(self):
+        # Logged by an older server that did not check field types
+        log = MessageLog(self.directory)
+        log.append(b'{"type": "public", "sender": "alice", "message": 5}')
+        log.append(b'{"type": "public", "sender": "alice", "message": "still here"}')
+        log.close()
+
+        with patch.object(chat_server, "history", MessageHistory()), \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "recent_ids", OrderedDict()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            log = chat_server.open_message_log(self.directory)
+            self.addCleanup(log.close)
+            self.assertEqual(chat_server.next_seq, 2)
+            self.assertEqual(chat_server.search_index.search(["public"], "still", 10), [1])
+
+    def test_malformed_message_takes_no_seq(self):
+        conn = RecordingConnection("alice")
+        with patch.object(chat_server, "history", MessageHistory()), \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "recent_ids", OrderedDict()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0), \
+                patch.dict(chat_server.clients, clear=True):
+            log = chat_server.open_message_log(self.directory)
+            self.addCleanup(log.close)
+            # The binary codec can carry bytes, or a number where text belongs
+            for bad in ({"message": b"\x00raw"}, {"message": 5}, {"receiver": ["bob"]},
+                        {"message": "hi", "extra": {"data": b"\x01"}}):
+                chat_server.handle_message(conn, dict(
+                    {"type": "public", "sender": "alice", "message": "hi", "id": "m1"}, **bad))
+            self.assertEqual(chat_server.next_seq, 0)
+            self.assertEqual(len(conn.sent), 8)  # a notice and a refusing ack each
+
+            chat_server.handle_message(conn, {"type": "public", "sender": "alice", "message": "fine"})
+            log.sync()
+            self.assertEqual((chat_server.next_seq, log.next_seq), (1, 1))
+            self.assertIn(b'"fine"', log.read_seqs([0])[0][1])
+
+    def test_replies_fit_in_a_frame(self):
+        conn = RecordingConnection("alice")
+        with patch.object(chat_server, "history", MessageHistory()), \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "recent_ids", OrderedDict()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0), \
+                patch.object(chat_server, "MAX_PAYLOAD_SIZE", 1000), \
+                patch.object(chat_server, "MAX_MESSAGE_SIZE", 250), \
+                patch.dict(chat_server.clients, clear=True):
+            log = chat_server.open_message_log(self.directory)
+            self.addCleanup(log.close)
+            for i in range(10):
+                chat_server.handle_message(conn, {
+                    "type": "public", "sender": "alice", "message": f"deploy {i} " + "x" * 100})
+            chat_server.handle_message(conn, {
+                "type": "public", "sender": "alice", "message": "deploy " + "x" * 300, "id": "big"})
+            self.assertEqual(chat_server.next_seq, 10)  # the big one was refused
+            log.sync()
+
+            def reply():
+                frame = conn.sent[-1]
+                self.assertLessEqual(len(frame), 4 + chat_server.MAX_FRAME_SIZE)
+                return parse_payload(decrypt_bytes(frame[4:]))
+
+            chat_server.send_history_page(conn, {"type": "history_request", "channel": "public"})
+            page = reply()
+            self.assertTrue(page["has_more"])
+            self.assertLess(len(page["messages"]), 10)
+            self.assertEqual(page["first_seq"], page["messages"][0]["seq"])
+            self.assertEqual(page["messages"][-1]["seq"], 9)
+
+            chat_server.send_search_results(conn, {"type": "search", "query": "deploy", "limit": 10})
+            self.assertLess(len(reply()["messages"]), 10)
+
+    def test_restart_reads_only_the_tail(self):
+        log = MessageLog(self.directory)
+        for i in range(50):
+            log.append(f'{{"type": "public", "sender": "alice", "message": "m{i}", "id": "m{i}"}}'.encode())
+        log.close()
+
+        def reopen():
+            with patch.object(chat_server, "history", MessageHistory()), \
+                    patch.object(chat_server, "channel_index", ChannelIndex()), \
+                    patch.object(chat_server, "search_index", SearchIndex()), \
+                    patch.object(chat_server, "recent_ids", OrderedDict()), \
+                    patch.object(chat_server, "message_log", None), \
+                    patch.object(chat_server, "next_seq", 0), \
+                    patch.object(chat_server, "LOG_REBUILD_RECORDS", 5), \
+                    patch.object(chat_server, "DEDUP_WINDOW", 3), \
+                    patch.object(MessageLog, "iter_records", autospec=True,
+                                 side_effect=MessageLog.iter_records) as iter_records:
+                chat_server.open_message_log(self.directory)
+                pages = chat_server.channel_index.page(["public"], 50, 100)
+                ids = list(chat_server.recent_ids)
+                chat_server.close_message_log()
+            return iter_records.call_args[0][1], pages, ids
+
+        # No saved indexes yet: everything is indexed once
+        start, pages, ids = reopen()
+        self.assertEqual((start, pages), (0, list(range(50))))
+        # Then only the records the history and dedup window need are read
+        start, pages, ids = reopen()
+        self.assertEqual((start, pages), (45, list(range(50))))
+        self.assertEqual(ids, [("alice", f"m{i}") for i in (47, 48, 49)])
+
+
+if __name__ == "__main__":
+    unittest.main()
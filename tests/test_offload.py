@@ -0,0 +1,116 @@
+import unittest
+import asyncio
+import base64
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from server.offload import FrameOffload, create_offload, decode_payload
+from shared.codec import seal
+from shared.common import build_chunk
+from shared.compress import compress
+from shared.encrypt import encrypt_bytes, encrypt_message, new_key_exchange, derive_session_ciphers
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """A thread pool that remembers which functions it ran."""
+
+    def __init__(self):
+        super().__init__(1)
+        self.ran = []
+
+    def submit(self, fn, *args):
+        self.ran.append(fn.__name__)
+        return super().submit(fn, *args)
+
+
+class TestFrameOffload(unittest.TestCase):
+
+    def setUp(self):
+        self.crypto, self.decode = RecordingExecutor(), RecordingExecutor()
+        self.offload = FrameOffload(4096, self.crypto, self.decode)
+        self.addCleanup(self.offload.shutdown)
+
+    def decode_async(self, frame, cipher=None):
+        return asyncio.run(self.offload.decode_frame_async(frame, cipher))
+
+    def test_small_frames_stay_inline(self):
+        frame = encrypt_message(json.dumps({"type": "public", "message": "hi"}))
+        self.assertEqual(self.decode_async(frame)["message"], "hi")
+        self.assertEqual(self.offload.decode_frame(frame)["message"], "hi")
+        self.assertEqual((self.crypto.ran, self.decode.ran), ([], []))
+        self.assertEqual(self.offload.report()["crypto"]["jobs"], 0)
+
+    def test_chunks_decrypted_on_the_crypto_pool(self):
+        data = os.urandom(20_000)
+        msg = self.decode_async(encrypt_bytes(build_chunk("t1", 0, data)))
+        self.assertEqual((msg["type"], msg["data"]), ("file_chunk", data))
+        # Chunks parse by slicing: no trip to the decode pool
+        self.assertEqual((self.crypto.ran, self.decode.ran), (["open_payload"], []))
+
+    def test_big_messages_parsed_on_the_decode_pool(self):
+        data = os.urandom(20_000)
+        frame = seal({"type": "file_upload", "sender": "alice", "filename": "a.bin",
+                      "file_data": base64.b64encode(data).decode()})
+        for msg in (self.decode_async(frame), self.offload.decode_frame(frame)):
+            self.assertEqual(msg["file_data"], data)
+        # The thread engine decrypts on the connection's own thread
+        self.assertEqual(self.crypto.ran, ["open_payload"])
+        self.assertEqual(self.decode.ran, ["decode_payload", "decode_payload"])
+
+    def test_small_compressed_frame_of_a_big_message(self):
+        msg = {"type": "history", "messages": [{"type": "public", "message": "ok"}] * 500}
+        frame = seal(msg, compression="zlib")
+        self.assertLess(len(frame), 4096)
+        self.assertEqual(self.decode_async(frame), msg)
+        self.assertEqual((self.crypto.ran, self.decode.ran), ([], ["decode_payload"]))
+
+    def test_session_keys_on_the_pool(self):
+        client_key, client_public = new_key_exchange()
+        server_key, server_public = new_key_exchange()
+        client, _ = derive_session_ciphers("aes-gcm", client_key, server_public, is_client=True)
+        server, _ = derive_session_ciphers("aes-gcm", server_key, client_public, is_client=False)
+        frame = client.encrypt(build_chunk("t1", 0, b"x" * 10_000))
+        self.assertEqual(self.decode_async(frame, server)["offset"], 0)
+        with self.assertRaises(ValueError):
+            self.decode_async(frame, server)  # a replay, even from another thread
+
+    def test_errors_reach_the_connection(self):
+        with self.assertRaises(Exception):
+            self.decode_async(b"g" + os.urandom(10_000))
+        with self.assertRaises(ValueError):
+            self.decode_async(encrypt_bytes(b"{" + b" " * 10_000))
+        self.assertEqual(self.offload.report()["crypto"]["depth"], 0)
+
+    def test_report(self):
+        release = threading.Event()
+        futures = [self.offload.submit("crypto", release.wait) for _ in range(3)]
+        self.assertEqual(self.offload.report()["crypto"]["depth"], 3)
+        release.set()
+        for future in futures:
+            future.result()
+        report = self.offload.report(reset=True)["crypto"]
+        self.assertEqual((report["depth"], report["max_depth"], report["jobs"]), (0, 3, 3))
+        self.assertGreater(report["max_ms"], 0)
+        self.assertEqual(self.offload.report()["crypto"]["jobs"], 0)
+
+
+class TestCreateOffload(unittest.TestCase):
+
+    def test_process_pool(self):
+        offload = create_offload(4096, threads=1, processes=1)
+        self.addCleanup(offload.shutdown)
+        payload = json.dumps({"type": "file_upload", "file_data": base64.b64encode(b"a" * 6000).decode()})
+        self.assertEqual(offload.run("decode", decode_payload, payload.encode())["file_data"], b"a" * 6000)
+        self.assertEqual(offload.report()["decode"]["jobs"], 1)
+
+    def test_no_pools_means_inline(self):
+        offload = create_offload(4096, threads=0, processes=0)
+        frame = encrypt_bytes(compress(json.dumps({"message": "x" * 10_000}).encode(), "zlib"))
+        self.assertEqual(len(offload.decode_frame(frame)["message"]), 10_000)
+        self.assertEqual(offload.report()["decode"]["jobs"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
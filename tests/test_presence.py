@@ -0,0 +1,42 @@
+import unittest
+
+from client.presence import PresenceTracker
+
+
+class TestPresenceTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = PresenceTracker()
+        self.tracker.apply({"type": "presence_snapshot", "version": 4,
+                            "users": ["alice", "bob"]})
+
+    def delta(self, msg_type, user, version):
+        return self.tracker.apply({"type": msg_type, "user": user, "version": version})
+
+    def test_snapshot_replaces_list(self):
+        change = self.tracker.apply({"type": "presence_snapshot", "version": 9,
+                                     "users": ["carol"]})
+        self.assertEqual(change, ("snapshot", ["carol"]))
+        self.assertEqual(self.tracker.version, 9)
+
+    def test_join_and_leave_report_positions(self):
+        self.assertEqual(self.delta("presence_join", "carol", 5), ("join", "carol", 2))
+        self.assertEqual(self.delta("presence_leave", "alice", 6), ("leave", "alice", 0))
+        self.assertEqual(self.tracker.users, ["bob", "carol"])
+
+    def test_stale_delta_ignored(self):
+        self.assertIsNone(self.delta("presence_leave", "bob", 4))
+        self.assertEqual(self.tracker.users, ["alice", "bob"])
+
+    def test_gap_requests_snapshot(self):
+        self.assertEqual(self.delta("presence_join", "carol", 7), ("gap",))
+        self.assertEqual(self.tracker.version, 4)
+
+    def test_deltas_before_snapshot_ignored(self):
+        tracker = PresenceTracker()
+        self.assertIsNone(tracker.apply(
+            {"type": "presence_join", "user": "x", "version": 1}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from server import server as chat_server
+from server.history import MessageHistory, ChannelIndex
+from server.message_log import MessageLog
+from server.search import SearchIndex, tokenize
+
+
+class TestTokenize(unittest.TestCase):
+
+    def test_lowercase_distinct_words(self):
+        self.assertEqual(tokenize("See https://Example.com/Docs, see docs!"),
+                         ["see", "https", "example", "com", "docs"])
+
+    def test_single_letters_and_overlong_words_skipped(self):
+        self.assertEqual(tokenize("a " + "x" * 100 + " ok"), ["ok"])
+
+    def test_non_text_has_no_words(self):
+        for value in (None, 5, ["deploy"], b"deploy"):
+            self.assertEqual(tokenize(value), [])
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        messages = [
+            (["public"], "lunch at noon?"),
+            (["public"], "the deploy link is https://ci.example.com/42"),
+            (["private:alice", "private:bob"], "secret link for the deploy"),
+            (["public"], "lunch link please"),
+            (["public"], "noon works"),
+        ]
+        for seq, (channels, text) in enumerate(messages):
+            self.index.add(seq, channels, text)
+
+    def test_rarer_words_rank_higher(self):
+        # Both contain "link"; only seq 1 also has the rarer "deploy"
+        self.assertEqual(self.index.search(["public"], "deploy link", 10), [1, 3])
+
+    def test_ties_go_to_newest(self):
+        self.assertEqual(self.index.search(["public"], "noon", 10), [4, 0])
+
+    def test_private_messages_only_in_own_channels(self):
+        self.assertNotIn(2, self.index.search(["public", "private:carol"], "secret deploy", 10))
+        self.assertEqual(self.index.search(["public", "private:bob"], "secret", 10), [2])
+        self.assertEqual(self.index.search(["public", "private:bob"], "secret", 10, {"private:bob": 3}), [])
+
+    def test_limit_and_unknown_words(self):
+        self.assertEqual(len(self.index.search(["public"], "link lunch noon", 2)), 2)
+        self.assertEqual(self.index.search(["public"], "nothing here", 10), [])
+        self.assertEqual(self.index.search(["public"], "", 10), [])
+
+    def test_only_recent_candidates_scored(self):
+        index = SearchIndex(candidates=3)
+        for seq in range(10):
+            index.add(seq, ["public"], "hello")
+        self.assertEqual(index.search(["public"], "hello", 10), [9, 8, 7])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "search.idx")
+            self.index.save(path)
+            loaded = SearchIndex()
+            self.assertTrue(loaded.load(path))
+            self.assertEqual(loaded.next_seq, 5)
+            self.assertEqual(loaded.search(["public"], "deploy link", 10), [1, 3])
+            self.assertEqual(loaded.search(["private:alice"], "secret", 10), [2])
+
+    def test_unreadable_index_ignored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "search.idx")
+            self.index.save(path)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 4)
+            loaded = SearchIndex()
+            self.assertFalse(loaded.load(path))
+            self.assertFalse(loaded.load(os.path.join(directory, "missing.idx")))
+            self.assertEqual(loaded.next_seq, 0)
+
+
+class TestSearchIndexStartup(unittest.TestCase):
+
+    def test_saved_index_catches_up_with_log(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(chat_server, "history", MessageHistory()), \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            chat_server.open_message_log(directory)
+            chat_server.record_message({"type": "public", "sender": "alice", "message": "old news"})
+            chat_server.close_message_log()
+
+            # Written while the server was down, so only in the log
+            log = MessageLog(directory)
+            log.append(json.dumps({"type": "public", "sender": "bob", "message": "fresh news"}).encode())
+            log.close()
+
+            with patch.object(chat_server, "search_index", SearchIndex()) as index:
+                with patch.object(index, "add", wraps=index.add) as add:
+                    chat_server.open_message_log(directory)
+                    self.addCleanup(chat_server.message_log.close)
+                self.assertEqual(add.call_count, 1)
+                self.assertEqual(index.search(["public"], "news", 10), [1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,89 @@
 import unittest
 from unittest.mock import MagicMock, patch
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
 import socket
+import tempfile
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from server import server as chat_server
+from server.history import MessageHistory, ChannelIndex
+from server.search import SearchIndex
+from server.mailbox import Mailbox
+from server.offload import FrameOffload
+from client.session import ResumeState, Outbox, resume_session, login_request
+from shared.common import build_message, build_chunk, parse_message, parse_payload, send_msg, recv_msg, FrameReader
+from shared.codec import BINARY_MARKER, seal
+from shared.compress import COMPRESSED_MARKER, COMPRESSIONS
+from shared.encrypt import encrypt_message, encrypt_bytes, encrypt_frame, decrypt_message, decrypt_bytes, decrypt_frame
+
+
+def login(port, username):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    send_msg(sock, encrypt_message(
+        build_message("system", username, "login_request")))
+    return sock
+
+
+def recv_until(sock, predicate):
+    """Reads frames until one matches `predicate` and returns it."""
+    while True:
+        msg = parse_message(decrypt_message(recv_msg(sock)))
+        if predicate(msg):
+            return msg
+
+
+def recv_frame_until(sock, predicate):
+    """Like recv_until(), but also understands binary chunk frames."""
+    while True:
+        msg = parse_payload(decrypt_bytes(recv_msg(sock)))
+        if predicate(msg):
+            return msg
+
+
+class AsyncEngineServer:
+    """Runs the asyncio engine on an ephemeral port in a background thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(
+            chat_server.handle_client_async, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait(5)
+        return self.port
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self._shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [t for t in asyncio.all_tasks()
+                 if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 
 class TestServerModule(unittest.TestCase):
 
@@ -17,6 +99,942 @@ class TestServerModule(unittest.TestCase):
         t = threading.Thread(target=lambda: None)
         self.assertTrue(callable(t.run))
 
+    def test_parse_args_engine(self):
+        self.assertEqual(chat_server.parse_args([]).engine, "threads")
+        self.assertEqual(chat_server.parse_args(
+            ["--engine", "asyncio"]).engine, "asyncio")
+
+
+class TestPartialUploads(unittest.TestCase):
+
+    def test_expired_partial_uploads_are_removed(self):
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage), \
+                patch.object(chat_server, "last_expiry_check", 0):
+            old_part, old_meta = chat_server.partial_paths("old")
+            new_part, new_meta = chat_server.partial_paths("new")
+            for path in (old_part, old_meta, new_part, new_meta):
+                with open(path, "w") as f:
+                    f.write("{}")
+            stale = time.time() - chat_server.PARTIAL_UPLOAD_TTL - 10
+            os.utime(old_part, (stale, stale))
+
+            chat_server.expire_partial_uploads()
+            self.assertFalse(os.path.exists(old_part))
+            self.assertFalse(os.path.exists(old_meta))
+            self.assertTrue(os.path.exists(new_part))
+
+
+class RecordingSocket:
+    def __init__(self, codec="json", compression=None, cipher=None):
+        self.sent = []
+        self.codec = codec
+        self.compression = compression
+        self.cipher = cipher
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def enqueue(self, data):
+        self.sent.append(data)
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        chat_server.clients.clear()
+        for name in ("alice", "bob", "carol"):
+            chat_server.clients[name] = RecordingSocket()
+
+    def tearDown(self):
+        chat_server.clients.clear()
+
+    def test_broadcast_encrypts_once(self):
+        with patch("shared.codec.encrypt_frame",
+                   wraps=encrypt_frame) as mock_encrypt:
+            chat_server.broadcast({"type": "public", "message": "hi"})
+        self.assertEqual(mock_encrypt.call_count, 1)
+        frames = [conn.sent[0] for conn in chat_server.clients.values()]
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+
+    def test_broadcast_encrypts_once_per_codec(self):
+        chat_server.clients["dave"] = RecordingSocket(codec="binary")
+        chat_server.clients["erin"] = RecordingSocket(codec="binary")
+        with patch("shared.codec.encrypt_frame", wraps=encrypt_frame) as mock_encrypt:
+            chat_server.broadcast({"type": "public", "message": "hi"})
+        self.assertEqual(mock_encrypt.call_count, 2)
+        self.assertIs(chat_server.clients["dave"].sent[0], chat_server.clients["erin"].sent[0])
+        for name in ("alice", "dave"):
+            frame = chat_server.clients[name].sent[0]
+            msg = parse_payload(decrypt_bytes(frame[4:]))
+            self.assertEqual(msg, {"type": "public", "message": "hi"})
+
+    def test_broadcast_exclude(self):
+        chat_server.broadcast({"type": "public", "message": "hi"},
+                              exclude="bob")
+        self.assertEqual(chat_server.clients["bob"].sent, [])
+        self.assertEqual(len(chat_server.clients["alice"].sent), 1)
+
+    def test_channel_fan_out_only_reaches_members(self):
+        with patch.dict(chat_server.channel_members, {"#ops": {"alice", "carol", "dave"}}):
+            chat_server.fan_out_channel("#ops", '{"type": "channel_message"}', exclude="carol")
+        self.assertEqual(len(chat_server.clients["alice"].sent), 1)
+        self.assertEqual(chat_server.clients["bob"].sent, [])
+        self.assertEqual(chat_server.clients["carol"].sent, [])
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        chat_server.clients.clear()
+        history = patch.object(chat_server, "history", MessageHistory())
+        history.start()
+        self.addCleanup(history.stop)
+        # Users leave as soon as they disconnect unless a test says otherwise
+        grace = patch.object(chat_server, "session_grace", 0)
+        grace.start()
+        self.addCleanup(grace.stop)
+        self.server = AsyncEngineServer()
+        self.port = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        chat_server.clients.clear()
+        chat_server.away.clear()
+        chat_server.session_tokens.clear()
+        chat_server.channel_members.clear()
+        chat_server.user_channels.clear()
+
+    def test_public_message_relayed(self):
+        alice = login(self.port, "alice")
+        recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        bob = login(self.port, "bob")
+        snapshot = recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+        self.assertEqual(snapshot["users"], ["alice", "bob"])
+
+        send_msg(alice, encrypt_message(
+            build_message("public", "alice", "hello bob")))
+        msg = recv_until(bob, lambda m: m["type"] == "public")
+        self.assertEqual(msg["sender"], "alice")
+        self.assertEqual(msg["message"], "hello bob")
+        alice.close()
+        bob.close()
+
+    def test_binary_codec_negotiated(self):
+        alice = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        send_msg(alice, encrypt_message(login_request("alice")))
+        payload = decrypt_bytes(recv_msg(alice))
+        self.assertEqual(payload[0], BINARY_MARKER)
+        self.assertEqual(parse_payload(payload)["type"], "presence_snapshot")
+        session = recv_frame_until(alice, lambda m: m["type"] == "session")
+        self.assertEqual(session["codec"], "binary")
+        # A client that offers nothing keeps getting JSON
+        bob = login(self.port, "bob")
+        self.assertEqual(recv_until(bob, lambda m: m["type"] == "session")["codec"], "json")
+        recv_frame_until(alice, lambda m: m.get("type") == "presence_join")
+
+        send_msg(alice, seal(build_message("public", "alice", "hello bob"), "binary"))
+        msg = recv_until(bob, lambda m: m["type"] == "public")
+        self.assertEqual(msg["message"], "hello bob")
+        send_msg(bob, encrypt_message(build_message("public", "bob", "hi alice")))
+        msg = recv_frame_until(alice, lambda m: m["type"] == "public" and m["sender"] == "bob")
+        self.assertEqual(msg["message"], "hi alice")
+        alice.close()
+        bob.close()
+
+    def test_presence_deltas(self):
+        alice = login(self.port, "alice")
+        snapshot = recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        self.assertEqual(snapshot["users"], ["alice"])
+
+        bob = login(self.port, "bob")
+        recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+        join = recv_until(alice, lambda m: m["type"].startswith("presence_"))
+        self.assertEqual((join["type"], join["user"], join["version"]),
+                         ("presence_join", "bob", snapshot["version"] + 1))
+
+        bob.close()
+        leave = recv_until(alice, lambda m: m["type"].startswith("presence_"))
+        self.assertEqual((leave["type"], leave["user"], leave["version"]),
+                         ("presence_leave", "bob", snapshot["version"] + 2))
+
+        # After a gap the client asks for the whole list again
+        send_msg(alice, encrypt_message(json.dumps(
+            {"type": "presence_sync", "sender": "alice"})))
+        resync = recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        self.assertEqual((resync["users"], resync["version"]),
+                         (["alice"], leave["version"]))
+        alice.close()
+
+    def test_history_replayed_after_login(self):
+        alice = login(self.port, "alice")
+        recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+        bob = login(self.port, "bob")
+        recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+        send_msg(alice, encrypt_message(
+            build_message("public", "alice", "first")))
+        send_msg(alice, encrypt_message(
+            build_message("private", "alice", "secret", receiver="bob")))
+        recv_until(bob, lambda m: m["type"] == "private")
+        bob.close()
+
+        carol = login(self.port, "carol")
+        recv_until(carol, lambda m: m["type"] == "presence_snapshot")
+        replay = recv_until(carol, lambda m: True)
+        self.assertEqual(replay["type"], "history")
+        # Carol sees the public message but not alice's private one to bob
+        self.assertEqual([m["message"] for m in replay["messages"]], ["first"])
+
+        # Anyone can log in as bob, so only public messages by default
+        while "bob" in chat_server.clients:
+            time.sleep(0.01)
+        bob = login(self.port, "bob")
+        recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+        replay = recv_until(bob, lambda m: True)
+        self.assertEqual([m["message"] for m in replay["messages"]], ["first"])
+        bob.close()
+
+        while "bob" in chat_server.clients:
+            time.sleep(0.01)
+        with patch.object(chat_server, "PRIVATE_HISTORY_ON_LOGIN", True):
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+            replay = recv_until(bob, lambda m: True)
+        self.assertEqual([m["message"] for m in replay["messages"]], ["first", "secret"])
+        alice.close()
+        bob.close()
+        carol.close()
+
+    def test_retransmitted_message_acked_but_relayed_once(self):
+        with patch.object(chat_server, "recent_ids", OrderedDict()):
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+
+            outbox = Outbox()
+            message_json = outbox.track(json.loads(build_message("public", "alice", "hello")))
+            send_msg(alice, encrypt_message(message_json))
+            ack = recv_until(alice, lambda m: m["type"] == "ack")
+            # As if the ack was lost and the client resent after reconnecting
+            send_msg(alice, encrypt_message(message_json))
+            again = recv_until(alice, lambda m: m["type"] == "ack")
+            self.assertEqual(again, ack)
+            self.assertTrue(outbox.acked(again))
+            self.assertEqual(outbox.unacked(), [])
+
+            send_msg(alice, encrypt_message(build_message("public", "alice", "next")))
+            relayed = [recv_until(bob, lambda m: m["type"] == "public")["message"] for _ in range(2)]
+            self.assertEqual(relayed, ["hello", "next"])
+
+            # Refused messages are acked too, with no seq
+            refused = Outbox()
+            send_msg(alice, encrypt_message(refused.track(
+                {"type": "channel_message", "sender": "alice", "channel": "#nope", "message": "hi"})))
+            self.assertIsNone(recv_until(alice, lambda m: m["type"] == "ack")["seq"])
+            alice.close()
+            bob.close()
+
+    def test_private_message_queued_for_offline_user(self):
+        with tempfile.TemporaryDirectory() as mail_dir, \
+                patch.object(chat_server, "PRIVATE_HISTORY_ON_LOGIN", True):
+            box = patch.object(chat_server, "mailbox", Mailbox(mail_dir))
+            box.start()
+            self.addCleanup(box.stop)
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            send_msg(alice, encrypt_message(
+                build_message("private", "alice", "call me", receiver="bob")))
+            queued = recv_until(alice, lambda m: m["type"] in ("queued", "system"))
+            self.assertEqual((queued["type"], queued["receiver"]), ("queued", "bob"))
+
+            def login_frames(username):
+                """The frame types up to the resume token, and the mailbox if there was one."""
+                sock = login(self.port, username)
+                types, mail = [], None
+                while not types or types[-1] != "session":
+                    msg = recv_until(sock, lambda m: True)
+                    types.append(msg["type"])
+                    if msg["type"] == "mailbox":
+                        mail = msg
+                return sock, types, mail
+
+            # Not in the login replay, only in the mailbox, until acknowledged
+            bob, types, mail = login_frames("bob")
+            self.assertNotIn("history", types)
+            self.assertEqual([m["message"] for m in mail["messages"]], ["call me"])
+            bob.close()
+            while "bob" in chat_server.clients:
+                time.sleep(0.01)
+
+            state = ResumeState()
+            bob, types, mail = login_frames("bob")
+            new, ack = state.take_mailbox(mail, "bob")
+            self.assertEqual(ack["seqs"], [queued["seq"]])
+            send_msg(bob, encrypt_message(json.dumps(ack)))
+            self.assertEqual(state.take_mailbox(mail, "bob")[0], [])
+            while chat_server.mailbox.pending("bob"):
+                time.sleep(0.01)
+            bob.close()
+            while "bob" in chat_server.clients:
+                time.sleep(0.01)
+
+            bob, types, mail = login_frames("bob")
+            self.assertIsNone(mail)
+            alice.close()
+            bob.close()
+
+    def test_history_pages(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            self.addCleanup(chat_server.open_message_log(log_dir).close)
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+            for i in range(5):
+                send_msg(alice, encrypt_message(
+                    build_message("public", "alice", f"m{i}")))
+            send_msg(alice, encrypt_message(
+                build_message("private", "alice", "psst", receiver="bob")))
+            last = recv_until(bob, lambda m: m["type"] == "private")
+            self.assertEqual(last["seq"], 5)
+
+            send_msg(bob, encrypt_message(json.dumps({
+                "type": "history_request", "sender": "bob", "limit": 2})))
+            page = recv_until(bob, lambda m: m["type"] == "history_page")
+            self.assertEqual([m["message"] for m in page["messages"]], ["m4", "psst"])
+            self.assertTrue(page["has_more"])
+
+            send_msg(bob, encrypt_message(json.dumps({
+                "type": "history_request", "sender": "bob", "channel": "public",
+                "before_seq": page["first_seq"], "limit": 10})))
+            page = recv_until(bob, lambda m: m["type"] == "history_page")
+            self.assertEqual([m["seq"] for m in page["messages"]], [0, 1, 2, 3])
+            self.assertFalse(page["has_more"])
+
+            # Another user asking as bob only sees their own private window
+            carol = login(self.port, "carol")
+            recv_until(carol, lambda m: m["type"] == "presence_snapshot")
+            send_msg(carol, encrypt_message(json.dumps({
+                "type": "history_request", "sender": "bob", "channel": "private"})))
+            page = recv_until(carol, lambda m: m["type"] == "history_page")
+            self.assertEqual(page["messages"], [])
+            for sock in (alice, bob, carol):
+                sock.close()
+
+    def test_search_respects_private_visibility(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            self.addCleanup(chat_server.open_message_log(log_dir).close)
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+            send_msg(alice, encrypt_message(
+                build_message("public", "alice", "deploy notes are on the wiki")))
+            send_msg(alice, encrypt_message(
+                build_message("private", "alice", "secret deploy key", receiver="bob")))
+            recv_until(bob, lambda m: m["type"] == "private")
+
+            search = {"type": "search", "sender": "bob", "query": "secret deploy"}
+            send_msg(bob, encrypt_message(json.dumps(search)))
+            results = recv_until(bob, lambda m: m["type"] == "search_results")
+            self.assertEqual([m["seq"] for m in results["messages"]], [1, 0])
+
+            carol = login(self.port, "carol")
+            recv_until(carol, lambda m: m["type"] == "presence_snapshot")
+            send_msg(carol, encrypt_message(json.dumps(search)))
+            results = recv_until(carol, lambda m: m["type"] == "search_results")
+            self.assertEqual([m["message"] for m in results["messages"]],
+                             ["deploy notes are on the wiki"])
+
+            # Nor does a new login under bob's name, unless logins are trusted
+            bob.close()
+            while "bob" in chat_server.clients:
+                time.sleep(0.01)
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+            send_msg(bob, encrypt_message(json.dumps(search)))
+            results = recv_until(bob, lambda m: m["type"] == "search_results")
+            self.assertEqual([m["seq"] for m in results["messages"]], [0])
+            send_msg(bob, encrypt_message(json.dumps({
+                "type": "history_request", "sender": "bob", "channel": "private"})))
+            self.assertEqual(recv_until(bob, lambda m: m["type"] == "history_page")["messages"], [])
+            with patch.object(chat_server, "PRIVATE_HISTORY_ON_LOGIN", True):
+                send_msg(bob, encrypt_message(json.dumps(search)))
+                results = recv_until(bob, lambda m: m["type"] == "search_results")
+            self.assertEqual([m["seq"] for m in results["messages"]], [1, 0])
+            for sock in (alice, bob, carol):
+                sock.close()
+
+    def test_offline_mail_refused_unless_logins_trusted(self):
+        with tempfile.TemporaryDirectory() as mail_dir:
+            box = patch.object(chat_server, "mailbox", Mailbox(mail_dir))
+            box.start()
+            self.addCleanup(box.stop)
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            send_msg(alice, encrypt_message(
+                build_message("private", "alice", "call me", receiver="bob")))
+            refused = recv_until(alice, lambda m: m["type"] in ("queued", "system"))
+            self.assertIn("does not keep private messages for offline users", refused["message"])
+            self.assertEqual(chat_server.mailbox.pending("bob"), [])
+            alice.close()
+
+    def test_channel_messages_reach_members_only(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0):
+            self.addCleanup(chat_server.open_message_log(log_dir).close)
+            socks = {}
+            for name in ("alice", "bob", "carol"):
+                socks[name] = login(self.port, name)
+                recv_until(socks[name], lambda m: m["type"] == "presence_snapshot")
+            alice, bob, carol = socks["alice"], socks["bob"], socks["carol"]
+
+            send_msg(alice, encrypt_message(json.dumps({"type": "join", "sender": "alice", "channel": "#ops"})))
+            joined = recv_until(alice, lambda m: m["type"] == "channel_joined")
+            self.assertEqual(joined["members"], ["alice"])
+            channel_msg = {"type": "channel_message", "sender": "alice", "channel": "#ops", "message": "deploy at 5"}
+            send_msg(alice, encrypt_message(json.dumps(channel_msg)))
+            self.assertEqual(recv_until(alice, lambda m: m["type"] == "channel_message")["seq"], 0)
+
+            # Not a member: rejected, and nothing reaches the channel
+            send_msg(carol, encrypt_message(json.dumps(dict(channel_msg, sender="carol"))))
+            self.assertIn("#ops", recv_until(carol, lambda m: m["type"] == "system")["message"])
+
+            # A new member gets the channel's history, then live messages
+            send_msg(bob, encrypt_message(json.dumps({"type": "join", "sender": "bob", "channel": "#ops"})))
+            joined = recv_until(bob, lambda m: m["type"] == "channel_joined")
+            self.assertEqual(joined["members"], ["alice", "bob"])
+            self.assertEqual([m["message"] for m in joined["messages"]], ["deploy at 5"])
+            self.assertEqual(recv_until(alice, lambda m: m["type"] == "channel_join")["user"], "bob")
+            send_msg(alice, encrypt_message(json.dumps(dict(channel_msg, message="done"))))
+            self.assertEqual(recv_until(bob, lambda m: m["type"] == "channel_message")["message"], "done")
+
+            # Channel messages stay out of the public history and search
+            send_msg(carol, encrypt_message(json.dumps({"type": "search", "sender": "carol", "query": "deploy"})))
+            self.assertEqual(recv_until(carol, lambda m: m["type"] == "search_results")["messages"], [])
+            send_msg(bob, encrypt_message(json.dumps({"type": "search", "sender": "bob", "query": "deploy"})))
+            results = recv_until(bob, lambda m: m["type"] == "search_results")
+            self.assertEqual([m["channel"] for m in results["messages"]], ["#ops"])
+
+            bob.close()
+            self.assertEqual(recv_until(alice, lambda m: m["type"] == "channel_leave")["user"], "bob")
+            for sock in (alice, carol):
+                sock.close()
+
+    def test_session_resumed_within_grace_period(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                patch.object(chat_server, "channel_index", ChannelIndex()), \
+                patch.object(chat_server, "search_index", SearchIndex()), \
+                patch.object(chat_server, "message_log", None), \
+                patch.object(chat_server, "next_seq", 0), \
+                patch.object(chat_server, "session_grace", 30):
+            self.addCleanup(chat_server.open_message_log(log_dir).close)
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "presence_snapshot")
+            session = recv_until(bob, lambda m: m["type"] == "session")
+            joined = recv_until(alice, lambda m: m["type"] == "presence_join")
+            send_msg(alice, encrypt_message(
+                build_message("public", "alice", "before")))
+            seen = recv_until(bob, lambda m: m["type"] == "public")
+
+            bob.close()
+            while "bob" not in chat_server.away:
+                time.sleep(0.01)
+            send_msg(alice, encrypt_message(
+                build_message("public", "alice", "while away")))
+            send_msg(alice, encrypt_message(
+                build_message("private", "alice", "psst", receiver="bob")))
+
+            state = ResumeState()
+            state.update(session)
+            state.update(seen)
+            resumed = resume_session(
+                state, "bob", lambda: socket.create_connection(("127.0.0.1", self.port), timeout=5))
+            self.assertIsNotNone(resumed)
+            bob, reader, reply, _ = resumed
+            self.assertEqual([m["message"] for m in reply["messages"]], ["while away", "psst"])
+            # Later frames may already sit in the reader's buffer
+            # ... under the session keys agreed while resuming
+            self.assertEqual(state.cipher.name, "aes-gcm")
+            after = [state.open(reader.read_frame()) for _ in range(2)]
+            self.assertEqual([m["type"] for m in after], ["presence_snapshot", "session"])
+            self.assertNotEqual(after[1]["token"], session["token"])
+
+            # Nobody saw bob leave or come back
+            send_msg(alice, encrypt_message(json.dumps(
+                {"type": "presence_sync", "sender": "alice"})))
+            resync = recv_until(alice, lambda m: m["type"].startswith("presence_"))
+            self.assertEqual((resync["type"], resync["version"], resync["users"]),
+                             ("presence_snapshot", joined["version"], ["alice", "bob"]))
+            alice.close()
+            bob.close()
+
+    def test_session_expires_after_grace_period(self):
+        with patch.object(chat_server, "session_grace", 30):
+            alice = login(self.port, "alice")
+            recv_until(alice, lambda m: m["type"] == "presence_snapshot")
+            bob = login(self.port, "bob")
+            session = recv_until(bob, lambda m: m["type"] == "session")
+            recv_until(alice, lambda m: m["type"] == "presence_join")
+            bob.close()
+            while "bob" not in chat_server.away:
+                time.sleep(0.01)
+
+            self.server.loop.call_soon_threadsafe(
+                chat_server.expire_sessions, time.monotonic() + 60)
+            leave = recv_until(alice, lambda m: m["type"].startswith("presence_"))
+            self.assertEqual((leave["type"], leave["user"]), ("presence_leave", "bob"))
+
+            # The old token no longer resumes anything
+            state = ResumeState()
+            state.update(session)
+            self.assertIsNone(resume_session(
+                state, "bob", lambda: socket.create_connection(("127.0.0.1", self.port), timeout=5)))
+            self.assertIsNone(state.token)
+            alice.close()
+
+    def test_chunked_upload_saved(self):
+        content = os.urandom(5000)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            sock = login(self.port, "dave")
+            recv_until(sock, lambda m: m["type"] == "presence_snapshot")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_begin", "sender": "dave",
+                "timestamp": "10:00:00", "upload_id": "u1",
+                "filename": "notes.bin", "file_size": len(content)})))
+            ready = recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+            for offset in range(0, len(content), 2048):
+                send_msg(sock, encrypt_bytes(build_chunk(
+                    "u1", offset, content[offset:offset + 2048])))
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_end", "sender": "dave", "upload_id": "u1"})))
+            recv_until(sock, lambda m: "uploaded successfully" in m.get("message", ""))
+
+            path, record = chat_server.file_store().lookup(ready["file_id"])
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(record["sha256"], hashlib.sha256(content).hexdigest())
+            self.assertEqual(record["filename"], "notes.bin")
+            self.assertEqual(os.listdir(os.path.join(storage, "partial")), [])
+            sock.close()
+
+    def store_content(self, content):
+        """Puts `content` into the store as someone else's upload; returns its record."""
+        digest = hashlib.sha256(content).hexdigest()
+        os.makedirs(os.path.dirname(chat_server.file_store().object_path(digest)))
+        with open(chat_server.file_store().object_path(digest), "wb") as f:
+            f.write(content)
+        return chat_server.file_store().record(
+            "first", digest, "a.bin", len(content), "eve", "09:00:00")
+
+    def begin_known_upload(self, sock, content):
+        send_msg(sock, encrypt_message(json.dumps({
+            "type": "file_upload_begin", "sender": "kate",
+            "timestamp": "10:00:00", "upload_id": "dup1",
+            "filename": "b.bin", "file_size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest()})))
+        return recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+
+    def test_proven_content_skips_upload(self):
+        content = os.urandom(3000)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            first = self.store_content(content)
+            sock = login(self.port, "kate")
+            ready = self.begin_known_upload(sock, content)
+            self.assertEqual(ready["offset"], 0)
+
+            proof = hmac.new(bytes.fromhex(ready["challenge"]), content, hashlib.sha256).hexdigest()
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_proof", "sender": "kate", "upload_id": "dup1", "proof": proof})))
+            done = recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+            self.assertTrue(done["stored"])
+            self.assertEqual((done["file_id"], done["offset"]), (ready["file_id"], len(content)))
+            recv_until(sock, lambda m: "uploaded successfully" in m.get("message", ""))
+
+            path, record = chat_server.file_store().lookup(done["file_id"])
+            self.assertNotEqual(done["file_id"], first["file_id"])
+            self.assertEqual((record["filename"], record["uploader"]), ("b.bin", "kate"))
+            self.assertEqual(path, chat_server.file_store().object_path(first["sha256"]))
+            self.assertEqual(os.listdir(os.path.join(storage, "partial")), [])
+            sock.close()
+
+    def test_known_hash_still_uploaded(self):
+        content = os.urandom(3000)
+        digest = hashlib.sha256(content).hexdigest()
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            first = self.store_content(content)
+
+            # Knowing the hash is not enough: without the bytes the proof is wrong
+            sock = login(self.port, "kate")
+            ready = self.begin_known_upload(sock, content)
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_proof", "sender": "kate", "upload_id": "dup1", "proof": digest})))
+            ready = recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+            self.assertFalse(ready["stored"])
+            self.assertEqual(ready["offset"], 0)
+            self.assertIsNone(chat_server.file_store().lookup(ready["file_id"]))
+
+            send_msg(sock, encrypt_bytes(build_chunk("dup1", 0, content)))
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_end", "sender": "kate", "upload_id": "dup1"})))
+            recv_until(sock, lambda m: "uploaded successfully" in m.get("message", ""))
+
+            path, record = chat_server.file_store().lookup(ready["file_id"])
+            self.assertNotEqual(ready["file_id"], first["file_id"])
+            self.assertEqual((record["filename"], record["uploader"]), ("b.bin", "kate"))
+            self.assertEqual(path, chat_server.file_store().object_path(digest))
+            sock.close()
+
+    def test_upload_resumes_after_disconnect(self):
+        content = os.urandom(6000)
+        begin = {
+            "type": "file_upload_begin", "sender": "hank",
+            "timestamp": "10:00:00", "upload_id": "resume1",
+            "filename": "notes.bin", "file_size": len(content)}
+        offload = FrameOffload(64 * 1024, ThreadPoolExecutor(1))
+        self.addCleanup(offload.shutdown)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage), \
+                patch.object(chat_server, "offload", offload):
+            sock = login(self.port, "hank")
+            send_msg(sock, encrypt_message(json.dumps(begin)))
+            ready = recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+            self.assertEqual(ready["offset"], 0)
+            send_msg(sock, encrypt_bytes(build_chunk("resume1", 0, content[:2500])))
+            sock.close()
+            while "hank" in chat_server.clients:
+                time.sleep(0.01)
+
+            sock = login(self.port, "hank")
+            send_msg(sock, encrypt_message(json.dumps(begin)))
+            ready = recv_until(sock, lambda m: m["type"] == "file_upload_ready")
+            self.assertEqual(ready["offset"], 2500)
+            send_msg(sock, encrypt_bytes(build_chunk("resume1", 2500, content[2500:])))
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_end", "sender": "hank", "upload_id": "resume1"})))
+            recv_until(sock, lambda m: "uploaded successfully" in m.get("message", ""))
+            # The resumed file was hashed on the pool, not on the loop
+            self.assertEqual(offload.report()["crypto"]["jobs"], 1)
+
+            path, _ = chat_server.file_store().lookup(ready["file_id"])
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(os.listdir(os.path.join(storage, "partial")), [])
+            sock.close()
+
+    def test_upload_ids_belong_to_their_user(self):
+        begin = {"type": "file_upload_begin", "timestamp": "10:00:00", "upload_id": "same",
+                 "filename": "notes.bin", "file_size": 4000}
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            ivan = login(self.port, "ivan")
+            send_msg(ivan, encrypt_message(json.dumps(dict(begin, sender="ivan"))))
+            recv_until(ivan, lambda m: m["type"] == "file_upload_ready")
+            send_msg(ivan, encrypt_bytes(build_chunk("same", 0, b"i" * 3000)))
+
+            # Another user with the same upload_id starts an upload of their own
+            judy = login(self.port, "judy")
+            send_msg(judy, encrypt_message(json.dumps(dict(begin, sender="judy"))))
+            self.assertEqual(recv_until(judy, lambda m: m["type"] == "file_upload_ready")["offset"], 0)
+            send_msg(ivan, encrypt_bytes(build_chunk("same", 3000, b"i" * 1000)))
+            send_msg(ivan, encrypt_message(json.dumps({
+                "type": "file_upload_end", "sender": "ivan", "upload_id": "same"})))
+            recv_until(ivan, lambda m: "uploaded successfully" in m.get("message", ""))
+            ivan.close()
+            judy.close()
+
+    def test_bad_transfer_sizes_refused(self):
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_a.bin"), "wb") as f:
+                f.write(b"abc")
+            sock = login(self.port, "kim")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload_begin", "sender": "kim", "timestamp": "10:00:00",
+                "upload_id": "u1", "filename": "a.bin", "file_size": "lots"})))
+            error = recv_until(sock, lambda m: m["type"] == "file_error")
+            self.assertEqual(error["upload_id"], "u1")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "kim",
+                "file_id": "10-00-00_a.bin", "transfer_id": "t1", "offset": -5})))
+            error = recv_until(sock, lambda m: m["type"] == "file_error")
+            self.assertEqual(error["transfer_id"], "t1")
+
+            # Still connected
+            send_msg(sock, encrypt_message(build_message("public", "kim", "still here")))
+            self.assertEqual(recv_until(sock, lambda m: m["type"] == "public")["message"], "still here")
+            sock.close()
+
+    def test_ranged_download(self):
+        content = os.urandom(700 * 1024)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_big.bin"), "wb") as f:
+                f.write(content)
+            sock = login(self.port, "ivy")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "ivy",
+                "file_id": "10-00-00_big.bin", "transfer_id": "r1",
+                "offset": 1000, "length": 300000})))
+            begin = recv_frame_until(
+                sock, lambda m: m["type"] == "file_download_begin")
+            self.assertEqual((begin["offset"], begin["length"]), (1000, 300000))
+            received = bytearray()
+            while True:
+                msg = recv_frame_until(sock, lambda m: m["type"] != "system")
+                if msg["type"] == "file_download_end":
+                    break
+                self.assertEqual(msg["offset"], 1000 + len(received))
+                received += msg["data"]
+            self.assertEqual(bytes(received), content[1000:301000])
+            sock.close()
+
+    def test_missing_file_download_error(self):
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            sock = login(self.port, "jack")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "jack",
+                "file_id": "missing.bin", "transfer_id": "t9"})))
+            error = recv_frame_until(
+                sock, lambda m: m["type"] == "file_download_error")
+            self.assertEqual(error["transfer_id"], "t9")
+            sock.close()
+
+    def test_streamed_download(self):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_big.bin"), "wb") as f:
+                f.write(content)
+            sock = login(self.port, "erin")
+            recv_until(sock, lambda m: m["type"] == "presence_snapshot")
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "erin",
+                "file_id": "10-00-00_big.bin", "transfer_id": "t1"})))
+
+            begin = recv_frame_until(
+                sock, lambda m: m["type"] == "file_download_begin")
+            self.assertEqual(begin["message"], "big.bin")
+            self.assertEqual(begin["file_size"], len(content))
+            received = bytearray()
+            while True:
+                msg = recv_frame_until(sock, lambda m: True)
+                if msg["type"] == "file_download_end":
+                    break
+                self.assertEqual(msg["transfer_id"], "t1")
+                self.assertEqual(msg["offset"], len(received))
+                received += msg["data"]
+            self.assertEqual(bytes(received), content)
+            sock.close()
+
+    def test_large_frames_offloaded(self):
+        content = os.urandom(600_000)
+        offload = FrameOffload(64 * 1024, ThreadPoolExecutor(2), ThreadPoolExecutor(1))
+        self.addCleanup(offload.shutdown)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage), \
+                patch.object(chat_server, "offload", offload):
+            sock = login(self.port, "olga")
+            send_msg(sock, encrypt_message(build_message("public", "olga", "small stays inline")))
+            recv_until(sock, lambda m: m["type"] == "public")
+            self.assertEqual(offload.report()["crypto"]["jobs"], 0)
+
+            # A legacy upload: decrypted on a thread, parsed and base64-decoded in the decode pool
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_upload", "sender": "olga", "timestamp": "10:00:00",
+                "filename": "big.bin", "file_data": base64.b64encode(content).decode()})))
+            recv_until(sock, lambda m: "uploaded successfully" in m.get("message", ""))
+            file_id, = chat_server.file_store().index
+
+            send_msg(sock, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "olga",
+                "file_id": file_id, "transfer_id": "t1"})))
+            received = bytearray()
+            while True:
+                msg = recv_frame_until(sock, lambda m: m["type"] in ("file_chunk", "file_download_end"))
+                if msg["type"] == "file_download_end":
+                    break
+                received += msg["data"]
+            self.assertEqual(bytes(received), content)
+            report = offload.report()
+            self.assertEqual(report["decode"]["jobs"], 1)
+            # The upload's decryption and the download's frames
+            self.assertGreaterEqual(report["crypto"]["jobs"], 1 + 3)
+            self.assertEqual(report["crypto"]["depth"], 0)
+            sock.close()
+
+    def test_compressed_download(self):
+        content = b"".join(b"%d,alice,bob,hello there\n" % i for i in range(40_000))
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_log.csv"), "wb") as f:
+                f.write(content)
+            sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+            send_msg(sock, encrypt_message(login_request("erin")))
+            session = recv_frame_until(sock, lambda m: m["type"] == "session")
+            self.assertEqual(session["compression"], COMPRESSIONS[0])
+            send_msg(sock, seal({"type": "file_download_request", "sender": "erin",
+                                 "file_id": "10-00-00_log.csv", "transfer_id": "t1"},
+                                session["codec"], session["compression"]))
+
+            recv_frame_until(sock, lambda m: m["type"] == "file_download_begin")
+            received = bytearray()
+            wire_bytes = 0
+            while True:
+                payload = decrypt_bytes(recv_msg(sock))
+                msg = parse_payload(payload)
+                if msg["type"] == "file_download_end":
+                    break
+                self.assertEqual(payload[0], COMPRESSED_MARKER)
+                wire_bytes += len(payload)
+                received += msg["data"]
+            self.assertEqual(bytes(received), content)
+            self.assertLess(wire_bytes, len(content) // 3)
+            sock.close()
+
+    def test_download_uses_data_channel(self):
+        content = os.urandom(2 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_big.bin"), "wb") as f:
+                f.write(content)
+            frank = login(self.port, "frank")
+            offer = recv_until(frank, lambda m: m["type"] == "data_channel")
+            data = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+            send_msg(data, encrypt_message(json.dumps({
+                "type": "data_channel_attach", "sender": "frank",
+                "token": offer["token"]})))
+            # Wait until the server has attached the channel
+            while chat_server.clients["frank"].bulk is None:
+                time.sleep(0.01)
+
+            send_msg(frank, encrypt_message(json.dumps({
+                "type": "file_download_request", "sender": "frank",
+                "file_id": "10-00-00_big.bin", "transfer_id": "t2"})))
+            send_msg(frank, encrypt_message(
+                build_message("public", "frank", "still chatting")))
+
+            # Chat arrives on the chat socket, the file on the data socket
+            msg = recv_frame_until(frank, lambda m: m["type"] != "system")
+            self.assertEqual(msg["message"], "still chatting")
+            recv_frame_until(data, lambda m: m["type"] == "file_download_begin")
+            received = bytearray()
+            while True:
+                msg = recv_frame_until(data, lambda m: True)
+                if msg["type"] == "file_download_end":
+                    break
+                received += msg["data"]
+            self.assertEqual(bytes(received), content)
+            frank.close()
+            data.close()
+
+    def test_session_keys_agreed_at_login(self):
+        content = os.urandom(300_000)
+        with tempfile.TemporaryDirectory() as storage, \
+                patch.object(chat_server, "FILE_STORAGE_DIR", storage):
+            with open(os.path.join(storage, "10-00-00_key.bin"), "wb") as f:
+                f.write(content)
+            state = ResumeState()
+            alice = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+            send_msg(alice, encrypt_message(login_request("alice", state.offer_key())))
+            reader = FrameReader(alice)
+            exchange = state.open(reader.read_frame())
+            self.assertEqual((exchange["type"], exchange["cipher"]), ("key_exchange", "aes-gcm"))
+            state.key_agreed(exchange)
+            frame = reader.read_frame()
+            self.assertEqual(frame[0], 1)  # raw AES-GCM, not a base64 Fernet token
+            self.assertEqual(state.open(frame)["type"], "presence_snapshot")
+            while True:
+                msg = state.open(reader.read_frame())
+                if msg["type"] == "data_channel":
+                    break
+                state.update(msg)
+
+            # The data channel has keys of its own from the same exchange
+            data = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+            send_msg(data, encrypt_message(json.dumps({
+                "type": "data_channel_attach", "sender": "alice", "token": msg["token"]})))
+            send_msg(data, seal({"type": "file_download_request", "sender": "alice",
+                                 "file_id": "10-00-00_key.bin", "transfer_id": "t3"},
+                                cipher=state.data_cipher))
+            received = bytearray()
+            while True:
+                msg = parse_payload(decrypt_frame(recv_msg(data), state.data_cipher))
+                if msg["type"] == "file_download_end":
+                    break
+                if msg["type"] == "file_chunk":
+                    received += msg["data"]
+            self.assertEqual(bytes(received), content)
+
+            bob = login(self.port, "bob")
+            recv_until(bob, lambda m: m["type"] == "session")
+            send_msg(alice, state.seal(build_message("public", "alice", "hello bob")))
+            self.assertEqual(recv_until(bob, lambda m: m["type"] == "public")["message"], "hello bob")
+
+            # Once keys are agreed, a frame under the shared key ends the connection
+            send_msg(alice, encrypt_message(build_message("public", "alice", "forged")))
+            msg = recv_until(bob, lambda m: m["type"] in ("public", "presence_leave"))
+            self.assertEqual((msg["type"], msg["user"]), ("presence_leave", "alice"))
+            alice.close()
+            data.close()
+            bob.close()
+
+    def test_data_channel_rejects_bad_token(self):
+        grace = login(self.port, "grace")
+        recv_until(grace, lambda m: m["type"] == "data_channel")
+        data = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        send_msg(data, encrypt_message(json.dumps({
+            "type": "data_channel_attach", "sender": "grace", "token": "nope"})))
+        self.assertIsNone(recv_msg(data))
+        self.assertIsNone(chat_server.clients["grace"].bulk)
+        grace.close()
+        data.close()
+
+    def test_data_channel_carries_only_transfers(self):
+        henry = login(self.port, "henry")
+        offer = recv_until(henry, lambda m: m["type"] == "data_channel")
+        data = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        send_msg(data, encrypt_message(json.dumps({
+            "type": "data_channel_attach", "sender": "henry", "token": offer["token"]})))
+        while chat_server.clients["henry"].bulk is None:
+            time.sleep(0.01)
+        self.assertEqual(chat_server.clients["henry"].bulk.username, "henry")
+
+        # Chat sent on the data channel is ignored
+        send_msg(data, encrypt_message(build_message("public", "henry", "sneaky")))
+        send_msg(henry, encrypt_message(build_message("public", "henry", "on the chat socket")))
+        self.assertEqual(recv_until(henry, lambda m: m["type"] == "public")["message"], "on the chat socket")
+        henry.close()
+        data.close()
+
+    def test_duplicate_username_rejected(self):
+        first = login(self.port, "carol")
+        recv_until(first, lambda m: m["type"] == "presence_snapshot")
+        second = login(self.port, "carol")
+        msg = recv_until(second, lambda m: True)
+        self.assertEqual(msg["message"], "username_rejected")
+        first.close()
+        second.close()
+
+
 if __name__ == '__main__':
     print("Testing: server.py")
     unittest.main()
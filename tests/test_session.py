@@ -0,0 +1,96 @@
+import unittest
+import base64
+import json
+from unittest.mock import MagicMock, patch
+
+from client.session import ResumeState, Outbox, resume_session, resend_unacked
+from shared.compress import COMPRESSIONS
+
+
+class TestResumeState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ResumeState()
+        self.state.update({"type": "session", "token": "abc"})
+
+    def test_tracks_token_and_highest_seq(self):
+        self.state.update({"type": "public", "seq": 7})
+        self.state.update({"type": "public", "seq": 5})
+        self.state.update({"type": "system", "message": "no seq"})
+        request = self.state.request("alice")
+        self.assertEqual(len(base64.b64decode(request.pop("key_exchange"))), 32)
+        self.assertEqual(request, {
+            "type": "resume", "sender": "alice", "token": "abc", "last_seq": 7,
+            "codecs": ["binary", "json"], "compression": list(COMPRESSIONS),
+            "ciphers": ["aes-gcm", "chacha20-poly1305"]})
+
+    def test_replayed_messages_dropped_once_when_they_arrive_live(self):
+        missed = self.state.accept({"type": "resumed", "messages": [
+            {"type": "public", "seq": 3}, {"type": "private", "seq": 4}]})
+        self.assertEqual([m["seq"] for m in missed], [3, 4])
+        self.assertEqual(self.state.last_seq, 4)
+
+        self.assertFalse(self.state.update({"type": "public", "seq": 4}))
+        self.assertTrue(self.state.update({"type": "public", "seq": 5}))
+        self.assertTrue(self.state.update({"type": "public", "seq": 4}))
+
+    def test_channel_history_dropped_when_it_arrives_live(self):
+        self.state.note_replayed([{"type": "channel_message", "seq": 9}])
+        self.assertEqual(self.state.last_seq, 9)
+        self.assertFalse(self.state.update({"type": "channel_message", "seq": 9}))
+
+    def test_login_catch_up_counts_as_seen(self):
+        self.state.update({"type": "history", "messages": [{"seq": 2}, {"seq": 6}]})
+        self.state.update({"type": "mailbox", "messages": [{"seq": 4}]})
+        self.assertEqual(self.state.last_seq, 6)
+
+    def test_repeated_mailbox_delivery_shown_once(self):
+        delivery = {"type": "mailbox", "messages": [{"type": "private", "seq": 4}]}
+        new, ack = self.state.take_mailbox(delivery, "bob")
+        self.assertEqual([m["seq"] for m in new], [4])
+        self.assertEqual(ack, {"type": "mailbox_ack", "sender": "bob", "seqs": [4]})
+        new, ack = self.state.take_mailbox(delivery, "bob")
+        self.assertEqual(new, [])
+        self.assertEqual(ack["seqs"], [4])
+
+
+class TestOutbox(unittest.TestCase):
+
+    def test_in_flight_until_acked(self):
+        outbox = Outbox()
+        first = outbox.track({"type": "public", "message": "one"})
+        second = outbox.track({"type": "public", "message": "two"})
+        first_id = json.loads(first)["id"]
+        self.assertNotEqual(first_id, json.loads(second)["id"])
+        self.assertEqual(outbox.unacked(), [first, second])
+
+        self.assertTrue(outbox.acked({"type": "ack", "id": first_id, "seq": 4}))
+        self.assertFalse(outbox.acked({"type": "ack", "id": first_id, "seq": 4}))
+        self.assertEqual(outbox.unacked(), [second])
+
+    def test_resend_unacked_in_order(self):
+        outbox = Outbox()
+        for text in ("one", "two"):
+            outbox.track({"type": "public", "message": text})
+        with patch("client.session.send_msg") as send:
+            resend_unacked(outbox, "sock")
+        self.assertEqual(send.call_count, 2)
+
+
+class TestResumeSession(unittest.TestCase):
+
+    def test_no_token_means_no_attempt(self):
+        connect = MagicMock()
+        self.assertIsNone(resume_session(ResumeState(), "alice", connect))
+        connect.assert_not_called()
+
+    def test_gives_up_after_attempts(self):
+        state = ResumeState()
+        state.token = "abc"
+        connect = MagicMock(side_effect=ConnectionRefusedError)
+        self.assertIsNone(resume_session(state, "alice", connect, attempts=3, delay=0))
+        self.assertEqual(connect.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
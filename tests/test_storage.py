@@ -0,0 +1,84 @@
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+
+from server.storage import FileStore
+
+
+class TestFileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = FileStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add(self, file_id, content, filename="a.txt"):
+        path = os.path.join(self.root, f"{file_id}.tmp")
+        with open(path, "wb") as f:
+            f.write(content)
+        digest = hashlib.sha256(content).hexdigest()
+        return self.store.add_file(file_id, path, digest, filename, "alice", "10:00:00")
+
+    def test_objects_are_sharded_by_hash(self):
+        record = self.add("f1", b"hello")
+        digest = record["sha256"]
+        path, _ = self.store.lookup("f1")
+        self.assertEqual(path, os.path.join(self.root, "objects", digest[:2], digest))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"hello")
+
+    def test_same_content_stored_once(self):
+        self.add("f1", b"same bytes", "one.pdf")
+        self.add("f2", b"same bytes", "two.pdf")
+        self.assertEqual(self.store.lookup("f1")[0], self.store.lookup("f2")[0])
+        self.assertEqual(self.store.lookup("f2")[1]["filename"], "two.pdf")
+        shard = os.path.dirname(self.store.lookup("f1")[0])
+        self.assertEqual(len(os.listdir(shard)), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "f2.tmp")))
+
+    def test_has_checks_size(self):
+        digest = self.add("f1", b"12345")["sha256"]
+        self.assertTrue(self.store.has(digest))
+        self.assertTrue(self.store.has(digest, 5))
+        self.assertFalse(self.store.has(digest, 6))
+        self.assertFalse(self.store.has("0" * 64))
+
+    def test_index_survives_restart(self):
+        self.add("f1", b"data", "kept.txt")
+        with open(self.store.index_path, "a") as f:
+            f.write('{"file_id": "torn"')  # half-written line from a crash
+        reopened = FileStore(self.root)
+        _, record = reopened.lookup("f1")
+        self.assertEqual((record["filename"], record["size"], record["uploader"]),
+                         ("kept.txt", 4, "alice"))
+        self.assertIsNone(reopened.lookup("torn"))
+
+    def test_files_added_by_another_process_found(self):
+        other = FileStore(self.root)  # e.g. another server worker
+        self.add("f1", b"shared")
+        self.assertEqual(other.lookup("f1")[1]["size"], 6)
+        self.assertIsNone(other.lookup("f2"))
+        self.add("f2", b"later")
+        self.assertEqual(other.lookup("f2")[1]["size"], 5)
+
+    def test_legacy_files_still_found(self):
+        with open(os.path.join(self.root, "10-00-00_old.txt"), "wb") as f:
+            f.write(b"old")
+        path, record = self.store.lookup("10-00-00_old.txt")
+        self.assertEqual(record["filename"], "old.txt")
+        self.assertIsNone(self.store.lookup("missing"))
+
+    def test_only_legacy_uploads_served_from_root(self):
+        self.add("f1", b"data")
+        with open(os.path.join(self.root, ".secret"), "wb") as f:
+            f.write(b"hidden")
+        for file_id in ("index.jsonl", ".secret", "objects", "partial", "../index.jsonl"):
+            self.assertIsNone(self.store.lookup(file_id), file_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,322 @@
+import unittest
+from unittest.mock import patch
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+from server import server as chat_server
+from server.history import MessageHistory
+from server.workers import Hub, BusSocket, CoreLink
+from shared.common import build_message, parse_message, parse_payload, send_msg, recv_msg
+from shared.encrypt import encrypt_message, decrypt_message, decrypt_bytes
+
+
+def as_dict(message):
+    """Messages cross the bus as dicts or as JSON text from the history."""
+    return json.loads(message) if isinstance(message, str) else message
+
+
+class FakeWorker:
+    """A worker's end of the bus, driven by hand."""
+
+    def __init__(self, path, name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.settimeout(5)
+        self.bus = BusSocket(sock)
+        self.incoming = self.bus.ops()
+        self.skipped = []  # ops read while waiting for another
+        self.bus.send({"op": "hello", "worker": name})
+
+    def open(self, conn_id, msg):
+        self.bus.send({"op": "open", "conn": conn_id, "addr": "test", "codec": "json",
+                       "compression": None, "msg": json.loads(msg)})
+        return self.until(lambda op: op["op"] == "opened" and op["conn"] == conn_id)["user"]
+
+    def until(self, predicate):
+        """The first op matching `predicate`, read or skipped before."""
+        for op in self.skipped:
+            if predicate(op):
+                self.skipped.remove(op)
+                return op
+        for op in self.incoming:
+            if predicate(op):
+                return op
+            self.skipped.append(op)
+        raise AssertionError("bus closed")
+
+    def message(self, op_name, msg_type):
+        return self.until(lambda op: op["op"] == op_name and as_dict(op["message"])["type"] == msg_type)
+
+
+class TestCore(unittest.TestCase):
+    """The core's side: shared state here, clients on (fake) workers."""
+
+    def setUp(self):
+        chat_server.clients.clear()
+        for name, value in (("history", MessageHistory()), ("session_grace", 0)):
+            patcher = patch.object(chat_server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.hub = Hub()
+        patcher = patch.object(chat_server, "hub", self.hub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        threading.Thread(target=self.hub.serve, args=(
+            chat_server.log_in, chat_server.handle_message, chat_server.drop_remote), daemon=True).start()
+        self.one = FakeWorker(self.hub.path, "worker-1")
+        self.two = FakeWorker(self.hub.path, "worker-2")
+
+    def tearDown(self):
+        self.hub.close()
+        chat_server.clients.clear()
+        chat_server.away.clear()
+        chat_server.session_tokens.clear()
+        chat_server.channel_members.clear()
+        chat_server.user_channels.clear()
+
+    def test_routing_across_workers(self):
+        self.assertEqual(self.one.open(1, build_message("system", "alice", "login_request")), "alice")
+        self.assertEqual(self.two.open(7, build_message("system", "bob", "login_request")), "bob")
+        join = self.one.until(lambda op: op["op"] == "fan_out" and as_dict(op["message"]).get("user") == "bob")
+        self.assertEqual((as_dict(join["message"])["type"], join["exclude"]), ("presence_join", "bob"))
+        self.assertIsInstance(chat_server.clients["bob"], chat_server.RemoteConnection)
+        # No data channel without a socket to the core
+        self.assertNotIn("bob", chat_server.data_tokens)
+
+        self.one.bus.send({"op": "message", "conn": 1, "msg": json.loads(
+            build_message("public", "alice", "hello all"))})
+        for worker in (self.one, self.two):
+            self.assertEqual(as_dict(worker.message("fan_out", "public")["message"])["message"], "hello all")
+
+        self.one.bus.send({"op": "message", "conn": 1, "msg": json.loads(
+            build_message("private", "alice", "psst", receiver="bob"))})
+        private = self.two.message("send", "private")
+        self.assertEqual((private["conn"], as_dict(private["message"])["message"]), (7, "psst"))
+
+    def test_name_taken_on_another_worker(self):
+        self.one.open(1, build_message("system", "alice", "login_request"))
+        self.assertIsNone(self.two.open(2, build_message("system", "alice", "login_request")))
+        self.assertEqual(as_dict(self.two.message("send", "system")["message"])["message"],
+                         "username_rejected")
+
+    def test_channel_message_sent_per_worker(self):
+        for conn_id, name in ((1, "alice"), (2, "carol")):
+            self.one.open(conn_id, build_message("system", name, "login_request"))
+            self.one.bus.send({"op": "message", "conn": conn_id,
+                               "msg": {"type": "join", "sender": name, "channel": "#ops"}})
+        self.two.open(3, build_message("system", "bob", "login_request"))
+        self.one.bus.send({"op": "message", "conn": 1, "msg": {
+            "type": "channel_message", "sender": "alice", "channel": "#ops", "message": "hi ops"}})
+        op = self.one.message("send_many", "channel_message")
+        self.assertEqual((sorted(op["conns"]), as_dict(op["message"])["message"]), ([1, 2], "hi ops"))
+        # bob is not in the channel: nothing for the other worker
+        self.two.bus.send({"op": "message", "conn": 3, "msg": {"type": "presence_sync", "sender": "bob"}})
+        self.assertNotIn("send_many", [op["op"] for op in (self.two.message("send", "presence_snapshot"),
+                                                          *self.two.skipped)])
+
+    def test_resume_on_another_worker_aborts_the_old_connection(self):
+        with patch.object(chat_server, "session_grace", 30):
+            self.one.open(1, build_message("system", "alice", "login_request"))
+            token = self.one.message("send", "session")["message"]["token"]
+            resume = json.dumps({"type": "resume", "sender": "alice", "token": token, "last_seq": -1})
+            self.assertEqual(self.two.open(4, resume), "alice")
+            self.assertEqual(self.one.until(lambda op: op["op"] == "abort")["conn"], 1)
+            # The old connection closing afterwards changes nothing
+            self.one.bus.send({"op": "close", "conn": 1})
+            self.two.bus.send({"op": "message", "conn": 4, "msg": {"type": "presence_sync", "sender": "alice"}})
+            snapshot = self.two.message("send", "presence_snapshot")["message"]
+            self.assertEqual(as_dict(snapshot)["users"], ["alice"])
+
+    def test_lost_worker_drops_its_users(self):
+        self.one.open(1, build_message("system", "alice", "login_request"))
+        self.two.open(1, build_message("system", "bob", "login_request"))
+        self.two.bus.close()
+        leave = self.one.until(lambda op: op["op"] == "fan_out" and
+                               as_dict(op["message"]).get("type") == "presence_leave")
+        self.assertEqual(as_dict(leave["message"])["user"], "bob")
+        self.assertEqual(list(chat_server.clients), ["alice"])
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.sent = []
+        self.codec = "json"
+        self.compression = None
+        self.cipher = None
+        self.username = None
+        self.aborted = False
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def enqueue(self, data):
+        self.sent.append(data)
+
+    def abort(self):
+        self.aborted = True
+
+
+def messages(conn):
+    return [parse_payload(decrypt_bytes(frame[4:])) for frame in conn.sent]
+
+
+class TestWorker(unittest.TestCase):
+    """A worker's side, against a core driven by hand."""
+
+    def setUp(self):
+        chat_server.clients.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "bus.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        self.link = CoreLink(path, "worker-0")
+        sock, _ = listener.accept()
+        sock.settimeout(5)
+        listener.close()
+        self.core = BusSocket(sock)
+        self.incoming = self.core.ops()
+        self.assertEqual(next(self.incoming), {"op": "hello", "worker": "worker-0"})
+        self.lost = threading.Event()
+        self.link.start(chat_server.carry_out, self.lost.set)
+        patcher = patch.object(chat_server, "core", self.link)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.core.close()
+        self.assertTrue(self.lost.wait(5))
+        self.link.close()
+        chat_server.clients.clear()
+
+    def log_in(self, name):
+        conn = RecordingConnection()
+        future = self.link.open(conn, json.loads(build_message("system", name, "login_request")), "addr")
+        op = next(self.incoming)
+        self.assertEqual((op["op"], op["msg"]["sender"]), ("open", name))
+        self.core.send({"op": "login", "conn": op["conn"], "user": name})
+        self.core.send({"op": "opened", "conn": op["conn"], "user": name})
+        self.assertEqual(future.result(5), name)
+        return conn, op["conn"]
+
+    def test_ops_from_the_core(self):
+        alice, alice_id = self.log_in("alice")
+        bob, bob_id = self.log_in("bob")
+        self.assertIs(chat_server.clients["alice"], alice)
+
+        self.core.send({"op": "fan_out", "message": {"type": "public", "message": "hi"},
+                        "exclude": "bob"})
+        self.core.send({"op": "send_many", "conns": [alice_id, bob_id],
+                        "message": '{"type": "channel_message", "message": "ops"}'})
+        self.core.send({"op": "send", "conn": bob_id, "message": {"type": "private", "message": "psst"}})
+        self.core.send({"op": "abort", "conn": alice_id})
+        deadline = time.monotonic() + 5
+        while not alice.aborted and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([m["message"] for m in messages(alice)], ["hi", "ops"])
+        self.assertEqual([m["message"] for m in messages(bob)], ["ops", "psst"])
+        # One frame for both
+        self.assertIs(alice.sent[1], bob.sent[0])
+        self.assertNotIn("alice", chat_server.clients)
+
+    def test_file_transfers_stay_on_the_worker(self):
+        alice, alice_id = self.log_in("alice")
+        with patch.object(chat_server, "handle_message") as handle:
+            chat_server.route(alice, {"type": "file_download_request", "sender": "alice", "file_id": "x"})
+            chat_server.route(alice, {"type": "public", "sender": "alice", "message": "hi"})
+        self.assertEqual(handle.call_args[0][1]["type"], "file_download_request")
+        op = next(self.incoming)
+        self.assertEqual((op["op"], op["conn"], op["msg"]["message"]), ("message", alice_id, "hi"))
+
+        chat_server.leave_worker(alice)
+        self.assertEqual(next(self.incoming), {"op": "close", "conn": alice_id})
+        self.assertNotIn("alice", chat_server.clients)
+
+
+def run_server(engine, port, root):
+    """Target of the server process in TestWorkerProcesses."""
+    os.chdir(root)  # for server.log
+    chat_server.FILE_STORAGE_DIR = root
+    chat_server.start_server(engine, workers=2, port=port, host="127.0.0.1", grace=0,
+                             log_dir=os.path.join(root, "log"), mailbox_dir=os.path.join(root, "mailbox"),
+                             offload_threads=0, offload_processes=0)
+
+
+def login(port, username):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    send_msg(sock, encrypt_message(build_message("system", username, "login_request")))
+    return sock
+
+
+def recv_until(sock, predicate):
+    while True:
+        msg = parse_message(decrypt_message(recv_msg(sock)))
+        if predicate(msg):
+            return msg
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "needs SO_REUSEPORT")
+class TestWorkerProcesses(unittest.TestCase):
+    engine = "threads"
+
+    def setUp(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        # Spawned, so the server forks its workers from a process without test threads
+        self.server = multiprocessing.get_context("spawn").Process(
+            target=run_server, args=(self.engine, self.port, self.root))
+        self.server.start()
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def tearDown(self):
+        os.kill(self.server.pid, signal.SIGINT)
+        self.server.join(10)
+        if self.server.is_alive():
+            self.server.terminate()
+
+    def test_chat_across_workers(self):
+        users = ["user%d" % i for i in range(6)]
+        socks = {}
+        for user in users:
+            socks[user] = login(self.port, user)
+            recv_until(socks[user], lambda m: m["type"] == "presence_snapshot")
+        send_msg(socks["user0"], encrypt_message(build_message("public", "user0", "hello everyone")))
+        for user in users:
+            self.assertEqual(recv_until(socks[user], lambda m: m["type"] == "public")["message"],
+                             "hello everyone")
+        send_msg(socks["user5"], encrypt_message(build_message("private", "user5", "psst", receiver="user1")))
+        self.assertEqual(recv_until(socks["user1"], lambda m: m["type"] == "private")["message"], "psst")
+
+        socks["user3"].close()
+        leave = recv_until(socks["user0"], lambda m: m["type"] == "presence_leave")
+        self.assertEqual(leave["user"], "user3")
+        for user, sock in socks.items():
+            sock.close()
+
+
+class TestAsyncWorkerProcesses(TestWorkerProcesses):
+    engine = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()